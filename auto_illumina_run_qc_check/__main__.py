@@ -1,21 +1,553 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
+import atexit
+import concurrent.futures
+import csv
 import datetime
 import json
 import logging
 import os
+import sys
 import time
 
+import auto_illumina_run_qc_check.backfill
 import auto_illumina_run_qc_check.config
 import auto_illumina_run_qc_check.core as core
+import auto_illumina_run_qc_check.failure_ledger as failure_ledger
+import auto_illumina_run_qc_check.instrumentation as instrumentation
+import auto_illumina_run_qc_check.journal as journal
+import auto_illumina_run_qc_check.metrics_store as metrics_store
+import auto_illumina_run_qc_check.pipeline as pipeline
+import auto_illumina_run_qc_check.profiling as profiling
+import auto_illumina_run_qc_check.regrade
+import auto_illumina_run_qc_check.sharding as sharding
+import auto_illumina_run_qc_check.notification as notification
+import auto_illumina_run_qc_check.watch
 
 DEFAULT_SCAN_INTERVAL_SECONDS = 3600.0
+DEFAULT_MAX_CONCURRENT_CHECKS = 1
+
+def _get_max_concurrent_checks(config):
+    """
+    Get the maximum number of qc checks to run concurrently from the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Maximum number of concurrent qc checks.
+    :rtype: int
+    """
+    max_concurrent_checks = DEFAULT_MAX_CONCURRENT_CHECKS
+    if "max_concurrent_checks" in config:
+        try:
+            max_concurrent_checks = max(1, int(str(config['max_concurrent_checks'])))
+        except ValueError as e:
+            logging.error(json.dumps({
+                "event_type": "invalid_max_concurrent_checks",
+                "max_concurrent_checks": config['max_concurrent_checks'],
+            }))
+
+    return max_concurrent_checks
+
+
+def _get_scan_interval(config):
+    """
+    Get the time between the starts of full scans from the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Scan interval, in seconds.
+    :rtype: float
+    """
+    scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
+    if "scan_interval_seconds" in config:
+        try:
+            scan_interval = float(str(config['scan_interval_seconds']))
+        except ValueError as e:
+            logging.error(json.dumps({
+                "event_type": "invalid_scan_interval_seconds",
+                "scan_interval_seconds": config['scan_interval_seconds'],
+            }))
+
+    return scan_interval
+
+
+def _get_pipeline_settings(config):
+    """
+    Get the concurrency of each stage of the asyncio pipeline from the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Keyword arguments for `pipeline.QcCheckPipeline`. Keys: ['max_concurrent_scans', 'max_concurrent_checks', 'max_concurrent_notifications', 'queue_size']
+    :rtype: dict[str, int]
+    """
+    pipeline_settings = {
+        'max_concurrent_scans': pipeline.DEFAULT_MAX_CONCURRENT_SCANS,
+        'max_concurrent_checks': _get_max_concurrent_checks(config),
+        'max_concurrent_notifications': pipeline.DEFAULT_MAX_CONCURRENT_NOTIFICATIONS,
+        'queue_size': pipeline.DEFAULT_PIPELINE_QUEUE_SIZE,
+    }
+    for key, config_key in [('max_concurrent_scans', 'max_concurrent_scans'), ('max_concurrent_notifications', 'max_concurrent_notifications'), ('queue_size', 'pipeline_queue_size')]:
+        if config_key in config:
+            try:
+                pipeline_settings[key] = max(1, int(str(config[config_key])))
+            except ValueError as e:
+                logging.error(json.dumps({"event_type": "invalid_" + config_key, config_key: config[config_key]}))
+
+    return pipeline_settings
+
+
+def _load_initial_config(config_path):
+    """
+    Load the config file when the tool starts. There is no earlier config to fall back on,
+    so if it can't be loaded, the error is logged and the tool exits.
+
+    :param config_path: Path to the config file.
+    :type config_path: str
+    :return: The config.
+    :rtype: dict[str, object]
+    """
+    try:
+        config = auto_illumina_run_qc_check.config.load_config(config_path)
+    except (OSError, ValueError) as e:
+        logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(config_path), "error": str(e)}))
+        exit(-1)
+    logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(config_path)}))
+
+    return config
+
+
+def _reload_config(config_path, config):
+    """
+    Reload the config file. If it can't be loaded (eg. it is invalid, or has been removed), keep using the last valid config.
+    Files are only re-read if they have changed since the last reload.
+
+    :param config_path: Path to the config file.
+    :type config_path: Optional[str]
+    :param config: The last valid config.
+    :type config: dict[str, object]
+    :return: The reloaded config, or the last valid config if loading failed.
+    :rtype: dict[str, object]
+    """
+    if config_path:
+        try:
+            loaded_config = auto_illumina_run_qc_check.config.load_config(config_path)
+            # The config loader returns the same config if none of its files have changed.
+            if loaded_config is not config:
+                logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(config_path)}))
+            config = loaded_config
+        except (OSError, ValueError) as e:
+            # If we fail to load the config file, we continue on with the
+            # last valid config that was loaded.
+            logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(config_path), "error": str(e)}))
+
+    return config
+
+
+def _submit_qc_check(executor, in_flight_checks, max_concurrent_checks, config, run):
+    """
+    Submit a qc check to the worker pool, blocking until a worker is free
+    so that we don't queue up more runs than we can check at once.
+
+    Runs that are already being checked are not submitted again, and runs that
+    are backing off after a failure (or have been quarantined) are skipped.
+
+    :param executor: Worker pool.
+    :type executor: concurrent.futures.Executor
+    :param in_flight_checks: Sequencing run IDs of in-flight qc checks, indexed by their futures.
+    :type in_flight_checks: dict[concurrent.futures.Future, str]
+    :param max_concurrent_checks: Maximum number of concurrent qc checks.
+    :type max_concurrent_checks: int
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
+    :type run: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    if run['sequencing_run_id'] in in_flight_checks.values():
+        return
+    allowed, reason = failure_ledger.check_run_allowed(config, run)
+    if not allowed:
+        logging.debug(json.dumps({"event_type": "qc_check_deferred", "sequencing_run_id": run['sequencing_run_id'], "reason": reason}))
+        instrumentation.increment('qc_checks_deferred_total', reason=reason)
+        return
+
+    while len(in_flight_checks) >= max_concurrent_checks:
+        done, _ = concurrent.futures.wait(in_flight_checks, return_when=concurrent.futures.FIRST_COMPLETED)
+        _remove_completed_checks(done, in_flight_checks)
+    if profiling.is_profiling():
+        future = executor.submit(profiling.profile_call, core.run_qc_check, config, run)
+    else:
+        future = executor.submit(core.run_qc_check, config, run)
+    in_flight_checks[future] = run['sequencing_run_id']
+
+
+def _remove_completed_checks(done, in_flight_checks):
+    """
+    Remove completed qc checks from the set of in-flight checks, logging any that raised an exception.
+
+    :param done: Futures for completed qc checks.
+    :type done: set[concurrent.futures.Future]
+    :param in_flight_checks: Sequencing run IDs of in-flight qc checks, indexed by their futures.
+    :type in_flight_checks: dict[concurrent.futures.Future, str]
+    :return: None
+    :rtype: None
+    """
+    for future in done:
+        run_id = in_flight_checks.pop(future, None)
+        exception = future.exception()
+        if exception is not None:
+            logging.error(json.dumps({"event_type": "qc_check_raised_exception", "sequencing_run_id": run_id, "exception": repr(exception)}))
+
+
+def _wait_for_in_flight_checks(in_flight_checks):
+    """
+    Wait for all in-flight qc checks to complete.
+
+    A KeyboardInterrupt received while waiting is logged and ignored, so that
+    checks that have already started are always allowed to finish.
+
+    :param in_flight_checks: Sequencing run IDs of in-flight qc checks, indexed by their futures. Completed checks are removed.
+    :type in_flight_checks: dict[concurrent.futures.Future, str]
+    :return: None
+    :rtype: None
+    """
+    while in_flight_checks:
+        try:
+            done, _ = concurrent.futures.wait(in_flight_checks)
+            _remove_completed_checks(done, in_flight_checks)
+        except KeyboardInterrupt as e:
+            logging.info(json.dumps({"event_type": "waiting_for_in_flight_qc_checks", "num_in_flight_qc_checks": len(in_flight_checks)}))
+
+
+def _open_journal(config):
+    """
+    Open the journal listed in the config (if it isn't already open), and resume the qc checks
+    that have written their results, but haven't sent their notification.
+
+    When the journal is opened (ie. after a restart), every check that had written its result is resumed.
+    After that, only checks whose notification failed are resumed, on each scan, so that a notification
+    that is about to be sent by a check that is still in progress isn't sent twice.
+
+    Checks that stopped earlier don't need to be resumed here: they don't have a 'qc_check_complete.json'
+    file yet, so they will be found by the next scan.
+
+    :param config: Application config. Optional keys: ['journal_file']
+    :type config: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    if not config.get('journal_file', None):
+        return
+    try:
+        journal_opened = journal.open_journal(config['journal_file'])
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "open_journal_failed", "journal_file": config['journal_file'], "exception": str(e)}))
+        return
+
+    resumed_stages = [journal.NOTIFICATION_FAILED]
+    if journal_opened:
+        resumed_stages = [journal.VERDICT_WRITTEN, journal.NOTIFICATION_FAILED, journal.NOTIFICATION_QUEUED]
+    for incomplete_check in journal.get_incomplete_checks():
+        if incomplete_check['stage'] not in resumed_stages:
+            continue
+        run_id = incomplete_check['sequencing_run_id']
+        qc_check_complete_path = os.path.join(incomplete_check.get('run_dir_path', ''), 'qc_check_complete.json')
+        try:
+            with open(qc_check_complete_path, 'r') as f:
+                qc_check_result = json.load(f)
+        except (OSError, ValueError) as e:
+            # Without its result, the run has to be checked again (if it still exists), so there's nothing left to resume.
+            journal.record_stage(run_id, journal.CHECK_FAILED)
+            logging.error(json.dumps({"event_type": "resume_qc_check_failed", "sequencing_run_id": run_id, "exception": str(e)}))
+            continue
+        logging.info(json.dumps({"event_type": "qc_check_resumed", "sequencing_run_id": run_id, "stage": incomplete_check['stage']}))
+        core.notify_qc_check_result(config, run_id, qc_check_complete_path, qc_check_result.get('overall_pass_fail', None))
+
+
+def _export_instrumentation(config):
+    """
+    Export instrumentation metrics as configured: start the Prometheus http endpoint
+    (if it isn't already running) and/or write the Prometheus text file.
+
+    :param config: Application config. Optional keys: ['prometheus_port', 'prometheus_text_file']
+    :type config: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    try:
+        if config.get('prometheus_port', None) is not None:
+            instrumentation.start_prometheus_http_server(int(str(config['prometheus_port'])))
+        if config.get('prometheus_text_file', None):
+            instrumentation.write_prometheus_text_file(config['prometheus_text_file'])
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "export_instrumentation_failed", "exception": str(e)}))
+
+
+def _flush_notification_digest(config, force=False):
+    """
+    Send any qc check results that are waiting to be included in a digest email.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param force: Send the digest even if the digest window has not yet elapsed.
+    :type force: bool
+    :return: None
+    :rtype: None
+    """
+    notification_config = config.get('notification', {})
+    if not notification.digest_mode_enabled(notification_config):
+        return None
+
+    try:
+        num_runs = notification.flush_digest(notification_config, force=force)
+        if num_runs > 0:
+            logging.info(json.dumps({"event_type": "send_digest_email_complete", "num_runs": num_runs}))
+    except Exception as e:
+        logging.error(json.dumps({"event_type": "send_digest_email_failed", "exception": str(e)}))
+
+
+async def _run_pipeline(config_path, config):
+    """
+    Scan for runs, QC check them, and send notifications, using the asyncio pipeline
+    (see `pipeline.QcCheckPipeline`), until stopped by SIGINT or SIGTERM.
+
+    The concurrency of each stage is read from the config when the pipeline starts.
+
+    :param config_path: Path to the config file.
+    :type config_path: Optional[str]
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    qc_check_pipeline = pipeline.QcCheckPipeline(**_get_pipeline_settings(config))
+    watcher = None
+    current_watcher_settings = None
+    try:
+        while not qc_check_pipeline.is_stopping():
+            config = _reload_config(config_path, config)
+            _open_journal(config)
+            sharding.join_shard(config)
+
+            watcher_settings = (config.get('watch_mode', None), tuple(config.get('run_parent_dirs', [])), config.get('watch_poll_interval_seconds', None))
+            if watcher_settings != current_watcher_settings:
+                if watcher is not None:
+                    watcher.close()
+                watcher = auto_illumina_run_qc_check.watch.create_run_dir_watcher(config)
+                current_watcher_settings = watcher_settings
+
+            _export_instrumentation(config)
+
+            scan_start_timestamp = datetime.datetime.now()
+            await qc_check_pipeline.scan(config)
+            # Without a digest window, everything found during the scan goes out in one digest.
+            await qc_check_pipeline.run_in_thread(_flush_notification_digest, config, 'digest_window_seconds' not in config.get('notification', {}))
+
+            scan_complete_timestamp = datetime.datetime.now()
+            scan_duration_seconds = (scan_complete_timestamp - scan_start_timestamp).total_seconds()
+            instrumentation.record_phase_duration('scan', scan_duration_seconds)
+            _export_instrumentation(config)
+            profiling.dump_profile('scan_' + scan_start_timestamp.strftime('%Y%m%dT%H%M%S'))
+            scan_interval = _get_scan_interval(config)
+            next_scan_timestamp = scan_start_timestamp + datetime.timedelta(seconds=scan_interval)
+            logging.info(json.dumps({
+                "event_type": "scan_complete",
+                "scan_duration_seconds": scan_duration_seconds,
+                "scan_interval_seconds": scan_interval,
+                "timestamp_next_scan_start": next_scan_timestamp.isoformat(),
+            }))
+
+            remaining_seconds = (next_scan_timestamp - datetime.datetime.now()).total_seconds()
+            if watcher is None:
+                await qc_check_pipeline.wait(remaining_seconds)
+                continue
+            # Between full scans, check runs as soon as the watcher sees their upload complete.
+            while remaining_seconds > 0 and not qc_check_pipeline.is_stopping():
+                wait_seconds = remaining_seconds
+                digest_window_seconds = config.get('notification', {}).get('digest_window_seconds', None)
+                if notification.digest_mode_enabled(config.get('notification', {})) and digest_window_seconds is not None:
+                    # Wake up often enough to send digests on time.
+                    wait_seconds = min(remaining_seconds, max(1.0, float(digest_window_seconds)))
+                config = _reload_config(config_path, config)
+                await qc_check_pipeline.watch(config, watcher, wait_seconds)
+                if digest_window_seconds is not None:
+                    await qc_check_pipeline.run_in_thread(_flush_notification_digest, config)
+                _export_instrumentation(config)
+                remaining_seconds = (next_scan_timestamp - datetime.datetime.now()).total_seconds()
+    finally:
+        await qc_check_pipeline.close()
+        if watcher is not None:
+            watcher.close()
+        _flush_notification_digest(config, force=True)
+
+
+def query(args):
+    """
+    Print time series of run-level QC metrics from the metrics store, as csv.
+
+    :param args: Command-line arguments for the 'query' subcommand.
+    :type args: argparse.Namespace
+    :return: None
+    :rtype: None
+    """
+    metrics_store_db = args.metrics_store_db
+    if not metrics_store_db and args.config:
+        config = _load_initial_config(args.config)
+        metrics_store_db = config.get('metrics_store_db', None)
+    if not metrics_store_db or not os.path.exists(metrics_store_db):
+        logging.error(json.dumps({"event_type": "metrics_store_db_not_found", "metrics_store_db": metrics_store_db}))
+        exit(-1)
+
+    output_fields = ['run_date', 'sequencing_run_id', 'instrument_id', 'metric', 'value']
+    if args.rolling_mean:
+        output_fields.append('rolling_mean')
+    writer = csv.DictWriter(sys.stdout, fieldnames=output_fields, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+    writer.writeheader()
+
+    conn = metrics_store.open_metrics_store_db(metrics_store_db)
+    try:
+        for metric in args.metric:
+            time_series = metrics_store.query_metric_time_series(
+                conn,
+                metric,
+                instrument_id=args.instrument_id,
+                instrument_type=args.instrument_type,
+                start_date=args.start_date,
+                end_date=args.end_date,
+            )
+            if args.rolling_mean:
+                metrics_store.add_rolling_mean(time_series, args.rolling_mean)
+            for point in time_series:
+                writer.writerow(point)
+    finally:
+        conn.close()
+
+
+def backfill(args):
+    """
+    QC check an entire run archive in parallel, then print throughput statistics.
+
+    :param args: Command-line arguments for the 'backfill' subcommand.
+    :type args: argparse.Namespace
+    :return: None
+    :rtype: None
+    """
+    if not args.config:
+        logging.error(json.dumps({"event_type": "config_file_required", "command": "backfill"}))
+        exit(-1)
+
+    throughput_stats = auto_illumina_run_qc_check.backfill.backfill(
+        args.config,
+        run_parent_dirs=args.run_parent_dir,
+        start_date=args.start_date,
+        end_date=args.end_date,
+        num_workers=args.workers,
+        max_io_concurrency=args.max_io_concurrency,
+        checkpoint_path=args.checkpoint_file,
+        reuse_qc_metrics=not args.no_reuse_qc_metrics,
+    )
+    print(json.dumps(throughput_stats, indent=2))
+
+
+def regrade(args):
+    """
+    Re-evaluate the qc thresholds for previously-checked runs, and print the runs whose verdict changed, as csv.
+
+    :param args: Command-line arguments for the 'regrade' subcommand.
+    :type args: argparse.Namespace
+    :return: None
+    :rtype: None
+    """
+    if not args.config:
+        logging.error(json.dumps({"event_type": "config_file_required", "command": "regrade"}))
+        exit(-1)
+    config = _load_initial_config(args.config)
+
+    output_fields = ['sequencing_run_id', 'previous_overall_pass_fail', 'overall_pass_fail']
+    writer = csv.DictWriter(sys.stdout, fieldnames=output_fields, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+    writer.writeheader()
+
+    num_runs_regraded = 0
+    num_verdicts_changed = 0
+    regrade_results = auto_illumina_run_qc_check.regrade.regrade(
+        config,
+        run_parent_dirs=args.run_parent_dir,
+        start_date=args.start_date,
+        end_date=args.end_date,
+        dry_run=args.dry_run,
+    )
+    for regrade_result in regrade_results:
+        num_runs_regraded += 1
+        if regrade_result['verdict_changed'] or args.all_runs:
+            writer.writerow(regrade_result)
+        if regrade_result['verdict_changed']:
+            num_verdicts_changed += 1
+
+    logging.info(json.dumps({"event_type": "regrade_complete", "num_runs_regraded": num_runs_regraded, "num_verdicts_changed": num_verdicts_changed, "dry_run": args.dry_run}))
+
+
+def failures(args):
+    """
+    Print the runs with recorded qc check failures, as csv, or release a run so that it is checked again.
+
+    :param args: Command-line arguments for the 'failures' subcommand.
+    :type args: argparse.Namespace
+    :return: None
+    :rtype: None
+    """
+    if not args.config:
+        logging.error(json.dumps({"event_type": "config_file_required", "command": "failures"}))
+        exit(-1)
+    config = _load_initial_config(args.config)
+
+    for run_id in args.release or []:
+        released = failure_ledger.release_run(config, run_id)
+        logging.info(json.dumps({"event_type": "run_released_from_quarantine", "sequencing_run_id": run_id, "reason": "released_by_user", "had_failures": released}))
+    if args.release:
+        return
+
+    output_fields = ['sequencing_run_id', 'num_failures', 'quarantined', 'timestamp_last_failure', 'timestamp_next_retry', 'error']
+    writer = csv.DictWriter(sys.stdout, fieldnames=output_fields, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+    writer.writeheader()
+    for entry in failure_ledger.get_ledger_entries(config):
+        entry['timestamp_next_retry'] = None if entry['quarantined'] else datetime.datetime.fromtimestamp(entry['next_retry_time']).isoformat()
+        writer.writerow(entry)
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config')
     parser.add_argument('--log-level')
+    parser.add_argument('--worker-id', help="ID of this worker, when sharding runs between several workers with 'shard_dir' (default: <hostname>-<pid>)")
+    parser.add_argument('--profile', metavar='OUTPUT_DIR', help='Write cProfile and tracemalloc profiles to this directory (after each scan, and on exit)')
+    subparsers = parser.add_subparsers(dest='command')
+    query_parser = subparsers.add_parser('query', help='Print time series of QC metrics from the metrics store')
+    query_parser.add_argument('-m', '--metric', action='append', required=True, help='Metric to query (eg. PercentGtQ30). May be repeated.')
+    query_parser.add_argument('--metrics-store-db', help="Path to the metrics store database (default: 'metrics_store_db' from the config)")
+    query_parser.add_argument('-i', '--instrument-id', help='Only include runs from this instrument (eg. VH00123)')
+    query_parser.add_argument('-t', '--instrument-type', choices=['miseq', 'nextseq'], help='Only include runs from this type of instrument')
+    query_parser.add_argument('--start-date', help='Only include runs on or after this date (YYYY-MM-DD)')
+    query_parser.add_argument('--end-date', help='Only include runs on or before this date (YYYY-MM-DD)')
+    query_parser.add_argument('--rolling-mean', type=int, metavar='NUM_RUNS', help='Include the rolling mean over this many runs')
+    backfill_parser = subparsers.add_parser('backfill', help='QC check all runs in an archive, without sending notifications')
+    backfill_parser.add_argument('-d', '--run-parent-dir', action='append', help="Directory to search for runs. May be repeated. (default: 'run_parent_dirs' from the config)")
+    backfill_parser.add_argument('--start-date', help='Only include runs on or after this date (YYYY-MM-DD)')
+    backfill_parser.add_argument('--end-date', help='Only include runs on or before this date (YYYY-MM-DD)')
+    backfill_parser.add_argument('-w', '--workers', type=int, help='Number of worker processes (default: number of CPUs)')
+    backfill_parser.add_argument('--max-io-concurrency', type=int, default=auto_illumina_run_qc_check.backfill.DEFAULT_MAX_IO_CONCURRENCY, help='Maximum number of runs whose InterOp files are read at once (default: %(default)s)')
+    backfill_parser.add_argument('--checkpoint-file', help='File to record completed runs in. Runs listed in this file are skipped.')
+    backfill_parser.add_argument('--no-reuse-qc-metrics', action='store_true', help='Collect metrics again, even if a <RUN_ID>_qc_metrics.json file exists')
+    regrade_parser = subparsers.add_parser('regrade', help='Re-evaluate qc thresholds for previously-checked runs, using their saved metrics')
+    regrade_parser.add_argument('-d', '--run-parent-dir', action='append', help="Directory to search for runs. May be repeated. (default: 'run_parent_dirs' from the config)")
+    regrade_parser.add_argument('--start-date', help='Only include runs on or after this date (YYYY-MM-DD)')
+    regrade_parser.add_argument('--end-date', help='Only include runs on or before this date (YYYY-MM-DD)')
+    regrade_parser.add_argument('-n', '--dry-run', action='store_true', help="Report changes without updating any 'qc_check_complete.json' files")
+    regrade_parser.add_argument('--all-runs', action='store_true', help='Print all regraded runs, not only those whose verdict changed')
+    failures_parser = subparsers.add_parser('failures', help='List runs whose qc checks have failed, or release quarantined runs')
+    failures_parser.add_argument('-r', '--release', action='append', metavar='RUN_ID', help='Release a run, so that it is checked again on the next scan. May be repeated.')
     args = parser.parse_args()
 
     config = {}
@@ -26,29 +558,75 @@ def main():
         log_level = logging.INFO
 
     logging.basicConfig(
-        format='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module", "%(module)s", "function_name": "%(funcName)s", "line_num", %(lineno)d, "message": %(message)s}',
+        format='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module": "%(module)s", "function_name": "%(funcName)s", "line_num": %(lineno)d, "message": %(message)s}',
         datefmt='%Y-%m-%dT%H:%M:%S',
         encoding='utf-8',
         level=log_level,
     )
     logging.debug(json.dumps({"event_type": "debug_logging_enabled"}))
 
+    if args.profile:
+        profiling.start_profiling(args.profile)
+        atexit.register(profiling.stop_profiling)
+
+    if args.command == 'query':
+        query(args)
+        return
+    elif args.command == 'backfill':
+        backfill(args)
+        return
+    elif args.command == 'regrade':
+        regrade(args)
+        return
+    elif args.command == 'failures':
+        failures(args)
+        return
+
+    if args.worker_id:
+        sharding.set_worker_id(args.worker_id)
+    atexit.register(sharding.leave_shard)
+
+    if args.config:
+        config = _load_initial_config(args.config)
+    if config.get('pipeline_mode', 'threads') == 'asyncio':
+        asyncio.run(_run_pipeline(args.config, config))
+        return
+
     quit_when_safe = False
+    executor = None
+    executor_max_workers = None
+    watcher = None
+    current_watcher_settings = None
+    in_flight_checks = {}
 
     while(True):
         try:
             # Safe to quit before initiating a full scan.
             if quit_when_safe:
+                _wait_for_in_flight_checks(in_flight_checks)
+                _flush_notification_digest(config, force=True)
                 exit(0)
 
-            if args.config:
-                try:
-                    config = auto_illumina_run_qc_check.config.load_config(args.config)
-                    logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
-                except json.decoder.JSONDecodeError as e:
-                    # If we fail to load the config file, we continue on with the
-                    # last valid config that was loaded.
-                    logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
+            config = _reload_config(args.config, config)
+            _open_journal(config)
+            sharding.join_shard(config)
+
+            max_concurrent_checks = _get_max_concurrent_checks(config)
+            if executor is None or executor_max_workers != max_concurrent_checks:
+                if executor is not None:
+                    _wait_for_in_flight_checks(in_flight_checks)
+                    executor.shutdown(wait=True)
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_checks, thread_name_prefix='qc_check')
+                executor_max_workers = max_concurrent_checks
+
+            watcher_settings = (config.get('watch_mode', None), tuple(config.get('run_parent_dirs', [])), config.get('watch_poll_interval_seconds', None))
+            if watcher_settings != current_watcher_settings:
+                if watcher is not None:
+                    watcher.close()
+                watcher = auto_illumina_run_qc_check.watch.create_run_dir_watcher(config)
+                current_watcher_settings = watcher_settings
+
+            _export_instrumentation(config)
 
             scan_start_timestamp = datetime.datetime.now()
             for run in core.scan(config):
@@ -58,29 +636,27 @@ def main():
                     'instrument_type',
                 ]
                 if run is not None and all([k in run for k in required_run_keys]):
-                    try:
-                        config = auto_illumina_run_qc_check.config.load_config(args.config)
-                        logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
-                    except json.decoder.JSONDecodeError as e:
-                        logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
-                    core.qc_check(config, run)
-
-                # Safe to quit after completing a qc check on a single run.
+                    config = _reload_config(args.config, config)
+                    _submit_qc_check(executor, in_flight_checks, max_concurrent_checks, config, run)
+
+                # Safe to quit after submitting a qc check on a single run,
+                # once all in-flight checks have completed.
                 if quit_when_safe:
+                    _wait_for_in_flight_checks(in_flight_checks)
+                    _flush_notification_digest(config, force=True)
                     exit(0)
 
+            _wait_for_in_flight_checks(in_flight_checks)
+            # Without a digest window, everything found during the scan goes out in one digest.
+            _flush_notification_digest(config, force='digest_window_seconds' not in config.get('notification', {}))
+
             scan_complete_timestamp = datetime.datetime.now()
             scan_duration_delta = scan_complete_timestamp - scan_start_timestamp
             scan_duration_seconds = scan_duration_delta.total_seconds()
-            scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
-            if "scan_interval_seconds" in config:
-                try:
-                    scan_interval = float(str(config['scan_interval_seconds']))
-                except ValueError as e:
-                    logging.error(json.dumps({
-                        "event_type": "invalid_scan_interval_seconds",
-                        "scan_interval_seconds": config['scan_interval_seconds'],
-                    }))
+            instrumentation.record_phase_duration('scan', scan_duration_seconds)
+            _export_instrumentation(config)
+            profiling.dump_profile('scan_' + scan_start_timestamp.strftime('%Y%m%dT%H%M%S'))
+            scan_interval = _get_scan_interval(config)
             next_scan_timestamp = scan_start_timestamp + datetime.timedelta(seconds=scan_interval)
             logging.info(json.dumps({
                 "event_type": "scan_complete",
@@ -91,10 +667,29 @@ def main():
 
             # Safe to quit after completing a full scan.
             if quit_when_safe:
+                _flush_notification_digest(config, force=True)
                 exit(0)
 
-            
-            time.sleep(scan_interval)
+            if watcher is None:
+                time.sleep(scan_interval)
+            else:
+                # Between full scans, check runs as soon as the watcher sees their upload complete.
+                remaining_seconds = (next_scan_timestamp - datetime.datetime.now()).total_seconds()
+                while remaining_seconds > 0:
+                    wait_seconds = remaining_seconds
+                    digest_window_seconds = config.get('notification', {}).get('digest_window_seconds', None)
+                    if notification.digest_mode_enabled(config.get('notification', {})) and digest_window_seconds is not None:
+                        # Wake up often enough to send digests on time.
+                        wait_seconds = min(remaining_seconds, max(1.0, float(digest_window_seconds)))
+                    for run_dir_path in watcher.wait_for_run_dirs(wait_seconds):
+                        config = _reload_config(args.config, config)
+                        run = core.find_run_dir(config, run_dir_path)
+                        if run is not None:
+                            _submit_qc_check(executor, in_flight_checks, max_concurrent_checks, config, run)
+                    if digest_window_seconds is not None:
+                        _flush_notification_digest(config)
+                    _export_instrumentation(config)
+                    remaining_seconds = (next_scan_timestamp - datetime.datetime.now()).total_seconds()
         except KeyboardInterrupt as e:
             logging.info(json.dumps({"event_type": "quit_when_safe_enabled"}))
             quit_when_safe = True
@@ -0,0 +1,250 @@
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import auto_illumina_run_qc_check.config
+import auto_illumina_run_qc_check.core as core
+
+
+DEFAULT_MAX_IO_CONCURRENCY = 4
+PROGRESS_LOG_INTERVAL_SECONDS = 60.0
+
+# Set in each worker process by `_init_backfill_worker`.
+_worker_config = None
+_worker_io_semaphore = None
+
+
+def _init_backfill_worker(config_path, io_semaphore):
+    """
+    Load the config in a worker process. The config is loaded in each worker rather than being
+    passed to it, because the compiled qc rules can't be pickled.
+
+    Drift detection is turned off in the workers: old runs, checked in no particular order, would
+    otherwise be added to the instruments' baselines a second time, out of date order.
+    """
+    global _worker_config
+    global _worker_io_semaphore
+    _worker_config = dict(auto_illumina_run_qc_check.config.load_config(config_path))
+    _worker_config.pop('spc_state_file', None)
+    _worker_io_semaphore = io_semaphore
+
+
+def _backfill_run(run, reuse_qc_metrics):
+    """
+    QC check a single run in a worker process, without sending notifications.
+
+    Runs that need their metrics collected from the InterOp files wait for the I/O semaphore,
+    so that only a limited number of runs are read from the archive at once. Runs with existing
+    '<RUN_ID>_qc_metrics.json' files only need to read that file, so they don't wait.
+
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
+    :type run: dict[str, object]
+    :param reuse_qc_metrics: Use existing '<RUN_ID>_qc_metrics.json' files, if present.
+    :type reuse_qc_metrics: bool
+    :return: Backfill result. Keys: ['sequencing_run_id', 'overall_pass_fail', 'reused_qc_metrics']
+    :rtype: dict[str, object]
+    """
+    run_id = run['sequencing_run_id']
+    qc_metrics_path = os.path.join(run['path'], run_id + '_qc_metrics.json')
+    reused_qc_metrics = reuse_qc_metrics and os.path.exists(qc_metrics_path)
+    if reused_qc_metrics or _worker_io_semaphore is None:
+        qc_check_result = core.qc_check(_worker_config, run, reuse_qc_metrics=reuse_qc_metrics, send_notifications=False)
+    else:
+        with _worker_io_semaphore:
+            qc_check_result = core.qc_check(_worker_config, run, reuse_qc_metrics=reuse_qc_metrics, send_notifications=False)
+
+    backfill_result = {
+        'sequencing_run_id': run_id,
+        'overall_pass_fail': None,
+        'reused_qc_metrics': reused_qc_metrics,
+    }
+    if qc_check_result is not None:
+        backfill_result['overall_pass_fail'] = qc_check_result['overall_pass_fail']
+
+    return backfill_result
+
+
+def load_checkpoint(checkpoint_path):
+    """
+    Load the IDs of runs that have already been backfilled.
+
+    :param checkpoint_path: Path to the checkpoint file. One sequencing run ID per line.
+    :type checkpoint_path: str
+    :return: Sequencing run IDs of completed runs.
+    :rtype: set[str]
+    """
+    completed_run_ids = set()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r') as f:
+            for line in f:
+                run_id = line.strip()
+                if run_id:
+                    completed_run_ids.add(run_id)
+
+    return completed_run_ids
+
+
+def find_backfill_runs(config, run_parent_dirs, start_date=None, end_date=None, completed_run_ids=None):
+    """
+    Find runs to backfill. Runs are found using the same rules as a scan, except that
+    runs which already have a 'qc_check_complete.json' file are included.
+
+    The run date (taken from the sequencing run ID) is checked before anything else, so
+    runs outside of the date range are skipped without touching the filesystem.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_parent_dirs: Directories to search for runs.
+    :type run_parent_dirs: list[str]
+    :param start_date: Only include runs on or after this date (YYYY-MM-DD).
+    :type start_date: Optional[str]
+    :param end_date: Only include runs on or before this date (YYYY-MM-DD).
+    :type end_date: Optional[str]
+    :param completed_run_ids: Sequencing run IDs of runs to skip.
+    :type completed_run_ids: Optional[set[str]]
+    :return: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
+    :rtype: Iterator[dict[str, object]]
+    """
+    if completed_run_ids is None:
+        completed_run_ids = set()
+
+    for run_parent_dir in run_parent_dirs:
+        run_parent_dir = os.path.abspath(run_parent_dir)
+        try:
+            with os.scandir(run_parent_dir) as entries:
+                run_dir_names = sorted(entry.name for entry in entries)
+        except OSError as e:
+            logging.error(json.dumps({"event_type": "scan_run_parent_dir_failed", "run_parent_dir": run_parent_dir, "exception": str(e)}))
+            continue
+
+        for run_id in run_dir_names:
+            if core.get_instrument_type(run_id) == 'unknown' or run_id in completed_run_ids:
+                continue
+            try:
+                run_date = core.get_run_date(run_id)
+            except ValueError as e:
+                continue
+            if (start_date is not None and run_date < start_date) or (end_date is not None and run_date > end_date):
+                continue
+            run = core.find_run_dir(config, os.path.join(run_parent_dir, run_id), include_qc_checked=True)
+            if run is not None:
+                yield run
+
+
+def _get_throughput_stats(stats, start_time):
+    elapsed_seconds = time.monotonic() - start_time
+    throughput_stats = dict(stats)
+    throughput_stats['elapsed_seconds'] = round(elapsed_seconds, 1)
+    throughput_stats['runs_per_second'] = round(stats['num_runs_completed'] / elapsed_seconds, 3) if elapsed_seconds > 0 else 0.0
+
+    return throughput_stats
+
+
+def backfill(config_path, run_parent_dirs=None, start_date=None, end_date=None, num_workers=None, max_io_concurrency=DEFAULT_MAX_IO_CONCURRENCY, checkpoint_path=None, reuse_qc_metrics=True):
+    """
+    QC check every run in an archive, in parallel, without sending notifications.
+
+    Results are written to each run's 'qc_check_complete.json' (and the metrics store, if configured),
+    as they would be by a scan. If a checkpoint file is given, each completed run is recorded there,
+    and runs listed in it are skipped, so an interrupted backfill can be resumed.
+
+    :param config_path: Path to the config file.
+    :type config_path: str
+    :param run_parent_dirs: Directories to search for runs. Defaults to the 'run_parent_dirs' from the config.
+    :type run_parent_dirs: Optional[list[str]]
+    :param start_date: Only include runs on or after this date (YYYY-MM-DD).
+    :type start_date: Optional[str]
+    :param end_date: Only include runs on or before this date (YYYY-MM-DD).
+    :type end_date: Optional[str]
+    :param num_workers: Number of worker processes. Defaults to the number of CPUs.
+    :type num_workers: Optional[int]
+    :param max_io_concurrency: Maximum number of runs whose InterOp files are read at once.
+    :type max_io_concurrency: int
+    :param checkpoint_path: Path to the checkpoint file.
+    :type checkpoint_path: Optional[str]
+    :param reuse_qc_metrics: Use existing '<RUN_ID>_qc_metrics.json' files, if present.
+    :type reuse_qc_metrics: bool
+    :return: Throughput statistics. Keys: ['num_runs_completed', 'num_pass', 'num_fail', 'num_errors', 'num_reused_qc_metrics', 'elapsed_seconds', 'runs_per_second']
+    :rtype: dict[str, object]
+    """
+    config = auto_illumina_run_qc_check.config.load_config(config_path)
+    if run_parent_dirs is None:
+        run_parent_dirs = config.get('run_parent_dirs', [])
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    completed_run_ids = load_checkpoint(checkpoint_path)
+    logging.info(json.dumps({
+        "event_type": "backfill_started",
+        "run_parent_dirs": run_parent_dirs,
+        "start_date": start_date,
+        "end_date": end_date,
+        "num_workers": num_workers,
+        "max_io_concurrency": max_io_concurrency,
+        "num_runs_already_completed": len(completed_run_ids),
+    }))
+
+    stats = {
+        'num_runs_completed': 0,
+        'num_pass': 0,
+        'num_fail': 0,
+        'num_errors': 0,
+        'num_reused_qc_metrics': 0,
+    }
+    start_time = time.monotonic()
+    last_progress_log_time = start_time
+
+    checkpoint_file = None
+    if checkpoint_path:
+        checkpoint_file = open(checkpoint_path, 'a')
+
+    def record_result(future, run_id):
+        nonlocal last_progress_log_time
+        if time.monotonic() - last_progress_log_time >= PROGRESS_LOG_INTERVAL_SECONDS:
+            last_progress_log_time = time.monotonic()
+            logging.info(json.dumps(dict({"event_type": "backfill_progress"}, **_get_throughput_stats(stats, start_time))))
+        exception = future.exception()
+        if exception is not None:
+            stats['num_errors'] += 1
+            logging.error(json.dumps({"event_type": "backfill_run_failed", "sequencing_run_id": run_id, "exception": repr(exception)}))
+            return
+        backfill_result = future.result()
+        if backfill_result['overall_pass_fail'] is None:
+            stats['num_errors'] += 1
+            return
+        stats['num_runs_completed'] += 1
+        if backfill_result['overall_pass_fail'] == 'PASS':
+            stats['num_pass'] += 1
+        else:
+            stats['num_fail'] += 1
+        if backfill_result['reused_qc_metrics']:
+            stats['num_reused_qc_metrics'] += 1
+        if checkpoint_file is not None:
+            checkpoint_file.write(run_id + "\n")
+            checkpoint_file.flush()
+
+    io_semaphore = multiprocessing.BoundedSemaphore(max(1, max_io_concurrency))
+    in_flight_runs = {}
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_init_backfill_worker, initargs=(config_path, io_semaphore)) as executor:
+            for run in find_backfill_runs(config, run_parent_dirs, start_date, end_date, completed_run_ids):
+                # Keep a bounded number of runs queued, so that results are recorded as runs are found.
+                while len(in_flight_runs) >= 2 * num_workers:
+                    done, _ = concurrent.futures.wait(in_flight_runs, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        record_result(future, in_flight_runs.pop(future))
+                in_flight_runs[executor.submit(_backfill_run, run, reuse_qc_metrics)] = run['sequencing_run_id']
+
+            for future in concurrent.futures.as_completed(list(in_flight_runs)):
+                record_result(future, in_flight_runs.pop(future))
+    finally:
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+
+    throughput_stats = _get_throughput_stats(stats, start_time)
+    logging.info(json.dumps(dict({"event_type": "backfill_complete"}, **throughput_stats)))
+
+    return throughput_stats
@@ -1,40 +1,313 @@
+import copy
 import csv
+import errno
 import json
 import os
+import threading
+
+import auto_illumina_run_qc_check.outliers as outliers
+import auto_illumina_run_qc_check.parsers as parsers
+import auto_illumina_run_qc_check.sharding as sharding
+import auto_illumina_run_qc_check.spc as spc
+import auto_illumina_run_qc_check.thresholds as thresholds
+
+
+def _is_number(value):
+    """
+    Numeric settings may be given as numbers or as strings, eg. "3600".
+    """
+    if isinstance(value, bool):
+        return False
+    try:
+        float(str(value))
+        return True
+    except ValueError as e:
+        return False
+
+
+def _is_integer(value):
+    if isinstance(value, bool):
+        return False
+    try:
+        int(str(value))
+        return True
+    except ValueError as e:
+        return False
+
+
+def _is_string(value):
+    return isinstance(value, str)
+
+
+def _is_bool(value):
+    return isinstance(value, bool)
+
+
+def _is_list_of_strings(value):
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+def _is_list(value):
+    return isinstance(value, list)
+
+
+def _is_dict(value):
+    return isinstance(value, dict)
+
+
+# Expected type of each known top-level config key, as (check, description).
+CONFIG_SCHEMA = {
+    'run_parent_dirs': (_is_list_of_strings, "a list of strings"),
+    'excluded_runs_list': (_is_string, "a string"),
+    'projects_definition_file': (_is_string, "a string"),
+    'scan_interval_seconds': (_is_number, "a number"),
+    'scan_state_db': (_is_string, "a string"),
+    'metrics_store_db': (_is_string, "a string"),
+    'max_concurrent_checks': (_is_integer, "an integer"),
+    'pipeline_mode': (lambda v: v in ['threads', 'asyncio'], "one of ['threads', 'asyncio']"),
+    'max_concurrent_scans': (_is_integer, "an integer"),
+    'max_concurrent_notifications': (_is_integer, "an integer"),
+    'pipeline_queue_size': (_is_integer, "an integer"),
+    'watch_mode': (lambda v: v in [None, False, 'inotify', 'poll'], "one of ['inotify', 'poll']"),
+    'watch_poll_interval_seconds': (_is_number, "a number"),
+    'run_parameters_fields': (lambda v: _is_list_of_strings(v) and all(f in parsers.RUN_PARAMETERS_FIELDS for f in v), "a list of: " + str(list(parsers.RUN_PARAMETERS_FIELDS.keys()))),
+    'interop_reader': (lambda v: v in ['native', 'interop_summary'], "one of ['native', 'interop_summary']"),
+    'interop_summary_timeout_seconds': (_is_number, "a number"),
+    'interop_summary_max_cpu_seconds': (_is_integer, "an integer"),
+    'interop_summary_max_memory_mb': (_is_integer, "an integer"),
+    'max_concurrent_interop_processes': (_is_integer, "an integer"),
+    'journal_file': (_is_string, "a string"),
+    'shard_dir': (_is_string, "a string"),
+    'shard_by': (lambda v: v in sharding.SHARD_BY_OPTIONS, "one of " + str(sharding.SHARD_BY_OPTIONS)),
+    'lease_expiry_seconds': (_is_number, "a number"),
+    'lease_heartbeat_seconds': (_is_number, "a number"),
+    'failure_ledger_file': (_is_string, "a string"),
+    'max_qc_check_attempts': (_is_integer, "an integer"),
+    'qc_check_retry_backoff_seconds': (_is_number, "a number"),
+    'qc_check_retry_max_backoff_seconds': (_is_number, "a number"),
+    'prometheus_text_file': (_is_string, "a string"),
+    'prometheus_port': (_is_integer, "an integer"),
+    'lane_outlier_method': (lambda v: v in outliers.OUTLIER_METHODS, "one of " + str(outliers.OUTLIER_METHODS)),
+    'lane_outlier_metrics': (lambda v: _is_list_of_strings(v) and all(m in thresholds.LANE_LEVEL_METRICS for m in v), "a list of lane-level metrics"),
+    'lane_outlier_score_threshold': (_is_number, "a number"),
+    'lane_outlier_history_runs': (_is_integer, "an integer"),
+    'spc_state_file': (_is_string, "a string"),
+    'spc_metrics': (lambda v: _is_list_of_strings(v) and all(m in spc.DEFAULT_SPC_METRICS for m in v), "a list of: " + str(spc.DEFAULT_SPC_METRICS)),
+    'spc_min_baseline_runs': (_is_integer, "an integer"),
+    'spc_ewma_lambda': (lambda v: _is_number(v) and 0 < float(str(v)) <= 1, "a number greater than 0, up to 1"),
+    'spc_ewma_limit': (_is_number, "a number"),
+    'spc_cusum_k': (_is_number, "a number"),
+    'spc_cusum_h': (_is_number, "a number"),
+    'spc_exclude_signals_from_baseline': (_is_bool, "true or false"),
+    'qc_thresholds': (_is_list, "a list"),
+    'notification': (_is_dict, "an object"),
+}
+
+# Expected type of each known key in the 'notification' section of the config.
+NOTIFICATION_CONFIG_SCHEMA = {
+    'system_config_file': (_is_string, "a string"),
+    'recipient_email_addresses': (_is_list_of_strings, "a list of strings"),
+    'send_notification_emails': (_is_bool, "true or false"),
+    'http_timeout_seconds': (_is_number, "a number"),
+    'http_max_retries': (_is_integer, "an integer"),
+    'http_retry_backoff_seconds': (_is_number, "a number"),
+    'http_retry_max_backoff_seconds': (_is_number, "a number"),
+    'digest_mode': (_is_bool, "true or false"),
+    'digest_window_seconds': (_is_number, "a number"),
+    'digest_send_failures_immediately': (_is_bool, "true or false"),
+    'email_template': (_is_string, "a string"),
+    'failed_email_template': (_is_string, "a string"),
+    'digest_email_template': (_is_string, "a string"),
+    'template_dir': (_is_string, "a string"),
+    'template_bytecode_cache_dir': (_is_string, "a string"),
+}
+
+# Parsed contents of each file read while loading the config, indexed by path.
+# Each entry holds the file's (mtime_ns, size) when it was read, so it's only
+# re-read if it changes.
+_file_cache = {}
+# Most recently loaded config for each config file, along with the
+# (mtime_ns, size) of every file it was built from.
+_loaded_configs = {}
+_config_lock = threading.Lock()
+
+
+def _get_file_signature(path):
+    """
+    Get a signature for a file that changes whenever the file is modified.
+
+    :param path: Path to the file.
+    :type path: str
+    :return: (mtime_ns, size) of the file, or None if it doesn't exist.
+    :rtype: Optional[tuple[int, int]]
+    """
+    try:
+        stat_result = os.stat(path)
+    except OSError as e:
+        return None
+
+    return (stat_result.st_mtime_ns, stat_result.st_size)
+
+
+def _read_file_cached(path, parse):
+    """
+    Read and parse a file, re-using the previously parsed contents if the file hasn't changed.
+
+    :param path: Path to the file.
+    :type path: str
+    :param parse: Function that takes an open file and returns its parsed contents.
+    :type parse: Callable[[TextIO], object]
+    :return: The file's signature and parsed contents, or (None, None) if the file doesn't exist.
+    :rtype: tuple[Optional[tuple[int, int]], object]
+    """
+    signature = _get_file_signature(path)
+    if signature is None:
+        return None, None
+
+    cached = _file_cache.get(path, None)
+    if cached is not None and cached['signature'] == signature:
+        return signature, cached['contents']
+
+    with open(path, 'r') as f:
+        contents = parse(f)
+    _file_cache[path] = {
+        'signature': signature,
+        'contents': contents,
+    }
+
+    return signature, contents
+
+
+def _parse_json(f):
+    try:
+        return json.load(f)
+    except json.decoder.JSONDecodeError as e:
+        raise ValueError("Invalid JSON in " + f.name + ": " + str(e))
+
+
+def _parse_config_file(f):
+    """
+    Parse and validate the config file. Validation only happens when the file
+    is (re-)read, not each time the config is loaded.
+    """
+    raw_config = _parse_json(f)
+    validate_config(raw_config)
+
+    return raw_config
+
+
+def _parse_excluded_runs(f):
+    excluded_runs = set()
+    for line in f:
+        run_id = line.strip()
+        if run_id:
+            excluded_runs.add(run_id)
+
+    return frozenset(excluded_runs)
+
+
+def _parse_projects(f):
+    return list(csv.DictReader(f, dialect='unix'))
+
+
+def validate_config(config: dict[str, object]):
+    """
+    Check that the values of known config keys have the expected types.
+
+    :param config: Application config, as read from the config file.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: None
+    :raises ValueError: If any values are invalid. All problems found are included in the message.
+    """
+    if not isinstance(config, dict):
+        raise ValueError("Invalid config: must be a JSON object")
+
+    problems = []
+    for key, (check, description) in CONFIG_SCHEMA.items():
+        if key in config and not check(config[key]):
+            problems.append("'" + key + "' must be " + description + ", got: " + json.dumps(config[key]))
+
+    for key, (check, description) in NOTIFICATION_CONFIG_SCHEMA.items():
+        notification_config = config.get('notification', {})
+        if isinstance(notification_config, dict) and key in notification_config and not check(notification_config[key]):
+            problems.append("'notification." + key + "' must be " + description + ", got: " + json.dumps(notification_config[key]))
+
+    if problems:
+        raise ValueError("Invalid config: " + "; ".join(problems))
+
+
+def _build_config(raw_config, excluded_runs, projects, notification_system_config):
+    """
+    Combine the contents of the config file and the files it refers to into the application config.
+    """
+    config = copy.deepcopy(raw_config)
+    config['excluded_runs'] = excluded_runs if excluded_runs is not None else frozenset()
+    config['projects'] = projects if projects is not None else []
+
+    if 'notification' in config and notification_system_config is not None:
+        for k, v in notification_system_config.items():
+            config['notification'][k] = v
+
+    # Raises ValueError if any of the thresholds are invalid, so that bad
+    # thresholds are reported when the config is loaded rather than during a QC check.
+    config['qc_rules'] = thresholds.compile_qc_thresholds(config.get('qc_thresholds', []))
+
+    return config
 
 
 def load_config(config_path: str) -> dict[str, object]:
     """
     Load the application config file.
 
+    The config file and the files it refers to ('excluded_runs_list', 'projects_definition_file'
+    and the notification 'system_config_file') are only re-read if their modification time or size
+    has changed since they were last loaded. If none of them have changed, the previously-loaded
+    config is returned, so callers can check whether the config has changed with `is`.
+
+    Excluded runs are loaded into a frozenset, under the 'excluded_runs' key.
+
     :param config_path: Path to config file.
     :type config_path: str
     :return: A dictionary containing configuration data.
     :rtype: dict[str, object]
+    :raises ValueError: If the config file is not valid JSON, or contains invalid values or qc thresholds.
+    :raises FileNotFoundError: If the config file does not exist.
     """
-    config = {}
-    with open(config_path, 'r') as f:
-        config = json.load(f)
-
-    config['excluded_runs'] = []
-    if 'excluded_runs_list' in config and os.path.exists(config['excluded_runs_list']):
-        with open(config['excluded_runs_list'], 'r') as f:
-            for line in f.readlines():
-                config['excluded_runs'].append(line.strip())
-
-    config['projects'] = []
-    if 'projects_definition_file' in config and os.path.exists(config['projects_definition_file']):
-        with open(config['projects_definition_file'], 'r') as f:
-            reader = csv.DictReader(f, dialect='unix')
-            for row in reader:
-                config['projects'].append(row)
-
-    if 'notification' in config:
-        notification_system_config_file = config['notification'].get('system_config_file', None)
-        if notification_system_config_file and os.path.exists(notification_system_config_file):
-            with open(notification_system_config_file, 'r') as f:
-                notification_system_config = json.load(f)
-                for k, v in notification_system_config.items():
-                    config['notification'][k] = v
+    with _config_lock:
+        config_signature, raw_config = _read_file_cached(config_path, _parse_config_file)
+        if config_signature is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), config_path)
+
+        excluded_runs_signature, excluded_runs = None, None
+        if 'excluded_runs_list' in raw_config:
+            excluded_runs_signature, excluded_runs = _read_file_cached(raw_config['excluded_runs_list'], _parse_excluded_runs)
+
+        projects_signature, projects = None, None
+        if 'projects_definition_file' in raw_config:
+            projects_signature, projects = _read_file_cached(raw_config['projects_definition_file'], _parse_projects)
+
+        notification_system_config_signature, notification_system_config = None, None
+        notification_system_config_file = raw_config.get('notification', {}).get('system_config_file', None)
+        if notification_system_config_file:
+            notification_system_config_signature, notification_system_config = _read_file_cached(notification_system_config_file, _parse_json)
+            if notification_system_config is not None and not isinstance(notification_system_config, dict):
+                raise ValueError("Invalid notification system config: must be a JSON object")
+
+        signatures = (
+            config_signature,
+            excluded_runs_signature,
+            projects_signature,
+            notification_system_config_signature,
+        )
+        loaded_config = _loaded_configs.get(config_path, None)
+        if loaded_config is not None and loaded_config['signatures'] == signatures:
+            return loaded_config['config']
+
+        config = _build_config(raw_config, excluded_runs, projects, notification_system_config)
+        _loaded_configs[config_path] = {
+            'signatures': signatures,
+            'config': config,
+        }
 
     return config
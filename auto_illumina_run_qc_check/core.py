@@ -1,4 +1,5 @@
 import datetime
+import fnmatch
 import glob
 import hashlib
 import json
@@ -6,20 +7,209 @@ import logging
 import os
 import re
 import shutil
-import subprocess
+import sqlite3
+import struct
 import time
+import traceback
 import uuid
 
 from typing import Iterator, Optional
 from pathlib import Path
 
+import auto_illumina_run_qc_check.failure_ledger as failure_ledger
+import auto_illumina_run_qc_check.instrumentation as instrumentation
+import auto_illumina_run_qc_check.interop as interop
+import auto_illumina_run_qc_check.journal as journal
+import auto_illumina_run_qc_check.metrics_store as metrics_store
+import auto_illumina_run_qc_check.outliers as outliers
 import auto_illumina_run_qc_check.parsers as parsers
+import auto_illumina_run_qc_check.scan_state as scan_state
+import auto_illumina_run_qc_check.sharding as sharding
+import auto_illumina_run_qc_check.spc as spc
+import auto_illumina_run_qc_check.thresholds as thresholds
+import auto_illumina_run_qc_check.notification as notification
+
 from auto_illumina_run_qc_check.notification import send_notification_email
 
+MISEQ_RUN_ID_REGEX = re.compile("\\d{6}_M\\d{5}_\\d+_\\d{9}-[A-Z0-9]{5}")
+NEXTSEQ_RUN_ID_REGEX = re.compile("\\d{6}_VH\\d{5}_\\d+_[A-Z0-9]{9}")
+
+
+def get_instrument_type(run_id):
+    """
+    Determine the instrument type from the format of a sequencing run ID.
+
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Instrument type. One of ['miseq', 'nextseq', 'unknown']
+    :rtype: str
+    """
+    instrument_type = 'unknown'
+    if MISEQ_RUN_ID_REGEX.match(run_id):
+        instrument_type = 'miseq'
+    elif NEXTSEQ_RUN_ID_REGEX.match(run_id):
+        instrument_type = 'nextseq'
+
+    return instrument_type
+
+
+def get_instrument_id(run_id):
+    """
+    Get the ID of the instrument that produced a run, from the sequencing run ID.
+
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Instrument ID (eg. 'M00123' or 'VH00123').
+    :rtype: str
+    """
+    return run_id.split('_')[1]
+
+
+def get_run_date(run_id):
+    """
+    Get the date that a run was started, from the sequencing run ID.
+
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Run date, in ISO format (YYYY-MM-DD).
+    :rtype: str
+    """
+    run_date = datetime.datetime.strptime(run_id.split('_')[0], '%y%m%d').date()
+
+    return run_date.isoformat()
+
+
+def _is_excluded(config, run_id):
+    """
+    Check whether a run is listed in the config's excluded runs. If the excluded runs
+    haven't been loaded, every run is treated as excluded.
+    """
+    return 'excluded_runs' not in config or run_id in config['excluded_runs']
+
+
+def _evaluate_run_dir(config, run_id, run_dir_path, is_dir, get_mtime=None, known_run_dir_state=None, include_qc_checked=False, check_upload_complete=True):
+    """
+    Check whether a directory is a sequencing run directory that is ready for a QC check.
+
+    Conditions are checked from cheapest to most expensive, and we stop
+    at the first one that isn't met.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Name of the directory.
+    :type run_id: str
+    :param run_dir_path: Absolute path to the directory.
+    :type run_dir_path: str
+    :param is_dir: Whether the path is a directory.
+    :type is_dir: bool
+    :param get_mtime: Function returning the mtime of the directory. Only used if a scan state index is in use.
+    :type get_mtime: Optional[Callable[[], float]]
+    :param known_run_dir_state: Previously-recorded scan state for the directory. Keys: ['state', 'mtime']
+    :type known_run_dir_state: Optional[dict[str, object]]
+    :param include_qc_checked: Include runs that already have a 'qc_check_complete.json' file.
+    :type include_qc_checked: bool
+    :param check_upload_complete: Check for presence of 'upload_complete.json' file.
+    :type check_upload_complete: bool
+    :return: The run (if it is ready for a QC check), and the scan state to record for the directory (if any).
+    :rtype: tuple[Optional[dict[str, object]], Optional[dict[str, object]]]
+    """
+    conditions_checked = {}
+    instrument_type = get_instrument_type(run_id)
+    conditions_checked['matches_illumina_run_id_format'] = instrument_type != 'unknown'
+    conditions_checked['is_directory'] = is_dir
+    if not all(conditions_checked.values()):
+        logging.debug(json.dumps({"event_type": "directory_skipped", "run_directory_path": run_dir_path, "conditions_checked": conditions_checked}))
+        instrumentation.increment('run_dirs_skipped_total', reason=scan_state.WRONG_FORMAT)
+        return None, {'state': scan_state.WRONG_FORMAT, 'mtime': None}
+
+    # Ownership can change as workers join and leave the shard, so no scan state is recorded.
+    if not sharding.owns_run(os.path.dirname(run_dir_path), run_id):
+        logging.debug(json.dumps({"event_type": "directory_skipped", "run_directory_path": run_dir_path, "owner_worker_id": sharding.get_owner(run_id)}))
+        instrumentation.increment('run_dirs_skipped_total', reason=sharding.OWNED_BY_OTHER_WORKER)
+        return None, None
+
+    conditions_checked['not_excluded'] = not _is_excluded(config, run_id)
+    if not conditions_checked['not_excluded']:
+        logging.debug(json.dumps({"event_type": "directory_skipped", "run_directory_path": run_dir_path, "conditions_checked": conditions_checked}))
+        instrumentation.increment('run_dirs_skipped_total', reason=scan_state.EXCLUDED)
+        return None, {'state': scan_state.EXCLUDED, 'mtime': None}
+
+    run_dir_mtime = None
+    if get_mtime:
+        run_dir_mtime = get_mtime()
+        # Creating 'upload_complete.json' (or removing 'qc_check_complete.json') updates the mtime of the
+        # run directory, so if the mtime hasn't changed then the directory is still in the same state.
+        settled_states = scan_state.SETTLED_STATES
+        if not check_upload_complete:
+            settled_states = settled_states - {scan_state.UPLOAD_INCOMPLETE}
+        if known_run_dir_state and known_run_dir_state['state'] in settled_states and known_run_dir_state['mtime'] == run_dir_mtime:
+            logging.debug(json.dumps({"event_type": "directory_skipped", "run_directory_path": run_dir_path, "scan_state": known_run_dir_state['state']}))
+            instrumentation.increment('run_dirs_skipped_total', reason=known_run_dir_state['state'])
+            return None, None
+
+    if check_upload_complete:
+        conditions_checked['upload_complete'] = os.path.exists(os.path.join(run_dir_path, 'upload_complete.json'))
+        if not conditions_checked['upload_complete']:
+            logging.debug(json.dumps({"event_type": "directory_skipped", "run_directory_path": run_dir_path, "conditions_checked": conditions_checked}))
+            instrumentation.increment('run_dirs_skipped_total', reason=scan_state.UPLOAD_INCOMPLETE)
+            return None, {'state': scan_state.UPLOAD_INCOMPLETE, 'mtime': run_dir_mtime}
+
+    if not include_qc_checked:
+        conditions_checked['qc_check_not_complete'] = not os.path.exists(os.path.join(run_dir_path, 'qc_check_complete.json'))
+        if not conditions_checked['qc_check_not_complete']:
+            logging.debug(json.dumps({"event_type": "directory_skipped", "run_directory_path": run_dir_path, "conditions_checked": conditions_checked}))
+            instrumentation.increment('run_dirs_skipped_total', reason=scan_state.QC_CHECK_COMPLETE)
+            return None, {'state': scan_state.QC_CHECK_COMPLETE, 'mtime': run_dir_mtime}
+
+    run_parameters = {}
+    run_parameters_path = os.path.join(run_dir_path, 'RunParameters.xml')
+    try:
+        run_parameters = parsers.parse_run_parameters_xml(run_parameters_path, instrument_type, config.get('run_parameters_fields', None))
+    except FileNotFoundError as e:
+        pass
+
+    run = {}
+    instrumentation.increment('runs_found_total', instrument_type=instrument_type)
+    logging.info(json.dumps({"event_type": "run_directory_found", "sequencing_run_id": run_id, "run_directory_path": run_dir_path}))
+    run['path'] = run_dir_path
+    run['sequencing_run_id'] = run_id
+    run['instrument_type'] = instrument_type
+    run['run_parameters'] = run_parameters
+
+    return run, None
+
+
+def find_run_dir(config, run_dir_path, include_qc_checked=False):
+    """
+    Check a single directory, as would be done for each directory during a scan.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_dir_path: Path to the directory.
+    :type run_dir_path: str
+    :param include_qc_checked: Include the run even if it already has a 'qc_check_complete.json' file.
+    :type include_qc_checked: bool
+    :return: Run directory, if it is ready for a QC check. Keys: ['sequencing_run_id', 'path', 'instrument_type']
+    :rtype: Optional[dict[str, str]]
+    """
+    run_dir_path = os.path.abspath(run_dir_path)
+    run_id = os.path.basename(run_dir_path)
+    run, _ = _evaluate_run_dir(config, run_id, run_dir_path, os.path.isdir(run_dir_path), include_qc_checked=include_qc_checked)
+
+    return run
+
+
 def find_run_dirs(config, check_upload_complete=True):
     """
     Find sequencing run directories under the 'run_parent_dirs' listed in the config.
 
+    If a 'scan_state_db' is listed in the config, the state of each directory is recorded
+    there so that directories which can never become eligible for a QC check
+    (not a run directory) are skipped on later scans without touching the filesystem.
+    Excluded runs are skipped in the same way, for as long as they stay in the excluded runs list.
+    Directories that are still waiting for upload, or have already been checked, are only
+    re-checked when their modification time changes.
+
     :param config: Application config.
     :type config: dict[str, object]
     :param check_upload_complete: Check for presence of 'upload_complete.json' file.
@@ -27,94 +217,176 @@ def find_run_dirs(config, check_upload_complete=True):
     :return: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
     :rtype: Iterator[Optional[dict[str, str]]]
     """
-    miseq_run_id_regex = "\\d{6}_M\\d{5}_\\d+_\\d{9}-[A-Z0-9]{5}"
-    nextseq_run_id_regex = "\\d{6}_VH\\d{5}_\\d+_[A-Z0-9]{9}"
     run_parent_dirs = config['run_parent_dirs']
 
-    for run_parent_dir in run_parent_dirs:
-        subdirs = os.scandir(run_parent_dir)
-
-        for subdir in subdirs:
-            run_id = subdir.name
-            matches_miseq_regex = re.match(miseq_run_id_regex, run_id)
-            matches_nextseq_regex = re.match(nextseq_run_id_regex, run_id)
-            instrument_type = 'unknown'
-            if matches_miseq_regex:
-                instrument_type = 'miseq'
-            elif matches_nextseq_regex:
-                instrument_type = 'nextseq'
-
-            run_parameters = {}
-            run_parameters_path = os.path.join(subdir, 'RunParameters.xml')
-            if os.path.exists(run_parameters_path):
-                run_parameters = parsers.parse_run_parameters_xml(run_parameters_path, instrument_type)
-                    
-            upload_complete = os.path.exists(os.path.join(subdir, 'upload_complete.json'))
-            not_excluded = False
-            if 'excluded_runs' in config:
-                not_excluded = not run_id in config['excluded_runs']
-
-            qc_check_complete = os.path.exists(os.path.join(subdir, 'qc_check_complete.json'))
-
-            conditions_checked = {
-                "is_directory": subdir.is_dir(),
-                "matches_illumina_run_id_format": ((matches_miseq_regex is not None) or
-                                                   (matches_nextseq_regex is not None)),
-                "upload_complete": upload_complete,
-                "qc_check_not_complete": not qc_check_complete,
-                "not_excluded": not_excluded,
-            }
-
-            conditions_met = list(conditions_checked.values())
-            run = {}
-            if all(conditions_met):
-                logging.info(json.dumps({"event_type": "run_directory_found", "sequencing_run_id": run_id, "run_directory_path": os.path.abspath(subdir.path)}))
-                run['path'] = os.path.abspath(subdir.path)
-                run['sequencing_run_id'] = run_id
-                run['instrument_type'] = instrument_type
-                run['run_parameters'] = run_parameters
-                yield run
-            else:
-                logging.debug(json.dumps({"event_type": "directory_skipped", "run_directory_path": os.path.abspath(subdir.path), "conditions_checked": conditions_checked}))
-                yield None
+    scan_state_db_conn = None
+    if config.get('scan_state_db', None):
+        scan_state_db_conn = scan_state.open_scan_state_db(config['scan_state_db'])
 
+    try:
+        for run_parent_dir in run_parent_dirs:
+            run_parent_dir = os.path.abspath(run_parent_dir)
+            if not sharding.owns_run_parent_dir(run_parent_dir):
+                logging.debug(json.dumps({"event_type": "run_parent_dir_skipped", "run_parent_dir": run_parent_dir, "owner_worker_id": sharding.get_owner(run_parent_dir)}))
+                continue
+            known_run_dir_states = {}
+            if scan_state_db_conn:
+                known_run_dir_states = scan_state.get_run_dir_states(scan_state_db_conn, run_parent_dir)
+            updated_run_dir_states = {}
 
-def get_sum_sample_fastq_file_sizes(run):
+            # Time spent scanning this parent dir, not including time spent
+            # by the caller between runs (eg. waiting to start a qc check).
+            scan_seconds = 0.0
+            resumed_at = time.perf_counter()
+            try:
+                subdirs = os.scandir(run_parent_dir)
+                for subdir in subdirs:
+                    instrumentation.increment('run_dirs_seen_total')
+                    run_id = subdir.name
+                    run_dir_path = os.path.abspath(subdir.path)
+                    known_run_dir_state = known_run_dir_states.get(run_id, None)
+                    known_state = known_run_dir_state['state'] if known_run_dir_state else None
+                    if known_state in scan_state.TERMINAL_STATES or (known_state == scan_state.EXCLUDED and _is_excluded(config, run_id)):
+                        logging.debug(json.dumps({"event_type": "directory_skipped", "run_directory_path": run_dir_path, "scan_state": known_run_dir_state['state']}))
+                        instrumentation.increment('run_dirs_skipped_total', reason=known_run_dir_state['state'])
+                        run = None
+                    else:
+                        get_mtime = None
+                        if scan_state_db_conn:
+                            get_mtime = lambda: subdir.stat().st_mtime
+                        try:
+                            run, run_dir_state = _evaluate_run_dir(config, run_id, run_dir_path, subdir.is_dir(), get_mtime, known_run_dir_state, check_upload_complete=check_upload_complete)
+                        except Exception as e:
+                            # A single unreadable directory shouldn't stop the scan.
+                            logging.error(json.dumps({"event_type": "evaluate_run_dir_failed", "run_directory_path": run_dir_path, "exception": repr(e), "traceback": traceback.format_exc()}))
+                            run, run_dir_state = None, None
+                        if run_dir_state:
+                            updated_run_dir_states[run_id] = run_dir_state
+                    scan_seconds += time.perf_counter() - resumed_at
+                    resumed_at = None
+                    yield run
+                    resumed_at = time.perf_counter()
+            except OSError as e:
+                logging.error(json.dumps({"event_type": "scan_run_parent_dir_failed", "run_parent_dir": run_parent_dir, "exception": str(e)}))
+            finally:
+                if scan_state_db_conn and updated_run_dir_states:
+                    scan_state.set_run_dir_states(scan_state_db_conn, run_parent_dir, updated_run_dir_states)
+                if resumed_at is not None:
+                    scan_seconds += time.perf_counter() - resumed_at
+                instrumentation.record_phase_duration('find_run_dirs', scan_seconds, run_parent_dir=run_parent_dir)
+    finally:
+        if scan_state_db_conn:
+            scan_state_db_conn.close()
+
+
+def _find_latest_fastq_dir(run):
     """
-    Get the sum of all sample fastq file sizes in the run directory.
+    Find the most recent fastq output directory for a run.
 
     :param run: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
     :type run: dict[str, str]
-    :return: Sum of all sample fastq file sizes in the run directory.
-    :rtype: float
+    :return: Path to the latest fastq directory, or None if there isn't one.
+    :rtype: Optional[str]
     """
-    sum_sample_fastq_file_sizes = 0.0
     latest_fastq_path = None
+    fastq_paths = []
     if run['instrument_type'] == 'miseq':
         fastq_paths_glob = os.path.join(run['path'], 'Alignment_*', '*', 'Fastq')
         fastq_paths = glob.glob(fastq_paths_glob)
-        latest_fastq_path = sorted(fastq_paths)[-1]
     elif run['instrument_type'] == 'nextseq':
         fastq_paths_glob = os.path.join(run['path'], 'Analysis', '*', 'Data', 'fastq')
         fastq_paths = glob.glob(fastq_paths_glob)
-        if len(fastq_paths) > 0:
-            latest_fastq_path = sorted(fastq_paths)[-1]
+    if len(fastq_paths) > 0:
+        latest_fastq_path = sorted(fastq_paths)[-1]
+
+    return latest_fastq_path
+
+
+def _get_fastq_manifest(run, fastq_dir):
+    """
+    Get the sizes of all fastq files in a fastq directory.
+
+    The listing is taken with a single `os.scandir` pass, and saved to a manifest file in the run directory,
+    keyed by the fastq directory's mtime. If the fastq directory hasn't changed since the manifest was written,
+    the manifest is used without listing the directory again.
+
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
+    :type run: dict[str, str]
+    :param fastq_dir: Path to the fastq directory.
+    :type fastq_dir: str
+    :return: Size (in bytes) of each fastq file, indexed by filename.
+    :rtype: dict[str, int]
+    """
+    manifest_path = os.path.join(run['path'], run['sequencing_run_id'] + '_fastq_manifest.json')
+    fastq_dir_mtime_ns = os.stat(fastq_dir).st_mtime_ns
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('fastq_dir') == fastq_dir and manifest.get('fastq_dir_mtime_ns') == fastq_dir_mtime_ns:
+                return manifest['fastq_file_sizes']
+        except (ValueError, KeyError) as e:
+            logging.warning(json.dumps({"event_type": "fastq_manifest_invalid", "sequencing_run_id": run['sequencing_run_id'], "manifest_path": manifest_path}))
 
+    fastq_file_sizes = {}
+    with os.scandir(fastq_dir) as entries:
+        for entry in entries:
+            if fnmatch.fnmatch(entry.name, '*.f*q.gz') and entry.is_file():
+                fastq_file_sizes[entry.name] = entry.stat().st_size
+
+    manifest = {
+        'fastq_dir': fastq_dir,
+        'fastq_dir_mtime_ns': fastq_dir_mtime_ns,
+        'fastq_file_sizes': fastq_file_sizes,
+    }
+    try:
+        journal.write_json_atomically(manifest_path, manifest)
+    except OSError as e:
+        logging.warning(json.dumps({"event_type": "write_fastq_manifest_failed", "sequencing_run_id": run['sequencing_run_id'], "manifest_path": manifest_path, "exception": str(e)}))
+
+    return fastq_file_sizes
+
+
+@instrumentation.timed('get_sample_fastq_file_sizes')
+def get_sample_fastq_file_sizes(run):
+    """
+    Get the total size of the fastq files for each library in the run directory.
+    Undetermined reads are not included.
+
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
+    :type run: dict[str, str]
+    :return: Total size (in MB) of fastq files for each library, indexed by library ID.
+    :rtype: dict[str, float]
+    """
+    sample_fastq_file_sizes = {}
+    latest_fastq_path = _find_latest_fastq_dir(run)
     if not latest_fastq_path:
         logging.error(json.dumps({"event_type": "no_fastq_paths_found", "sequencing_run_id": run['sequencing_run_id']}))
-        return sum_sample_fastq_file_sizes
+        return sample_fastq_file_sizes
 
-    fastq_files_glob = os.path.join(latest_fastq_path, '*.f*q.gz')
-    fastq_files = glob.glob(fastq_files_glob)
-
-    for fastq_file in fastq_files:
-        file_basename = os.path.basename(fastq_file)
-        library_id = file_basename.split('_')[0]
+    fastq_file_sizes = _get_fastq_manifest(run, latest_fastq_path)
+    for fastq_filename, fastq_file_size in sorted(fastq_file_sizes.items()):
+        library_id = fastq_filename.split('_')[0]
         if library_id != 'Undetermined':
-            file_size_mb = os.path.getsize(fastq_file) / (1024 * 1024)
-            sum_sample_fastq_file_sizes += file_size_mb
+            file_size_mb = fastq_file_size / (1024 * 1024)
+            sample_fastq_file_sizes[library_id] = sample_fastq_file_sizes.get(library_id, 0.0) + file_size_mb
+
+    return sample_fastq_file_sizes
+
 
-    return sum_sample_fastq_file_sizes
+@instrumentation.timed('get_sum_sample_fastq_file_sizes')
+def get_sum_sample_fastq_file_sizes(run):
+    """
+    Get the sum of all sample fastq file sizes in the run directory.
+
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
+    :type run: dict[str, str]
+    :return: Sum of all sample fastq file sizes in the run directory.
+    :rtype: float
+    """
+    sample_fastq_file_sizes = get_sample_fastq_file_sizes(run)
+
+    return sum(sample_fastq_file_sizes.values(), 0.0)
     
 
 def scan(config: dict[str, object]) -> Iterator[Optional[dict[str, object]]]:
@@ -133,7 +405,76 @@ def scan(config: dict[str, object]) -> Iterator[Optional[dict[str, object]]]:
         yield run_dir
 
 
-def qc_check(config, run):
+def _get_interop_summary_limits(config):
+    """
+    Get the limits to apply to the interop_summary process from the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Keyword arguments for `interop.run_interop_summary`. Keys: ['timeout_seconds', 'max_cpu_seconds', 'max_memory_mb', 'max_concurrent_processes']
+    :rtype: dict[str, object]
+    """
+    interop_summary_limits = {
+        'timeout_seconds': float(str(config.get('interop_summary_timeout_seconds', interop.DEFAULT_INTEROP_SUMMARY_TIMEOUT_SECONDS))),
+        'max_cpu_seconds': None,
+        'max_memory_mb': None,
+        'max_concurrent_processes': None,
+    }
+    if config.get('interop_summary_max_cpu_seconds', None) is not None:
+        interop_summary_limits['max_cpu_seconds'] = int(str(config['interop_summary_max_cpu_seconds']))
+    if config.get('interop_summary_max_memory_mb', None) is not None:
+        interop_summary_limits['max_memory_mb'] = int(str(config['interop_summary_max_memory_mb']))
+    if config.get('max_concurrent_interop_processes', None) is not None:
+        interop_summary_limits['max_concurrent_processes'] = max(1, int(str(config['max_concurrent_interop_processes'])))
+
+    return interop_summary_limits
+
+
+def _add_lane_outlier_scores(config, run, qc_metrics):
+    """
+    Score each lane's metrics against the other lanes of the run, and (if a metrics store is configured)
+    against the lanes of previous runs on the same instrument. See `outliers.add_lane_outlier_scores`.
+
+    :param config: Application config. Keys: ['lane_outlier_method'] Optional keys: ['lane_outlier_metrics', 'lane_outlier_score_threshold', 'lane_outlier_history_runs', 'metrics_store_db']
+    :type config: dict[str, object]
+    :param run: Run directory. Keys: ['sequencing_run_id']
+    :type run: dict[str, object]
+    :param qc_metrics: QC metrics. Updated in place.
+    :type qc_metrics: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    run_id = run['sequencing_run_id']
+    metrics = config.get('lane_outlier_metrics', outliers.DEFAULT_LANE_OUTLIER_METRICS)
+    num_history_runs = int(str(config.get('lane_outlier_history_runs', outliers.DEFAULT_LANE_OUTLIER_HISTORY_RUNS)))
+    lane_history = None
+    if config.get('metrics_store_db', None) and num_history_runs > 0:
+        history_run = {
+            'sequencing_run_id': run_id,
+            'instrument_id': get_instrument_id(run_id),
+            'run_date': get_run_date(run_id),
+        }
+        try:
+            conn = metrics_store.open_metrics_store_db(config['metrics_store_db'])
+            try:
+                lane_history = metrics_store.query_lane_metric_history(conn, history_run, num_history_runs, metrics)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.error(json.dumps({"event_type": "query_lane_metric_history_failed", "sequencing_run_id": run_id, "exception": str(e)}))
+
+    lane_outliers = outliers.add_lane_outlier_scores(
+        qc_metrics,
+        method=config['lane_outlier_method'],
+        metrics=metrics,
+        score_threshold=float(str(config.get('lane_outlier_score_threshold', outliers.DEFAULT_LANE_OUTLIER_SCORE_THRESHOLD))),
+        lane_history=lane_history,
+    )
+    for lane_outlier in lane_outliers:
+        logging.warning(json.dumps({"event_type": "lane_outlier_found", "sequencing_run_id": run_id, "lane_outlier": lane_outlier}))
+
+
+def qc_check(config, run, reuse_qc_metrics=False, send_notifications=True, defer_notification=False):
     """
     Initiate an analysis on one directory of fastq files.
 
@@ -141,10 +482,17 @@ def qc_check(config, run):
     :type config: dict[str, object]
     :param run: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
     :type run: dict[str, str]
-    :return: None
-    :rtype: None
+    :param reuse_qc_metrics: If the run already has a '<RUN_ID>_qc_metrics.json' file, use the metrics from it instead of collecting them again.
+    :type reuse_qc_metrics: bool
+    :param send_notifications: Send (or queue) a notification email, if enabled in the config.
+    :type send_notifications: bool
+    :param defer_notification: Leave the notification to the caller, which must call `notify_qc_check_result` with the result.
+    :type defer_notification: bool
+    :return: The QC check result that was written to 'qc_check_complete.json', or None if QC metrics couldn't be collected.
+    :rtype: Optional[dict[str, object]]
     """
     run_id = run['sequencing_run_id']
+    qc_check_result = None
 
     interop_command = [
         'interop_summary',
@@ -153,79 +501,224 @@ def qc_check(config, run):
     ]
 
     logging.info(json.dumps({"event_type": "qc_check_started", "sequencing_run_id": run_id, "interop_command": " ".join(interop_command)}))
+    # If an earlier attempt wrote the metrics before stopping, don't collect them again.
+    if journal.get_stage(run_id) == journal.METRICS_WRITTEN:
+        reuse_qc_metrics = True
+    journal.record_stage(run_id, journal.STARTED, run['path'])
     timestamp_qc_check_started = datetime.datetime.now().isoformat()
     timestamp_qc_check_completed = None
 
-    qc_check_complete = False
-    interop_result = None
-    try:
-        interop_result = subprocess.run(interop_command, capture_output=True, check=True, text=True)
-        if interop_result.returncode == 0:
-            qc_check_complete = True
+    qc_rules = config.get('qc_rules', None)
+    if qc_rules is None:
+        qc_rules = thresholds.compile_qc_thresholds(config['qc_thresholds'])
+    flowcell_version = run['run_parameters'].get('flowcell_version', None)
+
+    qc_metrics = None
+    qc_metrics_output_path = os.path.join(run['path'], run_id + '_qc_metrics.json')
+    reused_qc_metrics = False
+    if reuse_qc_metrics and os.path.exists(qc_metrics_output_path):
+        try:
+            with open(qc_metrics_output_path, 'r') as f:
+                qc_metrics = json.load(f)
+            reused_qc_metrics = True
             timestamp_qc_check_completed = datetime.datetime.now().isoformat()
-        logging.info(json.dumps({"event_type": "qc_check_completed", "sequencing_run_id": run_id, "interop_command": " ".join(interop_command)}))
-    except subprocess.CalledProcessError as e:
-        logging.error(json.dumps({"event_type": "qc_check_failed", "sequencing_run_id": run_id, "interop_command": " ".join(interop_command)}))
-
-    if qc_check_complete and interop_result:
-        summary_lines = interop_result.stdout.splitlines()
-        qc_metrics = parsers.parse_interop_summary(summary_lines)
-        sum_sample_fastq_file_sizes = get_sum_sample_fastq_file_sizes(run)
-        qc_metrics['SumSampleFastqFileSizesMb'] = round(sum_sample_fastq_file_sizes, 2)
-        qc_metrics_output_path = os.path.join(run['path'], run_id + '_qc_metrics.json')
-        with open(qc_metrics_output_path, 'w') as f:
-            json.dump(qc_metrics, f, indent=2)
-            f.write("\n")
-        qc_check_result = {}
-        qc_check_result['checked_metrics'] = []
-        for qc_threshold in config['qc_thresholds']:
-            instrument_type_matches = qc_threshold.get('instrument_type', '').lower() == run['instrument_type']
-            instrument_type_not_specified = 'instrument_type' not in qc_threshold
-            flowcell_version_matches = qc_threshold.get('flowcell_version', '') == run['run_parameters'].get('flowcell_version', None)
-            flowcell_version_not_specified = 'flowcell_version' not in qc_threshold
-            qc_threshold_application_conditions_met = [
-                (instrument_type_matches or instrument_type_not_specified),
-                (flowcell_version_matches or flowcell_version_not_specified),
-            ]
-            if all(qc_threshold_application_conditions_met):
-                metric = qc_threshold['metric']
-                threshold = qc_threshold['threshold']
-                checked_metric = {}
-                checked_metric['metric'] = metric
-                checked_metric['value'] = qc_metrics[metric]
-                checked_metric['threshold'] = threshold
-                checked_metric['pass_above_or_below'] = qc_threshold['pass_above_or_below']
-                if qc_threshold['pass_above_or_below'] == 'above':
-                    if qc_metrics[metric] >= threshold:
-                        checked_metric['pass_fail'] = "PASS"
-                    else:
-                        checked_metric['pass_fail'] = "FAIL"
-                elif qc_threshold['pass_above_or_below'] == 'below':
-                    if qc_metrics[metric] <= threshold:
-                        checked_metric['pass_fail'] = "PASS"
-                    else:
-                        checked_metric['pass_fail'] = "FAIL"
-                qc_check_result['checked_metrics'].append(checked_metric)
+            logging.info(json.dumps({"event_type": "qc_metrics_reused", "sequencing_run_id": run_id, "qc_metrics_path": qc_metrics_output_path}))
+        except (OSError, ValueError) as e:
+            logging.warning(json.dumps({"event_type": "load_qc_metrics_failed", "sequencing_run_id": run_id, "qc_metrics_path": qc_metrics_output_path, "exception": str(e)}))
+
+    if qc_metrics is None and config.get('interop_reader', 'interop_summary') == 'native':
+        try:
+            with instrumentation.timed('read_interop_metrics', sequencing_run_id=run_id):
+                qc_metrics = interop.read_interop_metrics(run['path'])
+            missing_lane_metrics = thresholds.find_missing_lane_metrics(qc_rules, qc_metrics, run['instrument_type'], flowcell_version, run['run_parameters'])
+            if missing_lane_metrics:
+                # The run doesn't have the InterOp files that these metrics come from. interop_summary
+                # reports them anyway (as 0), which is what the qc thresholds were written against.
+                logging.info(json.dumps({"event_type": "native_interop_reader_metrics_missing", "sequencing_run_id": run_id, "missing_lane_metrics": missing_lane_metrics}))
+                qc_metrics = None
+            else:
+                timestamp_qc_check_completed = datetime.datetime.now().isoformat()
+                logging.info(json.dumps({"event_type": "qc_check_completed", "sequencing_run_id": run_id, "interop_reader": "native"}))
+        except (interop.InterOpError, OSError, struct.error) as e:
+            # Fall back to interop_summary for anything the native reader can't handle.
+            logging.warning(json.dumps({"event_type": "native_interop_reader_failed", "sequencing_run_id": run_id, "exception": str(e)}))
 
-        qc_check_result['overall_pass_fail'] = "FAIL"
-        qc_pass_conditions_met = [m['pass_fail'] == "PASS" for m in qc_check_result['checked_metrics']]
-        if all(qc_pass_conditions_met):
-            qc_check_result['overall_pass_fail'] = "PASS"
+    if qc_metrics is None:
+        try:
+            with instrumentation.timed('interop_summary', sequencing_run_id=run_id):
+                qc_metrics, interop_summary_resource_usage = interop.run_interop_summary(run['path'], **_get_interop_summary_limits(config))
+            timestamp_qc_check_completed = datetime.datetime.now().isoformat()
+            logging.info(json.dumps({
+                "event_type": "qc_check_completed",
+                "sequencing_run_id": run_id,
+                "interop_command": " ".join(interop_command),
+                "interop_summary_resource_usage": interop_summary_resource_usage,
+            }))
+        except (interop.InterOpError, OSError) as e:
+            logging.error(json.dumps({"event_type": "qc_check_failed", "sequencing_run_id": run_id, "interop_command": " ".join(interop_command), "exception": str(e)}))
+
+    if qc_metrics is None:
+        instrumentation.increment('qc_checks_total', result='ERROR')
+
+    if qc_metrics is not None:
+        # Reused metrics are scored again too, so that qc thresholds on outlier scores can be checked
+        # even if the metrics were collected without (or with different) lane outlier settings.
+        if config.get('lane_outlier_method', None):
+            _add_lane_outlier_scores(config, run, qc_metrics)
+        if not reused_qc_metrics:
+            sample_fastq_file_sizes = get_sample_fastq_file_sizes(run)
+            sum_sample_fastq_file_sizes = sum(sample_fastq_file_sizes.values(), 0.0)
+            qc_metrics['SumSampleFastqFileSizesMb'] = round(sum_sample_fastq_file_sizes, 2)
+            if sample_fastq_file_sizes:
+                qc_metrics['MinSampleFastqFileSizeMb'] = round(min(sample_fastq_file_sizes.values()), 2)
+            qc_metrics['SampleFastqFileSizesMb'] = {k: round(v, 2) for k, v in sample_fastq_file_sizes.items()}
+            journal.write_json_atomically(qc_metrics_output_path, qc_metrics)
+        journal.record_stage(run_id, journal.METRICS_WRITTEN)
+
+        if config.get('metrics_store_db', None):
+            try:
+                conn = metrics_store.open_metrics_store_db(config['metrics_store_db'])
+                try:
+                    stored_run = {
+                        'sequencing_run_id': run_id,
+                        'instrument_id': get_instrument_id(run_id),
+                        'instrument_type': run['instrument_type'],
+                        'run_date': get_run_date(run_id),
+                    }
+                    metrics_store.store_run_metrics(conn, stored_run, qc_metrics)
+                finally:
+                    conn.close()
+                logging.debug(json.dumps({"event_type": "qc_metrics_stored", "sequencing_run_id": run_id, "metrics_store_db": config['metrics_store_db']}))
+            except (sqlite3.Error, ValueError) as e:
+                logging.error(json.dumps({"event_type": "store_qc_metrics_failed", "sequencing_run_id": run_id, "exception": str(e)}))
+        qc_check_result = {}
+        qc_check_result['checked_metrics'] = thresholds.evaluate_qc_rules(qc_rules, qc_metrics, run['instrument_type'], flowcell_version, run['run_parameters'])
+        qc_check_result['overall_pass_fail'] = thresholds.get_overall_pass_fail(qc_check_result['checked_metrics'])
+        if config.get('spc_state_file', None):
+            qc_check_result['drift'] = spc.assess_run(config, run_id, get_instrument_id(run_id), qc_metrics)
         qc_check_result['sequencing_run_id'] = run_id
         qc_check_result['instrument_type'] = run['instrument_type']
         qc_check_result['run_parameters'] = run['run_parameters']
         qc_check_result['timestamp_qc_check_started'] = timestamp_qc_check_started
         qc_check_result['timestamp_qc_check_completed'] = timestamp_qc_check_completed
         qc_check_complete_output_path = os.path.join(run['path'], 'qc_check_complete.json')
-        with open(qc_check_complete_output_path, 'w') as f:
-            json.dump(qc_check_result, f, indent=2)
-            f.write("\n")
+        journal.write_json_atomically(qc_check_complete_output_path, qc_check_result)
+        journal.record_stage(run_id, journal.VERDICT_WRITTEN)
         logging.info(json.dumps({"event_type": "qc_check_complete", "sequencing_run_id": run_id, "qc_check_result": qc_check_result['overall_pass_fail']}))
+        instrumentation.increment('qc_checks_total', result=qc_check_result['overall_pass_fail'])
 
-        notification_emails_enabled = 'send_notification_emails' in config.get('notification', {}) and config['notification']['send_notification_emails']
-        if  notification_emails_enabled:
-            try:
-                send_notification_email(Path(qc_check_complete_output_path), config['notification'])
-                logging.info(json.dumps({"event_type": "send_notification_email_complete", "sequencing_run_id": run_id, "qc_check_result": qc_check_result.get('overall_pass_fail', "Unknown")}))
-            except Exception as e:
-                logging.error(json.dumps({"event_type": "send_notification_email_failed", "sequencing_run_id": run_id, "exception": str(e)}))
+        if defer_notification:
+            pass
+        elif send_notifications:
+            notify_qc_check_result(config, run_id, qc_check_complete_output_path, qc_check_result['overall_pass_fail'])
+        else:
+            journal.record_stage(run_id, journal.COMPLETE)
+
+    return qc_check_result
+
+
+def _record_qc_check_failure(config, run, error, traceback_text=None):
+    """
+    Record a failed qc check in the failure ledger, which decides when it is retried, and drop it from the journal,
+    so that the journal doesn't keep an entry for it forever (eg. if the run is quarantined, or removed).
+    A check that failed after writing its verdict is left in the journal, so that its notification is still sent.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path']
+    :type run: dict[str, object]
+    :param error: Description of the error.
+    :type error: str
+    :param traceback_text: Traceback of the exception that caused the failure, if any.
+    :type traceback_text: Optional[str]
+    :return: None
+    :rtype: None
+    """
+    failure_ledger.record_failure(config, run, error, traceback_text)
+    if journal.get_stage(run['sequencing_run_id']) in [journal.STARTED, journal.METRICS_WRITTEN]:
+        journal.record_stage(run['sequencing_run_id'], journal.CHECK_FAILED)
+
+
+def run_qc_check(config, run, defer_notification=False):
+    """
+    QC check a run found by a scan, recording the outcome in the failure ledger.
+
+    If this worker is part of a shard, the run is claimed with a lease first, and
+    isn't checked if another worker holds the lease or has already checked it.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
+    :type run: dict[str, object]
+    :param defer_notification: Leave the notification to the caller (see `qc_check`).
+    :type defer_notification: bool
+    :return: The QC check result, or None if QC metrics couldn't be collected or the run was claimed by another worker.
+    :rtype: Optional[dict[str, object]]
+    """
+    if sharding.is_sharded():
+        if not sharding.acquire_run_lease(run):
+            return None
+        # Another worker may have checked the run since it was found.
+        if os.path.exists(os.path.join(run['path'], 'qc_check_complete.json')):
+            sharding.release_run_lease(run)
+            logging.info(json.dumps({"event_type": "qc_check_skipped", "sequencing_run_id": run['sequencing_run_id'], "reason": "qc_check_complete"}))
+            return None
+
+    try:
+        # The lease is released before the outcome is recorded, because the failure ledger
+        # records the mtime of the run dir, which removing the lease file changes.
+        try:
+            qc_check_result = qc_check(config, run, defer_notification=defer_notification)
+        finally:
+            sharding.release_run_lease(run)
+    except Exception as e:
+        _record_qc_check_failure(config, run, repr(e), traceback.format_exc())
+        raise
+    if qc_check_result is None:
+        _record_qc_check_failure(config, run, "QC metrics could not be collected")
+    else:
+        failure_ledger.record_success(config, run)
+
+    return qc_check_result
+
+
+def notify_qc_check_result(config, run_id, qc_check_complete_path, overall_pass_fail):
+    """
+    Send (or queue for the next digest) a notification email for a completed qc check, if enabled in the config,
+    and record the outcome in the journal.
+
+    If the email can't be sent, the qc check is left incomplete in the journal, so that the email
+    is sent again on the next scan.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param qc_check_complete_path: Path to the run's 'qc_check_complete.json' file.
+    :type qc_check_complete_path: str
+    :param overall_pass_fail: Overall result of the qc check.
+    :type overall_pass_fail: str
+    :return: None
+    :rtype: None
+    """
+    notification_emails_enabled = 'send_notification_emails' in config.get('notification', {}) and config['notification']['send_notification_emails']
+    if not notification_emails_enabled:
+        journal.record_stage(run_id, journal.COMPLETE)
+        return
+
+    notification_config = config['notification']
+    send_immediately = not notification.digest_mode_enabled(notification_config)
+    if overall_pass_fail == 'FAIL' and notification_config.get('digest_send_failures_immediately', False):
+        send_immediately = True
+    try:
+        if not send_immediately:
+            notification.queue_digest_entry(Path(qc_check_complete_path))
+            journal.record_stage(run_id, journal.NOTIFICATION_QUEUED)
+            logging.info(json.dumps({"event_type": "notification_queued_for_digest", "sequencing_run_id": run_id, "qc_check_result": overall_pass_fail}))
+        else:
+            send_notification_email(Path(qc_check_complete_path), notification_config)
+            journal.record_stage(run_id, journal.COMPLETE)
+            logging.info(json.dumps({"event_type": "send_notification_email_complete", "sequencing_run_id": run_id, "qc_check_result": overall_pass_fail}))
+    except Exception as e:
+        journal.record_stage(run_id, journal.NOTIFICATION_FAILED)
+        logging.error(json.dumps({"event_type": "send_notification_email_failed", "sequencing_run_id": run_id, "exception": str(e)}))
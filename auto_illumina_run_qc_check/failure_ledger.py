@@ -0,0 +1,246 @@
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import auto_illumina_run_qc_check.journal as journal
+
+
+DEFAULT_MAX_QC_CHECK_ATTEMPTS = 5
+DEFAULT_QC_CHECK_RETRY_BACKOFF_SECONDS = 300.0
+DEFAULT_QC_CHECK_RETRY_MAX_BACKOFF_SECONDS = 86400.0
+
+# Length of traceback to keep for each failure, in characters (from the end of the traceback).
+MAX_TRACEBACK_LENGTH = 8000
+
+# Failed runs, indexed by sequencing run ID.
+# Keys: ['sequencing_run_id', 'run_dir_path', 'run_dir_mtime', 'num_failures', 'timestamp_first_failure',
+#        'timestamp_last_failure', 'next_retry_time', 'quarantined', 'error', 'traceback']
+_ledger = {}
+# Path to the file that the ledger was loaded from (if any).
+_ledger_path = None
+# (inode, mtime_ns, size) of the ledger file when it was last loaded or saved, so that changes
+# made by another process (such as `failures --release`) are picked up.
+_ledger_signature = None
+_ledger_lock = threading.Lock()
+
+
+def _get_retry_settings(config):
+    """
+    Get the retry settings from the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Maximum number of attempts, backoff after the first failure, and maximum backoff.
+    :rtype: tuple[int, float, float]
+    """
+    max_attempts = max(1, int(str(config.get('max_qc_check_attempts', DEFAULT_MAX_QC_CHECK_ATTEMPTS))))
+    backoff_seconds = float(str(config.get('qc_check_retry_backoff_seconds', DEFAULT_QC_CHECK_RETRY_BACKOFF_SECONDS)))
+    max_backoff_seconds = float(str(config.get('qc_check_retry_max_backoff_seconds', DEFAULT_QC_CHECK_RETRY_MAX_BACKOFF_SECONDS)))
+
+    return max_attempts, backoff_seconds, max_backoff_seconds
+
+
+def _load_ledger(config):
+    """
+    Load the ledger from the 'failure_ledger_file' listed in the config, unless it has already been loaded
+    and the file hasn't changed since.
+    Must be called with the ledger lock held.
+    """
+    global _ledger
+    global _ledger_path
+    global _ledger_signature
+    ledger_path = config.get('failure_ledger_file', None)
+    ledger_signature = journal.get_file_signature(ledger_path) if ledger_path else None
+    if ledger_path == _ledger_path and ledger_signature == _ledger_signature:
+        return
+
+    _ledger = {}
+    _ledger_path = ledger_path
+    _ledger_signature = ledger_signature
+    if ledger_signature is not None:
+        try:
+            with open(ledger_path, 'r') as f:
+                _ledger = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(json.dumps({"event_type": "load_failure_ledger_failed", "failure_ledger_file": ledger_path, "exception": str(e)}))
+
+
+def _save_ledger():
+    """
+    Write the ledger to its file (if any). The file is replaced atomically.
+    Must be called with the ledger lock held.
+    """
+    global _ledger_signature
+    if not _ledger_path:
+        return
+
+    try:
+        journal.write_json_atomically(_ledger_path, _ledger)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "save_failure_ledger_failed", "failure_ledger_file": _ledger_path, "exception": str(e)}))
+    _ledger_signature = journal.get_file_signature(_ledger_path)
+
+
+@contextlib.contextmanager
+def _locked_ledger(config):
+    """
+    Lock the ledger, and its file (so that other processes can't change it in the meantime), then load it.
+    """
+    with _ledger_lock:
+        with journal.file_lock(config.get('failure_ledger_file', None)):
+            _load_ledger(config)
+            yield
+
+
+def _get_run_dir_mtime(run_dir_path):
+    try:
+        return os.stat(run_dir_path).st_mtime
+    except OSError as e:
+        return None
+
+
+def check_run_allowed(config, run):
+    """
+    Check whether a run may be QC checked now, based on its previous failures.
+
+    A run is not checked while it is backing off after a failure, or once it has been quarantined.
+    A quarantined run is released (and its failures forgotten) if its run directory is modified,
+    for example by re-uploading it.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path']
+    :type run: dict[str, object]
+    :return: Whether the run may be checked, and if not, the reason. One of ['backoff', 'quarantined']
+    :rtype: tuple[bool, Optional[str]]
+    """
+    run_id = run['sequencing_run_id']
+    with _locked_ledger(config):
+        entry = _ledger.get(run_id, None)
+        if entry is None:
+            return True, None
+
+        if entry['quarantined']:
+            if _get_run_dir_mtime(run['path']) != entry['run_dir_mtime']:
+                _ledger.pop(run_id)
+                _save_ledger()
+                logging.info(json.dumps({"event_type": "run_released_from_quarantine", "sequencing_run_id": run_id, "reason": "run_dir_modified"}))
+                return True, None
+            return False, 'quarantined'
+
+        if time.time() < entry['next_retry_time']:
+            return False, 'backoff'
+
+    return True, None
+
+
+def record_failure(config, run, error, traceback_text=None):
+    """
+    Record a failed QC check. The run is retried after an exponentially-increasing backoff,
+    and quarantined once it has failed 'max_qc_check_attempts' times.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path']
+    :type run: dict[str, object]
+    :param error: Description of the failure.
+    :type error: str
+    :param traceback_text: Formatted traceback, if the failure was an exception.
+    :type traceback_text: Optional[str]
+    :return: The updated ledger entry for the run.
+    :rtype: dict[str, object]
+    """
+    run_id = run['sequencing_run_id']
+    max_attempts, backoff_seconds, max_backoff_seconds = _get_retry_settings(config)
+    now = time.time()
+    with _locked_ledger(config):
+        entry = _ledger.get(run_id, None)
+        if entry is None:
+            entry = {
+                'sequencing_run_id': run_id,
+                'num_failures': 0,
+                'timestamp_first_failure': datetime.datetime.now().isoformat(),
+            }
+            _ledger[run_id] = entry
+        entry['num_failures'] += 1
+        entry['run_dir_path'] = run['path']
+        entry['run_dir_mtime'] = _get_run_dir_mtime(run['path'])
+        entry['timestamp_last_failure'] = datetime.datetime.now().isoformat()
+        entry['next_retry_time'] = now + min(max_backoff_seconds, backoff_seconds * 2 ** (entry['num_failures'] - 1))
+        entry['quarantined'] = entry['num_failures'] >= max_attempts
+        entry['error'] = error
+        entry['traceback'] = traceback_text[-MAX_TRACEBACK_LENGTH:] if traceback_text else None
+        _save_ledger()
+        entry = dict(entry)
+
+    if entry['quarantined']:
+        logging.error(json.dumps({
+            "event_type": "run_quarantined",
+            "sequencing_run_id": run_id,
+            "num_failures": entry['num_failures'],
+            "error": error,
+        }))
+    else:
+        logging.warning(json.dumps({
+            "event_type": "qc_check_retry_scheduled",
+            "sequencing_run_id": run_id,
+            "num_failures": entry['num_failures'],
+            "timestamp_next_retry": datetime.datetime.fromtimestamp(entry['next_retry_time']).isoformat(),
+            "error": error,
+        }))
+
+    return entry
+
+
+def record_success(config, run):
+    """
+    Forget any previous failures of a run, after it has been QC checked successfully.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run directory. Keys: ['sequencing_run_id']
+    :type run: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    with _locked_ledger(config):
+        if _ledger.pop(run['sequencing_run_id'], None) is not None:
+            _save_ledger()
+
+
+def get_ledger_entries(config):
+    """
+    Get the ledger entries for all runs with recorded failures.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Ledger entries, sorted by sequencing run ID.
+    :rtype: list[dict[str, object]]
+    """
+    with _locked_ledger(config):
+        entries = [dict(_ledger[run_id]) for run_id in sorted(_ledger)]
+
+    return entries
+
+
+def release_run(config, run_id):
+    """
+    Forget the failures of a run, so that it is checked again on the next scan.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: True if the run had recorded failures.
+    :rtype: bool
+    """
+    with _locked_ledger(config):
+        released = _ledger.pop(run_id, None) is not None
+        if released:
+            _save_ledger()
+
+    return released
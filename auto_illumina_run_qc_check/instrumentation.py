@@ -0,0 +1,244 @@
+import contextlib
+import http.server
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+METRIC_NAME_PREFIX = 'auto_illumina_run_qc_check_'
+
+# Upper bounds of the buckets used for phase latency histograms, in seconds.
+DEFAULT_LATENCY_BUCKETS_SECONDS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0]
+
+METRIC_DESCRIPTIONS = {
+    'phase_duration_seconds': 'Time spent in each phase of scanning and QC checking',
+    'run_dirs_seen_total': 'Directories examined while scanning run parent dirs',
+    'run_dirs_skipped_total': 'Directories skipped while scanning, by reason',
+    'runs_found_total': 'Run directories found that are ready for a QC check',
+    'qc_checks_total': 'Completed QC checks, by result',
+    'qc_checks_deferred_total': 'Runs not checked because of previous failures, by reason',
+    'run_leases_reclaimed_total': 'Run leases reclaimed from workers whose heartbeats had expired',
+    'spc_assessments_total': 'Runs assessed for drift against their instrument baselines, by verdict',
+}
+
+# Counter values, indexed by metric name, then by labels (a sorted tuple of (name, value) pairs).
+_counters = {}
+# Histograms, indexed by metric name, then by labels. Keys: ['bucket_counts', 'sum', 'count']
+_histograms = {}
+_metrics_lock = threading.Lock()
+
+_prometheus_http_server = None
+
+
+def _get_label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    """
+    Increase the value of a counter.
+
+    :param name: Counter name.
+    :type name: str
+    :param amount: Amount to increase the counter by.
+    :type amount: int
+    :return: None
+    :rtype: None
+    """
+    label_key = _get_label_key(labels)
+    with _metrics_lock:
+        counter = _counters.setdefault(name, {})
+        counter[label_key] = counter.get(label_key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """
+    Record a value in a histogram.
+
+    :param name: Histogram name.
+    :type name: str
+    :param value: Value to record.
+    :type value: float
+    :return: None
+    :rtype: None
+    """
+    label_key = _get_label_key(labels)
+    with _metrics_lock:
+        histogram = _histograms.setdefault(name, {})
+        series = histogram.get(label_key, None)
+        if series is None:
+            series = {
+                'bucket_counts': [0] * len(DEFAULT_LATENCY_BUCKETS_SECONDS),
+                'sum': 0.0,
+                'count': 0,
+            }
+            histogram[label_key] = series
+        for idx, upper_bound in enumerate(DEFAULT_LATENCY_BUCKETS_SECONDS):
+            if value <= upper_bound:
+                series['bucket_counts'][idx] += 1
+                break
+        series['sum'] += value
+        series['count'] += 1
+
+
+def record_phase_duration(phase, duration_seconds, **log_fields):
+    """
+    Record the time spent in a phase that was measured separately (eg. excluding time that a generator was suspended).
+
+    :param phase: Name of the phase.
+    :type phase: str
+    :param duration_seconds: Time spent in the phase.
+    :type duration_seconds: float
+    :return: None
+    :rtype: None
+    """
+    observe('phase_duration_seconds', duration_seconds, phase=phase)
+    log_event = {"event_type": "phase_timing", "phase": phase, "duration_seconds": round(duration_seconds, 6)}
+    log_event.update(log_fields)
+    logging.debug(json.dumps(log_event))
+
+
+class timed(contextlib.ContextDecorator):
+    """
+    Measure the time spent in a phase, as a context manager or a function decorator.
+
+    The duration is recorded in the 'phase_duration_seconds' histogram, and logged
+    as a 'phase_timing' event (at debug level).
+
+        with instrumentation.timed('interop_summary', sequencing_run_id=run_id):
+            ...
+
+        @instrumentation.timed('parse_interop_summary')
+        def parse_interop_summary(lines):
+            ...
+
+    Labels other than 'phase' are only included in the log event, not the histogram,
+    so that the number of histogram series stays small.
+    """
+    def __init__(self, phase, **log_fields):
+        self.phase = phase
+        self.log_fields = log_fields
+        self._start_times = threading.local()
+
+    def __enter__(self):
+        start_times = getattr(self._start_times, 'values', None)
+        if start_times is None:
+            start_times = []
+            self._start_times.values = start_times
+        start_times.append(time.perf_counter())
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration_seconds = time.perf_counter() - self._start_times.values.pop()
+        log_fields = dict(self.log_fields)
+        if exc_type is not None:
+            log_fields['exception'] = exc_type.__name__
+        record_phase_duration(self.phase, duration_seconds, **log_fields)
+
+        return False
+
+
+def _format_labels(label_key, extra_labels=()):
+    labels = list(label_key) + list(extra_labels)
+    if not labels:
+        return ''
+    formatted_labels = []
+    for k, v in labels:
+        v = v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formatted_labels.append(k + '="' + v + '"')
+
+    return '{' + ','.join(formatted_labels) + '}'
+
+
+def render_prometheus_text():
+    """
+    Render all counters and histograms in the Prometheus text exposition format.
+
+    :return: Metrics, in Prometheus text format.
+    :rtype: str
+    """
+    lines = []
+    with _metrics_lock:
+        for name in sorted(_counters):
+            metric_name = METRIC_NAME_PREFIX + name
+            lines.append('# HELP ' + metric_name + ' ' + METRIC_DESCRIPTIONS.get(name, name))
+            lines.append('# TYPE ' + metric_name + ' counter')
+            for label_key, value in sorted(_counters[name].items()):
+                lines.append(metric_name + _format_labels(label_key) + ' ' + str(value))
+
+        for name in sorted(_histograms):
+            metric_name = METRIC_NAME_PREFIX + name
+            lines.append('# HELP ' + metric_name + ' ' + METRIC_DESCRIPTIONS.get(name, name))
+            lines.append('# TYPE ' + metric_name + ' histogram')
+            for label_key, series in sorted(_histograms[name].items()):
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(DEFAULT_LATENCY_BUCKETS_SECONDS, series['bucket_counts']):
+                    cumulative_count += bucket_count
+                    lines.append(metric_name + '_bucket' + _format_labels(label_key, [('le', repr(upper_bound))]) + ' ' + str(cumulative_count))
+                lines.append(metric_name + '_bucket' + _format_labels(label_key, [('le', '+Inf')]) + ' ' + str(series['count']))
+                lines.append(metric_name + '_sum' + _format_labels(label_key) + ' ' + repr(series['sum']))
+                lines.append(metric_name + '_count' + _format_labels(label_key) + ' ' + str(series['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_text_file(path):
+    """
+    Write all metrics to a file in Prometheus text format (eg. for the node_exporter textfile collector).
+
+    The file is replaced atomically, so readers never see a partially-written file.
+
+    :param path: Path to the file.
+    :type path: str
+    :return: None
+    :rtype: None
+    """
+    output_dir = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=output_dir, prefix='.' + os.path.basename(path) + '.', delete=False) as f:
+        f.write(render_prometheus_text())
+        tmp_path = f.name
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+class _PrometheusRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ['/metrics', '/']:
+            self.send_error(404)
+            return
+        body = render_prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_prometheus_http_server(port, address=''):
+    """
+    Serve metrics in Prometheus text format at '/metrics', from a background thread.
+
+    Only one server is started. Later calls have no effect.
+
+    :param port: Port to listen on.
+    :type port: int
+    :param address: Address to listen on. Defaults to all interfaces.
+    :type address: str
+    :return: None
+    :rtype: None
+    """
+    global _prometheus_http_server
+    if _prometheus_http_server is not None:
+        return
+
+    _prometheus_http_server = http.server.ThreadingHTTPServer((address, port), _PrometheusRequestHandler)
+    server_thread = threading.Thread(target=_prometheus_http_server.serve_forever, name='prometheus_http_server', daemon=True)
+    server_thread.start()
+    logging.info(json.dumps({"event_type": "prometheus_http_server_started", "port": port}))
@@ -0,0 +1,756 @@
+import collections
+import json
+import logging
+import math
+import mmap
+import os
+import resource
+import signal
+import statistics
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree
+
+import auto_illumina_run_qc_check.parsers as parsers
+
+
+class InterOpError(Exception):
+    """
+    Raised when an InterOp binary file is missing, truncated, or in an unsupported format,
+    or when `interop_summary` fails.
+    """
+    pass
+
+
+Q30_THRESHOLD = 30
+NUM_UNBINNED_Q_SCORES = 50
+
+TILE_METRIC_CODE_DENSITY = 100
+TILE_METRIC_CODE_DENSITY_PF = 101
+TILE_METRIC_CODE_CLUSTER_COUNT = 102
+TILE_METRIC_CODE_CLUSTER_COUNT_PF = 103
+TILE_METRIC_CODE_PHASING_BASE = 200
+TILE_METRIC_CODE_PERCENT_ALIGNED_BASE = 300
+
+DEFAULT_INTEROP_SUMMARY_TIMEOUT_SECONDS = 1800.0
+
+# Limits the number of interop_summary processes running at once, across all qc checks.
+# Created by `_get_interop_summary_semaphore`, and replaced if the limit changes.
+_interop_summary_semaphore = None
+_interop_summary_semaphore_limit = None
+_interop_summary_semaphore_lock = threading.Lock()
+
+
+def _iter_records(path, record_format, header_size, record_size):
+    """
+    Memory-map an InterOp file and iterate over its fixed-width records.
+
+    The struct format is padded out to the record size declared in the file header,
+    so that trailing fields we don't need are skipped without being decoded.
+
+    :param path: Path to the InterOp file.
+    :type path: str
+    :param record_format: struct format for the leading fields of each record.
+    :type record_format: str
+    :param header_size: Number of header bytes preceding the first record.
+    :type header_size: int
+    :param record_size: Size of each record, in bytes.
+    :type record_size: int
+    :return: Decoded records.
+    :rtype: Iterator[tuple]
+    """
+    padding = record_size - struct.calcsize(record_format)
+    if padding < 0:
+        raise InterOpError("Record size " + str(record_size) + " too small in " + path)
+    record_struct = struct.Struct(record_format + (str(padding) + 'x' if padding else ''))
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= header_size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            records_size = ((len(mm) - header_size) // record_size) * record_size
+            with memoryview(mm) as view:
+                records = view[header_size:header_size + records_size]
+                try:
+                    yield from record_struct.iter_unpack(records)
+                finally:
+                    records.release()
+
+
+def _read_header(path, num_bytes):
+    """
+    Read the first bytes of an InterOp file.
+
+    :param path: Path to the InterOp file.
+    :type path: str
+    :param num_bytes: Number of bytes to read.
+    :type num_bytes: int
+    :return: Header bytes.
+    :rtype: bytes
+    """
+    with open(path, 'rb') as f:
+        header = f.read(num_bytes)
+    if len(header) < 2:
+        raise InterOpError("Truncated header in " + path)
+
+    return header
+
+
+def read_tile_metrics(path):
+    """
+    Read a TileMetricsOut.bin file (versions 2 and 3).
+
+    :param path: Path to the TileMetricsOut.bin file.
+    :type path: str
+    :return: Tile metrics, indexed by (lane, tile). Keys: ['density', 'density_pf', 'cluster_count', 'cluster_count_pf', 'phasing', 'prephasing', 'percent_aligned']
+    :rtype: dict[tuple[int, int], dict[str, object]]
+    """
+    def new_tile():
+        return {
+            'density': None,
+            'density_pf': None,
+            'cluster_count': None,
+            'cluster_count_pf': None,
+            'phasing': {},
+            'prephasing': {},
+            'percent_aligned': {},
+        }
+    tiles = collections.defaultdict(new_tile)
+
+    header = _read_header(path, 6)
+    version, record_size = header[0], header[1]
+    if version == 2:
+        for lane, tile, code, value in _iter_records(path, '<HHHf', 2, record_size):
+            t = tiles[(lane, tile)]
+            if code == TILE_METRIC_CODE_DENSITY:
+                t['density'] = value
+            elif code == TILE_METRIC_CODE_DENSITY_PF:
+                t['density_pf'] = value
+            elif code == TILE_METRIC_CODE_CLUSTER_COUNT:
+                t['cluster_count'] = value
+            elif code == TILE_METRIC_CODE_CLUSTER_COUNT_PF:
+                t['cluster_count_pf'] = value
+            elif TILE_METRIC_CODE_PHASING_BASE <= code < TILE_METRIC_CODE_PERCENT_ALIGNED_BASE:
+                read_number = (code - TILE_METRIC_CODE_PHASING_BASE) // 2 + 1
+                if (code - TILE_METRIC_CODE_PHASING_BASE) % 2 == 0:
+                    t['phasing'][read_number] = value
+                else:
+                    t['prephasing'][read_number] = value
+            elif TILE_METRIC_CODE_PERCENT_ALIGNED_BASE <= code < TILE_METRIC_CODE_PERCENT_ALIGNED_BASE + 100:
+                read_number = code - TILE_METRIC_CODE_PERCENT_ALIGNED_BASE + 1
+                t['percent_aligned'][read_number] = value
+    elif version == 3:
+        [tile_area] = struct.unpack('<f', header[2:6])
+        for lane, tile, code, payload in _iter_records(path, '<HIc8s', 6, record_size):
+            t = tiles[(lane, tile)]
+            if code == b't':
+                cluster_count, cluster_count_pf = struct.unpack('<ff', payload)
+                t['cluster_count'] = cluster_count
+                t['cluster_count_pf'] = cluster_count_pf
+                if tile_area > 0:
+                    t['density'] = cluster_count / tile_area
+                    t['density_pf'] = cluster_count_pf / tile_area
+            elif code == b'r':
+                read_number, percent_aligned = struct.unpack('<If', payload)
+                t['percent_aligned'][read_number] = percent_aligned
+    else:
+        raise InterOpError("Unsupported TileMetricsOut.bin version " + str(version) + ": " + path)
+
+    return dict(tiles)
+
+
+def read_error_metrics(path):
+    """
+    Read an ErrorMetricsOut.bin file (versions 3 and 4).
+
+    :param path: Path to the ErrorMetricsOut.bin file.
+    :type path: str
+    :return: Error rate by cycle, indexed by (lane, tile).
+    :rtype: dict[tuple[int, int], dict[int, float]]
+    """
+    error_rates = collections.defaultdict(dict)
+
+    header = _read_header(path, 2)
+    version, record_size = header[0], header[1]
+    if version == 3:
+        record_format = '<HHHf'
+    elif version == 4:
+        record_format = '<HIHf'
+    else:
+        raise InterOpError("Unsupported ErrorMetricsOut.bin version " + str(version) + ": " + path)
+
+    for lane, tile, cycle, error_rate in _iter_records(path, record_format, 2, record_size):
+        error_rates[(lane, tile)][cycle] = error_rate
+
+    return dict(error_rates)
+
+
+def read_q_metrics(path):
+    """
+    Read a QMetricsOut.bin file (versions 4 to 7), accumulating base counts per lane and cycle.
+
+    The per-tile histograms are not retained, since they are only ever used in aggregate.
+
+    :param path: Path to the QMetricsOut.bin file.
+    :type path: str
+    :return: Counts of bases called at >= Q30 and of all bases called, indexed by (lane, cycle).
+    :rtype: dict[tuple[int, int], list[int]]
+    """
+    counts = collections.defaultdict(lambda: [0, 0])
+
+    with open(path, 'rb') as f:
+        header = f.read(3)
+        if len(header) < 2:
+            raise InterOpError("Truncated header in " + path)
+        version, record_size = header[0], header[1]
+        header_size = 2
+        q_values = list(range(1, NUM_UNBINNED_Q_SCORES + 1))
+        if version in [5, 6, 7]:
+            has_bins = header[2] if len(header) > 2 else 0
+            header_size = 3
+            if has_bins:
+                [num_bins] = f.read(1)
+                bin_definitions = f.read(3 * num_bins)
+                header_size = 4 + 3 * num_bins
+                if version in [6, 7]:
+                    # Each bin is stored as (lower bound, upper bound, value); only the values are needed.
+                    q_values = list(bin_definitions[2::3])
+        elif version != 4:
+            raise InterOpError("Unsupported QMetricsOut.bin version " + str(version) + ": " + path)
+
+    tile_width = 'I' if version == 7 else 'H'
+    num_q_values = (record_size - struct.calcsize('<H' + tile_width + 'H')) // 4
+    if version in [4, 5] or num_q_values != len(q_values):
+        q_values = list(range(1, num_q_values + 1))
+    q30_indices = [idx for idx, q in enumerate(q_values) if q >= Q30_THRESHOLD]
+    record_format = '<H' + tile_width + 'H' + str(num_q_values) + 'I'
+
+    for record in _iter_records(path, record_format, header_size, record_size):
+        lane, cycle = record[0], record[2]
+        histogram = record[3:]
+        total = sum(histogram)
+        q30 = sum(histogram[idx] for idx in q30_indices)
+        c = counts[(lane, cycle)]
+        c[0] += q30
+        c[1] += total
+
+    return dict(counts)
+
+
+def read_extraction_metrics(path):
+    """
+    Read an ExtractionMetricsOut.bin file (versions 2 and 3).
+
+    Only the intensity of the first channel is retained.
+
+    :param path: Path to the ExtractionMetricsOut.bin file.
+    :type path: str
+    :return: First-channel intensity by (lane, tile), indexed by cycle.
+    :rtype: dict[int, dict[tuple[int, int], int]]
+    """
+    intensities = collections.defaultdict(dict)
+
+    header = _read_header(path, 3)
+    version, record_size = header[0], header[1]
+    if version == 2:
+        record_format = '<HHH4f4H'
+        header_size = 2
+        intensity_index = 7
+    elif version == 3:
+        num_channels = header[2]
+        record_format = '<HIH' + str(num_channels) + 'f' + str(num_channels) + 'H'
+        header_size = 3
+        intensity_index = 3 + num_channels
+    else:
+        raise InterOpError("Unsupported ExtractionMetricsOut.bin version " + str(version) + ": " + path)
+
+    for record in _iter_records(path, record_format, header_size, record_size):
+        lane, tile, cycle = record[0], record[1], record[2]
+        intensities[cycle][(lane, tile)] = record[intensity_index]
+
+    return dict(intensities)
+
+
+def read_empirical_phasing_metrics(path):
+    """
+    Read an EmpiricalPhasingMetricsOut.bin file (versions 1 and 2).
+
+    :param path: Path to the EmpiricalPhasingMetricsOut.bin file.
+    :type path: str
+    :return: (phasing, prephasing) weights by cycle, indexed by (lane, tile).
+    :rtype: dict[tuple[int, int], dict[int, tuple[float, float]]]
+    """
+    phasing = collections.defaultdict(dict)
+
+    header = _read_header(path, 2)
+    version, record_size = header[0], header[1]
+    if version == 1:
+        record_format = '<HHHff'
+    elif version == 2:
+        record_format = '<HIHff'
+    else:
+        raise InterOpError("Unsupported EmpiricalPhasingMetricsOut.bin version " + str(version) + ": " + path)
+
+    for lane, tile, cycle, phasing_weight, prephasing_weight in _iter_records(path, record_format, 2, record_size):
+        phasing[(lane, tile)][cycle] = (phasing_weight, prephasing_weight)
+
+    return dict(phasing)
+
+
+def read_extended_tile_metrics(path):
+    """
+    Read an ExtendedTileMetricsOut.bin file (versions 2 and 3).
+
+    Only the number of occupied clusters is retained.
+
+    :param path: Path to the ExtendedTileMetricsOut.bin file.
+    :type path: str
+    :return: Number of occupied clusters, indexed by (lane, tile).
+    :rtype: dict[tuple[int, int], float]
+    """
+    occupied_cluster_counts = {}
+
+    header = _read_header(path, 2)
+    version, record_size = header[0], header[1]
+    if version not in [2, 3]:
+        raise InterOpError("Unsupported ExtendedTileMetricsOut.bin version " + str(version) + ": " + path)
+
+    for lane, tile, cluster_count_occupied in _iter_records(path, '<HIf', 2, record_size):
+        occupied_cluster_counts[(lane, tile)] = cluster_count_occupied
+
+    return occupied_cluster_counts
+
+
+def _mean(values):
+    """
+    Mean of the non-NaN values, or NaN if there are none.
+    """
+    values = [v for v in values if v is not None and not math.isnan(v)]
+    if len(values) == 0:
+        return math.nan
+    return statistics.fmean(values)
+
+
+def _stdev(values):
+    """
+    Sample standard deviation of the non-NaN values, or NaN if there are fewer than two.
+    """
+    values = [v for v in values if v is not None and not math.isnan(v)]
+    if len(values) < 2:
+        return math.nan
+    return statistics.stdev(values)
+
+
+def _round(value, digits=2):
+    """
+    Round like the interop_summary csv output, with NaN reported as 0.
+    """
+    if value is None or math.isnan(value):
+        return 0
+    return round(value, digits)
+
+
+def _read_cycles(run_info_reads):
+    """
+    Assign absolute cycle numbers to each read.
+
+    The last cycle of each read is excluded from the 'usable' cycles, matching interop_summary.
+
+    :param run_info_reads: Reads, as parsed by `parsers.parse_run_info_xml`.
+    :type run_info_reads: list[dict[str, object]]
+    :return: (first cycle, usable cycles) for each read, indexed by read number.
+    :rtype: dict[int, tuple[int, list[int]]]
+    """
+    read_cycles = {}
+    first_cycle = 1
+    for read in run_info_reads:
+        num_cycles = read['NumCycles']
+        usable_cycles = list(range(first_cycle, first_cycle + num_cycles - 1))
+        read_cycles[read['ReadNumber']] = (first_cycle, usable_cycles)
+        first_cycle += num_cycles
+
+    return read_cycles
+
+
+def _fit_line(xs, ys):
+    """
+    Least-squares fit of a straight line, as (slope, offset), or NaNs if there are fewer than two points.
+    """
+    if len(xs) < 2:
+        return math.nan, math.nan
+    mean_x = statistics.fmean(xs)
+    mean_y = statistics.fmean(ys)
+    sum_squares_x = sum((x - mean_x) ** 2 for x in xs)
+    if sum_squares_x == 0:
+        return math.nan, math.nan
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sum_squares_x
+
+    return slope, mean_y - slope * mean_x
+
+
+def _tile_phasing_fits(tile_phasing, first_cycle, num_cycles):
+    """
+    Fit the phasing and prephasing weights of one tile against the cycle number within a read,
+    over the cycles of the read that have phasing data.
+
+    :return: (phasing slope, phasing offset, prephasing slope, prephasing offset)
+    :rtype: tuple[float, float, float, float]
+    """
+    cycles = [c for c in range(first_cycle, first_cycle + num_cycles) if c in tile_phasing]
+    xs = [c - first_cycle + 1 for c in cycles]
+    phasing_slope, phasing_offset = _fit_line(xs, [tile_phasing[c][0] for c in cycles])
+    prephasing_slope, prephasing_offset = _fit_line(xs, [tile_phasing[c][1] for c in cycles])
+
+    return phasing_slope, phasing_offset, prephasing_slope, prephasing_offset
+
+
+def _tile_error_rate(tile_error_rates, cycles):
+    """
+    Mean error rate for one tile over the cycles (of those given) that have error data.
+    """
+    return _mean([tile_error_rates[c] for c in cycles if c in tile_error_rates])
+
+
+def read_interop_metrics(run_dir):
+    """
+    Read the InterOp binary files in a run directory, and summarize them into the same
+    qc metrics dict that is produced by parsing `interop_summary` output.
+
+    Phasing/prephasing slope/offset are read from EmpiricalPhasingMetricsOut.bin, and occupancy
+    from ExtendedTileMetricsOut.bin. Not all instruments write these files; if a file isn't present,
+    the metrics that come from it are left out of 'LanesByRead'.
+
+    :param run_dir: Path to the run directory.
+    :type run_dir: str
+    :return: A dict containing the qc metrics. Keys: ['ClusterDensity', 'ErrorRate', 'IntensityCycle1', 'PercentAligned', 'PercentGtQ30', 'ProjectedTotalYield', 'YieldTotal', 'Reads', 'LanesByRead']
+    :rtype: dict[str, object]
+    """
+    interop_dir = os.path.join(run_dir, 'InterOp')
+    run_info_path = os.path.join(run_dir, 'RunInfo.xml')
+    for p in [run_info_path, interop_dir]:
+        if not os.path.exists(p):
+            raise InterOpError("Not found: " + p)
+
+    try:
+        run_info_reads = parsers.parse_run_info_xml(run_info_path)
+    except (xml.etree.ElementTree.ParseError, KeyError, ValueError) as e:
+        raise InterOpError("Failed to parse " + run_info_path + ": " + str(e))
+    read_cycles = _read_cycles(run_info_reads)
+    tile_metrics = read_tile_metrics(os.path.join(interop_dir, 'TileMetricsOut.bin'))
+    q_counts = read_q_metrics(os.path.join(interop_dir, 'QMetricsOut.bin'))
+    intensities = read_extraction_metrics(os.path.join(interop_dir, 'ExtractionMetricsOut.bin'))
+    error_metrics_path = os.path.join(interop_dir, 'ErrorMetricsOut.bin')
+    error_rates = {}
+    if os.path.exists(error_metrics_path):
+        error_rates = read_error_metrics(error_metrics_path)
+    empirical_phasing_metrics_path = os.path.join(interop_dir, 'EmpiricalPhasingMetricsOut.bin')
+    phasing = None
+    if os.path.exists(empirical_phasing_metrics_path):
+        phasing = read_empirical_phasing_metrics(empirical_phasing_metrics_path)
+    extended_tile_metrics_path = os.path.join(interop_dir, 'ExtendedTileMetricsOut.bin')
+    occupied_cluster_counts = None
+    if os.path.exists(extended_tile_metrics_path):
+        occupied_cluster_counts = read_extended_tile_metrics(extended_tile_metrics_path)
+
+    lanes = sorted(set(lane for lane, _ in tile_metrics))
+    tiles_by_lane = {lane: [k for k in tile_metrics if k[0] == lane] for lane in lanes}
+    cycles_with_q_data = set(cycle for _, cycle in q_counts)
+
+    def q_totals(lanes_to_sum, cycles):
+        q30, total = 0, 0
+        for lane in lanes_to_sum:
+            for cycle in cycles:
+                c = q_counts.get((lane, cycle), None)
+                if c:
+                    q30 += c[0]
+                    total += c[1]
+        return q30, total
+
+    read_summary = []
+    lanes_by_read = []
+    read_level_values = []
+    for read in run_info_reads:
+        read_number = read['ReadNumber']
+        first_cycle, usable_cycles = read_cycles[read_number]
+        usable_cycle_set = set(usable_cycles)
+        q30, total = q_totals(lanes, usable_cycles)
+        num_cycles_with_data = len(usable_cycle_set & cycles_with_q_data)
+        yield_total = total / 1e9
+        projected_yield = yield_total
+        if num_cycles_with_data > 0:
+            projected_yield = yield_total * len(usable_cycles) / num_cycles_with_data
+        percent_gt_q30 = 100.0 * q30 / total if total > 0 else math.nan
+        tile_keys = list(tile_metrics)
+        error_rate = _mean([_tile_error_rate(error_rates[k], usable_cycles) for k in tile_keys if k in error_rates])
+        percent_aligned = _mean([tile_metrics[k]['percent_aligned'].get(read_number, None) for k in tile_keys])
+        intensity_cycle_1 = _mean(list(intensities.get(first_cycle, {}).values()))
+        read_level_values.append({
+            'read': read,
+            'q30': q30,
+            'total': total,
+            'yield_total': yield_total,
+            'projected_yield': projected_yield,
+            'error_rate': error_rate,
+            'percent_aligned': percent_aligned,
+            'intensity_cycle_1': intensity_cycle_1,
+        })
+        read_summary.append(collections.OrderedDict([
+            ('ReadNumber', read_number),
+            ('IsIndexed', read['IsIndexed']),
+            ('YieldTotal', _round(yield_total)),
+            ('ProjectedTotalYield', _round(projected_yield)),
+            ('PercentAligned', _round(percent_aligned)),
+            ('ErrorRate', _round(error_rate)),
+            ('IntensityCycle1', float(_round(intensity_cycle_1, 0))),
+            ('PercentGtQ30', _round(percent_gt_q30)),
+        ]))
+
+        for lane in lanes:
+            lane_tiles = tiles_by_lane[lane]
+            lane_q30, lane_total = q_totals([lane], usable_cycles)
+            densities = [tile_metrics[k]['density'] for k in lane_tiles]
+            percent_pf = [
+                100.0 * tile_metrics[k]['cluster_count_pf'] / tile_metrics[k]['cluster_count']
+                for k in lane_tiles
+                if tile_metrics[k]['cluster_count'] and tile_metrics[k]['cluster_count_pf'] is not None
+            ]
+            lane_error_rates = {}
+            for label, max_cycles in [('ErrorRate', None), ('ErrorRate35', 35), ('ErrorRate75', 75), ('ErrorRate100', 100)]:
+                cycles = usable_cycles if max_cycles is None else usable_cycles[:max_cycles]
+                if max_cycles is not None and len(usable_cycles) < max_cycles:
+                    cycles = []
+                lane_error_rates[label] = [_tile_error_rate(error_rates[k], cycles) for k in lane_tiles if k in error_rates]
+            cycles_error = set()
+            for k in lane_tiles:
+                cycles_error.update(c for c in error_rates.get(k, {}) if c in usable_cycle_set)
+            lane_percent_aligned = [tile_metrics[k]['percent_aligned'].get(read_number, None) for k in lane_tiles]
+            lane_intensities = [intensities.get(first_cycle, {}).get(k, None) for k in lane_tiles]
+            density = _mean(densities)
+            reads = sum(tile_metrics[k]['cluster_count'] or 0 for k in lane_tiles)
+            reads_pf = sum(tile_metrics[k]['cluster_count_pf'] or 0 for k in lane_tiles)
+
+            lane_read = collections.OrderedDict()
+            lane_read['ReadNumber'] = read_number
+            lane_read['LaneNumber'] = lane
+            lane_read['TileCount'] = len(lane_tiles)
+            lane_read['Density'] = int(_round(density, 0))
+            lane_read['DensityDeviation'] = _round(_stdev(densities) / 1000)
+            lane_read['PercentPf'] = _round(_mean(percent_pf))
+            lane_read['PercentPfDeviation'] = _round(_stdev(percent_pf))
+            lane_read['Reads'] = int(reads)
+            lane_read['ReadsPf'] = int(reads_pf)
+            lane_read['PercentGtQ30'] = _round(100.0 * lane_q30 / lane_total if lane_total > 0 else math.nan)
+            lane_read['Yield'] = _round(lane_total / 1e9)
+            lane_read['CyclesError'] = str(len(cycles_error))
+            lane_read['PercentAligned'] = _round(_mean(lane_percent_aligned))
+            lane_read['PercentAlignedDeviation'] = _round(_stdev(lane_percent_aligned))
+            for label in ['ErrorRate', 'ErrorRate35', 'ErrorRate75', 'ErrorRate100']:
+                lane_read[label] = _round(_mean(lane_error_rates[label]))
+                lane_read[label + 'Deviation'] = _round(_stdev(lane_error_rates[label]))
+            lane_read['IntensityCycle1'] = float(_round(_mean(lane_intensities), 0))
+            lane_read['IntensityCycle1Deviation'] = float(_round(_stdev(lane_intensities), 0))
+            if phasing is not None:
+                phasing_fits = [_tile_phasing_fits(phasing[k], first_cycle, read['NumCycles']) for k in lane_tiles if k in phasing]
+                for idx, label in enumerate(['PhasingSlope', 'PhasingOffset', 'PrePhasingSlope', 'PrePhasingOffset']):
+                    lane_read[label] = _round(_mean([fit[idx] for fit in phasing_fits]), 3)
+            lane_read['ClusterDensity'] = lane_read['Density']
+            if occupied_cluster_counts is not None:
+                lane_read['Occupancy'] = _round(_mean([
+                    100.0 * occupied_cluster_counts[k] / tile_metrics[k]['cluster_count']
+                    for k in lane_tiles
+                    if k in occupied_cluster_counts and tile_metrics[k]['cluster_count']
+                ]))
+            lanes_by_read.append(lane_read)
+
+    for level, level_reads in [('NonIndexed', [r for r in read_level_values if not r['read']['IsIndexed']]),
+                               ('Total', read_level_values)]:
+        q30 = sum(r['q30'] for r in level_reads)
+        total = sum(r['total'] for r in level_reads)
+        non_indexed_reads = [r for r in level_reads if not r['read']['IsIndexed']]
+        read_summary.append(collections.OrderedDict([
+            ('ReadNumber', level),
+            ('IsIndexed', False),
+            ('YieldTotal', _round(sum(r['yield_total'] for r in level_reads))),
+            ('ProjectedTotalYield', _round(sum(r['projected_yield'] for r in level_reads))),
+            ('PercentAligned', _round(_mean([r['percent_aligned'] for r in non_indexed_reads]))),
+            ('ErrorRate', _round(_mean([r['error_rate'] for r in non_indexed_reads]))),
+            ('IntensityCycle1', float(_round(_mean([r['intensity_cycle_1'] for r in level_reads]), 0))),
+            ('PercentGtQ30', _round(100.0 * q30 / total if total > 0 else math.nan)),
+        ]))
+
+    return parsers.summarize_qc_metrics(read_summary, lanes_by_read, run_info_reads)
+
+
+def _get_interop_summary_semaphore(max_concurrent_processes):
+    """
+    Get the semaphore that limits the number of concurrent interop_summary processes.
+
+    :param max_concurrent_processes: Maximum number of concurrent processes.
+    :type max_concurrent_processes: int
+    :return: Semaphore.
+    :rtype: threading.BoundedSemaphore
+    """
+    global _interop_summary_semaphore
+    global _interop_summary_semaphore_limit
+    with _interop_summary_semaphore_lock:
+        if _interop_summary_semaphore is None or _interop_summary_semaphore_limit != max_concurrent_processes:
+            # Processes holding the old semaphore release it when they finish.
+            _interop_summary_semaphore = threading.BoundedSemaphore(max_concurrent_processes)
+            _interop_summary_semaphore_limit = max_concurrent_processes
+
+        return _interop_summary_semaphore
+
+
+def _set_resource_limits(pid, max_cpu_seconds, max_memory_mb):
+    """
+    Apply CPU time and address space limits to a running process.
+
+    Limits are applied with `prlimit` after the process has started, rather than with a
+    `preexec_fn`, because `preexec_fn` is not safe to use when qc checks run in threads.
+    """
+    if max_cpu_seconds is not None:
+        max_cpu_seconds = int(max_cpu_seconds)
+        resource.prlimit(pid, resource.RLIMIT_CPU, (max_cpu_seconds, max_cpu_seconds))
+    if max_memory_mb is not None:
+        max_memory_bytes = int(max_memory_mb) * 1024 * 1024
+        resource.prlimit(pid, resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+
+
+def _kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError as e:
+        pass
+
+
+def _exit_status_to_returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
+
+
+def run_interop_summary(run_dir, timeout_seconds=DEFAULT_INTEROP_SUMMARY_TIMEOUT_SECONDS, max_cpu_seconds=None, max_memory_mb=None, max_concurrent_processes=None):
+    """
+    Run `interop_summary` on a run directory, parsing its output as it is produced.
+
+    The output is streamed line-by-line into `parsers.parse_interop_summary`, rather than being
+    held in memory. If the process runs for longer than `timeout_seconds`, it is killed.
+
+    :param run_dir: Path to the run directory.
+    :type run_dir: str
+    :param timeout_seconds: Maximum wall time for the process. No limit if None.
+    :type timeout_seconds: Optional[float]
+    :param max_cpu_seconds: Maximum CPU time for the process (RLIMIT_CPU). No limit if None.
+    :type max_cpu_seconds: Optional[int]
+    :param max_memory_mb: Maximum address space for the process, in MB (RLIMIT_AS). No limit if None.
+    :type max_memory_mb: Optional[int]
+    :param max_concurrent_processes: Maximum number of interop_summary processes running at once. No limit if None.
+    :type max_concurrent_processes: Optional[int]
+    :return: The qc metrics, and the resources used by the process. Resource usage keys: ['wall_time_seconds', 'user_cpu_seconds', 'system_cpu_seconds', 'max_rss_mb']
+    :rtype: tuple[dict[str, object], dict[str, float]]
+    :raises InterOpError: If the process fails, or is killed because it exceeded the timeout or a resource limit.
+    :raises OSError: If the process can't be started (for example, if `interop_summary` isn't installed).
+    """
+    interop_command = [
+        'interop_summary',
+        run_dir,
+        '--csv=1',
+    ]
+
+    # The read structure is used to label each read with its role. If it can't be read,
+    # roles are determined from the index reads reported by interop_summary.
+    run_info_reads = None
+    run_info_path = os.path.join(run_dir, 'RunInfo.xml')
+    try:
+        run_info_reads = parsers.parse_run_info_xml(run_info_path)
+    except FileNotFoundError as e:
+        pass
+    except (OSError, xml.etree.ElementTree.ParseError, KeyError, ValueError) as e:
+        logging.warning(json.dumps({"event_type": "parse_run_info_xml_failed", "run_info_xml_path": run_info_path, "exception": str(e)}))
+
+    semaphore = None
+    if max_concurrent_processes is not None:
+        semaphore = _get_interop_summary_semaphore(max_concurrent_processes)
+        semaphore.acquire()
+
+    try:
+        # stderr goes to a file, so that a process writing lots to stderr can't
+        # block while we're reading stdout.
+        with tempfile.TemporaryFile() as stderr_file:
+            start_time = time.monotonic()
+            # The process is started in its own process group, so that any processes it starts
+            # are also killed on timeout, and can't keep its stdout open.
+            process = subprocess.Popen(interop_command, stdout=subprocess.PIPE, stderr=stderr_file, text=True, start_new_session=True)
+            timed_out = threading.Event()
+            # Once the process has been reaped its pid (and process group id) can be reused by another
+            # process, so it mustn't be killed after that. Both are checked and set under the lock.
+            reap_lock = threading.Lock()
+            reaped = False
+
+            def kill_on_timeout():
+                with reap_lock:
+                    if reaped:
+                        return
+                    timed_out.set()
+                    _kill_process_group(process.pid)
+
+            timer = None
+            if timeout_seconds is not None:
+                timer = threading.Timer(timeout_seconds, kill_on_timeout)
+                timer.daemon = True
+                timer.start()
+            qc_metrics = None
+            parse_error = None
+            try:
+                try:
+                    _set_resource_limits(process.pid, max_cpu_seconds, max_memory_mb)
+                    qc_metrics = parsers.parse_interop_summary(process.stdout, run_info_reads)
+                    # Drain anything the parser didn't read, so the process isn't blocked writing.
+                    for line in process.stdout:
+                        pass
+                except (ValueError, IndexError, KeyError) as e:
+                    parse_error = e
+                except OSError as e:
+                    _kill_process_group(process.pid)
+                    raise
+                finally:
+                    process.stdout.close()
+                    # Wait for the process to exit without reaping it, so that it can't be
+                    # replaced by another process with the same pid before the timer is stopped.
+                    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+                    with reap_lock:
+                        reaped = True
+                        if timer is not None:
+                            timer.cancel()
+                        _, status, rusage = os.wait4(process.pid, 0)
+                    process.returncode = _exit_status_to_returncode(status)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            wall_time_seconds = time.monotonic() - start_time
+
+            if timed_out.is_set():
+                raise InterOpError("interop_summary timed out after " + str(timeout_seconds) + " seconds: " + run_dir)
+            if process.returncode != 0:
+                stderr_file.seek(0)
+                stderr_tail = stderr_file.read()[-1000:].decode('utf-8', errors='replace').strip()
+                raise InterOpError("interop_summary exited with code " + str(process.returncode) + ": " + stderr_tail)
+            if parse_error is not None:
+                raise InterOpError("Failed to parse interop_summary output: " + repr(parse_error))
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+
+    resource_usage = {
+        'wall_time_seconds': round(wall_time_seconds, 3),
+        'user_cpu_seconds': round(rusage.ru_utime, 3),
+        'system_cpu_seconds': round(rusage.ru_stime, 3),
+        # ru_maxrss is in kilobytes on Linux.
+        'max_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+    }
+
+    return qc_metrics, resource_usage
@@ -0,0 +1,289 @@
+import contextlib
+import datetime
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+
+
+# Stages of a qc check, in the order they are recorded.
+STARTED = 'started'
+METRICS_WRITTEN = 'metrics_written'
+VERDICT_WRITTEN = 'verdict_written'
+NOTIFICATION_QUEUED = 'notification_queued'
+COMPLETE = 'complete'
+# Recorded instead of NOTIFICATION_QUEUED or COMPLETE if the notification couldn't be sent or queued.
+NOTIFICATION_FAILED = 'notification_failed'
+# Recorded if the qc check failed before writing its verdict, or its verdict was lost, so the run has to be checked again.
+CHECK_FAILED = 'check_failed'
+
+STAGES = [STARTED, METRICS_WRITTEN, VERDICT_WRITTEN, NOTIFICATION_FAILED, NOTIFICATION_QUEUED, COMPLETE, CHECK_FAILED]
+# Stages after which there is nothing left to resume, so the check is dropped from the journal.
+FINAL_STAGES = [COMPLETE, CHECK_FAILED]
+
+_journal_path = None
+_journal_file = None
+# Most recent journal entry for each run that hasn't completed, indexed by sequencing run ID.
+_incomplete_checks = {}
+_journal_lock = threading.Lock()
+
+
+def _fsync_dir(dir_path):
+    """
+    Flush a directory entry to disk, so that a file created or renamed in it survives a crash.
+    """
+    try:
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+    except OSError as e:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError as e:
+        # Some filesystems don't support fsync on directories.
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def write_file_atomically(path, content):
+    """
+    Write a file so that readers (and a restart after a crash) see either the old contents or the
+    complete new contents, never a partially-written file.
+
+    The content is written to a temporary file in the same directory, flushed to disk, then renamed over the original.
+
+    :param path: Path to the file.
+    :type path: str
+    :param content: Contents of the file.
+    :type content: str
+    :return: None
+    :rtype: None
+    """
+    output_dir = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=output_dir, prefix='.' + os.path.basename(path) + '.', suffix='.tmp', delete=False) as f:
+        tmp_path = f.name
+        try:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException as e:
+            f.close()
+            os.unlink(tmp_path)
+            raise
+    os.chmod(tmp_path, 0o644)
+    try:
+        os.replace(tmp_path, path)
+    except BaseException as e:
+        os.unlink(tmp_path)
+        raise
+    _fsync_dir(output_dir)
+
+
+def write_json_atomically(path, data):
+    """
+    Write an object to a json file, atomically (see `write_file_atomically`).
+
+    :param path: Path to the file.
+    :type path: str
+    :param data: Object to write.
+    :type data: object
+    :return: None
+    :rtype: None
+    """
+    write_file_atomically(path, json.dumps(data, indent=2) + "\n")
+
+
+def get_file_signature(path):
+    """
+    Get a signature for a file that changes whenever it is modified or replaced (for example,
+    by `write_file_atomically` in another process).
+
+    :param path: Path to the file.
+    :type path: str
+    :return: (inode, mtime_ns, size) of the file, or None if it doesn't exist.
+    :rtype: Optional[tuple[int, int, int]]
+    """
+    try:
+        stat_result = os.stat(path)
+    except OSError as e:
+        return None
+
+    return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on a file shared with other processes (for example, the CLI and a running
+    daemon), while it is read, modified and written. The lock is taken on a separate '<path>.lock' file,
+    because files written with `write_file_atomically` are replaced rather than modified.
+
+    If the lock file can't be opened, a warning is logged and the caller proceeds without the lock.
+
+    :param path: Path to the file to lock. Nothing is locked if this is empty.
+    :type path: Optional[str]
+    :return: Context manager that holds the lock.
+    :rtype: ContextManager[None]
+    """
+    if not path:
+        yield
+        return
+
+    lock_path = path + '.lock'
+    try:
+        lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        logging.warning(json.dumps({"event_type": "open_lock_file_failed", "lock_file": lock_path, "exception": str(e)}))
+        yield
+        return
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(lock_fd)
+
+
+def _read_journal(journal_path):
+    """
+    Read a journal file, and find the most recent entry for each run that hasn't reached a final stage.
+
+    A partially-written final line (from a crash while it was being written) is ignored.
+
+    :param journal_path: Path to the journal file.
+    :type journal_path: str
+    :return: Most recent journal entry for each incomplete run, indexed by sequencing run ID.
+    :rtype: dict[str, dict[str, object]]
+    """
+    incomplete_checks = {}
+    with open(journal_path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError as e:
+                logging.warning(json.dumps({"event_type": "journal_entry_ignored", "journal_file": journal_path, "exception": str(e)}))
+                continue
+            if entry.get('stage', None) in FINAL_STAGES:
+                incomplete_checks.pop(entry['sequencing_run_id'], None)
+            else:
+                incomplete_checks[entry['sequencing_run_id']] = entry
+
+    return incomplete_checks
+
+
+def open_journal(journal_path):
+    """
+    Open the journal, creating it if it doesn't exist.
+
+    Existing entries are read to find the checks that didn't complete. The journal is then
+    compacted, so that it only holds the most recent entry for each of those checks.
+    If the journal is already open at the same path, this has no effect.
+
+    :param journal_path: Path to the journal file.
+    :type journal_path: str
+    :return: True if the journal was opened, False if it was already open.
+    :rtype: bool
+    """
+    global _journal_path
+    global _journal_file
+    global _incomplete_checks
+    with _journal_lock:
+        if _journal_file is not None and _journal_path == journal_path:
+            return False
+        if _journal_file is not None:
+            _journal_file.close()
+            _journal_file = None
+
+        incomplete_checks = {}
+        if os.path.exists(journal_path):
+            incomplete_checks = _read_journal(journal_path)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+        write_file_atomically(journal_path, "".join(json.dumps(entry) + "\n" for entry in incomplete_checks.values()))
+
+        _journal_file = open(journal_path, 'a')
+        _journal_path = journal_path
+        _incomplete_checks = incomplete_checks
+
+    logging.info(json.dumps({"event_type": "journal_opened", "journal_file": os.path.abspath(journal_path), "num_incomplete_qc_checks": len(incomplete_checks)}))
+
+    return True
+
+
+def close_journal():
+    """
+    Close the journal, if it is open.
+
+    :return: None
+    :rtype: None
+    """
+    global _journal_path
+    global _journal_file
+    with _journal_lock:
+        if _journal_file is not None:
+            _journal_file.close()
+        _journal_file = None
+        _journal_path = None
+        _incomplete_checks.clear()
+
+
+def record_stage(run_id, stage, run_dir_path=None):
+    """
+    Record that a qc check has reached a stage. The entry is flushed to disk before returning.
+    Has no effect if the journal isn't open.
+
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param stage: Stage that the qc check has reached. One of `STAGES`.
+    :type stage: str
+    :param run_dir_path: Path to the run directory.
+    :type run_dir_path: Optional[str]
+    :return: None
+    :rtype: None
+    """
+    with _journal_lock:
+        if _journal_file is None:
+            return
+        entry = {
+            'sequencing_run_id': run_id,
+            'stage': stage,
+            'timestamp': datetime.datetime.now().isoformat(),
+        }
+        if run_dir_path is None and run_id in _incomplete_checks:
+            run_dir_path = _incomplete_checks[run_id].get('run_dir_path', None)
+        if run_dir_path is not None:
+            entry['run_dir_path'] = run_dir_path
+        _journal_file.write(json.dumps(entry) + "\n")
+        _journal_file.flush()
+        os.fsync(_journal_file.fileno())
+        if stage in FINAL_STAGES:
+            _incomplete_checks.pop(run_id, None)
+        else:
+            _incomplete_checks[run_id] = entry
+
+
+def get_stage(run_id):
+    """
+    Get the most recent stage recorded for a qc check that hasn't completed.
+
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: The stage, or None if the journal isn't open or there is no incomplete check for the run.
+    :rtype: Optional[str]
+    """
+    with _journal_lock:
+        entry = _incomplete_checks.get(run_id, None)
+
+    return entry['stage'] if entry is not None else None
+
+
+def get_incomplete_checks():
+    """
+    Get the most recent journal entry for each qc check that hasn't completed.
+
+    :return: Journal entries. Keys: ['sequencing_run_id', 'stage', 'timestamp', 'run_dir_path']
+    :rtype: list[dict[str, object]]
+    """
+    with _journal_lock:
+        return [dict(entry) for entry in _incomplete_checks.values()]
@@ -0,0 +1,221 @@
+import os
+import sqlite3
+
+import auto_illumina_run_qc_check.thresholds as thresholds
+
+
+def open_metrics_store_db(metrics_store_db_path: str) -> sqlite3.Connection:
+    """
+    Open (and initialize, if needed) the metrics store database.
+
+    Metrics are stored in long format (one row per run & metric), with the instrument ID and
+    run date alongside each value so that time series for an instrument can be read from a single index.
+    Lane-level metrics are stored in the same way, with one row per run, read role, lane & metric.
+
+    :param metrics_store_db_path: Path to the sqlite database file.
+    :type metrics_store_db_path: str
+    :return: A connection to the metrics store database.
+    :rtype: sqlite3.Connection
+    """
+    metrics_store_db_dir = os.path.dirname(os.path.abspath(metrics_store_db_path))
+    os.makedirs(metrics_store_db_dir, exist_ok=True)
+    # Several qc checks may write to the store at once.
+    conn = sqlite3.connect(metrics_store_db_path, timeout=30.0)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS run_metric ("
+        " sequencing_run_id TEXT NOT NULL,"
+        " instrument_id TEXT NOT NULL,"
+        " instrument_type TEXT NOT NULL,"
+        " run_date TEXT NOT NULL,"
+        " metric TEXT NOT NULL,"
+        " value REAL,"
+        " PRIMARY KEY (sequencing_run_id, metric)"
+        ")"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS run_metric_by_instrument"
+        " ON run_metric (metric, instrument_id, run_date)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS run_metric_by_instrument_type"
+        " ON run_metric (metric, instrument_type, run_date)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS lane_metric ("
+        " sequencing_run_id TEXT NOT NULL,"
+        " instrument_id TEXT NOT NULL,"
+        " instrument_type TEXT NOT NULL,"
+        " run_date TEXT NOT NULL,"
+        " read_role TEXT NOT NULL,"
+        " lane_number INTEGER NOT NULL,"
+        " metric TEXT NOT NULL,"
+        " value REAL,"
+        " PRIMARY KEY (sequencing_run_id, read_role, lane_number, metric)"
+        ")"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS lane_metric_by_instrument"
+        " ON lane_metric (instrument_id, run_date)"
+    )
+    conn.commit()
+
+    return conn
+
+
+def store_run_metrics(conn: sqlite3.Connection, run: dict[str, object], qc_metrics: dict[str, object]):
+    """
+    Store the run-level and lane-level metrics for a run, replacing any previously stored for the same run.
+
+    Only numeric run-level metrics (see `thresholds.RUN_LEVEL_METRICS`) and lane-level metrics
+    (see `thresholds.LANE_LEVEL_METRICS`) are stored. Lanes of reads without a read role aren't stored.
+
+    :param conn: Connection to the metrics store database.
+    :type conn: sqlite3.Connection
+    :param run: Run. Keys: ['sequencing_run_id', 'instrument_id', 'instrument_type', 'run_date']
+    :type run: dict[str, object]
+    :param qc_metrics: QC metrics, as produced by `parsers.parse_interop_summary`.
+    :type qc_metrics: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    rows = []
+    for metric in thresholds.RUN_LEVEL_METRICS:
+        value = qc_metrics.get(metric, None)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            rows.append((run['sequencing_run_id'], run['instrument_id'], run['instrument_type'], run['run_date'], metric, value))
+
+    lane_rows = []
+    for lane_read in qc_metrics.get('LanesByRead', []):
+        read_role = lane_read.get('Role', None)
+        lane_number = lane_read.get('LaneNumber', None)
+        if read_role is None or not isinstance(lane_number, int):
+            continue
+        for metric in thresholds.LANE_LEVEL_METRICS:
+            value = lane_read.get(metric, None)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lane_rows.append((run['sequencing_run_id'], run['instrument_id'], run['instrument_type'], run['run_date'], read_role, lane_number, metric, value))
+
+    with conn:
+        conn.execute("DELETE FROM run_metric WHERE sequencing_run_id = ?", (run['sequencing_run_id'],))
+        conn.executemany(
+            "INSERT INTO run_metric (sequencing_run_id, instrument_id, instrument_type, run_date, metric, value) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.execute("DELETE FROM lane_metric WHERE sequencing_run_id = ?", (run['sequencing_run_id'],))
+        conn.executemany(
+            "INSERT INTO lane_metric (sequencing_run_id, instrument_id, instrument_type, run_date, read_role, lane_number, metric, value) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            lane_rows,
+        )
+
+
+def query_metric_time_series(conn: sqlite3.Connection, metric: str, instrument_id=None, instrument_type=None, start_date=None, end_date=None):
+    """
+    Get the values of a metric over time, ordered by run date.
+
+    :param conn: Connection to the metrics store database.
+    :type conn: sqlite3.Connection
+    :param metric: Name of the metric (eg. 'PercentGtQ30').
+    :type metric: str
+    :param instrument_id: Only include runs from this instrument (eg. 'VH00123').
+    :type instrument_id: Optional[str]
+    :param instrument_type: Only include runs from this type of instrument. One of ['miseq', 'nextseq']
+    :type instrument_type: Optional[str]
+    :param start_date: Only include runs on or after this date (YYYY-MM-DD).
+    :type start_date: Optional[str]
+    :param end_date: Only include runs on or before this date (YYYY-MM-DD).
+    :type end_date: Optional[str]
+    :return: Time series. Keys: ['run_date', 'sequencing_run_id', 'instrument_id', 'metric', 'value']
+    :rtype: list[dict[str, object]]
+    """
+    query = "SELECT run_date, sequencing_run_id, instrument_id, metric, value FROM run_metric WHERE metric = ?"
+    params = [metric]
+    if instrument_id is not None:
+        query += " AND instrument_id = ?"
+        params.append(instrument_id)
+    if instrument_type is not None:
+        query += " AND instrument_type = ?"
+        params.append(instrument_type)
+    if start_date is not None:
+        query += " AND run_date >= ?"
+        params.append(start_date)
+    if end_date is not None:
+        query += " AND run_date <= ?"
+        params.append(end_date)
+    query += " ORDER BY instrument_id, run_date, sequencing_run_id"
+
+    time_series = []
+    for run_date, sequencing_run_id, row_instrument_id, row_metric, value in conn.execute(query, params):
+        time_series.append({
+            'run_date': run_date,
+            'sequencing_run_id': sequencing_run_id,
+            'instrument_id': row_instrument_id,
+            'metric': row_metric,
+            'value': value,
+        })
+
+    return time_series
+
+
+def query_lane_metric_history(conn: sqlite3.Connection, run: dict[str, object], num_runs: int, metrics: list[str]):
+    """
+    Get the lane-level metrics of the most recent previous runs on the same instrument.
+
+    Runs on or before the run's date are included (not including the run itself), so that
+    backfilled runs are only compared with the runs before them.
+
+    :param conn: Connection to the metrics store database.
+    :type conn: sqlite3.Connection
+    :param run: Run. Keys: ['sequencing_run_id', 'instrument_id', 'run_date']
+    :type run: dict[str, object]
+    :param num_runs: Maximum number of previous runs to include.
+    :type num_runs: int
+    :param metrics: Lane-level metrics to include.
+    :type metrics: list[str]
+    :return: Values for all lanes of the previous runs, indexed by (read role, metric).
+    :rtype: dict[tuple[str, str], list[float]]
+    """
+    query = (
+        "SELECT read_role, metric, value FROM lane_metric"
+        " WHERE sequencing_run_id IN ("
+        "  SELECT DISTINCT sequencing_run_id FROM lane_metric"
+        "  WHERE instrument_id = ? AND run_date <= ? AND sequencing_run_id != ?"
+        "  ORDER BY run_date DESC, sequencing_run_id DESC LIMIT ?"
+        " )"
+        " AND metric IN (" + ", ".join(["?"] * len(metrics)) + ")"
+    )
+    params = [run['instrument_id'], run['run_date'], run['sequencing_run_id'], num_runs] + list(metrics)
+
+    lane_history = {}
+    for read_role, metric, value in conn.execute(query, params):
+        if value is not None:
+            lane_history.setdefault((read_role, metric), []).append(value)
+
+    return lane_history
+
+
+def add_rolling_mean(time_series: list[dict[str, object]], window: int):
+    """
+    Add the rolling mean of the previous `window` values (including the current one) to each
+    point in a time series. The rolling mean is calculated separately for each instrument.
+
+    :param time_series: Time series, as produced by `query_metric_time_series`. Updated in place.
+    :type time_series: list[dict[str, object]]
+    :param window: Number of runs to include in the rolling mean.
+    :type window: int
+    :return: The time series, with 'rolling_mean' added to each point.
+    :rtype: list[dict[str, object]]
+    """
+    values_by_instrument = {}
+    sums_by_instrument = {}
+    for point in time_series:
+        instrument_id = point['instrument_id']
+        values = values_by_instrument.setdefault(instrument_id, [])
+        values.append(point['value'])
+        sums_by_instrument[instrument_id] = sums_by_instrument.get(instrument_id, 0.0) + point['value']
+        if len(values) > window:
+            sums_by_instrument[instrument_id] -= values[-window - 1]
+        point['rolling_mean'] = sums_by_instrument[instrument_id] / min(len(values), window)
+
+    return time_series
@@ -1,68 +1,327 @@
 import argparse
-import datetime
 import glob
 import json
 import logging
 import os
+import threading
+import time
 import uuid
 
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
-from jinja2 import Environment, Template
-from jinja2 import BaseLoader
-from importlib.resources import files
+from jinja2 import Environment
+from jinja2 import ChoiceLoader, FileSystemLoader, PackageLoader
+from jinja2 import FileSystemBytecodeCache
+
+import auto_illumina_run_qc_check.instrumentation as instrumentation
+import auto_illumina_run_qc_check.journal as journal
 
 from auto_illumina_run_qc_check.config import load_config
 
 
+DEFAULT_HTTP_TIMEOUT_SECONDS = 30.0
+DEFAULT_HTTP_MAX_RETRIES = 4
+DEFAULT_HTTP_RETRY_BACKOFF_SECONDS = 1.0
+DEFAULT_HTTP_RETRY_MAX_BACKOFF_SECONDS = 60.0
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# Access tokens are refreshed this long before they expire.
+ACCESS_TOKEN_EXPIRY_MARGIN_SECONDS = 60.0
+
+_session = None
+_session_lock = threading.Lock()
+_access_token_cache = {}
+_access_token_cache_lock = threading.Lock()
+# Locks held while a new access token is requested, indexed by (auth_url, client_id), so that threads which need
+# a token from the same auth service at the same time wait for a single request, without holding up the others.
+_access_token_request_locks = {}
+
+DEFAULT_EMAIL_TEMPLATE = 'qc_check_complete_email.html'
+DEFAULT_DIGEST_EMAIL_TEMPLATE = 'qc_check_digest_email.html'
+
+# Template environments, indexed by (template_dir, template_bytecode_cache_dir).
+_template_environments = {}
+_template_environments_lock = threading.Lock()
+
+# Completed qc checks waiting to be sent in the next digest email.
+_digest_entries = []
+_digest_lock = threading.Lock()
+_digest_window_started = None
+
+
+def _get_session():
+    """
+    Get the shared HTTP session, creating it if needed.
+    The session keeps connections to the auth and email services open between requests.
+
+    :return: The shared HTTP session.
+    :rtype: requests.Session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+
+    return _session
+
+
+def _get_retry_delay_seconds(response, attempt, backoff_seconds, max_backoff_seconds=DEFAULT_HTTP_RETRY_MAX_BACKOFF_SECONDS):
+    """
+    Determine how long to wait before retrying a request.
+    Honours a numeric 'Retry-After' header if one was sent, otherwise uses exponential backoff.
+    Either way, the delay is no longer than `max_backoff_seconds`.
+
+    :param response: The response to the failed request, if there was one.
+    :type response: Optional[requests.Response]
+    :param attempt: The number of attempts made so far.
+    :type attempt: int
+    :param backoff_seconds: Base backoff delay.
+    :type backoff_seconds: float
+    :param max_backoff_seconds: Longest delay.
+    :type max_backoff_seconds: float
+    :return: Delay before the next attempt, in seconds.
+    :rtype: float
+    """
+    if response is not None:
+        retry_after = response.headers.get('Retry-After', None)
+        try:
+            if retry_after is not None:
+                return min(max(0.0, float(retry_after)), max_backoff_seconds)
+        except ValueError as e:
+            pass
+
+    return min(backoff_seconds * (2 ** (attempt - 1)), max_backoff_seconds)
+
+
+def _post_with_retries(url: str, notification_config: dict, **kwargs):
+    """
+    POST to a URL using the shared session, retrying with exponential backoff
+    on connection errors, timeouts, and 429/5xx responses.
+
+    :param url: The URL to POST to.
+    :type url: str
+    :param notification_config: Notification config. Optional keys: ['http_timeout_seconds', 'http_max_retries', 'http_retry_backoff_seconds', 'http_retry_max_backoff_seconds']
+    :type notification_config: dict
+    :return: The last response received.
+    :rtype: requests.Response
+    :raises requests.exceptions.RequestException: If the final attempt fails with a connection error or timeout.
+    """
+    session = _get_session()
+    timeout = float(notification_config.get('http_timeout_seconds', DEFAULT_HTTP_TIMEOUT_SECONDS))
+    max_retries = int(notification_config.get('http_max_retries', DEFAULT_HTTP_MAX_RETRIES))
+    backoff_seconds = float(notification_config.get('http_retry_backoff_seconds', DEFAULT_HTTP_RETRY_BACKOFF_SECONDS))
+    max_backoff_seconds = float(notification_config.get('http_retry_max_backoff_seconds', DEFAULT_HTTP_RETRY_MAX_BACKOFF_SECONDS))
+
+    attempt = 0
+    while True:
+        attempt += 1
+        response = None
+        try:
+            with instrumentation.timed('notification_http_request', url=url, attempt=attempt):
+                response = session.post(url, timeout=timeout, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES or attempt > max_retries:
+                return response
+            reason = "status_code_" + str(response.status_code)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt > max_retries:
+                raise
+            reason = type(e).__name__
+
+        delay_seconds = _get_retry_delay_seconds(response, attempt, backoff_seconds, max_backoff_seconds)
+        logging.warning(json.dumps({
+            'event_type': 'http_request_retry',
+            'url': url,
+            'attempt': attempt,
+            'reason': reason,
+            'retry_delay_seconds': delay_seconds,
+        }))
+        time.sleep(delay_seconds)
+
+
+def _invalidate_access_token(email_config: dict):
+    """
+    Remove the cached access token for the auth service in the config, if there is one.
+
+    :param email_config: A dict containing the MCMS auth service URL and client ID.
+    :type email_config: dict
+    """
+    with _access_token_cache_lock:
+        _access_token_cache.pop((email_config['auth_url'], email_config['client_id']), None)
+
+
+def _get_cached_access_token(cache_key):
+    """
+    Get a cached access token, if there is one that hasn't expired.
+
+    :param cache_key: (auth_url, client_id)
+    :type cache_key: tuple[str, str]
+    :return: The access token, or None.
+    :rtype: Optional[str]
+    """
+    with _access_token_cache_lock:
+        cached_token = _access_token_cache.get(cache_key, None)
+        if cached_token and time.monotonic() < cached_token['expires_at']:
+            return cached_token['access_token']
+
+    return None
+
+
 def _get_access_token(email_config: dict):
     """
     Get an access token from the MCMS auth service.
 
+    Tokens are cached until shortly before they expire (according to the 'expires_in'
+    value returned by the auth service), so a new token is only requested when needed.
+    Threads that need a token from the same auth service at the same time wait for a single request,
+    rather than each requesting their own. The request (and any retries) is made without holding the
+    cache lock, so threads using other auth services, or tokens that are already cached, aren't held up.
+
     :param config: A dict containing the MCMS auth service URL, client ID, and client secret.
                    Required keys are: ['auth_url', 'client_id', 'client_secret'].
     :type config: dict
-    :return: A dict containing the access token and other info.
-             Keys are: ['access_token', 'token_type', 'expires_in', 'timestamp_token_received'].
-    :rtype: dict
+    :return: The access token.
+    :rtype: str
+    :raises requests.exceptions.RequestException: If authentication failed.
     """
     auth_url = email_config['auth_url']
     client_id = email_config['client_id']
     client_secret = email_config['client_secret']
 
-    auth = HTTPBasicAuth(client_id, client_secret)
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-    data = {
-        "client_id": client_id,
-        "grant_type": "client_credentials",
-    }
-    response = requests.post(auth_url, data=data, headers=headers, auth=auth)
-    response_json = {}
-    if response.status_code == 200:
-        response_json = response.json()
-        timestamp = datetime.datetime.now().isoformat()
-        response_json['timestamp_token_received'] = timestamp
-    else:
-        logging.error(json.dumps({
-            'event_type': 'email_authentication_failed',
-            'status_code': response.status_code,
-            'message': response.text
-        }))
-        return None
+    cache_key = (auth_url, client_id)
+    access_token = _get_cached_access_token(cache_key)
+    if access_token is not None:
+        return access_token
+
+    with _access_token_cache_lock:
+        request_lock = _access_token_request_locks.setdefault(cache_key, threading.Lock())
+    with request_lock:
+        # Another thread may have got a token while this one was waiting.
+        access_token = _get_cached_access_token(cache_key)
+        if access_token is not None:
+            return access_token
 
-    access_token = response_json['access_token']
+        auth = HTTPBasicAuth(client_id, client_secret)
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/x-www-form-urlencoded",
+        }
+        data = {
+            "client_id": client_id,
+            "grant_type": "client_credentials",
+        }
+        response = _post_with_retries(auth_url, email_config, data=data, headers=headers, auth=auth)
+        response_json = {}
+        if response.status_code == 200:
+            try:
+                response_json = response.json()
+            except ValueError as e:
+                pass
+        if not response_json.get('access_token', None):
+            logging.error(json.dumps({
+                'event_type': 'email_authentication_failed',
+                'status_code': response.status_code,
+                'message': response.text
+            }))
+            raise requests.exceptions.HTTPError("Authentication failed with status code " + str(response.status_code) + ": " + auth_url, response=response)
+
+        access_token = response_json['access_token']
+
+        expires_in = response_json.get('expires_in', None)
+        if expires_in is not None:
+            try:
+                expires_at = time.monotonic() + float(expires_in) - ACCESS_TOKEN_EXPIRY_MARGIN_SECONDS
+                with _access_token_cache_lock:
+                    _access_token_cache[cache_key] = {
+                        'access_token': access_token,
+                        'expires_at': expires_at,
+                    }
+            except ValueError as e:
+                pass
 
     return access_token
 
 
+def _get_template_environment(notification_config: dict):
+    """
+    Get the template environment for a notification config, creating it if needed.
+
+    Templates are looked up in the 'template_dir' from the config first (if set), then in
+    the templates bundled with this package. Compiled templates are cached by the environment,
+    and re-compiled if the template file's modification time changes. If 'template_bytecode_cache_dir'
+    is set, compiled templates are also cached on disk, so they don't need to be re-compiled
+    each time the notification CLI is run.
+
+    :param notification_config: Notification config. Optional keys: ['template_dir', 'template_bytecode_cache_dir']
+    :type notification_config: dict
+    :return: Template environment.
+    :rtype: jinja2.Environment
+    """
+    template_dir = notification_config.get('template_dir', None)
+    bytecode_cache_dir = notification_config.get('template_bytecode_cache_dir', None)
+    environment_key = (template_dir, bytecode_cache_dir)
+    with _template_environments_lock:
+        env = _template_environments.get(environment_key, None)
+        if env is None:
+            loaders = []
+            if template_dir:
+                loaders.append(FileSystemLoader(template_dir))
+            loaders.append(PackageLoader('auto_illumina_run_qc_check', 'templates'))
+            bytecode_cache = None
+            if bytecode_cache_dir:
+                os.makedirs(bytecode_cache_dir, exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+            env = Environment(
+                loader=ChoiceLoader(loaders),
+                bytecode_cache=bytecode_cache,
+                auto_reload=True,
+            )
+            _template_environments[environment_key] = env
+
+    return env
+
+
+def _render_template(template_name: str, template_data: dict, notification_config: dict):
+    """
+    Render a template.
+
+    :param template_name: Template file name. Templates ending in '.txt' are rendered as plain text, others as html.
+    :type template_name: str
+    :param template_data: Values available to the template.
+    :type template_data: dict
+    :param notification_config: Notification config.
+    :type notification_config: dict
+    :return: The rendered template, and the email body type. Body type is one of: ['html', 'text']
+    :rtype: tuple[str, str]
+    """
+    env = _get_template_environment(notification_config)
+    template = env.get_template(template_name)
+    body = template.render(template_data)
+    body_type = 'html'
+    if template_name.endswith('.txt'):
+        body_type = 'text'
+
+    return body, body_type
+
+
 def _prepare_email_body(email_data: dict, notification_config: dict):
     """
+    Prepare the email request body for a single completed qc check.
+
+    Runs that failed QC are rendered with the 'failed_email_template' from the config (if set),
+    otherwise the 'email_template' is used.
+
+    :param email_data: Contents of the run's qc_check_complete.json file.
+    :type email_data: dict
+    :param notification_config: Notification config. Optional keys: ['email_template', 'failed_email_template']
+    :type notification_config: dict
+    :return: Email request body.
+    :rtype: dict
     """
     message_id = str(uuid.uuid4())
     sender_email = notification_config['sender_email']
@@ -70,13 +329,11 @@ def _prepare_email_body(email_data: dict, notification_config: dict):
     sequencing_run_id = email_data['sequencing_run_id']
     subject = f"[auto-illumina-run-qc-check] QC Check Complete: {sequencing_run_id}"
 
-    template_path = files("auto_illumina_run_qc_check.templates").joinpath("qc_check_complete_email.html")
-    template_text = template_path.read_text()
+    template_name = notification_config.get('email_template', DEFAULT_EMAIL_TEMPLATE)
+    if email_data.get('overall_pass_fail', None) == 'FAIL':
+        template_name = notification_config.get('failed_email_template', template_name)
 
-    env = Environment(loader=BaseLoader())
-    template = env.from_string(template_text)
-    
-    body = template.render(email_data)
+    body, body_type = _render_template(template_name, email_data, notification_config)
     
     email_request_body = {
         "messageId": message_id,
@@ -84,7 +341,7 @@ def _prepare_email_body(email_data: dict, notification_config: dict):
         "email": {
             "to": recipients,
             "subject": subject,
-            "bodyType": "html",
+            "bodyType": body_type,
             "body": body,
         }
     }
@@ -102,18 +359,20 @@ def _collect_email_data(qc_check_complete_path):
     return email_data
     
 
-def send_notification_email(qc_check_complete_path: Path, notification_config: dict):
+def _send_email_request(email_body: dict, notification_config: dict):
     """
-    Collect relevant data from an analysis output dir
+    Send a prepared email request to the email service.
+
+    :param email_body: Email request body, as produced by `_prepare_email_body`.
+    :type email_body: dict
+    :param notification_config: Notification config.
+    :type notification_config: dict
+    :return: None
+    :rtype: None
+    :raises requests.exceptions.RequestException: If the email could not be sent.
     """
     access_token = _get_access_token(notification_config)
-    if not access_token:
-        return None
 
-    email_info = _collect_email_data(qc_check_complete_path)
-    sequencing_run_id = email_info['sequencing_run_id']
-    email_body = _prepare_email_body(email_info, notification_config)
-        
     email_url = notification_config['email_url']
     headers = {
         "Accept": "application/json",
@@ -121,9 +380,138 @@ def send_notification_email(qc_check_complete_path: Path, notification_config: d
         "Authorization": "Bearer " + access_token,
     }
 
-    response = requests.post(email_url, data=json.dumps(email_body), headers=headers)
-    
-    # print(json.dumps(response.json(), indent=2))
+    response = _post_with_retries(email_url, notification_config, data=json.dumps(email_body), headers=headers)
+    if response.status_code == 401:
+        # The cached token may have been revoked. Get a new one and try once more.
+        _invalidate_access_token(notification_config)
+        access_token = _get_access_token(notification_config)
+        headers['Authorization'] = "Bearer " + access_token
+        response = _post_with_retries(email_url, notification_config, data=json.dumps(email_body), headers=headers)
+
+    response.raise_for_status()
+
+
+def send_notification_email(qc_check_complete_path: Path, notification_config: dict):
+    """
+    Collect relevant data from an analysis output dir
+    """
+    email_info = _collect_email_data(qc_check_complete_path)
+    email_body = _prepare_email_body(email_info, notification_config)
+
+    _send_email_request(email_body, notification_config)
+
+
+def digest_mode_enabled(notification_config: dict):
+    """
+    Check whether notifications should be batched into digest emails.
+
+    :param notification_config: Notification config.
+    :type notification_config: dict
+    :return: True if digest mode is enabled.
+    :rtype: bool
+    """
+    return bool(notification_config.get('digest_mode', False))
+
+
+def queue_digest_entry(qc_check_complete_path: Path):
+    """
+    Add a completed qc check to the next digest email.
+
+    :param qc_check_complete_path: Path to the run's qc_check_complete.json file.
+    :type qc_check_complete_path: Path
+    :return: None
+    :rtype: None
+    """
+    global _digest_window_started
+    email_data = _collect_email_data(qc_check_complete_path)
+    with _digest_lock:
+        if not _digest_entries:
+            _digest_window_started = time.monotonic()
+        _digest_entries.append(email_data)
+
+
+def _prepare_digest_email_body(digest_entries: list, notification_config: dict):
+    """
+    Prepare a single email request body summarizing several completed qc checks.
+
+    :param digest_entries: Contents of the qc_check_complete.json files for each run.
+    :type digest_entries: list[dict]
+    :param notification_config: Notification config. Optional keys: ['digest_email_template']
+    :type notification_config: dict
+    :return: Email request body.
+    :rtype: dict
+    """
+    message_id = str(uuid.uuid4())
+    sender_email = notification_config['sender_email']
+    recipients = notification_config['recipient_email_addresses']
+    num_fail = len([e for e in digest_entries if e.get('overall_pass_fail', None) == 'FAIL'])
+    num_pass = len(digest_entries) - num_fail
+    subject = f"[auto-illumina-run-qc-check] QC Check Digest: {len(digest_entries)} run(s), {num_fail} failed"
+
+    template_name = notification_config.get('digest_email_template', DEFAULT_DIGEST_EMAIL_TEMPLATE)
+    template_data = {
+        'runs': digest_entries,
+        'num_pass': num_pass,
+        'num_fail': num_fail,
+    }
+    body, body_type = _render_template(template_name, template_data, notification_config)
+
+    email_request_body = {
+        "messageId": message_id,
+        "from": sender_email,
+        "email": {
+            "to": recipients,
+            "subject": subject,
+            "bodyType": body_type,
+            "body": body,
+        }
+    }
+
+    return email_request_body
+
+
+def flush_digest(notification_config: dict, force: bool=False):
+    """
+    Send all queued qc check results in a single digest email.
+
+    If 'digest_window_seconds' is set in the notification config, the digest is only sent once
+    that long has passed since the first result was queued (unless `force` is set). Otherwise
+    the digest is sent whenever this function is called.
+
+    If the email can't be sent, the results are put back in the queue to be sent with the next digest.
+
+    :param notification_config: Notification config. Optional keys: ['digest_window_seconds']
+    :type notification_config: dict
+    :param force: Send the digest even if the digest window has not yet elapsed.
+    :type force: bool
+    :return: The number of runs included in the digest that was sent (0 if none was sent).
+    :rtype: int
+    """
+    global _digest_window_started
+    digest_window_seconds = float(notification_config.get('digest_window_seconds', 0))
+    with _digest_lock:
+        if not _digest_entries:
+            return 0
+        if not force and time.monotonic() - _digest_window_started < digest_window_seconds:
+            return 0
+        digest_entries = list(_digest_entries)
+        _digest_entries.clear()
+        digest_window_started = _digest_window_started
+        _digest_window_started = None
+
+    try:
+        email_body = _prepare_digest_email_body(digest_entries, notification_config)
+        _send_email_request(email_body, notification_config)
+    except Exception as e:
+        with _digest_lock:
+            _digest_entries[:0] = digest_entries
+            _digest_window_started = digest_window_started
+        raise
+    for digest_entry in digest_entries:
+        if 'sequencing_run_id' in digest_entry:
+            journal.record_stage(digest_entry['sequencing_run_id'], journal.COMPLETE)
+
+    return len(digest_entries)
 
 
 def main(args):
@@ -0,0 +1,179 @@
+import statistics
+
+
+OUTLIER_METHODS = ['mad', 'zscore']
+
+DEFAULT_LANE_OUTLIER_METRICS = [
+    'Density',
+    'PercentPf',
+    'PercentGtQ30',
+    'PercentAligned',
+    'ErrorRate',
+    'IntensityCycle1',
+    'PhasingSlope',
+    'PrePhasingSlope',
+    'Occupancy',
+]
+DEFAULT_LANE_OUTLIER_SCORE_THRESHOLD = 3.5
+DEFAULT_LANE_OUTLIER_HISTORY_RUNS = 20
+
+# A lane is only compared with the other lanes of its read if there are at least this many of them.
+MIN_RUN_REFERENCE_VALUES = 3
+# A lane is only compared with previous runs if there are at least this many previous values.
+MIN_HISTORY_REFERENCE_VALUES = 10
+
+# Scales the median absolute deviation (or mean absolute deviation, if the MAD is zero)
+# so that robust scores are comparable with z-scores for normally-distributed values.
+MAD_SCALE = 0.6745
+MEAN_ABSOLUTE_DEVIATION_SCALE = 1.253314
+# With only a few lanes to compare with, their spread can be tiny, which would make negligible differences
+# look like outliers. The spread used for scoring is at least this fraction of the reference median (or mean).
+MIN_SCALE_FRACTION_OF_CENTER = 0.02
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _scaled_score(value, center, scale):
+    scale = max(scale, MIN_SCALE_FRACTION_OF_CENTER * abs(center))
+    if scale == 0:
+        return None
+
+    return (value - center) / scale
+
+
+def robust_score(value, reference_values):
+    """
+    Calculate the robust (median / MAD-based) score of a value, relative to a set of reference values.
+    Unlike a z-score, the score isn't distorted by other outliers among the reference values.
+
+    :param value: Value to score.
+    :type value: float
+    :param reference_values: Values to compare against.
+    :type reference_values: list[float]
+    :return: Signed score, or None if the reference values are all zero.
+    :rtype: Optional[float]
+    """
+    median = statistics.median(reference_values)
+    absolute_deviations = [abs(v - median) for v in reference_values]
+    scale = statistics.median(absolute_deviations) / MAD_SCALE
+    if scale == 0:
+        # More than half of the reference values are identical.
+        scale = MEAN_ABSOLUTE_DEVIATION_SCALE * statistics.mean(absolute_deviations)
+
+    return _scaled_score(value, median, scale)
+
+
+def z_score(value, reference_values):
+    """
+    Calculate the z-score of a value, relative to a set of reference values.
+
+    :param value: Value to score.
+    :type value: float
+    :param reference_values: Values to compare against. At least two are needed.
+    :type reference_values: list[float]
+    :return: Signed score, or None if the reference values are all zero.
+    :rtype: Optional[float]
+    """
+    mean = statistics.mean(reference_values)
+
+    return _scaled_score(value, mean, statistics.stdev(reference_values))
+
+
+SCORE_FUNCTIONS = {
+    'mad': robust_score,
+    'zscore': z_score,
+}
+
+
+def index_lane_values(lanes_by_read, metrics):
+    """
+    Index the values of each metric for each lane, by read role and metric, so that the
+    lanes of each read can be compared with each other.
+
+    :param lanes_by_read: The 'LanesByRead' list from the qc metrics dict.
+    :type lanes_by_read: list[dict[str, object]]
+    :param metrics: Lane-level metrics to include.
+    :type metrics: list[str]
+    :return: Values for each lane, indexed by (read role, metric), then by lane number. Missing and non-numeric values are omitted.
+    :rtype: dict[tuple[str, str], dict[int, float]]
+    """
+    lane_values = {}
+    for lane_read in lanes_by_read:
+        role = lane_read.get('Role', None)
+        if role is None:
+            continue
+        for metric in metrics:
+            value = lane_read.get(metric, None)
+            if _is_number(value):
+                lane_values.setdefault((role, metric), {})[lane_read.get('LaneNumber', None)] = value
+
+    return lane_values
+
+
+def add_lane_outlier_scores(qc_metrics, method='mad', metrics=None, score_threshold=DEFAULT_LANE_OUTLIER_SCORE_THRESHOLD, lane_history=None):
+    """
+    Score each lane's metrics against the other lanes of the same read (in the same run), and against previous runs.
+
+    For each metric, '<Metric>OutlierScore' (relative to the other lanes) and '<Metric>HistoricalOutlierScore'
+    (relative to previous runs) are added to each lane in 'LanesByRead', so that they can be checked with lane-level
+    qc thresholds. Scores are signed: a lane with a lower value than usual has a negative score. A score is None if
+    there aren't enough values to compare against. Lanes with a score at least `score_threshold` away from zero are
+    listed in 'LaneOutliers'.
+
+    :param qc_metrics: QC metrics, as produced by `parsers.parse_interop_summary`. Updated in place.
+    :type qc_metrics: dict[str, object]
+    :param method: Scoring method. One of ['mad', 'zscore']
+    :type method: str
+    :param metrics: Lane-level metrics to score. Defaults to `DEFAULT_LANE_OUTLIER_METRICS`.
+    :type metrics: Optional[list[str]]
+    :param score_threshold: Minimum absolute score for a lane to be listed as an outlier.
+    :type score_threshold: float
+    :param lane_history: Values of each metric for lanes in previous runs, indexed by (read role, metric), as produced by `metrics_store.query_lane_metric_history`.
+    :type lane_history: Optional[dict[tuple[str, str], list[float]]]
+    :return: The outliers found. Keys: ['ReadNumber', 'Role', 'LaneNumber', 'Metric', 'Value', 'Reference', 'Score']
+    :rtype: list[dict[str, object]]
+    """
+    if metrics is None:
+        metrics = DEFAULT_LANE_OUTLIER_METRICS
+    if lane_history is None:
+        lane_history = {}
+    score = SCORE_FUNCTIONS[method]
+    lanes_by_read = qc_metrics.get('LanesByRead', [])
+    lane_values = index_lane_values(lanes_by_read, metrics)
+
+    lane_outliers = []
+    for lane_read in lanes_by_read:
+        role = lane_read.get('Role', None)
+        lane_number = lane_read.get('LaneNumber', None)
+        for metric in metrics:
+            value = lane_read.get(metric, None)
+            reference_values_by_source = {'run': [], 'history': []}
+            if role is not None and _is_number(value):
+                reference_values_by_source['run'] = [v for n, v in lane_values.get((role, metric), {}).items() if n != lane_number]
+                reference_values_by_source['history'] = lane_history.get((role, metric), [])
+            for reference, suffix, min_reference_values in [
+                    ('run', 'OutlierScore', MIN_RUN_REFERENCE_VALUES),
+                    ('history', 'HistoricalOutlierScore', MIN_HISTORY_REFERENCE_VALUES)]:
+                reference_values = reference_values_by_source[reference]
+                metric_score = None
+                if len(reference_values) >= min_reference_values:
+                    metric_score = score(value, reference_values)
+                if metric_score is not None:
+                    metric_score = round(metric_score, 2)
+                lane_read[metric + suffix] = metric_score
+                if metric_score is not None and abs(metric_score) >= score_threshold:
+                    lane_outliers.append({
+                        'ReadNumber': lane_read.get('ReadNumber', None),
+                        'Role': role,
+                        'LaneNumber': lane_number,
+                        'Metric': metric,
+                        'Value': value,
+                        'Reference': reference,
+                        'Score': metric_score,
+                    })
+
+    qc_metrics['LaneOutliers'] = lane_outliers
+
+    return lane_outliers
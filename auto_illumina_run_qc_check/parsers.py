@@ -1,265 +1,299 @@
 import argparse
 import collections
+import copy
+import functools
+import logging
 import math
+import os
 import sys
 import re
 import json
+import xml.etree.ElementTree
+
+import auto_illumina_run_qc_check.instrumentation as instrumentation
+
+
+READ_SUMMARY_HEADER_REGEX = re.compile("^Level,")
+READ_SUMMARY_END_REGEX = re.compile("^Total,")
+LANE_SECTION_START_REGEX = re.compile("^Read (\\d+)( \\(I\\))?$")
+LANE_SECTION_HEADER_REGEX = re.compile("^Lane,")
+LANE_SECTION_END_REGEX = re.compile("^(Extracted|Called|Scored)")
+READ_LEVEL_REGEX = re.compile("^Read (\\d+)")
+
+# Maps column names in the interop_summary csv read summary section to our field names.
+READ_SUMMARY_COLUMNS = {
+    'Level': 'Level',
+    'Yield': 'YieldTotal',
+    'Projected Yield': 'ProjectedTotalYield',
+    'Aligned': 'PercentAligned',
+    'Error Rate': 'ErrorRate',
+    'Intensity C1': 'IntensityCycle1',
+    '%>=Q30': 'PercentGtQ30',
+    '% Occupied': 'Occupancy',
+}
+
+READ_SUMMARY_OUTPUT_FIELDS = [
+    'YieldTotal',
+    'ProjectedTotalYield',
+    'PercentAligned',
+    'ErrorRate',
+    'IntensityCycle1',
+    'PercentGtQ30',
+]
+
+# Maps column names in the interop_summary csv lanes-by-read sections to our field names.
+LANE_COLUMNS = {
+    'Lane': 'LaneNumber',
+    'Surface': 'Surface',
+    'Tiles': 'TileCount',
+    'Density': 'Density',
+    'Cluster PF': 'PercentPf',
+    'Legacy Phasing/Prephasing Rate': 'LegacyPhasingPrephasingRate',
+    'Phasing slope/offset': 'Phasing',
+    'Prephasing slope/offset': 'Prephasing',
+    'Reads': 'Reads',
+    'Reads PF': 'ReadsPf',
+    '%>=Q30': 'PercentGtQ30',
+    'Yield': 'Yield',
+    'Cycles Error': 'CyclesError',
+    'Aligned': 'PercentAligned',
+    'Error': 'ErrorRate',
+    'Error (35)': 'ErrorRate35',
+    'Error (75)': 'ErrorRate75',
+    'Error (100)': 'ErrorRate100',
+    '% Occupied': 'Occupancy',
+    'Intensity C1': 'IntensityCycle1',
+}
+
+# Used if a section has no header line.
+DEFAULT_READ_SUMMARY_FIELD_INDEXES = {
+    field: idx for idx, field in enumerate(READ_SUMMARY_COLUMNS.values())
+}
+DEFAULT_LANE_FIELD_INDEXES = {
+    field: idx for idx, field in enumerate(LANE_COLUMNS.values())
+}
+
+# Elements to read from RunParameters.xml for each field, by instrument type. Element
+# names are matched without namespaces. For most fields, the first non-empty element is used.
+# 'read_cycles' is read from the children of the listed element, and 'reagent_lots' is
+# collected from every element that has a 'LotNumber' child, so its tags are not listed.
+RUN_PARAMETERS_FIELDS = {
+    'flowcell_version': {'miseq': ['ReagentKitVersion'], 'nextseq': ['FlowCellVersion']},
+    'chemistry': {'miseq': ['Chemistry'], 'nextseq': ['Chemistry', 'ChemistryVersion']},
+    'instrument_serial': {'miseq': ['ScannerID'], 'nextseq': ['InstrumentSerialNumber', 'InstrumentID']},
+    'run_start_date': {'miseq': ['RunStartDate'], 'nextseq': ['RunStartDate']},
+    'read_cycles': {'miseq': ['Reads'], 'nextseq': ['PlannedReads']},
+    'reagent_lots': {},
+}
+
+# Run parameters fields with a single (string) value, which qc thresholds can match on.
+SCALAR_RUN_PARAMETERS_FIELDS = ['flowcell_version', 'chemistry', 'instrument_serial', 'run_start_date']
+
+# Number of parsed RunParameters.xml files to keep.
+RUN_PARAMETERS_CACHE_SIZE = 1024
+
+# Per-read metrics that are lifted to the top level of the qc metrics dict for each read role,
+# with the role as a suffix (eg. 'PercentGtQ30R2').
+READ_ROLE_METRICS = {
+    'R1': ['ErrorRate', 'PercentGtQ30'],
+    'R2': ['ErrorRate', 'PercentGtQ30'],
+    'I1': ['PercentGtQ30'],
+    'I2': ['PercentGtQ30'],
+}
+
+# Number of parsed RunInfo.xml files to keep.
+RUN_INFO_CACHE_SIZE = 1024
+
+
+def _nan_to_zero(value):
+    if math.isnan(value):
+        return 0
+    return value
+
+
+def _parse_average_stdev(string_value):
+    """
+    Parse an 'average +/- stdev' value, with NaN replaced by 0.
+    """
+    [average, stdev] = string_value.split(' +/- ')
+    return _nan_to_zero(float(average)), _nan_to_zero(float(stdev))
 
 
-def parse_read_summary_line(read_summary_line):
+def _parse_slash_pair(string_value):
     """
-    Parse a line from a read summary csv file into a dict.
-
-    :param read_summary_line: A line from a read summary csv file.
-    :type read_summary_line: str
-    :return: A dict containing the parsed read summary line.
-             Keys: ['ReadNumber', 'IsIndexed', 'TotalCycles', 'YieldTotal', 'ProjectedTotalYield', 'PercentAligned', 'ErrorRate', 'IntensityCycle1', 'PercentGtQ30']
-    :rtype: dict[str, object]
+    Parse a 'numerator / denominator' value, with NaN replaced by 0.
     """
-    parsed_read_summary_line = {}
-
-    read_summary_line = read_summary_line.strip().split(',')
-
-    headers_input_order = [
-        'Level',
-        'YieldTotal',
-        'ProjectedTotalYield',
-        'PercentAligned',
-        'ErrorRate',
-        'IntensityCycle1',
-        'PercentGtQ30',
-        'Occupancy',
-    ]
-
-    level_to_read_number = {
-        'Read 1': 1,
-        'Read 2': 2,
-        'Read 2 (I)': 2,
-        'Read 3 (I)': 3,
-        'Read 3': 3,
-        'Read 4': 4,
-        'Non-indexed': 'NonIndexed',
-        'Total': 'Total',
-    }
+    [numerator, denominator] = string_value.split(' / ')
+    return _nan_to_zero(float(numerator)), _nan_to_zero(float(denominator))
 
-    float_fields = [
-        'ErrorRate',
-        'PercentAligned',
-        'Occupancy',
-    ]
-
-    headers_output_order = [
-        'ReadNumber',
-        'IsIndexed',
-        'TotalCycles',
-        'YieldTotal',
-        'ProjectedTotalYield',
-        'PercentAligned',
-        'ErrorRate',
-        'IntensityCycle1',
-        'PercentGtQ30',
-    ]
-
-    for idx, header in enumerate(headers_input_order):
-        if header == 'Level':
-            parsed_read_summary_line['ReadNumber'] = level_to_read_number[read_summary_line[idx]]
-            if re.search("(I)", read_summary_line[idx]):
-                parsed_read_summary_line['IsIndexed'] = True
-            else:
-                parsed_read_summary_line['IsIndexed'] = False
-        elif header == 'IntensityC1':
-            parsed_read_summary_line[header] = int(read_summary_line[idx])
-        elif header == 'ErrorRate':
-            if read_summary_line[idx] == 'nan':
-                parsed_read_summary_line[header] = 0
-            else:
-                parsed_read_summary_line[header] = float(read_summary_line[idx])
-        else:
-            parsed_read_summary_line[header] = float(read_summary_line[idx])
 
-        parsed_read_summary_line.pop('Occupancy', None)
-        parsed_read_summary_line_ordered = collections.OrderedDict(sorted(parsed_read_summary_line.items(), key=lambda x: headers_output_order.index(x[0])))
-        
-    return parsed_read_summary_line_ordered
+def _parse_header(header_line, columns):
+    """
+    Map our field names to column indexes, based on a header line.
+
+    :param header_line: A csv header line.
+    :type header_line: str
+    :param columns: Maps column names to field names.
+    :type columns: dict[str, str]
+    :return: Column index for each field name.
+    :rtype: dict[str, int]
+    """
+    field_indexes = {}
+    for idx, column_name in enumerate(header_line.split(',')):
+        column_name = column_name.strip()
+        if column_name in columns:
+            field_indexes[columns[column_name]] = idx
+
+    return field_indexes
 
 
-def parse_read_summary(summary_lines):
+def parse_read_summary_line(read_summary_line, field_indexes=DEFAULT_READ_SUMMARY_FIELD_INDEXES):
     """
-    Parse a read summary csv file into a list of dicts.
+    Parse a line from a read summary csv file into a dict.
 
-    :param summary_lines: A list of lines from a read summary csv file.
-    :type summary_lines: list[str]
-    :return: A list of dicts containing the parsed read summary.
-             Keys: ['ReadNumber', 'IsIndexed', 'TotalCycles', 'YieldTotal', 'ProjectedTotalYield', 'PercentAligned', 'ErrorRate', 'IntensityCycle1', 'PercentGtQ30']
-    :rtype: list[dict[str, object]]
+    :param read_summary_line: A line from a read summary csv file.
+    :type read_summary_line: str
+    :param field_indexes: Column index for each field, as determined from the header line.
+    :type field_indexes: dict[str, int]
+    :return: A dict containing the parsed read summary line.
+             Keys: ['ReadNumber', 'IsIndexed', 'YieldTotal', 'ProjectedTotalYield', 'PercentAligned', 'ErrorRate', 'IntensityCycle1', 'PercentGtQ30']
+    :rtype: dict[str, object]
     """
-    read_summary = []
+    values = read_summary_line.strip().split(',')
+
+    level = values[field_indexes['Level']]
+    read_level_match = READ_LEVEL_REGEX.match(level)
+    if read_level_match:
+        read_number = int(read_level_match.group(1))
+    elif level == 'Non-indexed':
+        read_number = 'NonIndexed'
+    else:
+        read_number = level
+
+    parsed_read_summary_line = {
+        'ReadNumber': read_number,
+        'IsIndexed': '(I)' in level,
+    }
+    for field in READ_SUMMARY_OUTPUT_FIELDS:
+        value = float(values[field_indexes[field]])
+        if field == 'ErrorRate':
+            value = _nan_to_zero(value)
+        parsed_read_summary_line[field] = value
 
-    header_line_num = 0
-    for line in summary_lines:
-        header_line_num += 1
-        if re.match("^Level", line):
-            break
-    for line in summary_lines[header_line_num:]:
-            if re.match("^Total", line):
-                read_summary_line = parse_read_summary_line(line)
-                read_summary.append(read_summary_line)
-                break
-            else:
-                read_summary_line = parse_read_summary_line(line)
-                read_summary.append(read_summary_line)
-    
-    return read_summary
+    return parsed_read_summary_line
 
 
-def parse_read_line(read_line, read_number):
+def parse_read_line(read_line, read_number, field_indexes=DEFAULT_LANE_FIELD_INDEXES):
     """
-    Parse a line from a read summary csv file into a dict.
+    Parse a line from a lanes-by-read section of an interop summary csv file into a dict.
 
-    :param read_line: A line from a read summary csv file.
+    :param read_line: A line from a lanes-by-read section of an interop summary csv file.
     :type read_line: str
     :param read_number: The read number.
     :type read_number: int
+    :param field_indexes: Column index for each field, as determined from the header line.
+    :type field_indexes: dict[str, int]
     :return: A dict containing the parsed read line.
              Keys: ['ReadNumber', 'LaneNumber', 'Surface', 'TileCount', 'Density', 'DensityDeviation', 'PercentPf', 'PercentPfDeviation', 'Reads', 'ReadsPf', 'PercentGtQ30', 'Yield', 'CyclesError', 'PercentAligned', 'PercentAlignedDeviation', 'ErrorRate', 'ErrorRateDeviation', 'ErrorRate35', 'ErrorRate35Deviation', 'ErrorRate75', 'ErrorRate75Deviation', 'ErrorRate100', 'ErrorRate100Deviation', 'IntensityCycle1', 'IntensityCycle1Deviation', 'PhasingSlope', 'PhasingOffset', 'PrePhasingSlope', 'PrePhasingOffset', 'ClusterDensity', 'Occupancy']
     :rtype: dict[str, object]
     """
-    parsed_read_line = {}
+    values = [record.strip() for record in read_line.strip().split(',')]
 
-    headers_input_order = [
-        'LaneNumber',
-        'Surface',
-        'TileCount',
-        'Density',
-        'PercentPf',
-        'LegacyPhasingPrephasingRate',
-        'Phasing',
-        'Prephasing',
-        'Reads',
-        'ReadsPf',
-        'PercentGtQ30',
-        'Yield',
-        'CyclesError',
-        'PercentAligned',
-        'ErrorRate',
-        'ErrorRate35',
-        'ErrorRate75',
-        'ErrorRate100',
-        'Occupancy',
-        'IntensityCycle1',
-    ]
-
-    headers_output_order = [
-        'ReadNumber',
-        'LaneNumber',
-        'Surface',
-        'TileCount',
-        'Density',
-        'DensityDeviation',
-        'PercentPf',
-        'PercentPfDeviation',
-        'Reads',
-        'ReadsPf',
-        'PercentGtQ30',
-        'Yield',
-        'CyclesError',
-        'PercentAligned',
-        'PercentAlignedDeviation',
-        'ErrorRate',
-        'ErrorRateDeviation',
-        'ErrorRate35',
-        'ErrorRate35Deviation',
-        'ErrorRate75',
-        'ErrorRate75Deviation',
-        'ErrorRate100',
-        'ErrorRate100Deviation',
-        'IntensityCycle1',
-        'IntensityCycle1Deviation',
-        'PhasingSlope',
-        'PhasingOffset',
-        'PrePhasingSlope',
-        'PrePhasingOffset',
-        'ClusterDensity',
-        'Occupancy',
-    ]
-
-    average_stdev_fields = [
-        'PercentAligned',
-        'PercentPf',
-        'Density',
-        'ErrorRate',
-        'ErrorRate35',
-        'ErrorRate75',
-        'ErrorRate100',
-        'IntensityCycle1',
-        'Occupancy',
-    ]
-
-    slash_fields = { 
-        'Phasing': {
-            'numerator_field': 'PhasingSlope',
-            'denominator_field': 'PhasingOffset'
-        },
-        'Prephasing': {
-            'numerator_field': 'PrePhasingSlope',
-            'denominator_field': 'PrePhasingOffset'
-        },
-    }
+    def get(field):
+        return values[field_indexes[field]]
 
-    float_fields = [
-        'PercentGtQ30',
-        'Reads',
-        'ReadsPf',
-        'Yield',
-    ]
-
-    int_fields = [
-        'ReadNumber',
-        'LaneNumber',
-        'TileCount',
-    ]
-
-    read_line_list = [record.strip() for record in read_line.strip().split(',')]
-    parsed_read_line = dict(zip(headers_input_order, read_line_list))
-    parsed_read_line['ReadNumber'] = read_number
-
-    for field in average_stdev_fields:
-        string_value = parsed_read_line[field]
-        [average, stdev] = [float(value) for value in string_value.split(' +/- ')]
-        deviation_field = field + 'Deviation'
+    density, density_deviation = _parse_average_stdev(get('Density'))
+    percent_pf, percent_pf_deviation = _parse_average_stdev(get('PercentPf'))
+    phasing_slope, phasing_offset = _parse_slash_pair(get('Phasing'))
+    prephasing_slope, prephasing_offset = _parse_slash_pair(get('Prephasing'))
+    density = int(float(density * 1000))
+
+    # Fields are added in the order that they should appear in the output.
+    parsed_read_line = {}
+    parsed_read_line['ReadNumber'] = int(read_number)
+    parsed_read_line['LaneNumber'] = int(get('LaneNumber'))
+    parsed_read_line['Surface'] = get('Surface')
+    parsed_read_line['TileCount'] = int(get('TileCount'))
+    parsed_read_line['Density'] = density
+    parsed_read_line['DensityDeviation'] = density_deviation
+    parsed_read_line['PercentPf'] = percent_pf
+    parsed_read_line['PercentPfDeviation'] = percent_pf_deviation
+    parsed_read_line['Reads'] = int(float(_nan_to_zero(float(get('Reads'))) * 1000000))
+    parsed_read_line['ReadsPf'] = int(float(_nan_to_zero(float(get('ReadsPf'))) * 1000000))
+    parsed_read_line['PercentGtQ30'] = _nan_to_zero(float(get('PercentGtQ30')))
+    parsed_read_line['Yield'] = _nan_to_zero(float(get('Yield')))
+    parsed_read_line['CyclesError'] = get('CyclesError')
+    for field in ['PercentAligned', 'ErrorRate', 'ErrorRate35', 'ErrorRate75', 'ErrorRate100', 'IntensityCycle1']:
+        average, stdev = _parse_average_stdev(get(field))
         parsed_read_line[field] = average
-        parsed_read_line[deviation_field] = stdev
+        parsed_read_line[field + 'Deviation'] = stdev
+    parsed_read_line['PhasingSlope'] = phasing_slope
+    parsed_read_line['PhasingOffset'] = phasing_offset
+    parsed_read_line['PrePhasingSlope'] = prephasing_slope
+    parsed_read_line['PrePhasingOffset'] = prephasing_offset
+    parsed_read_line['ClusterDensity'] = density
+    parsed_read_line['Occupancy'], _ = _parse_average_stdev(get('Occupancy'))
 
-    for field, num_denom in slash_fields.items():
-        string_value = parsed_read_line[field]
-        numerator_field = num_denom['numerator_field']
-        denominator_field = num_denom['denominator_field']
-        [numerator, denominator] = [float(value) for value in string_value.split(' / ')]
-        parsed_read_line[numerator_field] = numerator
-        parsed_read_line[denominator_field] = denominator
-        parsed_read_line.pop(field, None)
+    return parsed_read_line
 
-    for field in float_fields:
-        parsed_read_line[field] = float(parsed_read_line[field])
 
-    for field in int_fields:
-        parsed_read_line[field] = int(parsed_read_line[field])
+def _parse_summary_sections(summary_lines):
+    """
+    Parse the read summary and lanes-by-read sections of an interop summary csv file, in a single pass.
 
-    parsed_read_line['Density'] = int(float(parsed_read_line['Density'] * 1000))
-    parsed_read_line['ClusterDensity'] = parsed_read_line['Density']
-    parsed_read_line['Reads'] = int(float(parsed_read_line['Reads'] * 1000000))
-    parsed_read_line['ReadsPf'] = int(float(parsed_read_line['ReadsPf'] * 1000000))
+    :param summary_lines: Lines from an interop summary csv file.
+    :type summary_lines: Iterable[str]
+    :return: The parsed read summary and lanes-by-read summary.
+    :rtype: tuple[list[dict[str, object]], list[dict[str, object]]]
+    """
+    read_summary = []
+    lanes_by_read = []
 
-    parsed_read_line.pop('OccupancyDeviation', None)
-    parsed_read_line.pop('LegacyPhasingPrephasingRate', None)
+    state = 'preamble'
+    read_summary_field_indexes = DEFAULT_READ_SUMMARY_FIELD_INDEXES
+    lane_field_indexes = DEFAULT_LANE_FIELD_INDEXES
+    read_number = None
+    for line in summary_lines:
+        line = line.rstrip('\r\n')
+        if state == 'preamble':
+            if READ_SUMMARY_HEADER_REGEX.match(line):
+                read_summary_field_indexes = _parse_header(line, READ_SUMMARY_COLUMNS)
+                state = 'read_summary'
+        elif state == 'read_summary':
+            read_summary.append(parse_read_summary_line(line, read_summary_field_indexes))
+            if READ_SUMMARY_END_REGEX.match(line):
+                state = 'lanes_by_read'
+        elif state == 'lanes_by_read':
+            lane_section_start_match = LANE_SECTION_START_REGEX.match(line)
+            if lane_section_start_match:
+                read_number = int(lane_section_start_match.group(1))
+            elif LANE_SECTION_END_REGEX.match(line):
+                read_number = None
+            elif LANE_SECTION_HEADER_REGEX.match(line):
+                lane_field_indexes = _parse_header(line, LANE_COLUMNS)
+            elif read_number is not None and line.strip():
+                parsed_read_line = parse_read_line(line, read_number, lane_field_indexes)
+                # Only keep the per-lane lines, not the per-surface lines.
+                if parsed_read_line['Surface'] == '-':
+                    parsed_read_line.pop('Surface', None)
+                    lanes_by_read.append(parsed_read_line)
+
+    return read_summary, lanes_by_read
 
-    for k, v in parsed_read_line.items():
-        if type(v) is float and math.isnan(v):
-            parsed_read_line[k] = 0
 
-    parsed_read_line_ordered = collections.OrderedDict(sorted(parsed_read_line.items(), key=lambda x: headers_output_order.index(x[0])))
+def parse_read_summary(summary_lines):
+    """
+    Parse a read summary csv file into a list of dicts.
+
+    :param summary_lines: A list of lines from a read summary csv file.
+    :type summary_lines: list[str]
+    :return: A list of dicts containing the parsed read summary.
+             Keys: ['ReadNumber', 'IsIndexed', 'YieldTotal', 'ProjectedTotalYield', 'PercentAligned', 'ErrorRate', 'IntensityCycle1', 'PercentGtQ30']
+    :rtype: list[dict[str, object]]
+    """
+    read_summary, _ = _parse_summary_sections(summary_lines)
 
-    return parsed_read_line_ordered
+    return read_summary
 
 
 def parse_lanes_by_read(summary_lines):
@@ -269,162 +303,101 @@ def parse_lanes_by_read(summary_lines):
     :param summary_lines: A list of lines from a read summary csv file.
     :type summary_lines: list[str]
     :return: A list of dicts containing the parsed read summary.
-             Keys: ['ReadNumber', 'LaneNumber', 'Surface', 'TileCount', 'Density', 'DensityDeviation', 'PercentPf', 'PercentPfDeviation', 'Reads', 'ReadsPf', 'PercentGtQ30', 'Yield', 'CyclesError', 'PercentAligned', 'PercentAlignedDeviation', 'ErrorRate', 'ErrorRateDeviation', 'ErrorRate35', 'ErrorRate35Deviation', 'ErrorRate75', 'ErrorRate75Deviation', 'ErrorRate100', 'ErrorRate100Deviation', 'IntensityCycle1', 'IntensityCycle1Deviation', 'PhasingSlope', 'PhasingOffset', 'PrePhasingSlope', 'PrePhasingOffset', 'ClusterDensity', 'Occupancy']
+             Keys: ['ReadNumber', 'LaneNumber', 'TileCount', 'Density', 'DensityDeviation', 'PercentPf', 'PercentPfDeviation', 'Reads', 'ReadsPf', 'PercentGtQ30', 'Yield', 'CyclesError', 'PercentAligned', 'PercentAlignedDeviation', 'ErrorRate', 'ErrorRateDeviation', 'ErrorRate35', 'ErrorRate35Deviation', 'ErrorRate75', 'ErrorRate75Deviation', 'ErrorRate100', 'ErrorRate100Deviation', 'IntensityCycle1', 'IntensityCycle1Deviation', 'PhasingSlope', 'PhasingOffset', 'PrePhasingSlope', 'PrePhasingOffset', 'ClusterDensity', 'Occupancy']
     :rtype: list[dict[str, object]]
     """
-    lanes_by_read = []
-    read_number = None
-
-    for line in summary_lines:
-        if re.match("^Read 1$", line):
-            read_number = 1
-        elif re.match("^Read 2$", line):
-            read_number = 2
-        elif re.match("^Read 2 \(I\)$", line):
-            read_number = 2
-        elif re.match("^Read 3 \(I\)$", line):
-            read_number = 3
-        elif re.match("^Read 4$", line):
-            read_number = 4
-        elif re.match("^Extracted", line) or re.match("^Called", line) or re.match("^Scored", line):
-            read_number = None
-        else:
-            pass
-
-        if read_number and not re.match("^Lane", line) and not re.match("^Read", line):
-            parsed_read_line = parse_read_line(line, read_number)
-            parsed_read_line['ReadNumber'] = read_number
-        else:
-            parsed_read_line = {}
-
-        if parsed_read_line and parsed_read_line['Surface'] == '-':
-            parsed_read_line.pop('Surface', None)
-            lanes_by_read.append(parsed_read_line)
+    _, lanes_by_read = _parse_summary_sections(summary_lines)
 
     return lanes_by_read
 
 
-def parse_run_stats(summary_lines):
+@instrumentation.timed('parse_interop_summary')
+def parse_interop_summary(summary_lines, run_info_reads=None):
     """
-    Parse a run stats csv file into a dict.
+    Parse an interop summary csv file into a dict.
 
-    :param summary_lines: A list of lines from a run stats csv file.
-    :type summary_lines: list[str]
-    :return: A dict containing the parsed run stats. Keys: ['PercentGtQ30', 'ProjectedTotalYield', 'YieldTotal', 'ErrorRate', 'PercentAligned', 'Occupancy', 'Reads']
+    The lines are only iterated over once, so they may be supplied by a generator.
+
+    :param summary_lines: Lines from an interop summary csv file.
+    :type summary_lines: Iterable[str]
+    :param run_info_reads: Reads, as parsed by `parse_run_info_xml`. Used to determine the role of each read.
+    :type run_info_reads: Optional[list[dict[str, object]]]
+    :return: A dict containing the parsed interop summary. Keys: ['ClusterDensity', 'ErrorRate', 'IntensityCycle1', 'PercentAligned', 'PercentGtQ30', 'ProjectedTotalYield', 'YieldTotal', 'Reads', 'LanesByRead']
     :rtype: dict[str, object]
     """
-    run_stats = collections.OrderedDict()
+    read_summary, lanes_by_read = _parse_summary_sections(summary_lines)
 
-    read_summary_headers = []
-    read_summary_lines = []
+    return summarize_qc_metrics(read_summary, lanes_by_read, run_info_reads)
 
-    replaced_fields = {
-        '%>=Q30': 'PercentGtQ30',
-        'Projected Yield': 'ProjectedTotalYield',
-        'Yield': 'YieldTotal',
-        'Error Rate': 'ErrorRate',
-        'Aligned': 'PercentAligned',
-        '% Occupied': 'Occupancy',
-        'Level': 'ReadNumber',
-        'Intensity C1': 'IntensityCycle1',
-    }
 
-    level_to_read_number = {
-        'Read 1': 1,
-        'Read 2': 2,
-        'Read 2 (I)': 2,
-        'Read 3 (I)': 3,
-        'Read 3': 3,
-        'Read 4': 4,
-        'Total': 'Total',
-        'Non-Indexed': 'Non-Indexed',
-    }
+def assign_read_roles(reads):
+    """
+    Assign a role to each read, based on the order of the reads and whether they are index reads.
+    Non-indexed reads are 'R1', 'R2', and index reads are 'I1', 'I2', in order of read number.
 
-    headers_output_order = [
-        'ReadNumber',
-        'IsIndexed',
-        'TotalCycles',
-        'YieldTotal',
-        'ProjectedTotalYield',
-        'PercentAligned',
-        'ErrorRate',
-        'IntensityCycle1',
-        'PercentGtQ30',
-    ]
+    :param reads: Reads. Keys: ['ReadNumber', 'IsIndexed']
+    :type reads: list[dict[str, object]]
+    :return: Role of each read, indexed by read number.
+    :rtype: dict[int, str]
+    """
+    read_roles = {}
+    num_reads_by_prefix = {'R': 0, 'I': 0}
+    for read in sorted(reads, key=lambda r: r['ReadNumber']):
+        prefix = 'I' if read['IsIndexed'] else 'R'
+        num_reads_by_prefix[prefix] += 1
+        read_roles[read['ReadNumber']] = prefix + str(num_reads_by_prefix[prefix])
 
-    for line in summary_lines:
-        if re.match("^Level", line):
-            read_summary_headers = re.split("\s*,", line.rstrip())
+    return read_roles
 
-            for idx, header in enumerate(read_summary_headers):
-                if header in replaced_fields:
-                    read_summary_headers[idx] = replaced_fields[header]
-            break
-    for line in summary_lines:
-        if re.match("^Total", line) or re.match("^Non-indexed", line):
-            # read_summary_lines.append(re.split(",", line.rstrip()))
-            break
-        else:
-            if re.match("^Read", line):
-                read_summary_lines.append(re.split(",", line.rstrip()))
 
-    read_summary = []
-    for line in read_summary_lines:
-        read_summary_line_dict = {}
-        for idx, header in enumerate(read_summary_headers):
-            if header == 'ReadNumber':
-                read_summary_line_dict[header] = level_to_read_number[line[idx]]
-                if re.search("(I)", line[idx]):
-                    read_summary_line_dict['IsIndexed'] = True
-                else:
-                    read_summary_line_dict['IsIndexed'] = False
-            elif header == 'IntensityC1':
-                read_summary_line_dict[header] = int(line[idx])
-            elif header == 'ErrorRate':
-                if line[idx] == 'nan':
-                    read_summary_line_dict[header] = 0
-                else:
-                    read_summary_line_dict[header] = float(line[idx])
-            else:
-                read_summary_line_dict[header] = float(line[idx])
-
-        read_summary_line_dict.pop('Occupancy', None)
-        read_summary_line_dict_ordered = collections.OrderedDict(sorted(read_summary_line_dict.items(), key=lambda x: headers_output_order.index(x[0])))
-
-        read_summary.append(read_summary_line_dict_ordered)
-                 
-    return run_stats
-
-
-def parse_interop_summary(summary_lines):
+def _with_role(row, role):
     """
-    Parse an interop summary csv file into a dict.
+    Copy a read or lane row, with its read role added after the read number.
+    """
+    row_with_role = {}
+    for k, v in row.items():
+        row_with_role[k] = v
+        if k == 'ReadNumber':
+            row_with_role['Role'] = role
 
-    :param summary_lines: A list of lines from an interop summary csv file.
-    :type summary_lines: list[str]
-    :return: A dict containing the parsed interop summary. Keys: ['ClusterDensity', 'ErrorRate', 'IntensityCycle1', 'PercentAligned', 'PercentGtQ30', 'ProjectedTotalYield', 'YieldTotal', 'Reads', 'LanesByRead']
+    return row_with_role
+
+
+def summarize_qc_metrics(read_summary, lanes_by_read, run_info_reads=None):
+    """
+    Combine a parsed read summary and lanes-by-read summary into the run-level qc metrics dict.
+
+    Each read (and each lane of each read) is labelled with its role ('R1', 'R2', 'I1' or 'I2'),
+    and per-read metrics are taken from the read with the matching role, so runs with
+    any number of index reads are summarized correctly. Metrics for roles that the run
+    doesn't have (eg. 'ErrorRateR2' for a single-end run) are omitted.
+
+    :param read_summary: Parsed read summary, as produced by `parse_read_summary`.
+    :type read_summary: list[dict[str, object]]
+    :param lanes_by_read: Parsed lanes-by-read summary, as produced by `parse_lanes_by_read`.
+    :type lanes_by_read: list[dict[str, object]]
+    :param run_info_reads: Reads, as parsed by `parse_run_info_xml`. If not given, read roles are determined from the read summary.
+    :type run_info_reads: Optional[list[dict[str, object]]]
+    :return: A dict containing the qc metrics. Keys: ['ErrorRateR1', 'PercentGtQ30R1', ..., 'ClusterDensity', 'ErrorRate', 'IntensityCycle1', 'PercentAligned', 'PercentGtQ30', 'ProjectedTotalYield', 'YieldTotal', 'Reads', 'LanesByRead']
     :rtype: dict[str, object]
     """
     sequencingstats = {}
-    read_summary = parse_read_summary(summary_lines)
     reads = [r for r in read_summary if isinstance(r['ReadNumber'], int)]
-
-    for r in [r for r in read_summary if r['ReadNumber'] == 1]:
-        keys = [
-            'ErrorRate',
-            'PercentGtQ30',
-        ]
+    if run_info_reads:
+        read_roles = {r['ReadNumber']: r['Role'] for r in run_info_reads}
+    else:
+        read_roles = assign_read_roles(reads)
+    reads = [_with_role(r, read_roles.get(r['ReadNumber'], None)) for r in reads]
+    lanes_by_read = [_with_role(l, read_roles.get(l['ReadNumber'], None)) for l in lanes_by_read]
+
+    reads_by_role = {r['Role']: r for r in reads if r['Role'] is not None}
+    for role, keys in READ_ROLE_METRICS.items():
+        r = reads_by_role.get(role, None)
+        if r is None:
+            continue
         for k in keys:
-            sequencingstats[k + 'R1'] = r[k]
+            sequencingstats[k + role] = r[k]
 
-    for r in [r for r in read_summary if r['ReadNumber'] == 4]:
-        keys = [
-            'ErrorRate',
-            'PercentGtQ30',
-        ]
-        for k in keys:
-            sequencingstats[k + 'R2'] = r[k]
-    
     for r in [r for r in read_summary if r['ReadNumber'] == 'NonIndexed']:
         keys = [
             'ErrorRate',
@@ -448,8 +421,6 @@ def parse_interop_summary(summary_lines):
         ]
         for k in keys:
             sequencingstats[k] = r[k]
-        
-    lanes_by_read = parse_lanes_by_read(summary_lines)
 
     # The ClusterDensity and PercentPf fields are only present in the lanes_by_read list.
     # Lift them up to the top level of the dict, to make it easier to access them as run-level metrics.
@@ -465,29 +436,199 @@ def parse_interop_summary(summary_lines):
     return sequencingstats
 
 
-def parse_run_parameters_xml(run_parameters_xml_path, instrument_type):
+def _get_local_tag(element):
     """
-    Parse a run parameters xml file into a dict.
+    Get an element's tag, without its namespace.
+    """
+    return element.tag.rpartition('}')[2]
+
+
+def _parse_read_cycles(reads_element):
+    """
+    Parse the planned reads from a 'Reads' (MiSeq) or 'PlannedReads' (NextSeq) element.
+    """
+    read_cycles = []
+    for read_element in reads_element:
+        if 'NumCycles' in read_element.attrib:
+            num_cycles = read_element.attrib['NumCycles']
+            is_indexed = read_element.attrib.get('IsIndexedRead', 'N') == 'Y'
+        elif 'Cycles' in read_element.attrib:
+            num_cycles = read_element.attrib['Cycles']
+            is_indexed = read_element.attrib.get('ReadName', '').startswith('Index')
+        else:
+            continue
+        read_cycles.append({
+            'read_number': len(read_cycles) + 1,
+            'num_cycles': int(num_cycles),
+            'is_indexed': is_indexed,
+        })
+
+    return read_cycles
+
+
+def _get_reagent_lot(element):
+    """
+    Get the reagent lot number from an element describing a consumable, if it has one.
+
+    :return: Consumable name and lot number, or None if the element doesn't include a lot number.
+    :rtype: Optional[tuple[str, str]]
+    """
+    lot_number = None
+    consumable_type = None
+    for child in element:
+        child_tag = _get_local_tag(child)
+        if child_tag == 'LotNumber' and child.text:
+            lot_number = child.text.strip()
+        elif child_tag == 'Type' and child.text:
+            consumable_type = child.text.strip()
+    if not lot_number:
+        return None
+    if consumable_type is None:
+        consumable_type = _get_local_tag(element).replace('RFIDTag', '')
+
+    return consumable_type, lot_number
+
+
+@functools.lru_cache(maxsize=RUN_PARAMETERS_CACHE_SIZE)
+def _parse_run_parameters_xml_cached(run_parameters_xml_path, file_signature, instrument_type, fields):
+    """
+    Parse a run parameters xml file. Results are cached by path and file signature,
+    so the file is only parsed again if it changes.
+
+    The file is read incrementally, and reading stops as soon as all of the requested fields have been found.
 
     :param run_parameters_xml_path: The path to the run parameters xml file.
     :type run_parameters_xml_path: str
+    :param file_signature: (mtime_ns, size) of the file. Only used as part of the cache key.
+    :type file_signature: tuple[int, int]
     :param instrument_type: The instrument type. One of ['miseq', 'nextseq'].
     :type instrument_type: str
-    :return: A dict containing the parsed run parameters. Keys: ['flowcell_version']
+    :param fields: Fields to extract. Each must be a key of `RUN_PARAMETERS_FIELDS`.
+    :type fields: tuple[str]
+    :return: Parsed run parameters. Fields that aren't found in the file are omitted.
     :rtype: dict[str, object]
     """
     run_parameters = {}
-    with open(run_parameters_xml_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if instrument_type == 'miseq':
-                if re.search("^<ReagentKitVersion>", line):
-                    version = re.search("<ReagentKitVersion>(.*)</ReagentKitVersion>", line).group(1)
-                    version_num = version.lstrip('Version')
-                    run_parameters['flowcell_version'] = version_num
-            elif instrument_type == 'nextseq':
-                if re.search("^<FlowCellVersion>", line):
-                    version_num = re.search("<FlowCellVersion>(.*)</FlowCellVersion>", line).group(1)
-                    run_parameters['flowcell_version'] = version_num
-
-    return run_parameters
+    tags_to_fields = {}
+    for field in fields:
+        for tag in RUN_PARAMETERS_FIELDS[field].get(instrument_type, []):
+            tags_to_fields.setdefault(tag, []).append(field)
+    remaining_fields = set(fields)
+    # Lots are listed as siblings, so they are only complete once their parent element ends.
+    reagent_lots_parent_depth = None
+
+    depth = 0
+    try:
+        with open(run_parameters_xml_path, 'rb') as f:
+            for event, element in xml.etree.ElementTree.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    continue
+
+                tag = _get_local_tag(element)
+                for field in tags_to_fields.get(tag, []):
+                    if field not in remaining_fields:
+                        continue
+                    if field == 'read_cycles':
+                        read_cycles = _parse_read_cycles(element)
+                        if read_cycles:
+                            run_parameters[field] = read_cycles
+                            remaining_fields.discard(field)
+                    elif element.text and element.text.strip():
+                        value = element.text.strip()
+                        if field == 'flowcell_version':
+                            value = value.lstrip('Version')
+                        run_parameters[field] = value
+                        remaining_fields.discard(field)
+
+                if 'reagent_lots' in remaining_fields:
+                    reagent_lot = _get_reagent_lot(element)
+                    if reagent_lot is not None:
+                        run_parameters.setdefault('reagent_lots', {})[reagent_lot[0]] = reagent_lot[1]
+                        if reagent_lots_parent_depth is None:
+                            reagent_lots_parent_depth = depth - 1
+                    elif depth == reagent_lots_parent_depth:
+                        remaining_fields.discard('reagent_lots')
+
+                # Children of the root element have been fully processed once they end,
+                # so they can be discarded to keep memory use flat.
+                if depth == 2:
+                    element.clear()
+                depth -= 1
+
+                if not remaining_fields:
+                    break
+    except xml.etree.ElementTree.ParseError as e:
+        logging.warning(json.dumps({
+            "event_type": "parse_run_parameters_xml_failed",
+            "run_parameters_xml_path": run_parameters_xml_path,
+            "exception": str(e),
+            "fields_found": sorted(run_parameters.keys()),
+        }))
+
+    return {field: run_parameters[field] for field in fields if field in run_parameters}
+
+
+@instrumentation.timed('parse_run_parameters_xml')
+def parse_run_parameters_xml(run_parameters_xml_path, instrument_type, fields=None):
+    """
+    Parse a run parameters xml file into a dict.
+
+    :param run_parameters_xml_path: The path to the run parameters xml file.
+    :type run_parameters_xml_path: str
+    :param instrument_type: The instrument type. One of ['miseq', 'nextseq'].
+    :type instrument_type: str
+    :param fields: Fields to extract. Defaults to all of the keys of `RUN_PARAMETERS_FIELDS`.
+    :type fields: Optional[list[str]]
+    :return: A dict containing the parsed run parameters. Keys: ['flowcell_version', 'chemistry', 'instrument_serial', 'run_start_date', 'read_cycles', 'reagent_lots']
+    :rtype: dict[str, object]
+    """
+    if fields is None:
+        fields = list(RUN_PARAMETERS_FIELDS.keys())
+    fields = tuple(field for field in RUN_PARAMETERS_FIELDS if field in fields)
+    stat_result = os.stat(run_parameters_xml_path)
+    file_signature = (stat_result.st_mtime_ns, stat_result.st_size)
+    run_parameters = _parse_run_parameters_xml_cached(run_parameters_xml_path, file_signature, instrument_type, fields)
+
+    # Cached results are shared, so callers get their own copy.
+    return copy.deepcopy(run_parameters)
+
+
+@functools.lru_cache(maxsize=RUN_INFO_CACHE_SIZE)
+def _parse_run_info_xml_cached(run_info_xml_path, file_signature):
+    """
+    Parse the read structure from a RunInfo.xml file. Results are cached by path and file signature.
+    """
+    reads = []
+    tree = xml.etree.ElementTree.parse(run_info_xml_path)
+    for read in tree.getroot().iter('Read'):
+        reads.append({
+            'ReadNumber': int(read.attrib['Number']),
+            'NumCycles': int(read.attrib['NumCycles']),
+            'IsIndexed': read.attrib.get('IsIndexedRead', 'N') == 'Y',
+        })
+    reads.sort(key=lambda r: r['ReadNumber'])
+    read_roles = assign_read_roles(reads)
+    for read in reads:
+        read['Role'] = read_roles[read['ReadNumber']]
+
+    return reads
+
+
+def parse_run_info_xml(run_info_xml_path):
+    """
+    Parse the read structure from a RunInfo.xml file.
+
+    The file is only parsed again if its modification time or size changes.
+
+    :param run_info_xml_path: The path to the RunInfo.xml file.
+    :type run_info_xml_path: str
+    :return: A list of dicts describing each read, in order. Keys: ['ReadNumber', 'NumCycles', 'IsIndexed', 'Role']
+    :rtype: list[dict[str, object]]
+    """
+    stat_result = os.stat(run_info_xml_path)
+    file_signature = (stat_result.st_mtime_ns, stat_result.st_size)
+    reads = _parse_run_info_xml_cached(run_info_xml_path, file_signature)
+
+    # Cached results are shared, so callers get their own copy.
+    return copy.deepcopy(reads)
@@ -0,0 +1,276 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+import auto_illumina_run_qc_check.core as core
+import auto_illumina_run_qc_check.failure_ledger as failure_ledger
+import auto_illumina_run_qc_check.instrumentation as instrumentation
+import auto_illumina_run_qc_check.profiling as profiling
+
+
+DEFAULT_MAX_CONCURRENT_SCANS = 1
+DEFAULT_MAX_CONCURRENT_NOTIFICATIONS = 4
+DEFAULT_PIPELINE_QUEUE_SIZE = 16
+
+# Longest time that a watcher waits for run dirs before checking whether the pipeline is stopping.
+WATCH_STOP_CHECK_INTERVAL_SECONDS = 1.0
+
+
+def _check_run(config, run):
+    """
+    QC check a run on a check stage thread, unless it is backing off after a failure (or has been quarantined).
+    The notification is left to the notification stage.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
+    :type run: dict[str, object]
+    :return: The QC check result, or None if the run wasn't checked, or QC metrics couldn't be collected.
+    :rtype: Optional[dict[str, object]]
+    """
+    allowed, reason = failure_ledger.check_run_allowed(config, run)
+    if not allowed:
+        logging.debug(json.dumps({"event_type": "qc_check_deferred", "sequencing_run_id": run['sequencing_run_id'], "reason": reason}))
+        instrumentation.increment('qc_checks_deferred_total', reason=reason)
+        return None
+
+    return core.run_qc_check(config, run, defer_notification=True)
+
+
+class QcCheckPipeline:
+    """
+    Discovers, checks and sends notifications for runs in three stages, connected by bounded queues,
+    so that each stage runs at its own pace: a slow notification email doesn't hold up the next
+    qc check, and a slow scan of one run parent dir doesn't hold up checks of runs already found.
+
+    - Discovery: Run parent dirs are scanned on up to `max_concurrent_scans` threads.
+    - Checking: Up to `max_concurrent_checks` runs are qc checked at once.
+    - Notification: Up to `max_concurrent_notifications` notification emails are sent (or queued for a digest) at once.
+
+    The work in each stage is blocking (filesystem access, `interop_summary`, HTTP requests), so it is
+    run on that stage's own thread pool, while the event loop moves runs between the stages.
+    When the queue into a stage is full, the stage before it waits, rather than finding more runs than can be checked.
+
+    SIGINT and SIGTERM stop the pipeline gracefully: no more runs are found or started,
+    and qc checks that are already in progress finish and send their notifications.
+    Must be created from a coroutine running on the event loop.
+    """
+    def __init__(self, max_concurrent_scans=DEFAULT_MAX_CONCURRENT_SCANS, max_concurrent_checks=1, max_concurrent_notifications=DEFAULT_MAX_CONCURRENT_NOTIFICATIONS, queue_size=DEFAULT_PIPELINE_QUEUE_SIZE):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        # Set along with `stop_event`, for discovery threads to check.
+        self.stopping = threading.Event()
+        self.run_queue = asyncio.Queue(maxsize=queue_size)
+        self.notification_queue = asyncio.Queue(maxsize=queue_size)
+        # Sequencing run IDs of runs that are queued or being checked, so that a run found
+        # by both a scan and the watcher is only checked once.
+        self.pending_run_ids = set()
+        self.discovery_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_scans, thread_name_prefix='discovery')
+        self.check_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_checks, thread_name_prefix='qc_check')
+        self.notification_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_notifications, thread_name_prefix='notification')
+        self.check_workers = [self.loop.create_task(self._check_worker()) for _ in range(max_concurrent_checks)]
+        self.notification_workers = [self.loop.create_task(self._notification_worker()) for _ in range(max_concurrent_notifications)]
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            self.loop.add_signal_handler(signum, self.request_stop, signum)
+        logging.info(json.dumps({
+            "event_type": "pipeline_started",
+            "max_concurrent_scans": max_concurrent_scans,
+            "max_concurrent_checks": max_concurrent_checks,
+            "max_concurrent_notifications": max_concurrent_notifications,
+            "pipeline_queue_size": queue_size,
+        }))
+
+    def request_stop(self, signum=None):
+        """
+        Stop finding and starting qc checks. Checks that are in progress are allowed to finish.
+
+        :param signum: The signal that requested the stop, if any.
+        :type signum: Optional[int]
+        :return: None
+        :rtype: None
+        """
+        signal_name = signal.Signals(signum).name if signum is not None else None
+        logging.info(json.dumps({"event_type": "quit_when_safe_enabled", "signal": signal_name, "num_pending_qc_checks": len(self.pending_run_ids)}))
+        self.stopping.set()
+        self.stop_event.set()
+
+    def is_stopping(self):
+        """
+        :return: True if the pipeline has been asked to stop.
+        :rtype: bool
+        """
+        return self.stopping.is_set()
+
+    async def run_in_thread(self, func, *args):
+        """
+        Call a blocking function on the notification stage's threads, eg. to send a digest email.
+
+        :param func: Function to call.
+        :type func: Callable
+        :return: Whatever `func` returns.
+        :rtype: object
+        """
+        return await self.loop.run_in_executor(self.notification_executor, func, *args)
+
+    async def wait(self, timeout_seconds):
+        """
+        Wait until the timeout has passed, or the pipeline has been asked to stop.
+
+        :param timeout_seconds: Time to wait.
+        :type timeout_seconds: float
+        :return: None
+        :rtype: None
+        """
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), timeout=max(0.0, timeout_seconds))
+        except asyncio.TimeoutError as e:
+            pass
+
+    async def _enqueue_run(self, config, run):
+        if run['sequencing_run_id'] in self.pending_run_ids:
+            return
+        self.pending_run_ids.add(run['sequencing_run_id'])
+        await self.run_queue.put((config, run))
+
+    def _enqueue_run_from_thread(self, config, run):
+        """
+        Queue a run for checking from a discovery thread, blocking while the queue is full.
+        """
+        asyncio.run_coroutine_threadsafe(self._enqueue_run(config, run), self.loop).result()
+
+    def _discover_runs(self, config, run_parent_dir):
+        """
+        Scan a single run parent dir for runs that are ready for a qc check, on a discovery thread.
+        """
+        runs = core.find_run_dirs(dict(config, run_parent_dirs=[run_parent_dir]))
+        try:
+            for run in runs:
+                if self.stopping.is_set():
+                    break
+                if run is not None:
+                    self._enqueue_run_from_thread(config, run)
+        finally:
+            runs.close()
+
+    async def scan(self, config):
+        """
+        Scan all of the 'run_parent_dirs' listed in the config, and wait until every run found has been
+        checked and its notification has been sent (or queued for a digest).
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: None
+        :rtype: None
+        """
+        logging.info(json.dumps({"event_type": "scan_start"}))
+        run_parent_dirs = config.get('run_parent_dirs', [])
+        discovered = await asyncio.gather(
+            *[self.loop.run_in_executor(self.discovery_executor, self._discover_runs, config, d) for d in run_parent_dirs],
+            return_exceptions=True,
+        )
+        for run_parent_dir, result in zip(run_parent_dirs, discovered):
+            if isinstance(result, Exception):
+                logging.error(json.dumps({"event_type": "scan_run_parent_dir_failed", "run_parent_dir": run_parent_dir, "exception": repr(result)}))
+        await self.drain()
+
+    def _watch(self, config, watcher, timeout_seconds):
+        """
+        Wait for the watcher to find run dirs whose upload has completed, on a discovery thread.
+        """
+        deadline = time.monotonic() + timeout_seconds
+        while not self.stopping.is_set():
+            remaining_seconds = deadline - time.monotonic()
+            if remaining_seconds <= 0:
+                return
+            for run_dir_path in watcher.wait_for_run_dirs(min(remaining_seconds, WATCH_STOP_CHECK_INTERVAL_SECONDS)):
+                run = core.find_run_dir(config, run_dir_path)
+                if run is not None:
+                    self._enqueue_run_from_thread(config, run)
+
+    async def watch(self, config, watcher, timeout_seconds):
+        """
+        Check runs as soon as the watcher sees their upload complete, until the timeout has passed
+        or the pipeline has been asked to stop. Checks that have started may still be in progress when this returns.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param watcher: Run dir watcher, as created by `watch.create_run_dir_watcher`.
+        :type watcher: object
+        :param timeout_seconds: Time to watch for.
+        :type timeout_seconds: float
+        :return: None
+        :rtype: None
+        """
+        await self.loop.run_in_executor(self.discovery_executor, self._watch, config, watcher, timeout_seconds)
+
+    async def drain(self):
+        """
+        Wait until all queued runs have been checked, and all of their notifications have been sent.
+
+        :return: None
+        :rtype: None
+        """
+        await self.run_queue.join()
+        await self.notification_queue.join()
+
+    async def _check_worker(self):
+        while True:
+            item = await self.run_queue.get()
+            try:
+                if item is None:
+                    return
+                config, run = item
+                # Runs that haven't started are found again by the next scan, after a restart.
+                if self.stopping.is_set():
+                    continue
+                if profiling.is_profiling():
+                    qc_check_result = await self.loop.run_in_executor(self.check_executor, profiling.profile_call, _check_run, config, run)
+                else:
+                    qc_check_result = await self.loop.run_in_executor(self.check_executor, _check_run, config, run)
+                if qc_check_result is not None:
+                    qc_check_complete_path = os.path.join(run['path'], 'qc_check_complete.json')
+                    await self.notification_queue.put((config, run['sequencing_run_id'], qc_check_complete_path, qc_check_result['overall_pass_fail']))
+            except Exception as e:
+                logging.error(json.dumps({"event_type": "qc_check_raised_exception", "sequencing_run_id": run['sequencing_run_id'], "exception": repr(e)}))
+            finally:
+                if item is not None:
+                    self.pending_run_ids.discard(item[1]['sequencing_run_id'])
+                self.run_queue.task_done()
+
+    async def _notification_worker(self):
+        while True:
+            item = await self.notification_queue.get()
+            try:
+                if item is None:
+                    return
+                await self.loop.run_in_executor(self.notification_executor, core.notify_qc_check_result, *item)
+            except Exception as e:
+                logging.error(json.dumps({"event_type": "send_notification_email_failed", "sequencing_run_id": item[1], "exception": repr(e)}))
+            finally:
+                self.notification_queue.task_done()
+
+    async def close(self):
+        """
+        Wait for in-progress checks and notifications to finish, then stop the stages.
+
+        :return: None
+        :rtype: None
+        """
+        self.stopping.set()
+        await self.drain()
+        for _ in self.check_workers:
+            await self.run_queue.put(None)
+        await asyncio.gather(*self.check_workers)
+        for _ in self.notification_workers:
+            await self.notification_queue.put(None)
+        await asyncio.gather(*self.notification_workers)
+        for executor in [self.discovery_executor, self.check_executor, self.notification_executor]:
+            executor.shutdown(wait=True)
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            self.loop.remove_signal_handler(signum)
+        logging.info(json.dumps({"event_type": "pipeline_stopped"}))
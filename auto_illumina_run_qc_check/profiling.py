@@ -0,0 +1,124 @@
+import cProfile
+import datetime
+import json
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+
+
+TRACEMALLOC_NUM_FRAMES = 25
+NUM_TOP_ENTRIES = 50
+
+_output_dir = None
+_main_profile = None
+# Profiles of calls made on worker threads, by `profile_call`.
+_worker_profiles = []
+_worker_profiles_lock = threading.Lock()
+
+
+def is_profiling():
+    """
+    :return: True if profiling has been started.
+    :rtype: bool
+    """
+    return _output_dir is not None
+
+
+def start_profiling(output_dir):
+    """
+    Start collecting cProfile and tracemalloc data.
+
+    cProfile only profiles the thread that it was started on. Calls made on worker threads
+    are profiled separately by running them with `profile_call`, and are combined with the
+    main thread's profile when it is dumped.
+
+    :param output_dir: Directory to write profiles to.
+    :type output_dir: str
+    :return: None
+    :rtype: None
+    """
+    global _output_dir
+    global _main_profile
+    os.makedirs(output_dir, exist_ok=True)
+    _output_dir = output_dir
+    tracemalloc.start(TRACEMALLOC_NUM_FRAMES)
+    _main_profile = cProfile.Profile()
+    _main_profile.enable()
+    logging.info(json.dumps({"event_type": "profiling_started", "profile_output_dir": os.path.abspath(output_dir)}))
+
+
+def profile_call(func, *args, **kwargs):
+    """
+    Call a function under its own profiler, keeping the profile so it can be included in the next dump.
+
+    :param func: Function to call.
+    :type func: Callable
+    :return: Whatever `func` returns.
+    :rtype: object
+    """
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        with _worker_profiles_lock:
+            _worker_profiles.append(profile)
+
+
+def dump_profile(label=None):
+    """
+    Write the profiles collected so far to the output dir. Profiling continues afterwards.
+
+    The following files are written, named with the label (or the current time, if no label is given):
+
+    - `<label>.prof`: cProfile stats, for use with `pstats`, snakeviz etc.
+    - `<label>.cumulative.txt`: The functions with the highest cumulative time.
+    - `<label>.tracemalloc`: tracemalloc snapshot, for loading with `tracemalloc.Snapshot.load`.
+    - `<label>.tracemalloc.txt`: The lines that have allocated the most memory that hasn't been freed.
+
+    :param label: Prefix for the output files.
+    :type label: Optional[str]
+    :return: None
+    :rtype: None
+    """
+    if not is_profiling():
+        return
+    if label is None:
+        label = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    output_prefix = os.path.join(_output_dir, label)
+
+    # Creating stats disables the profiler, so it needs to be re-enabled afterwards.
+    _main_profile.create_stats()
+    stats = pstats.Stats(_main_profile)
+    _main_profile.enable()
+    with _worker_profiles_lock:
+        for worker_profile in _worker_profiles:
+            stats.add(worker_profile)
+    stats.dump_stats(output_prefix + '.prof')
+    with open(output_prefix + '.cumulative.txt', 'w') as f:
+        pstats.Stats(output_prefix + '.prof', stream=f).sort_stats('cumulative').print_stats(NUM_TOP_ENTRIES)
+
+    snapshot = tracemalloc.take_snapshot()
+    snapshot.dump(output_prefix + '.tracemalloc')
+    with open(output_prefix + '.tracemalloc.txt', 'w') as f:
+        for stat in snapshot.statistics('lineno')[:NUM_TOP_ENTRIES]:
+            f.write(str(stat) + "\n")
+
+    logging.info(json.dumps({"event_type": "profile_dumped", "profile_path": os.path.abspath(output_prefix + '.prof')}))
+
+
+def stop_profiling():
+    """
+    Write a final profile (labelled 'final'), then stop profiling.
+
+    :return: None
+    :rtype: None
+    """
+    global _output_dir
+    if not is_profiling():
+        return
+    dump_profile('final')
+    _main_profile.disable()
+    tracemalloc.stop()
+    _output_dir = None
@@ -0,0 +1,104 @@
+import datetime
+import json
+import logging
+import os
+
+import auto_illumina_run_qc_check.backfill as backfill
+import auto_illumina_run_qc_check.journal as journal
+import auto_illumina_run_qc_check.thresholds as thresholds
+
+
+def regrade_run(qc_rules, run, qc_metrics, qc_check_result):
+    """
+    Re-evaluate a run's qc metrics against the current qc rules.
+
+    :param qc_rules: Compiled rule set, as produced by `thresholds.compile_qc_thresholds`.
+    :type qc_rules: dict[str, object]
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type', 'run_parameters']
+    :type run: dict[str, object]
+    :param qc_metrics: The run's qc metrics, as written to '<RUN_ID>_qc_metrics.json'.
+    :type qc_metrics: dict[str, object]
+    :param qc_check_result: The run's previous qc check result, as written to 'qc_check_complete.json'.
+    :type qc_check_result: dict[str, object]
+    :return: Updated qc check result. The previous result is not modified.
+    :rtype: dict[str, object]
+    """
+    # Run parameters saved with the previous result take precedence. Fields that weren't
+    # collected when the run was first checked are taken from the run directory.
+    run_parameters = dict(run['run_parameters'])
+    run_parameters.update(qc_check_result.get('run_parameters', {}))
+    flowcell_version = run_parameters.get('flowcell_version', None)
+    regraded_qc_check_result = dict(qc_check_result)
+    regraded_qc_check_result['checked_metrics'] = thresholds.evaluate_qc_rules(qc_rules, qc_metrics, run['instrument_type'], flowcell_version, run_parameters)
+    regraded_qc_check_result['overall_pass_fail'] = thresholds.get_overall_pass_fail(regraded_qc_check_result['checked_metrics'])
+
+    return regraded_qc_check_result
+
+
+def regrade(config, run_parent_dirs=None, start_date=None, end_date=None, dry_run=False):
+    """
+    Re-evaluate the qc thresholds for previously-checked runs, using their saved
+    '<RUN_ID>_qc_metrics.json' files, without collecting metrics again or sending notifications.
+
+    Only runs that have both a '<RUN_ID>_qc_metrics.json' file and a 'qc_check_complete.json' file
+    are regraded. Each run's 'qc_check_complete.json' file is updated with the new results, unless `dry_run` is set.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_parent_dirs: Directories to search for runs. Defaults to the 'run_parent_dirs' from the config.
+    :type run_parent_dirs: Optional[list[str]]
+    :param start_date: Only include runs on or after this date (YYYY-MM-DD).
+    :type start_date: Optional[str]
+    :param end_date: Only include runs on or before this date (YYYY-MM-DD).
+    :type end_date: Optional[str]
+    :param dry_run: Report changes without updating any files.
+    :type dry_run: bool
+    :return: Regrade result for each run. Keys: ['sequencing_run_id', 'previous_overall_pass_fail', 'overall_pass_fail', 'verdict_changed']
+    :rtype: Iterator[dict[str, object]]
+    """
+    if run_parent_dirs is None:
+        run_parent_dirs = config.get('run_parent_dirs', [])
+    qc_rules = config.get('qc_rules', None)
+    if qc_rules is None:
+        qc_rules = thresholds.compile_qc_thresholds(config.get('qc_thresholds', []))
+
+    for run in backfill.find_backfill_runs(config, run_parent_dirs, start_date, end_date):
+        run_id = run['sequencing_run_id']
+        qc_metrics_path = os.path.join(run['path'], run_id + '_qc_metrics.json')
+        qc_check_complete_path = os.path.join(run['path'], 'qc_check_complete.json')
+        if not os.path.exists(qc_metrics_path) or not os.path.exists(qc_check_complete_path):
+            logging.debug(json.dumps({"event_type": "regrade_run_skipped", "sequencing_run_id": run_id, "reason": "qc_check_not_complete"}))
+            continue
+
+        try:
+            with open(qc_metrics_path, 'r') as f:
+                qc_metrics = json.load(f)
+            with open(qc_check_complete_path, 'r') as f:
+                qc_check_result = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(json.dumps({"event_type": "regrade_run_failed", "sequencing_run_id": run_id, "exception": str(e)}))
+            continue
+
+        regraded_qc_check_result = regrade_run(qc_rules, run, qc_metrics, qc_check_result)
+        previous_overall_pass_fail = qc_check_result.get('overall_pass_fail', None)
+        verdict_changed = regraded_qc_check_result['overall_pass_fail'] != previous_overall_pass_fail
+        checked_metrics_changed = regraded_qc_check_result['checked_metrics'] != qc_check_result.get('checked_metrics', None)
+
+        if checked_metrics_changed and not dry_run:
+            regraded_qc_check_result['timestamp_regraded'] = datetime.datetime.now().isoformat()
+            journal.write_json_atomically(qc_check_complete_path, regraded_qc_check_result)
+
+        if verdict_changed:
+            logging.info(json.dumps({
+                "event_type": "regrade_verdict_changed",
+                "sequencing_run_id": run_id,
+                "previous_qc_check_result": previous_overall_pass_fail,
+                "qc_check_result": regraded_qc_check_result['overall_pass_fail'],
+            }))
+
+        yield {
+            'sequencing_run_id': run_id,
+            'previous_overall_pass_fail': previous_overall_pass_fail,
+            'overall_pass_fail': regraded_qc_check_result['overall_pass_fail'],
+            'verdict_changed': verdict_changed,
+        }
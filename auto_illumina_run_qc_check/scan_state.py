@@ -0,0 +1,102 @@
+import os
+import sqlite3
+
+
+QC_CHECK_COMPLETE = 'qc_check_complete'
+EXCLUDED = 'excluded'
+UPLOAD_INCOMPLETE = 'upload_incomplete'
+WRONG_FORMAT = 'wrong_format'
+
+# Directories in these states will never become eligible for a QC check again,
+# so they can be skipped without touching the filesystem.
+TERMINAL_STATES = {
+    WRONG_FORMAT,
+}
+
+# Directories in the EXCLUDED state are skipped without touching the filesystem until
+# they are removed from the excluded runs list.
+
+# Directories in these states are only re-inspected when their modification time changes.
+# Removing 'qc_check_complete.json' (to have a run checked again) updates the mtime of the run directory.
+SETTLED_STATES = {
+    QC_CHECK_COMPLETE,
+    UPLOAD_INCOMPLETE,
+}
+
+
+def open_scan_state_db(scan_state_db_path: str) -> sqlite3.Connection:
+    """
+    Open (and initialize, if needed) the scan state database.
+
+    :param scan_state_db_path: Path to the sqlite database file.
+    :type scan_state_db_path: str
+    :return: A connection to the scan state database.
+    :rtype: sqlite3.Connection
+    """
+    scan_state_db_dir = os.path.dirname(os.path.abspath(scan_state_db_path))
+    os.makedirs(scan_state_db_dir, exist_ok=True)
+    conn = sqlite3.connect(scan_state_db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS run_dir_state ("
+        " run_parent_dir TEXT NOT NULL,"
+        " run_dir_name TEXT NOT NULL,"
+        " state TEXT NOT NULL,"
+        " mtime REAL,"
+        " PRIMARY KEY (run_parent_dir, run_dir_name)"
+        ")"
+    )
+    conn.commit()
+
+    return conn
+
+
+def get_run_dir_states(conn: sqlite3.Connection, run_parent_dir: str) -> dict[str, dict[str, object]]:
+    """
+    Get the recorded state of every known directory under a run parent dir.
+
+    :param conn: Connection to the scan state database.
+    :type conn: sqlite3.Connection
+    :param run_parent_dir: Absolute path to the run parent dir.
+    :type run_parent_dir: str
+    :return: Recorded states, indexed by directory name. Keys: ['state', 'mtime']
+    :rtype: dict[str, dict[str, object]]
+    """
+    run_dir_states = {}
+    cursor = conn.execute(
+        "SELECT run_dir_name, state, mtime FROM run_dir_state WHERE run_parent_dir = ?",
+        (run_parent_dir,),
+    )
+    for run_dir_name, state, mtime in cursor:
+        run_dir_states[run_dir_name] = {
+            'state': state,
+            'mtime': mtime,
+        }
+
+    return run_dir_states
+
+
+def set_run_dir_states(conn: sqlite3.Connection, run_parent_dir: str, run_dir_states: dict[str, dict[str, object]]):
+    """
+    Record the state of a batch of directories under a run parent dir.
+
+    :param conn: Connection to the scan state database.
+    :type conn: sqlite3.Connection
+    :param run_parent_dir: Absolute path to the run parent dir.
+    :type run_parent_dir: str
+    :param run_dir_states: States to record, indexed by directory name. Keys: ['state', 'mtime']
+    :type run_dir_states: dict[str, dict[str, object]]
+    :return: None
+    :rtype: None
+    """
+    rows = [
+        (run_parent_dir, run_dir_name, s['state'], s['mtime'])
+        for run_dir_name, s in run_dir_states.items()
+    ]
+    conn.executemany(
+        "INSERT OR REPLACE INTO run_dir_state (run_parent_dir, run_dir_name, state, mtime) VALUES (?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+
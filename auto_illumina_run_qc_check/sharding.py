@@ -0,0 +1,483 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import auto_illumina_run_qc_check.instrumentation as instrumentation
+import auto_illumina_run_qc_check.journal as journal
+
+
+DEFAULT_LEASE_EXPIRY_SECONDS = 300.0
+DEFAULT_LEASE_HEARTBEAT_SECONDS = 30.0
+
+SHARD_BY_SEQUENCING_RUN_ID = 'sequencing_run_id'
+SHARD_BY_RUN_PARENT_DIR = 'run_parent_dir'
+SHARD_BY_OPTIONS = [SHARD_BY_SEQUENCING_RUN_ID, SHARD_BY_RUN_PARENT_DIR]
+
+# Reason recorded when a run dir is skipped because another worker owns it.
+OWNED_BY_OTHER_WORKER = 'owned_by_other_worker'
+
+RUN_LEASE_FILENAME = 'qc_check.lease'
+WORKER_FILE_SUFFIX = '.worker'
+
+_worker_id = None
+_shard_dir = None
+_shard_by = SHARD_BY_SEQUENCING_RUN_ID
+_lease_expiry_seconds = DEFAULT_LEASE_EXPIRY_SECONDS
+_lease_heartbeat_seconds = DEFAULT_LEASE_HEARTBEAT_SECONDS
+# Worker IDs of the live workers in the shard, sorted.
+_shard_members = []
+# Run leases held by this worker. Lease IDs, indexed by lease file path.
+_held_run_leases = {}
+_sharding_lock = threading.Lock()
+_heartbeat_thread = None
+_heartbeat_stop = threading.Event()
+
+
+def get_default_worker_id():
+    """
+    :return: A worker ID that is unique to this process: '<hostname>-<pid>'.
+    :rtype: str
+    """
+    return socket.gethostname() + '-' + str(os.getpid())
+
+
+def set_worker_id(worker_id):
+    """
+    Set the ID that this worker uses when joining a shard. Must be called before `join_shard`.
+
+    :param worker_id: Worker ID. Must be unique among the workers sharing a 'shard_dir'.
+    :type worker_id: str
+    :return: None
+    :rtype: None
+    """
+    global _worker_id
+    _worker_id = worker_id
+
+
+def is_sharded():
+    """
+    :return: True if this worker has joined a shard.
+    :rtype: bool
+    """
+    return _shard_dir is not None
+
+
+def _get_worker_file_path(shard_dir, worker_id):
+    return os.path.join(shard_dir, worker_id + WORKER_FILE_SUFFIX)
+
+
+def _get_file_server_time(dir_path):
+    """
+    Get the current time according to the clock that sets the modification times of files in a directory.
+
+    On a shared filesystem such as NFS, the server sets the modification times of heartbeat and lease files,
+    so they're compared with the modification time of a file created in the same directory, rather than with
+    the local clock, which may be skewed relative to the server's.
+
+    :param dir_path: Path to the directory.
+    :type dir_path: str
+    :return: Current time, in seconds since the epoch. The local time if a file can't be created in the directory.
+    :rtype: float
+    """
+    clock_path = os.path.join(dir_path, '.' + uuid.uuid4().hex + '.clock')
+    try:
+        clock_fd = os.open(clock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except OSError as e:
+        logging.warning(json.dumps({"event_type": "get_file_server_time_failed", "worker_id": _worker_id, "dir_path": dir_path, "exception": str(e)}))
+        return time.time()
+    try:
+        return os.fstat(clock_fd).st_mtime
+    finally:
+        os.close(clock_fd)
+        try:
+            os.unlink(clock_path)
+        except OSError as e:
+            pass
+
+
+def _is_expired(mtime, now):
+    return now - mtime >= _lease_expiry_seconds
+
+
+def _list_live_workers(shard_dir):
+    """
+    Find the workers whose worker files in the shard dir have been updated within the lease expiry time.
+
+    :param shard_dir: Shared directory that workers record their heartbeats in.
+    :type shard_dir: str
+    :return: Worker IDs, sorted.
+    :rtype: list[str]
+    """
+    live_workers = []
+    now = _get_file_server_time(shard_dir)
+    with os.scandir(shard_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(WORKER_FILE_SUFFIX) or entry.name.startswith('.'):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError as e:
+                continue
+            if not _is_expired(mtime, now):
+                live_workers.append(entry.name[:-len(WORKER_FILE_SUFFIX)])
+
+    return sorted(live_workers)
+
+
+def _refresh_shard_members():
+    """
+    Update the list of live workers in the shard. This worker is always included,
+    so it keeps checking its share of runs even if the shard dir can't be read.
+    """
+    global _shard_members
+    try:
+        shard_members = _list_live_workers(_shard_dir)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "list_shard_members_failed", "shard_dir": _shard_dir, "exception": str(e)}))
+        return
+    if _worker_id not in shard_members:
+        shard_members = sorted(shard_members + [_worker_id])
+    with _sharding_lock:
+        previous_shard_members = _shard_members
+        _shard_members = shard_members
+    if shard_members != previous_shard_members:
+        logging.info(json.dumps({"event_type": "shard_members_changed", "worker_id": _worker_id, "shard_members": shard_members}))
+
+
+def _renew_run_leases():
+    """
+    Update the modification time of each run lease held by this worker, so that other workers don't reclaim them.
+    A lease that has been reclaimed by another worker is dropped.
+    """
+    with _sharding_lock:
+        held_run_leases = dict(_held_run_leases)
+    for lease_path, lease_id in held_run_leases.items():
+        lease = _read_lease(lease_path)
+        if lease is not None and lease.get('lease_id', None) == lease_id:
+            try:
+                os.utime(lease_path)
+                continue
+            except OSError as e:
+                pass
+        logging.error(json.dumps({"event_type": "run_lease_lost", "worker_id": _worker_id, "run_lease_path": lease_path}))
+        with _sharding_lock:
+            _held_run_leases.pop(lease_path, None)
+
+
+def _heartbeat():
+    """
+    Renew this worker's membership of the shard and its run leases, then refresh the list of live workers.
+    """
+    try:
+        os.utime(_get_worker_file_path(_shard_dir, _worker_id))
+    except FileNotFoundError as e:
+        # The worker file was removed, eg. by an operator clearing out the shard dir.
+        _write_worker_file()
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "shard_heartbeat_failed", "worker_id": _worker_id, "shard_dir": _shard_dir, "exception": str(e)}))
+    _renew_run_leases()
+    _refresh_shard_members()
+
+
+def _heartbeat_loop():
+    while not _heartbeat_stop.wait(_lease_heartbeat_seconds):
+        _heartbeat()
+
+
+def _write_worker_file():
+    worker = {
+        'worker_id': _worker_id,
+        'hostname': socket.gethostname(),
+        'pid': os.getpid(),
+        'timestamp_joined': datetime.datetime.now().isoformat(),
+    }
+    try:
+        journal.write_json_atomically(_get_worker_file_path(_shard_dir, _worker_id), worker)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "shard_heartbeat_failed", "worker_id": _worker_id, "shard_dir": _shard_dir, "exception": str(e)}))
+
+
+def join_shard(config):
+    """
+    Join the shard configured by 'shard_dir', if it hasn't already been joined.
+
+    Each worker in a shard records a heartbeat by updating a '<worker_id>.worker' file in the shard dir.
+    Runs are divided between the workers whose heartbeats haven't expired, by rendezvous hashing,
+    so that when a worker joins or leaves, only the runs that it owns (or will own) move between workers.
+    A background thread renews this worker's heartbeat and run leases every 'lease_heartbeat_seconds'.
+
+    If 'shard_dir' has been removed from the config, this worker leaves the shard.
+
+    :param config: Application config. Optional keys: ['shard_dir', 'shard_by', 'lease_expiry_seconds', 'lease_heartbeat_seconds']
+    :type config: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    global _worker_id
+    global _shard_dir
+    global _shard_by
+    global _lease_expiry_seconds
+    global _lease_heartbeat_seconds
+    global _heartbeat_thread
+    _shard_by = config.get('shard_by', SHARD_BY_SEQUENCING_RUN_ID)
+    _lease_expiry_seconds = float(str(config.get('lease_expiry_seconds', DEFAULT_LEASE_EXPIRY_SECONDS)))
+    _lease_heartbeat_seconds = float(str(config.get('lease_heartbeat_seconds', DEFAULT_LEASE_HEARTBEAT_SECONDS)))
+
+    shard_dir = config.get('shard_dir', None)
+    if shard_dir:
+        shard_dir = os.path.abspath(shard_dir)
+    if shard_dir == _shard_dir:
+        return
+    if _shard_dir is not None:
+        leave_shard()
+    if not shard_dir:
+        return
+
+    if _worker_id is None:
+        _worker_id = get_default_worker_id()
+    try:
+        os.makedirs(shard_dir, exist_ok=True)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "join_shard_failed", "worker_id": _worker_id, "shard_dir": shard_dir, "exception": str(e)}))
+        return
+    _shard_dir = shard_dir
+    _write_worker_file()
+    _refresh_shard_members()
+    logging.info(json.dumps({"event_type": "shard_joined", "worker_id": _worker_id, "shard_dir": shard_dir, "shard_by": _shard_by}))
+
+    _heartbeat_stop.clear()
+    _heartbeat_thread = threading.Thread(target=_heartbeat_loop, name='shard_heartbeat', daemon=True)
+    _heartbeat_thread.start()
+
+
+def leave_shard():
+    """
+    Stop the heartbeat thread and remove this worker's worker file, so that the other workers
+    take over its runs straight away, rather than once its heartbeat expires.
+
+    :return: None
+    :rtype: None
+    """
+    global _shard_dir
+    global _shard_members
+    global _heartbeat_thread
+    if _shard_dir is None:
+        return
+    _heartbeat_stop.set()
+    if _heartbeat_thread is not None:
+        _heartbeat_thread.join()
+        _heartbeat_thread = None
+    try:
+        os.unlink(_get_worker_file_path(_shard_dir, _worker_id))
+    except OSError as e:
+        pass
+    logging.info(json.dumps({"event_type": "shard_left", "worker_id": _worker_id, "shard_dir": _shard_dir}))
+    with _sharding_lock:
+        _shard_dir = None
+        _shard_members = []
+
+
+def _rendezvous_score(worker_id, key):
+    digest = hashlib.blake2b((worker_id + '\0' + key).encode('utf-8'), digest_size=8).digest()
+
+    return int.from_bytes(digest, 'big')
+
+
+def get_owner(key):
+    """
+    Find the worker that owns a key (a sequencing run ID or run parent dir), by rendezvous hashing:
+    the live worker with the highest hash of (worker ID, key).
+
+    :param key: Sequencing run ID or run parent dir.
+    :type key: str
+    :return: Worker ID of the owner, or None if this worker hasn't joined a shard.
+    :rtype: Optional[str]
+    """
+    with _sharding_lock:
+        shard_members = _shard_members
+    if not shard_members:
+        return None
+
+    return max(shard_members, key=lambda worker_id: _rendezvous_score(worker_id, key))
+
+
+def owns_run_parent_dir(run_parent_dir):
+    """
+    Check whether this worker should scan a run parent dir.
+
+    :param run_parent_dir: Absolute path to the run parent dir.
+    :type run_parent_dir: str
+    :return: True unless sharding by run parent dir, and the dir is owned by another worker.
+    :rtype: bool
+    """
+    if not is_sharded() or _shard_by != SHARD_BY_RUN_PARENT_DIR:
+        return True
+
+    return get_owner(run_parent_dir) == _worker_id
+
+
+def owns_run(run_parent_dir, run_id):
+    """
+    Check whether this worker should QC check a run.
+
+    :param run_parent_dir: Absolute path to the run parent dir that the run is in.
+    :type run_parent_dir: str
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: True unless the run is owned by another worker.
+    :rtype: bool
+    """
+    if not is_sharded():
+        return True
+    if _shard_by == SHARD_BY_RUN_PARENT_DIR:
+        return owns_run_parent_dir(run_parent_dir)
+
+    return get_owner(run_id) == _worker_id
+
+
+def _read_lease(lease_path):
+    """
+    Read a lease file.
+
+    :return: The lease, an empty dict if it hasn't been completely written yet, or None if it doesn't exist.
+    :rtype: Optional[dict[str, object]]
+    """
+    try:
+        with open(lease_path, 'r') as f:
+            return json.load(f)
+    except ValueError as e:
+        return {}
+    except OSError as e:
+        return None
+
+
+def _reclaim_expired_lease(lease_path):
+    """
+    Remove a lease file if its heartbeat has expired.
+
+    The lease's modification time is compared with the file server's clock (see `_get_file_server_time`),
+    so that a live lease isn't reclaimed early because of clock skew between hosts.
+    The lease is first renamed to a unique name, so that if several workers try to reclaim it
+    at once, only one of them succeeds. If the holder renewed the lease just before it was renamed,
+    it is put back.
+
+    :param lease_path: Path to the lease file.
+    :type lease_path: str
+    :return: True if the lease no longer exists, False if it is still held.
+    :rtype: bool
+    """
+    try:
+        mtime = os.stat(lease_path).st_mtime
+    except FileNotFoundError as e:
+        return True
+    now = _get_file_server_time(os.path.dirname(lease_path))
+    if not _is_expired(mtime, now):
+        return False
+
+    expired_lease_path = os.path.join(os.path.dirname(lease_path), '.' + os.path.basename(lease_path) + '.' + uuid.uuid4().hex + '.expired')
+    try:
+        os.rename(lease_path, expired_lease_path)
+    except FileNotFoundError as e:
+        # Released, or reclaimed by another worker.
+        return True
+    try:
+        if not _is_expired(os.stat(expired_lease_path).st_mtime, now):
+            try:
+                os.link(expired_lease_path, lease_path)
+            except OSError as e:
+                # Another worker has already created a new lease.
+                pass
+            return False
+        expired_lease = _read_lease(expired_lease_path) or {}
+    finally:
+        os.unlink(expired_lease_path)
+
+    logging.warning(json.dumps({
+        "event_type": "run_lease_reclaimed",
+        "worker_id": _worker_id,
+        "run_lease_path": lease_path,
+        "previous_worker_id": expired_lease.get('worker_id', None),
+    }))
+    instrumentation.increment('run_leases_reclaimed_total')
+
+    return True
+
+
+def acquire_run_lease(run):
+    """
+    Claim a run, so that no other worker QC checks it at the same time, by creating a 'qc_check.lease'
+    file in its run directory. The file is created with O_EXCL, so only one worker can create it.
+
+    The lease is renewed by the heartbeat thread until it is released. A lease whose heartbeat
+    has expired (because its worker has died) is reclaimed.
+
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path']
+    :type run: dict[str, object]
+    :return: True if the lease was acquired, False if it is held by another worker.
+    :rtype: bool
+    """
+    lease_path = os.path.join(run['path'], RUN_LEASE_FILENAME)
+    lease = {
+        'lease_id': uuid.uuid4().hex,
+        'worker_id': _worker_id,
+        'hostname': socket.gethostname(),
+        'pid': os.getpid(),
+        'sequencing_run_id': run['sequencing_run_id'],
+        'timestamp_acquired': datetime.datetime.now().isoformat(),
+    }
+    for attempt in range(2):
+        try:
+            lease_fd = os.open(lease_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError as e:
+            if _reclaim_expired_lease(lease_path):
+                continue
+            break
+        with os.fdopen(lease_fd, 'w') as f:
+            f.write(json.dumps(lease) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        with _sharding_lock:
+            _held_run_leases[lease_path] = lease['lease_id']
+        logging.debug(json.dumps({"event_type": "run_lease_acquired", "worker_id": _worker_id, "sequencing_run_id": run['sequencing_run_id']}))
+        return True
+
+    existing_lease = _read_lease(lease_path) or {}
+    logging.info(json.dumps({
+        "event_type": "run_lease_held",
+        "worker_id": _worker_id,
+        "sequencing_run_id": run['sequencing_run_id'],
+        "lease_worker_id": existing_lease.get('worker_id', None),
+    }))
+
+    return False
+
+
+def release_run_lease(run):
+    """
+    Release a run lease held by this worker, by removing its lease file.
+    A lease that has since been reclaimed by another worker is left alone.
+
+    :param run: Run directory. Keys: ['sequencing_run_id', 'path']
+    :type run: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    lease_path = os.path.join(run['path'], RUN_LEASE_FILENAME)
+    with _sharding_lock:
+        lease_id = _held_run_leases.pop(lease_path, None)
+    if lease_id is None:
+        return
+    lease = _read_lease(lease_path)
+    if lease is None or lease.get('lease_id', None) != lease_id:
+        logging.error(json.dumps({"event_type": "run_lease_lost", "worker_id": _worker_id, "run_lease_path": lease_path}))
+        return
+    try:
+        os.unlink(lease_path)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "release_run_lease_failed", "worker_id": _worker_id, "run_lease_path": lease_path, "exception": str(e)}))
@@ -0,0 +1,279 @@
+import json
+import logging
+import math
+import threading
+
+import auto_illumina_run_qc_check.instrumentation as instrumentation
+import auto_illumina_run_qc_check.journal as journal
+import auto_illumina_run_qc_check.thresholds as thresholds
+
+
+# Run-level metrics that aren't collected from the InterOp files.
+_NON_INTEROP_METRICS = ['SumSampleFastqFileSizesMb', 'MinSampleFastqFileSizeMb']
+DEFAULT_SPC_METRICS = [m for m in thresholds.RUN_LEVEL_METRICS if m not in _NON_INTEROP_METRICS]
+DEFAULT_SPC_MIN_BASELINE_RUNS = 20
+DEFAULT_SPC_EWMA_LAMBDA = 0.2
+DEFAULT_SPC_EWMA_LIMIT = 3.0
+DEFAULT_SPC_CUSUM_K = 0.5
+DEFAULT_SPC_CUSUM_H = 5.0
+DEFAULT_SPC_EXCLUDE_SIGNALS_FROM_BASELINE = True
+
+IN_CONTROL = 'IN_CONTROL'
+DRIFT = 'DRIFT'
+INSUFFICIENT_BASELINE = 'INSUFFICIENT_BASELINE'
+
+STATE_FILE_VERSION = 1
+# Number of recent sequencing run IDs kept for each instrument, so that a run that is checked
+# again (eg. after a restart) isn't added to the baseline twice.
+NUM_RECENT_RUN_IDS = 100
+
+# Baselines for each instrument. Keys: ['version', 'instruments']
+# Each instrument's baseline has keys: ['num_runs', 'recent_run_ids', 'last_drift', 'metrics'],
+# and each metric's baseline has keys: ['n', 'mean', 'm2', 'ewma', 'cusum_upper', 'cusum_lower']
+_state = {'version': STATE_FILE_VERSION, 'instruments': {}}
+# Path to the file that the state was loaded from (if any).
+_state_path = None
+# (inode, mtime_ns, size) of the state file when it was last loaded or saved, so that updates
+# made by other processes are merged rather than overwritten.
+_state_signature = None
+_state_lock = threading.Lock()
+
+
+def get_spc_settings(config):
+    """
+    Get the SPC settings from the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: SPC settings. Keys: ['metrics', 'min_baseline_runs', 'ewma_lambda', 'ewma_limit', 'cusum_k', 'cusum_h', 'exclude_signals_from_baseline']
+    :rtype: dict[str, object]
+    """
+    return {
+        'metrics': config.get('spc_metrics', DEFAULT_SPC_METRICS),
+        'min_baseline_runs': max(2, int(str(config.get('spc_min_baseline_runs', DEFAULT_SPC_MIN_BASELINE_RUNS)))),
+        'ewma_lambda': float(str(config.get('spc_ewma_lambda', DEFAULT_SPC_EWMA_LAMBDA))),
+        'ewma_limit': float(str(config.get('spc_ewma_limit', DEFAULT_SPC_EWMA_LIMIT))),
+        'cusum_k': float(str(config.get('spc_cusum_k', DEFAULT_SPC_CUSUM_K))),
+        'cusum_h': float(str(config.get('spc_cusum_h', DEFAULT_SPC_CUSUM_H))),
+        'exclude_signals_from_baseline': config.get('spc_exclude_signals_from_baseline', DEFAULT_SPC_EXCLUDE_SIGNALS_FROM_BASELINE),
+    }
+
+
+def update_metric_baseline(baseline, value, settings):
+    """
+    Assess one value of a metric against its baseline, and add the value to the baseline.
+
+    The baseline's mean and variance are updated with Welford's algorithm, so each update takes
+    constant time and space, however many runs the baseline includes. The value is compared with the
+    baseline as it was before the update. Once the baseline includes at least 'min_baseline_runs' values
+    (and they aren't all the same):
+
+    - The EWMA (exponentially-weighted moving average) of the values signals a drift if it is more than
+      'ewma_limit' times its standard error away from the baseline mean.
+    - The upper and lower CUSUMs (cumulative sums) of the standardized values, less a slack of 'cusum_k'
+      standard deviations per run, signal a drift if either is more than 'cusum_h' standard deviations.
+      A CUSUM that signals is reset to 0, so that it only signals again if the shift continues.
+
+    If 'exclude_signals_from_baseline' is set, a value that signals isn't added to the baseline's mean and variance,
+    so that a drift doesn't widen the limits that it is judged against.
+
+    :param baseline: The metric's baseline, or None if there isn't one yet. Not modified.
+    :type baseline: Optional[dict[str, float]]
+    :param value: Value of the metric for the run.
+    :type value: float
+    :param settings: SPC settings, as produced by `get_spc_settings`.
+    :type settings: dict[str, object]
+    :return: Updated baseline, and assessment of the value. Assessment keys: ['value', 'baseline_mean', 'baseline_stdev', 'num_baseline_runs', 'ewma', 'ewma_limit', 'cusum_upper', 'cusum_lower', 'signals']
+    :rtype: tuple[dict[str, float], dict[str, object]]
+    """
+    if baseline is None:
+        baseline = {'n': 0, 'mean': 0.0, 'm2': 0.0, 'ewma': value, 'cusum_upper': 0.0, 'cusum_lower': 0.0}
+
+    n = baseline['n']
+    mean = baseline['mean']
+    stdev = math.sqrt(baseline['m2'] / (n - 1)) if n > 1 else 0.0
+    ewma_lambda = settings['ewma_lambda']
+    ewma = ewma_lambda * value + (1.0 - ewma_lambda) * baseline['ewma']
+    cusum_upper = baseline['cusum_upper']
+    cusum_lower = baseline['cusum_lower']
+    ewma_limit = None
+    signals = []
+    if n >= settings['min_baseline_runs'] and stdev > 0:
+        z = (value - mean) / stdev
+        cusum_upper = max(0.0, cusum_upper + z - settings['cusum_k'])
+        cusum_lower = max(0.0, cusum_lower - z - settings['cusum_k'])
+        ewma_limit = settings['ewma_limit'] * stdev * math.sqrt(ewma_lambda / (2.0 - ewma_lambda))
+        if ewma - mean > ewma_limit:
+            signals.append('ewma_high')
+        elif mean - ewma > ewma_limit:
+            signals.append('ewma_low')
+        if cusum_upper > settings['cusum_h']:
+            signals.append('cusum_high')
+        if cusum_lower > settings['cusum_h']:
+            signals.append('cusum_low')
+
+    updated_baseline = {
+        'n': n,
+        'mean': mean,
+        'm2': baseline['m2'],
+        'ewma': ewma,
+        'cusum_upper': 0.0 if 'cusum_high' in signals else cusum_upper,
+        'cusum_lower': 0.0 if 'cusum_low' in signals else cusum_lower,
+    }
+    if not (signals and settings['exclude_signals_from_baseline']):
+        delta = value - mean
+        updated_baseline['n'] = n + 1
+        updated_baseline['mean'] = mean + delta / (n + 1)
+        updated_baseline['m2'] = baseline['m2'] + delta * (value - updated_baseline['mean'])
+    assessment = {
+        'value': value,
+        'baseline_mean': round(mean, 6) if n > 0 else None,
+        'baseline_stdev': round(stdev, 6) if n > 1 else None,
+        'num_baseline_runs': n,
+        'ewma': round(ewma, 6),
+        'ewma_limit': round(ewma_limit, 6) if ewma_limit is not None else None,
+        'cusum_upper': round(cusum_upper, 3),
+        'cusum_lower': round(cusum_lower, 3),
+        'signals': signals,
+    }
+
+    return updated_baseline, assessment
+
+
+def assess_instrument_run(instrument_baseline, qc_metrics, settings):
+    """
+    Assess each metric of a run against its instrument's baselines, and add the run to the baselines.
+
+    :param instrument_baseline: The instrument's baselines, or None if there aren't any yet. Not modified.
+    :type instrument_baseline: Optional[dict[str, object]]
+    :param qc_metrics: QC metrics, as produced by `parsers.parse_interop_summary`.
+    :type qc_metrics: dict[str, object]
+    :param settings: SPC settings, as produced by `get_spc_settings`.
+    :type settings: dict[str, object]
+    :return: Updated baselines, and drift verdict. Verdict keys: ['verdict', 'num_baseline_runs', 'drifting_metrics']
+    :rtype: tuple[dict[str, object], dict[str, object]]
+    """
+    if instrument_baseline is None:
+        instrument_baseline = {'num_runs': 0, 'recent_run_ids': [], 'last_drift': None, 'metrics': {}}
+
+    updated_metrics = dict(instrument_baseline['metrics'])
+    drifting_metrics = []
+    baseline_ready = False
+    for metric in settings['metrics']:
+        value = qc_metrics.get(metric, None)
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value):
+            continue
+        updated_metrics[metric], assessment = update_metric_baseline(updated_metrics.get(metric, None), value, settings)
+        if assessment['num_baseline_runs'] >= settings['min_baseline_runs']:
+            baseline_ready = True
+        if assessment['signals']:
+            drifting_metrics.append(dict(assessment, metric=metric))
+
+    if drifting_metrics:
+        verdict = DRIFT
+    elif baseline_ready:
+        verdict = IN_CONTROL
+    else:
+        verdict = INSUFFICIENT_BASELINE
+    drift = {
+        'verdict': verdict,
+        'num_baseline_runs': instrument_baseline['num_runs'],
+        'drifting_metrics': drifting_metrics,
+    }
+    updated_instrument_baseline = {
+        'num_runs': instrument_baseline['num_runs'] + 1,
+        'recent_run_ids': instrument_baseline['recent_run_ids'],
+        'last_drift': drift,
+        'metrics': updated_metrics,
+    }
+
+    return updated_instrument_baseline, drift
+
+
+def _load_state(config):
+    """
+    Load the state from the 'spc_state_file' listed in the config, unless it has already been loaded
+    and the file hasn't changed since.
+    Must be called with the state lock, and the lock on the state file, held.
+    """
+    global _state
+    global _state_path
+    global _state_signature
+    state_path = config.get('spc_state_file', None)
+    state_signature = journal.get_file_signature(state_path)
+    if state_path == _state_path and state_signature == _state_signature:
+        return
+
+    _state = {'version': STATE_FILE_VERSION, 'instruments': {}}
+    _state_path = state_path
+    _state_signature = state_signature
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        if state.get('version', None) != STATE_FILE_VERSION:
+            raise ValueError("unsupported state file version: " + str(state.get('version', None)))
+        _state = state
+    except FileNotFoundError as e:
+        pass
+    except (OSError, ValueError, AttributeError) as e:
+        logging.error(json.dumps({"event_type": "load_spc_state_failed", "spc_state_file": state_path, "exception": str(e)}))
+
+
+def _save_state():
+    """
+    Write the state to its file. The file is replaced atomically.
+    Must be called with the state lock, and the lock on the state file, held.
+    """
+    global _state_signature
+    try:
+        journal.write_file_atomically(_state_path, json.dumps(_state, separators=(',', ':')) + "\n")
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "save_spc_state_failed", "spc_state_file": _state_path, "exception": str(e)}))
+    _state_signature = journal.get_file_signature(_state_path)
+
+
+def assess_run(config, run_id, instrument_id, qc_metrics):
+    """
+    Assess a run's metrics for drift against the baselines of the instrument that it was sequenced on,
+    and add the run to the baselines, which are saved to the 'spc_state_file' listed in the config.
+    The state file is locked while it is updated, and re-read first if another process has changed it.
+
+    A run that was recently added to the baselines isn't added again. If it was the most recent run
+    on its instrument, the verdict it was given then is returned; otherwise, it is assessed against the current baselines.
+
+    :param config: Application config. Keys: ['spc_state_file'] Optional keys: ['spc_metrics', 'spc_min_baseline_runs', 'spc_ewma_lambda', 'spc_ewma_limit', 'spc_cusum_k', 'spc_cusum_h']
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param instrument_id: ID of the instrument that the run was sequenced on.
+    :type instrument_id: str
+    :param qc_metrics: QC metrics, as produced by `parsers.parse_interop_summary`.
+    :type qc_metrics: dict[str, object]
+    :return: Drift verdict. Keys: ['verdict', 'num_baseline_runs', 'drifting_metrics']
+    :rtype: dict[str, object]
+    """
+    settings = get_spc_settings(config)
+    with _state_lock, journal.file_lock(config['spc_state_file']):
+        _load_state(config)
+        instrument_baseline = _state['instruments'].get(instrument_id, None)
+        if instrument_baseline is not None and run_id in instrument_baseline['recent_run_ids']:
+            if instrument_baseline['recent_run_ids'][-1] == run_id and instrument_baseline['last_drift'] is not None:
+                return instrument_baseline['last_drift']
+            _, drift = assess_instrument_run(instrument_baseline, qc_metrics, settings)
+            return drift
+
+        updated_instrument_baseline, drift = assess_instrument_run(instrument_baseline, qc_metrics, settings)
+        updated_instrument_baseline['recent_run_ids'] = (updated_instrument_baseline['recent_run_ids'] + [run_id])[-NUM_RECENT_RUN_IDS:]
+        _state['instruments'][instrument_id] = updated_instrument_baseline
+        _save_state()
+
+    instrumentation.increment('spc_assessments_total', verdict=drift['verdict'])
+    if drift['verdict'] == DRIFT:
+        logging.warning(json.dumps({
+            "event_type": "spc_drift_detected",
+            "sequencing_run_id": run_id,
+            "instrument_id": instrument_id,
+            "drifting_metrics": {m['metric']: m['signals'] for m in drift['drifting_metrics']},
+        }))
+
+    return drift
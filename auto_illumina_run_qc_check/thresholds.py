@@ -0,0 +1,402 @@
+import json
+import logging
+
+import auto_illumina_run_qc_check.instrumentation as instrumentation
+import auto_illumina_run_qc_check.parsers as parsers
+
+
+# Metrics available at the top level of the qc metrics dict.
+RUN_LEVEL_METRICS = [
+    'ErrorRateR1',
+    'PercentGtQ30R1',
+    'ErrorRateR2',
+    'PercentGtQ30R2',
+    'PercentGtQ30I1',
+    'PercentGtQ30I2',
+    'NonIndexedErrorRate',
+    'NonIndexedIntensityCycle1',
+    'NonIndexedPercentAligned',
+    'NonIndexedPercentGtQ30',
+    'NonIndexedProjectedTotalYield',
+    'NonIndexedYieldTotal',
+    'ErrorRate',
+    'IntensityCycle1',
+    'PercentAligned',
+    'PercentGtQ30',
+    'ProjectedTotalYield',
+    'YieldTotal',
+    'ClusterDensity',
+    'PercentPf',
+    'SumSampleFastqFileSizesMb',
+    'MinSampleFastqFileSizeMb',
+]
+
+# Metrics available for each lane & read, in the 'LanesByRead' list of the qc metrics dict.
+LANE_LEVEL_METRICS = [
+    'TileCount',
+    'Density',
+    'DensityDeviation',
+    'PercentPf',
+    'PercentPfDeviation',
+    'Reads',
+    'ReadsPf',
+    'PercentGtQ30',
+    'Yield',
+    'PercentAligned',
+    'PercentAlignedDeviation',
+    'ErrorRate',
+    'ErrorRateDeviation',
+    'ErrorRate35',
+    'ErrorRate35Deviation',
+    'ErrorRate75',
+    'ErrorRate75Deviation',
+    'ErrorRate100',
+    'ErrorRate100Deviation',
+    'IntensityCycle1',
+    'IntensityCycle1Deviation',
+    'PhasingSlope',
+    'PhasingOffset',
+    'PrePhasingSlope',
+    'PrePhasingOffset',
+    'ClusterDensity',
+    'Occupancy',
+]
+
+# Scores added to each lane & read by `outliers.add_lane_outlier_scores`, eg. 'DensityOutlierScore'.
+# A score is None if there weren't enough other lanes (or previous runs) to compare with,
+# in which case thresholds on it don't apply.
+LANE_OUTLIER_SCORE_SUFFIXES = ['OutlierScore', 'HistoricalOutlierScore']
+LANE_OUTLIER_SCORE_METRICS = [metric + suffix for suffix in LANE_OUTLIER_SCORE_SUFFIXES for metric in LANE_LEVEL_METRICS]
+
+SUPPORTED_INSTRUMENT_TYPES = ['miseq', 'nextseq']
+
+READ_ROLES = list(parsers.READ_ROLE_METRICS.keys())
+
+# The read role that each per-read run-level metric is taken from.
+READ_ROLE_FOR_METRIC = {
+    metric + role: role for role, metrics in parsers.READ_ROLE_METRICS.items() for metric in metrics
+}
+
+COMPARISONS = {
+    'above': lambda value, threshold: value >= threshold,
+    'below': lambda value, threshold: value <= threshold,
+    'between': lambda value, threshold: threshold[0] <= value <= threshold[1],
+}
+
+SEVERITY_TO_FAILED_RESULT = {
+    'fail': 'FAIL',
+    'warn': 'WARN',
+}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _compile_qc_threshold(qc_threshold, idx):
+    """
+    Validate and compile a single qc threshold from the config.
+
+    :param qc_threshold: A qc threshold, as listed in the config.
+    :type qc_threshold: dict[str, object]
+    :param idx: Position of the threshold in the config, used to preserve ordering of results.
+    :type idx: int
+    :return: The compiled rule, and a list of problems found (empty if the threshold is valid).
+    :rtype: tuple[dict[str, object], list[str]]
+    """
+    problems = []
+    rule = {'index': idx}
+
+    metric = qc_threshold.get('metric', None)
+    level = qc_threshold.get('level', 'run')
+    if level not in ['run', 'lane']:
+        problems.append("unknown level: " + str(level))
+    elif metric is None:
+        problems.append("missing 'metric'")
+    elif level == 'run' and metric not in RUN_LEVEL_METRICS:
+        problems.append("unknown metric: " + str(metric))
+    elif level == 'lane' and metric not in LANE_LEVEL_METRICS and metric not in LANE_OUTLIER_SCORE_METRICS:
+        problems.append("unknown lane-level metric: " + str(metric))
+    rule['metric'] = metric
+    rule['level'] = level
+
+    pass_above_or_below = qc_threshold.get('pass_above_or_below', None)
+    threshold = qc_threshold.get('threshold', None)
+    if pass_above_or_below not in COMPARISONS:
+        problems.append("'pass_above_or_below' must be one of " + str(list(COMPARISONS.keys())) + ", got: " + str(pass_above_or_below))
+    elif pass_above_or_below == 'between':
+        valid_range = isinstance(threshold, list) and len(threshold) == 2 and all(_is_number(t) for t in threshold) and threshold[0] <= threshold[1]
+        if not valid_range:
+            problems.append("'threshold' must be a [lower, upper] range when 'pass_above_or_below' is 'between', got: " + str(threshold))
+    elif not _is_number(threshold):
+        problems.append("'threshold' must be a number, got: " + str(threshold))
+    rule['threshold'] = threshold
+    rule['pass_above_or_below'] = pass_above_or_below
+    rule['compare'] = COMPARISONS.get(pass_above_or_below, None)
+
+    severity = str(qc_threshold.get('severity', 'fail')).lower()
+    if severity not in SEVERITY_TO_FAILED_RESULT:
+        problems.append("'severity' must be one of " + str(list(SEVERITY_TO_FAILED_RESULT.keys())) + ", got: " + str(severity))
+    rule['severity'] = severity
+    rule['failed_result'] = SEVERITY_TO_FAILED_RESULT.get(severity, 'FAIL')
+
+    instrument_type = qc_threshold.get('instrument_type', None)
+    if instrument_type is not None:
+        instrument_type = str(instrument_type).lower()
+        if instrument_type not in SUPPORTED_INSTRUMENT_TYPES:
+            problems.append("unsupported instrument_type: " + str(qc_threshold['instrument_type']))
+    rule['instrument_type'] = instrument_type
+
+    flowcell_version = qc_threshold.get('flowcell_version', None)
+    if flowcell_version is not None:
+        flowcell_version = str(flowcell_version)
+    rule['flowcell_version'] = flowcell_version
+
+    # Other run parameters that a run must match for the rule to apply, eg. {"chemistry": "Amplicon"}
+    run_parameters = qc_threshold.get('run_parameters', {})
+    if not isinstance(run_parameters, dict):
+        problems.append("'run_parameters' must be an object, got: " + str(run_parameters))
+        run_parameters = {}
+    for field in run_parameters:
+        if field not in parsers.SCALAR_RUN_PARAMETERS_FIELDS:
+            problems.append("'run_parameters' may only include " + str(parsers.SCALAR_RUN_PARAMETERS_FIELDS) + ", got: " + str(field))
+    rule['run_parameters'] = {field: str(value) for field, value in run_parameters.items()}
+
+    for selector in ['read_number', 'lane_number']:
+        selector_value = qc_threshold.get(selector, None)
+        if selector_value is not None and level != 'lane':
+            problems.append("'" + selector + "' is only supported for lane-level thresholds")
+        elif selector_value is not None and not isinstance(selector_value, int):
+            problems.append("'" + selector + "' must be an integer, got: " + str(selector_value))
+        rule[selector] = selector_value
+
+    read_role = qc_threshold.get('read_role', None)
+    if read_role is not None and level != 'lane':
+        problems.append("'read_role' is only supported for lane-level thresholds")
+    elif read_role is not None and read_role not in READ_ROLES:
+        problems.append("'read_role' must be one of " + str(READ_ROLES) + ", got: " + str(read_role))
+    rule['read_role'] = read_role
+
+    return rule, problems
+
+
+def compile_qc_thresholds(qc_thresholds):
+    """
+    Validate the 'qc_thresholds' from the config, and compile them into a rule set
+    indexed by (instrument_type, flowcell_version).
+
+    Rules that don't specify an instrument_type or flowcell_version are indexed
+    under `None` for that key, and apply to all runs.
+
+    The rules that apply to each type of run are also listed up front, so that the
+    rule set isn't modified once compiled, and can be shared by concurrent checks.
+    Runs with a flowcell version that no rule mentions are listed under `None`.
+
+    :param qc_thresholds: The 'qc_thresholds' list from the config.
+    :type qc_thresholds: list[dict[str, object]]
+    :return: Compiled rule set. Keys: ['rules_by_key', 'rules_by_run_type', 'flowcell_versions']
+    :rtype: dict[str, object]
+    :raises ValueError: If any threshold is invalid. All problems found are included in the message.
+    """
+    rules_by_key = {}
+    all_problems = []
+    for idx, qc_threshold in enumerate(qc_thresholds):
+        rule, problems = _compile_qc_threshold(qc_threshold, idx)
+        for problem in problems:
+            all_problems.append("qc_thresholds[" + str(idx) + "]: " + problem)
+        key = (rule['instrument_type'], rule['flowcell_version'])
+        rules_by_key.setdefault(key, []).append(rule)
+
+    if all_problems:
+        raise ValueError("Invalid qc_thresholds: " + "; ".join(all_problems))
+
+    flowcell_versions = frozenset(flowcell_version for _, flowcell_version in rules_by_key if flowcell_version is not None)
+    rules_by_run_type = {}
+    for instrument_type in SUPPORTED_INSTRUMENT_TYPES + [None]:
+        for flowcell_version in list(flowcell_versions) + [None]:
+            rules = []
+            for key in set([(instrument_type, flowcell_version), (instrument_type, None), (None, flowcell_version), (None, None)]):
+                rules += rules_by_key.get(key, [])
+            rules.sort(key=lambda r: r['index'])
+            rules_by_run_type[(instrument_type, flowcell_version)] = rules
+
+    qc_rules = {
+        'rules_by_key': rules_by_key,
+        'rules_by_run_type': rules_by_run_type,
+        'flowcell_versions': flowcell_versions,
+    }
+
+    return qc_rules
+
+
+def get_rules_for_run(qc_rules, instrument_type, flowcell_version):
+    """
+    Get the rules that apply to a run, in the order they were listed in the config.
+
+    :param qc_rules: Compiled rule set, as produced by `compile_qc_thresholds`.
+    :type qc_rules: dict[str, object]
+    :param instrument_type: Instrument type of the run.
+    :type instrument_type: str
+    :param flowcell_version: Flowcell version of the run (if known).
+    :type flowcell_version: Optional[str]
+    :return: Rules that apply to the run.
+    :rtype: list[dict[str, object]]
+    """
+    if instrument_type not in SUPPORTED_INSTRUMENT_TYPES:
+        instrument_type = None
+    if flowcell_version is not None and str(flowcell_version) in qc_rules['flowcell_versions']:
+        flowcell_version = str(flowcell_version)
+    else:
+        flowcell_version = None
+
+    return qc_rules['rules_by_run_type'][(instrument_type, flowcell_version)]
+
+
+def _run_parameters_match(rule, run_parameters):
+    """
+    Check whether a run has all of the run parameters that a rule requires.
+    """
+    for field, value in rule['run_parameters'].items():
+        run_value = run_parameters.get(field, None)
+        if run_value is None or str(run_value) != value:
+            return False
+
+    return True
+
+
+def _check_value(rule, value):
+    """
+    Check a single value against a rule.
+
+    A missing value is treated as a failure.
+    """
+    checked_metric = {}
+    checked_metric['metric'] = rule['metric']
+    checked_metric['value'] = value
+    checked_metric['threshold'] = rule['threshold']
+    checked_metric['pass_above_or_below'] = rule['pass_above_or_below']
+    if value is not None and rule['compare'](value, rule['threshold']):
+        checked_metric['pass_fail'] = "PASS"
+    else:
+        checked_metric['pass_fail'] = rule['failed_result']
+    if rule['severity'] != 'fail':
+        checked_metric['severity'] = rule['severity']
+
+    return checked_metric
+
+
+@instrumentation.timed('evaluate_qc_rules')
+def evaluate_qc_rules(qc_rules, qc_metrics, instrument_type, flowcell_version, run_parameters=None):
+    """
+    Check qc metrics against the rules that apply to a run.
+
+    This function has no side effects other than logging, so it can be used to
+    re-evaluate previously-collected metrics.
+
+    :param qc_rules: Compiled rule set, as produced by `compile_qc_thresholds`.
+    :type qc_rules: dict[str, object]
+    :param qc_metrics: QC metrics, as produced by `parsers.parse_interop_summary`.
+    :type qc_metrics: dict[str, object]
+    :param instrument_type: Instrument type of the run.
+    :type instrument_type: str
+    :param flowcell_version: Flowcell version of the run (if known).
+    :type flowcell_version: Optional[str]
+    :param run_parameters: Run parameters, as produced by `parsers.parse_run_parameters_xml`. Rules that require run parameters are skipped if not given.
+    :type run_parameters: Optional[dict[str, object]]
+    :return: Checked metrics. Keys: ['metric', 'value', 'threshold', 'pass_above_or_below', 'pass_fail']
+    :rtype: list[dict[str, object]]
+    """
+    if run_parameters is None:
+        run_parameters = {}
+    # Metrics saved before read roles were recorded don't have a 'Role' for each read.
+    run_read_roles = set(r['Role'] for r in qc_metrics.get('Reads', []) if r.get('Role', None) is not None)
+    checked_metrics = []
+    for rule in get_rules_for_run(qc_rules, instrument_type, flowcell_version):
+        if rule['run_parameters'] and not _run_parameters_match(rule, run_parameters):
+            continue
+        if rule['level'] == 'run':
+            value = qc_metrics.get(rule['metric'], None)
+            read_role = READ_ROLE_FOR_METRIC.get(rule['metric'], None)
+            if value is None and read_role is not None and run_read_roles and read_role not in run_read_roles:
+                # eg. an 'R2' threshold for a single-end run.
+                logging.debug(json.dumps({"event_type": "qc_threshold_not_applicable", "metric": rule['metric'], "read_role": read_role}))
+                continue
+            if value is None:
+                logging.warning(json.dumps({"event_type": "qc_metric_not_found", "metric": rule['metric']}))
+            checked_metrics.append(_check_value(rule, value))
+        elif rule['level'] == 'lane':
+            for lane_read in qc_metrics.get('LanesByRead', []):
+                if rule['read_number'] is not None and lane_read.get('ReadNumber', None) != rule['read_number']:
+                    continue
+                if rule['lane_number'] is not None and lane_read.get('LaneNumber', None) != rule['lane_number']:
+                    continue
+                if rule['read_role'] is not None and lane_read.get('Role', None) != rule['read_role']:
+                    continue
+                value = lane_read.get(rule['metric'], None)
+                if value is None and rule['metric'] in LANE_OUTLIER_SCORE_METRICS:
+                    logging.debug(json.dumps({"event_type": "qc_threshold_not_applicable", "metric": rule['metric'], "read_number": lane_read.get('ReadNumber', None), "lane_number": lane_read.get('LaneNumber', None)}))
+                    continue
+                checked_metric = _check_value(rule, value)
+                checked_metric['read_number'] = lane_read.get('ReadNumber', None)
+                checked_metric['lane_number'] = lane_read.get('LaneNumber', None)
+                checked_metrics.append(checked_metric)
+
+    return checked_metrics
+
+
+def find_missing_lane_metrics(qc_rules, qc_metrics, instrument_type, flowcell_version, run_parameters=None):
+    """
+    Find the lane-level metrics that the rules which apply to a run need, but that are missing from
+    some lanes of its qc metrics (eg. because the files they come from weren't read).
+
+    A rule on a lane outlier score needs the metric that is scored.
+
+    :param qc_rules: Compiled rule set, as produced by `compile_qc_thresholds`.
+    :type qc_rules: dict[str, object]
+    :param qc_metrics: QC metrics, as produced by `parsers.parse_interop_summary`.
+    :type qc_metrics: dict[str, object]
+    :param instrument_type: Instrument type of the run.
+    :type instrument_type: str
+    :param flowcell_version: Flowcell version of the run (if known).
+    :type flowcell_version: Optional[str]
+    :param run_parameters: Run parameters, as produced by `parsers.parse_run_parameters_xml`. Rules that require run parameters are skipped if not given.
+    :type run_parameters: Optional[dict[str, object]]
+    :return: Missing lane-level metrics, in the order the rules that need them were listed.
+    :rtype: list[str]
+    """
+    if run_parameters is None:
+        run_parameters = {}
+    lanes_by_read = qc_metrics.get('LanesByRead', [])
+    missing_lane_metrics = []
+    for rule in get_rules_for_run(qc_rules, instrument_type, flowcell_version):
+        if rule['level'] != 'lane':
+            continue
+        if rule['run_parameters'] and not _run_parameters_match(rule, run_parameters):
+            continue
+        metric = rule['metric']
+        for suffix in LANE_OUTLIER_SCORE_SUFFIXES:
+            if metric in LANE_OUTLIER_SCORE_METRICS and metric.endswith(suffix):
+                metric = metric[:-len(suffix)]
+                break
+        if metric in missing_lane_metrics:
+            continue
+        if any(metric not in lane_read for lane_read in lanes_by_read):
+            missing_lane_metrics.append(metric)
+
+    return missing_lane_metrics
+
+
+def get_overall_pass_fail(checked_metrics):
+    """
+    Determine the overall result for a run. Warnings do not cause a run to fail.
+
+    :param checked_metrics: Checked metrics, as produced by `evaluate_qc_rules`.
+    :type checked_metrics: list[dict[str, object]]
+    :return: Overall result. One of ['PASS', 'FAIL']
+    :rtype: str
+    """
+    overall_pass_fail = "PASS"
+    if any([m['pass_fail'] == "FAIL" for m in checked_metrics]):
+        overall_pass_fail = "FAIL"
+
+    return overall_pass_fail
@@ -0,0 +1,330 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import sqlite3
+import struct
+import time
+
+import auto_illumina_run_qc_check.core as core
+import auto_illumina_run_qc_check.scan_state as scan_state
+
+
+UPLOAD_COMPLETE_FILENAME = 'upload_complete.json'
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+DEFAULT_POLL_INTERVAL_SECONDS = 30.0
+
+# States recorded in the scan state db for directories that can't be waiting for upload: their upload
+# has completed (and they've been checked), or they aren't run directories. Directories in these states
+# aren't looked at when the watcher starts. (Runs in the 'upload_incomplete' state are the ones to watch.)
+NOT_WAITING_FOR_UPLOAD_STATES = {scan_state.QC_CHECK_COMPLETE} | scan_state.TERMINAL_STATES
+
+
+def _is_waiting_for_upload(entry):
+    """
+    Check whether a directory looks like a sequencing run that is still being uploaded.
+
+    :param entry: The directory's entry in its run parent dir, as listed by `os.scandir`.
+    :type entry: os.DirEntry
+    :return: True if the directory name is a sequencing run ID and upload is not yet complete.
+    :rtype: bool
+    """
+    if core.get_instrument_type(entry.name) == 'unknown':
+        return False
+
+    return entry.is_dir() and not os.path.exists(os.path.join(entry.path, UPLOAD_COMPLETE_FILENAME))
+
+
+def _get_known_run_dir_states(scan_state_db, run_parent_dirs):
+    """
+    Get the states recorded in the scan state db for the directories under each run parent dir.
+
+    :param scan_state_db: Path to the scan state db, if there is one.
+    :type scan_state_db: Optional[str]
+    :param run_parent_dirs: Absolute paths to the run parent dirs.
+    :type run_parent_dirs: list[str]
+    :return: Recorded states for each run parent dir, indexed by directory name. Keys: ['state', 'mtime']
+    :rtype: dict[str, dict[str, dict[str, object]]]
+    """
+    known_run_dir_states = {run_parent_dir: {} for run_parent_dir in run_parent_dirs}
+    if not scan_state_db:
+        return known_run_dir_states
+
+    try:
+        conn = scan_state.open_scan_state_db(scan_state_db)
+        try:
+            for run_parent_dir in run_parent_dirs:
+                known_run_dir_states[run_parent_dir] = scan_state.get_run_dir_states(conn, run_parent_dir)
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError) as e:
+        logging.warning(json.dumps({"event_type": "load_scan_state_failed", "scan_state_db": scan_state_db, "exception": str(e)}))
+
+    return known_run_dir_states
+
+
+class PollingRunDirWatcher:
+    """
+    Watch run parent dirs for runs whose upload has completed, by periodically
+    checking only the runs that were seen waiting for upload, and listing the
+    parent dirs for new runs.
+
+    If a scan state db is given, runs that it records as already checked aren't looked at when the watcher starts.
+    """
+    def __init__(self, run_parent_dirs, poll_interval_seconds=DEFAULT_POLL_INTERVAL_SECONDS, scan_state_db=None):
+        self.run_parent_dirs = [os.path.abspath(d) for d in run_parent_dirs]
+        self.poll_interval_seconds = poll_interval_seconds
+        self.known_subdir_names = {}
+        self.waiting_run_dirs = set()
+        known_run_dir_states = _get_known_run_dir_states(scan_state_db, self.run_parent_dirs)
+        for run_parent_dir in self.run_parent_dirs:
+            self.known_subdir_names[run_parent_dir] = set()
+            for entry in self._find_new_subdirs(run_parent_dir):
+                known_run_dir_state = known_run_dir_states[run_parent_dir].get(entry.name, None)
+                if known_run_dir_state and known_run_dir_state['state'] in NOT_WAITING_FOR_UPLOAD_STATES:
+                    continue
+                if _is_waiting_for_upload(entry):
+                    self.waiting_run_dirs.add(entry.path)
+
+    def _find_new_subdirs(self, run_parent_dir):
+        """
+        List a run parent dir, returning the entries that weren't there last time.
+        """
+        new_subdirs = []
+        try:
+            with os.scandir(run_parent_dir) as entries:
+                for entry in entries:
+                    if entry.name not in self.known_subdir_names[run_parent_dir]:
+                        self.known_subdir_names[run_parent_dir].add(entry.name)
+                        new_subdirs.append(entry)
+        except OSError as e:
+            logging.error(json.dumps({"event_type": "watch_run_parent_dir_failed", "run_parent_dir": run_parent_dir, "exception": str(e)}))
+
+        return new_subdirs
+
+    def _poll(self):
+        """
+        Check for new runs, and for completed uploads of runs we've seen waiting.
+        """
+        for run_parent_dir in self.run_parent_dirs:
+            for entry in self._find_new_subdirs(run_parent_dir):
+                if core.get_instrument_type(entry.name) != 'unknown':
+                    self.waiting_run_dirs.add(entry.path)
+
+        upload_complete_run_dirs = []
+        for run_dir_path in sorted(self.waiting_run_dirs):
+            if os.path.exists(os.path.join(run_dir_path, UPLOAD_COMPLETE_FILENAME)):
+                upload_complete_run_dirs.append(run_dir_path)
+            elif not os.path.isdir(run_dir_path):
+                self.waiting_run_dirs.discard(run_dir_path)
+        self.waiting_run_dirs.difference_update(upload_complete_run_dirs)
+
+        return upload_complete_run_dirs
+
+    def wait_for_run_dirs(self, timeout_seconds):
+        """
+        Wait until at least one run's upload completes, or until the timeout expires.
+
+        :param timeout_seconds: Maximum time to wait.
+        :type timeout_seconds: float
+        :return: Paths to run directories whose upload has completed.
+        :rtype: list[str]
+        """
+        deadline = time.monotonic() + max(0.0, timeout_seconds)
+        while True:
+            upload_complete_run_dirs = self._poll()
+            remaining_seconds = deadline - time.monotonic()
+            if upload_complete_run_dirs or remaining_seconds <= 0:
+                return upload_complete_run_dirs
+            time.sleep(min(self.poll_interval_seconds, remaining_seconds))
+
+    def close(self):
+        pass
+
+
+class InotifyRunDirWatcher:
+    """
+    Watch run parent dirs for runs whose upload has completed, using Linux inotify.
+
+    Each run parent dir is watched for new subdirectories, and each run directory that is
+    waiting for upload is watched for the creation of 'upload_complete.json'. The watch on a
+    run directory is removed once its upload has completed.
+
+    inotify isn't notified of changes made by other hosts on a network filesystem (such as NFS),
+    so the run parent dirs are also polled every `poll_interval_seconds`, as by `PollingRunDirWatcher`.
+    The runs waiting for upload are found once, by the poller, and watched with inotify as well.
+    """
+    def __init__(self, run_parent_dirs, poll_interval_seconds=DEFAULT_POLL_INTERVAL_SECONDS, scan_state_db=None):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            self.parent_dir_watches = {}
+            self.run_dir_watches = {}
+            for run_parent_dir in run_parent_dirs:
+                run_parent_dir = os.path.abspath(run_parent_dir)
+                wd = self._add_watch(run_parent_dir, IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)
+                self.parent_dir_watches[wd] = run_parent_dir
+            # The run parent dirs are listed after they're watched, so that a run created in between isn't missed.
+            self.poller = PollingRunDirWatcher(run_parent_dirs, poll_interval_seconds, scan_state_db)
+            for run_dir_path in sorted(self.poller.waiting_run_dirs):
+                self._watch_run_dir(run_dir_path)
+            self.next_poll_time = time.monotonic() + poll_interval_seconds
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def _add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_add_watch failed: " + os.strerror(errno), path)
+
+        return wd
+
+    def _watch_run_dir(self, run_dir_path):
+        try:
+            wd = self._add_watch(run_dir_path, IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ONLYDIR)
+            self.run_dir_watches[wd] = run_dir_path
+        except OSError as e:
+            logging.error(json.dumps({"event_type": "watch_run_dir_failed", "run_directory_path": run_dir_path, "exception": str(e)}))
+
+    def _unwatch_run_dir(self, wd):
+        self.run_dir_watches.pop(wd, None)
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _read_events(self):
+        """
+        Read all pending inotify events.
+
+        :return: (watch descriptor, mask, name) for each event.
+        :rtype: list[tuple[int, int, str]]
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + INOTIFY_EVENT_HEADER.size <= len(buf):
+                wd, mask, cookie, name_length = INOTIFY_EVENT_HEADER.unpack_from(buf, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = os.fsdecode(buf[offset:offset + name_length].rstrip(b'\0'))
+                offset += name_length
+                events.append((wd, mask, name))
+
+        return events
+
+    def wait_for_run_dirs(self, timeout_seconds):
+        """
+        Wait until at least one run's upload completes, or until the timeout expires.
+
+        :param timeout_seconds: Maximum time to wait.
+        :type timeout_seconds: float
+        :return: Paths to run directories whose upload has completed.
+        :rtype: list[str]
+        """
+        deadline = time.monotonic() + max(0.0, timeout_seconds)
+        upload_complete_run_dirs = []
+        while not upload_complete_run_dirs:
+            now = time.monotonic()
+            remaining_seconds = deadline - now
+            if remaining_seconds <= 0:
+                break
+            if now >= self.next_poll_time:
+                upload_complete_run_dirs += self.poller._poll()
+                self.next_poll_time = now + self.poller.poll_interval_seconds
+                continue
+            readable, _, _ = select.select([self.fd], [], [], min(remaining_seconds, self.next_poll_time - now))
+            if not readable:
+                continue
+            for wd, mask, name in self._read_events():
+                if mask & IN_Q_OVERFLOW:
+                    # Events were dropped. They will be picked up by the next full scan.
+                    logging.warning(json.dumps({"event_type": "inotify_queue_overflow"}))
+                elif mask & IN_IGNORED:
+                    self.run_dir_watches.pop(wd, None)
+                elif wd in self.parent_dir_watches and mask & IN_ISDIR:
+                    run_parent_dir = self.parent_dir_watches[wd]
+                    run_dir_path = os.path.join(run_parent_dir, name)
+                    if core.get_instrument_type(name) == 'unknown':
+                        continue
+                    # Already seen, so the poller doesn't report it as a new run.
+                    self.poller.known_subdir_names[run_parent_dir].add(name)
+                    self.poller.waiting_run_dirs.add(run_dir_path)
+                    self._watch_run_dir(run_dir_path)
+                    # The upload may have completed before the watch was in place.
+                    if os.path.exists(os.path.join(run_dir_path, UPLOAD_COMPLETE_FILENAME)):
+                        upload_complete_run_dirs.append(run_dir_path)
+                elif wd in self.run_dir_watches and name == UPLOAD_COMPLETE_FILENAME:
+                    upload_complete_run_dirs.append(self.run_dir_watches[wd])
+
+        upload_complete_run_dirs = list(dict.fromkeys(upload_complete_run_dirs))
+        for run_dir_path in upload_complete_run_dirs:
+            self.poller.waiting_run_dirs.discard(run_dir_path)
+            for wd, watched_path in list(self.run_dir_watches.items()):
+                if watched_path == run_dir_path:
+                    self._unwatch_run_dir(wd)
+
+        return upload_complete_run_dirs
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_run_dir_watcher(config):
+    """
+    Create a watcher for the run parent dirs listed in the config, according to the 'watch_mode' setting.
+
+    If 'watch_mode' is 'inotify', the run parent dirs are polled as well, so that changes that inotify
+    isn't notified of are still found. If inotify is not available, falls back to polling alone.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: A run dir watcher, or None if watch mode is not enabled.
+    :rtype: Optional[InotifyRunDirWatcher | PollingRunDirWatcher]
+    """
+    watch_mode = config.get('watch_mode', None)
+    if not watch_mode:
+        return None
+
+    run_parent_dirs = config['run_parent_dirs']
+    scan_state_db = config.get('scan_state_db', None)
+    poll_interval_seconds = DEFAULT_POLL_INTERVAL_SECONDS
+    try:
+        poll_interval_seconds = float(str(config.get('watch_poll_interval_seconds', DEFAULT_POLL_INTERVAL_SECONDS)))
+    except ValueError as e:
+        logging.error(json.dumps({
+            "event_type": "invalid_watch_poll_interval_seconds",
+            "watch_poll_interval_seconds": config['watch_poll_interval_seconds'],
+        }))
+
+    if watch_mode == 'inotify':
+        try:
+            watcher = InotifyRunDirWatcher(run_parent_dirs, poll_interval_seconds, scan_state_db)
+            logging.info(json.dumps({"event_type": "run_dir_watcher_started", "watch_mode": "inotify", "watch_poll_interval_seconds": poll_interval_seconds}))
+            return watcher
+        except (OSError, AttributeError) as e:
+            logging.warning(json.dumps({"event_type": "inotify_unavailable", "exception": str(e)}))
+
+    watcher = PollingRunDirWatcher(run_parent_dirs, poll_interval_seconds, scan_state_db)
+    logging.info(json.dumps({"event_type": "run_dir_watcher_started", "watch_mode": "poll", "watch_poll_interval_seconds": poll_interval_seconds}))
+
+    return watcher
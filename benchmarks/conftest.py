@@ -0,0 +1,62 @@
+import os
+import stat
+
+import pytest
+
+import run_tree
+
+
+DEFAULT_RUN_DIR_COUNTS = '10,1000,50000'
+
+# Stands in for interop_summary: prints the recorded output for the run.
+STUB_INTEROP_SUMMARY = """#!/bin/sh
+cat "$1/interop_summary.csv"
+"""
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--run-dir-counts',
+        default=DEFAULT_RUN_DIR_COUNTS,
+        help='Comma-separated numbers of run directories to benchmark scans of (default: ' + DEFAULT_RUN_DIR_COUNTS + ')',
+    )
+
+
+def pytest_generate_tests(metafunc):
+    if 'num_run_dirs' in metafunc.fixturenames:
+        run_dir_counts = [int(n) for n in metafunc.config.getoption('run_dir_counts').split(',')]
+        metafunc.parametrize('num_run_dirs', run_dir_counts, scope='session')
+
+
+@pytest.fixture(scope='session')
+def run_tree_factory(tmp_path_factory):
+    """
+    Build (once per session) a tree of synthetic run directories, with 10 runs waiting for a QC check.
+    """
+    run_trees = {}
+
+    def get_run_tree(num_run_dirs):
+        if num_run_dirs not in run_trees:
+            run_parent_dir = str(tmp_path_factory.mktemp('runs_{}'.format(num_run_dirs)))
+            run_trees[num_run_dirs] = (run_parent_dir, run_tree.make_run_tree(run_parent_dir, num_run_dirs))
+        return run_trees[num_run_dirs]
+
+    return get_run_tree
+
+
+@pytest.fixture
+def run_tree_of_size(run_tree_factory, num_run_dirs):
+    run_parent_dir, pending_runs = run_tree_factory(num_run_dirs)
+    yield run_parent_dir, pending_runs
+    run_tree.reset_pending_runs(pending_runs)
+
+
+@pytest.fixture(scope='session')
+def stub_interop_summary(tmp_path_factory):
+    bin_dir = tmp_path_factory.mktemp('bin')
+    stub_path = bin_dir / 'interop_summary'
+    stub_path.write_text(STUB_INTEROP_SUMMARY)
+    stub_path.chmod(stub_path.stat().st_mode | stat.S_IXUSR)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+        yield
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Build a synthetic tree of sequencing run directories, for benchmarking and profiling.
+
+Each run directory has a RunParameters.xml file, an 'upload_complete.json' marker, and the RunInfo.xml and
+recorded 'interop_summary.csv' output of one of the fixture runs in tests/data. Runs that are 'pending' have
+fastq files (sparse, so they take no disk space) and no 'qc_check_complete.json'. The rest have already been
+QC checked, as most of the runs in an archive have.
+
+Usage:
+
+    python benchmarks/run_tree.py /path/to/runs --num-runs 50000 --num-pending-runs 10
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'data')
+FIXTURE_RUN_DIRS = {
+    'miseq': os.path.join(DATA_DIR, 'miseq_interop_run'),
+    'nextseq': os.path.join(DATA_DIR, 'nextseq_interop_run'),
+}
+INSTRUMENT_TYPES = ['miseq', 'nextseq']
+NUM_INSTRUMENTS_PER_TYPE = 2
+FIRST_RUN_DATE = datetime.date(2020, 1, 1)
+RUNS_PER_DAY = 4
+
+RUN_PARAMETERS_XML = {
+    'miseq': """<?xml version="1.0"?>
+<RunParameters xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <Setup>
+    <ApplicationName>MiSeq Control Software</ApplicationName>
+    <ApplicationVersion>4.0.0.1769</ApplicationVersion>
+  </Setup>
+  <RunID>{run_id}</RunID>
+  <ScannerID>{instrument_id}</ScannerID>
+  <RunStartDate>{run_date}</RunStartDate>
+  <Chemistry>Amplicon</Chemistry>
+  <ReagentKitVersion>Version2</ReagentKitVersion>
+  <Reads>
+    <RunInfoRead Number="1" NumCycles="151" IsIndexedRead="N" />
+    <RunInfoRead Number="2" NumCycles="8" IsIndexedRead="Y" />
+    <RunInfoRead Number="3" NumCycles="8" IsIndexedRead="Y" />
+    <RunInfoRead Number="4" NumCycles="151" IsIndexedRead="N" />
+  </Reads>
+  <ReagentKitRFIDTag>
+    <SerialNumber>MS1234567-300V2</SerialNumber>
+    <LotNumber>20500000</LotNumber>
+  </ReagentKitRFIDTag>
+</RunParameters>
+""",
+    'nextseq': """<?xml version="1.0"?>
+<RunParameters xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <Side>A</Side>
+  <RunId>{run_id}</RunId>
+  <InstrumentSerialNumber>{instrument_id}</InstrumentSerialNumber>
+  <RunStartDate>{run_date}</RunStartDate>
+  <FlowCellVersion>P2</FlowCellVersion>
+  <ChemistryVersion>XLEAP-SBS</ChemistryVersion>
+  <PlannedReads>
+    <Read ReadName="Read1" Cycles="151" />
+    <Read ReadName="Index1" Cycles="8" />
+    <Read ReadName="Index2" Cycles="8" />
+    <Read ReadName="Read2" Cycles="151" />
+  </PlannedReads>
+  <ConsumableInfo>
+    <ConsumableInfo>
+      <LotNumber>20600000</LotNumber>
+      <Type>Reagent</Type>
+    </ConsumableInfo>
+  </ConsumableInfo>
+</RunParameters>
+""",
+}
+
+
+def make_run_id(instrument_type, run_number):
+    """
+    Make a sequencing run ID in the format used by an instrument type.
+
+    :param instrument_type: Instrument type. One of ['miseq', 'nextseq']
+    :type instrument_type: str
+    :param run_number: Number of the run. Run IDs are unique for each run number.
+    :type run_number: int
+    :return: Sequencing run ID.
+    :rtype: str
+    """
+    run_date = (FIRST_RUN_DATE + datetime.timedelta(days=run_number // RUNS_PER_DAY)).strftime('%y%m%d')
+    instrument_number = 100 + (run_number // len(INSTRUMENT_TYPES)) % NUM_INSTRUMENTS_PER_TYPE
+    if instrument_type == 'miseq':
+        return '{}_M{:05d}_{:04d}_000000000-{:05X}'.format(run_date, instrument_number, run_number, run_number)
+
+    return '{}_VH{:05d}_{}_{:09X}'.format(run_date, instrument_number, run_number, run_number)
+
+
+def _link_or_copy(src, dst):
+    # The fixture files are the same for every run, so they're hard-linked where possible to save space.
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        shutil.copyfile(src, dst)
+
+
+def _get_fastq_dir(run_dir, instrument_type):
+    if instrument_type == 'miseq':
+        return os.path.join(run_dir, 'Alignment_1', '20200101_120000', 'Fastq')
+
+    return os.path.join(run_dir, 'Analysis', '1', 'Data', 'fastq')
+
+
+def make_fastq_files(run_dir, instrument_type, num_samples, fastq_size_bytes):
+    """
+    Create sparse fastq files for a run: R1 and R2 for each sample, plus 'Undetermined'.
+
+    :param run_dir: Path to the run directory.
+    :type run_dir: str
+    :param instrument_type: Instrument type. One of ['miseq', 'nextseq']
+    :type instrument_type: str
+    :param num_samples: Number of samples.
+    :type num_samples: int
+    :param fastq_size_bytes: Apparent size of each fastq file, in bytes.
+    :type fastq_size_bytes: int
+    :return: Path to the fastq directory.
+    :rtype: str
+    """
+    fastq_dir = _get_fastq_dir(run_dir, instrument_type)
+    os.makedirs(fastq_dir, exist_ok=True)
+    library_ids = ['S{:04d}'.format(i) for i in range(1, num_samples + 1)] + ['Undetermined']
+    for sample_number, library_id in enumerate(library_ids, 1):
+        for read in ['R1', 'R2']:
+            fastq_path = os.path.join(fastq_dir, '{}_S{}_L001_{}_001.fastq.gz'.format(library_id, sample_number, read))
+            with open(fastq_path, 'wb') as f:
+                f.truncate(fastq_size_bytes)
+
+    return fastq_dir
+
+
+def make_run_dir(run_parent_dir, instrument_type, run_number, pending=False, num_samples=24, fastq_size_bytes=50 * 1024 * 1024):
+    """
+    Create a synthetic run directory.
+
+    :param run_parent_dir: Directory to create the run directory in.
+    :type run_parent_dir: str
+    :param instrument_type: Instrument type. One of ['miseq', 'nextseq']
+    :type instrument_type: str
+    :param run_number: Number of the run, used to make its run ID.
+    :type run_number: int
+    :param pending: Whether the run is waiting for a QC check. Pending runs have fastq files, and no 'qc_check_complete.json'.
+    :type pending: bool
+    :param num_samples: Number of samples, for a pending run.
+    :type num_samples: int
+    :param fastq_size_bytes: Apparent size of each fastq file, for a pending run.
+    :type fastq_size_bytes: int
+    :return: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type', 'run_parameters']
+    :rtype: dict[str, object]
+    """
+    run_id = make_run_id(instrument_type, run_number)
+    run_dir = os.path.join(run_parent_dir, run_id)
+    os.makedirs(run_dir)
+    with open(os.path.join(run_dir, 'RunParameters.xml'), 'w') as f:
+        f.write(RUN_PARAMETERS_XML[instrument_type].format(
+            run_id=run_id,
+            instrument_id=run_id.split('_')[1],
+            run_date=run_id.split('_')[0],
+        ))
+    for filename in ['RunInfo.xml', 'interop_summary.csv']:
+        _link_or_copy(os.path.join(FIXTURE_RUN_DIRS[instrument_type], filename), os.path.join(run_dir, filename))
+    if pending:
+        make_fastq_files(run_dir, instrument_type, num_samples, fastq_size_bytes)
+    else:
+        with open(os.path.join(run_dir, 'qc_check_complete.json'), 'w') as f:
+            json.dump({'sequencing_run_id': run_id, 'overall_pass_fail': 'PASS', 'checked_metrics': []}, f)
+    with open(os.path.join(run_dir, 'upload_complete.json'), 'w') as f:
+        json.dump({}, f)
+
+    return {
+        'sequencing_run_id': run_id,
+        'path': run_dir,
+        'instrument_type': instrument_type,
+        'run_parameters': {},
+    }
+
+
+def make_run_tree(run_parent_dir, num_runs, num_pending_runs=10, num_samples=24, fastq_size_bytes=50 * 1024 * 1024):
+    """
+    Create a tree of synthetic run directories, alternating between MiSeq and NextSeq runs.
+    The pending runs are spread evenly through the tree.
+
+    :param run_parent_dir: Directory to create the run directories in. Created if it doesn't exist.
+    :type run_parent_dir: str
+    :param num_runs: Number of run directories.
+    :type num_runs: int
+    :param num_pending_runs: Number of runs waiting for a QC check.
+    :type num_pending_runs: int
+    :param num_samples: Number of samples in each pending run.
+    :type num_samples: int
+    :param fastq_size_bytes: Apparent size of each fastq file in the pending runs.
+    :type fastq_size_bytes: int
+    :return: The pending runs. Keys: ['sequencing_run_id', 'path', 'instrument_type', 'run_parameters']
+    :rtype: list[dict[str, object]]
+    """
+    os.makedirs(run_parent_dir, exist_ok=True)
+    num_pending_runs = min(num_pending_runs, num_runs)
+    pending_run_numbers = set()
+    if num_pending_runs > 0:
+        pending_run_numbers = set(i * num_runs // num_pending_runs for i in range(num_pending_runs))
+    pending_runs = []
+    for run_number in range(num_runs):
+        pending = run_number in pending_run_numbers
+        run = make_run_dir(
+            run_parent_dir,
+            INSTRUMENT_TYPES[run_number % len(INSTRUMENT_TYPES)],
+            run_number,
+            pending=pending,
+            num_samples=num_samples,
+            fastq_size_bytes=fastq_size_bytes,
+        )
+        if pending:
+            pending_runs.append(run)
+
+    return pending_runs
+
+
+def reset_pending_runs(pending_runs):
+    """
+    Remove the outputs of QC checks from pending runs, so that they can be checked again.
+
+    :param pending_runs: The pending runs, as returned by `make_run_tree`.
+    :type pending_runs: list[dict[str, object]]
+    :return: None
+    :rtype: None
+    """
+    for run in pending_runs:
+        run_id = run['sequencing_run_id']
+        for filename in ['qc_check_complete.json', run_id + '_qc_metrics.json', run_id + '_fastq_manifest.json']:
+            try:
+                os.remove(os.path.join(run['path'], filename))
+            except FileNotFoundError as e:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a synthetic tree of sequencing run directories.')
+    parser.add_argument('run_parent_dir', help='Directory to create the run directories in')
+    parser.add_argument('--num-runs', type=int, default=1000, help='Number of run directories (default: 1000)')
+    parser.add_argument('--num-pending-runs', type=int, default=10, help='Number of runs waiting for a QC check (default: 10)')
+    parser.add_argument('--num-samples', type=int, default=24, help='Number of samples in each pending run (default: 24)')
+    parser.add_argument('--fastq-size-bytes', type=int, default=50 * 1024 * 1024, help='Apparent size of each fastq file (default: 50 MB)')
+    args = parser.parse_args()
+
+    pending_runs = make_run_tree(args.run_parent_dir, args.num_runs, args.num_pending_runs, args.num_samples, args.fastq_size_bytes)
+    for run in pending_runs:
+        print(run['path'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+import auto_illumina_run_qc_check.core as core
+import run_tree
+
+
+@pytest.fixture(params=[24, 384], ids=lambda num_samples: '{}_samples'.format(num_samples))
+def pending_run(request, tmp_path):
+    run = run_tree.make_run_dir(str(tmp_path), 'nextseq', 0, pending=True, num_samples=request.param, fastq_size_bytes=10 * 1024 * 1024)
+
+    return run, request.param
+
+
+def test_get_sum_sample_fastq_file_sizes(benchmark, pending_run):
+    run, num_samples = pending_run
+
+    # The fastq manifest is removed before each round, so the fastq directory is listed each time.
+    sum_sizes = benchmark.pedantic(
+        core.get_sum_sample_fastq_file_sizes,
+        args=(run,),
+        setup=lambda: run_tree.reset_pending_runs([run]),
+        rounds=20,
+    )
+
+    assert sum_sizes == pytest.approx(num_samples * 2 * 10.0)
+
+
+def test_get_sum_sample_fastq_file_sizes_from_manifest(benchmark, pending_run):
+    run, num_samples = pending_run
+    core.get_sum_sample_fastq_file_sizes(run)
+
+    sum_sizes = benchmark(core.get_sum_sample_fastq_file_sizes, run)
+
+    assert sum_sizes == pytest.approx(num_samples * 2 * 10.0)
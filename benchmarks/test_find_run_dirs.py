@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+import auto_illumina_run_qc_check.core as core
+
+
+def _find_runs(config):
+    return [run for run in core.find_run_dirs(config) if run is not None]
+
+
+def test_find_run_dirs(benchmark, run_tree_of_size):
+    run_parent_dir, pending_runs = run_tree_of_size
+    config = {'run_parent_dirs': [run_parent_dir], 'excluded_runs': frozenset()}
+
+    runs = benchmark(_find_runs, config)
+
+    assert len(runs) == len(pending_runs)
+
+
+def test_find_run_dirs_with_scan_state(benchmark, run_tree_of_size, tmp_path):
+    run_parent_dir, pending_runs = run_tree_of_size
+    config = {'run_parent_dirs': [run_parent_dir], 'excluded_runs': frozenset(), 'scan_state_db': str(tmp_path / 'scan_state.db')}
+    # The first scan records the state of every directory, so only later scans are measured.
+    _find_runs(config)
+
+    runs = benchmark(_find_runs, config)
+
+    assert len(runs) == len(pending_runs)
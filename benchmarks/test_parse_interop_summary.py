@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+import auto_illumina_run_qc_check.parsers as parsers
+import legacy_parsers
+import run_tree
+
+
+def _read_summary_lines(run_dir):
+    with open(os.path.join(run_dir, 'interop_summary.csv'), 'r') as f:
+        return f.readlines()
+
+
+def _add_lanes(summary_lines):
+    """
+    Turn a 2-lane summary into a 4-lane one (as for a NextSeq 500/550), by repeating the lines for lanes 1 and 2 as lanes 3 and 4.
+    """
+    four_lane_summary_lines = []
+    lane_lines = []
+    for line in summary_lines:
+        four_lane_summary_lines.append(line)
+        if line.startswith(('1,', '2,')):
+            lane_lines.append(line)
+        if line.startswith('2,'):
+            for lane_line in lane_lines:
+                four_lane_summary_lines.append(str(int(lane_line[0]) + 2) + lane_line[1:])
+            lane_lines = []
+
+    return four_lane_summary_lines
+
+
+@pytest.fixture(params=['miseq', 'nextseq', 'nextseq_4_lanes'])
+def interop_summary(request):
+    run_dir = run_tree.FIXTURE_RUN_DIRS[request.param.split('_')[0]]
+    summary_lines = _read_summary_lines(run_dir)
+    if request.param == 'nextseq_4_lanes':
+        summary_lines = _add_lanes(summary_lines)
+
+    return request.param, summary_lines, parsers.parse_run_info_xml(os.path.join(run_dir, 'RunInfo.xml'))
+
+
+def test_parse_interop_summary(benchmark, interop_summary):
+    name, summary_lines, run_info_reads = interop_summary
+    benchmark.group = 'parse_interop_summary: ' + name
+
+    qc_metrics = benchmark(parsers.parse_interop_summary, summary_lines, run_info_reads)
+
+    assert len(qc_metrics['LanesByRead']) == len(legacy_parsers.parse_interop_summary(summary_lines)['LanesByRead'])
+
+
+def test_legacy_parse_interop_summary(benchmark, interop_summary):
+    name, summary_lines, _ = interop_summary
+    benchmark.group = 'parse_interop_summary: ' + name
+
+    qc_metrics = benchmark(legacy_parsers.parse_interop_summary, summary_lines)
+
+    assert qc_metrics['LanesByRead']
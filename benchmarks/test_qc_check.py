@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+import auto_illumina_run_qc_check.core as core
+import run_tree
+
+
+QC_THRESHOLDS = [
+    {'metric': 'PercentGtQ30', 'level': 'lane', 'read_role': 'R1', 'pass_above_or_below': 'above', 'threshold': 70},
+    {'metric': 'ErrorRate', 'pass_above_or_below': 'below', 'threshold': 2.0},
+    {'metric': 'SumSampleFastqFileSizesMb', 'pass_above_or_below': 'above', 'threshold': 100},
+]
+
+
+def _scan_and_check(config):
+    qc_check_results = []
+    for run in core.find_run_dirs(config):
+        if run is not None:
+            qc_check_results.append(core.qc_check(config, run, send_notifications=False))
+
+    return qc_check_results
+
+
+def test_qc_check(benchmark, run_tree_factory, stub_interop_summary):
+    _, pending_runs = run_tree_factory(10)
+    run = pending_runs[0]
+    config = {'qc_thresholds': QC_THRESHOLDS}
+
+    qc_check_result = benchmark.pedantic(core.qc_check, args=(config, run), kwargs={'send_notifications': False}, setup=lambda: run_tree.reset_pending_runs([run]), rounds=20)
+    run_tree.reset_pending_runs([run])
+
+    assert qc_check_result['overall_pass_fail'] == 'PASS'
+
+
+def test_scan_and_qc_check(benchmark, run_tree_of_size, stub_interop_summary):
+    run_parent_dir, pending_runs = run_tree_of_size
+    config = {'run_parent_dirs': [run_parent_dir], 'excluded_runs': frozenset(), 'qc_thresholds': QC_THRESHOLDS}
+
+    qc_check_results = benchmark.pedantic(_scan_and_check, args=(config,), setup=lambda: run_tree.reset_pending_runs(pending_runs), rounds=5)
+
+    assert [r['overall_pass_fail'] for r in qc_check_results] == ['PASS'] * len(pending_runs)
@@ -3,7 +3,7 @@ from setuptools import setup, find_namespace_packages
 setup(
     name='auto-illumina-run-qc-check',
     version='0.1.0',
-    packages=find_namespace_packages(),
+    packages=find_namespace_packages(include=['auto_illumina_run_qc_check*']),
     entry_points={
         "console_scripts": [
             "auto-illumina-run-qc-check = auto_illumina_run_qc_check.__main__:main",
@@ -11,13 +11,17 @@ setup(
     },
     scripts=[],
     package_data={
-        "auto_illumina_run_qc_check": ["templates/*.html"],
+        "auto_illumina_run_qc_check": ["templates/*.html", "templates/*.txt"],
     },
     python_requires='>=3.5,<3.11',
     install_requires=[
         'requests~=2.32',
         'jinja2~=3.1',
     ],
+    extras_require={
+        'test': ['pytest'],
+        'benchmark': ['pytest', 'pytest-benchmark'],
+    },
     description='Automated checking of run-level QC metrics for illumina sequencing runs.',
     url='https://github.com/BCCDC-PHL/auto-illumina-run-qc-check',
     author='Dan Fornika',
@@ -0,0 +1,23 @@
+import os
+import stat
+
+import pytest
+
+
+# Stands in for interop_summary: prints the recorded output for the run (after sleeping
+# for $STUB_INTEROP_SUMMARY_SLEEP seconds, if set), and records that it was run.
+STUB_INTEROP_SUMMARY = """#!/bin/sh
+touch "$1/interop_summary_was_run"
+sleep "${STUB_INTEROP_SUMMARY_SLEEP:-0}"
+cat "$1/interop_summary.csv"
+"""
+
+
+@pytest.fixture
+def stub_interop_summary(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub_path = bin_dir / 'interop_summary'
+    stub_path.write_text(STUB_INTEROP_SUMMARY)
+    stub_path.chmod(stub_path.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
@@ -0,0 +1,169 @@
+"""
+Write the synthetic InterOp run directories used by the native InterOp reader tests.
+
+The binaries are deterministic, so running this again reproduces the committed files.
+After changing them, record the matching interop_summary output with `record_interop_summary.py`.
+
+    python tests/data/make_interop_fixtures.py tests/data
+"""
+import os
+import random
+import struct
+import sys
+
+
+def _write_run_info(run_dir, run_id, reads, lane_count, tiles, image_channels=None):
+    with open(os.path.join(run_dir, 'RunInfo.xml'), 'w') as f:
+        f.write('<?xml version="1.0"?>\n')
+        f.write('<RunInfo Version="' + ('6' if image_channels else '2') + '">\n')
+        f.write('  <Run Id="' + run_id + '" Number="' + run_id.split('_')[2] + '">\n')
+        f.write('    <Flowcell>' + run_id.split('_')[3] + '</Flowcell>\n')
+        f.write('    <Instrument>' + run_id.split('_')[1] + '</Instrument>\n')
+        f.write('    <Date>' + run_id.split('_')[0] + '</Date>\n')
+        f.write('    <Reads>\n')
+        for read_number, num_cycles, is_indexed in reads:
+            f.write('      <Read Number="%d" NumCycles="%d" IsIndexedRead="%s" />\n' % (read_number, num_cycles, 'Y' if is_indexed else 'N'))
+        f.write('    </Reads>\n')
+        f.write('    <FlowcellLayout LaneCount="%d" SurfaceCount="2" SwathCount="1" TileCount="%d">\n' % (lane_count, len(tiles) // lane_count // 2))
+        f.write('      <TileSet TileNamingConvention="FourDigit">\n        <Tiles>\n')
+        for lane, tile in tiles:
+            f.write('          <Tile>%d_%d</Tile>\n' % (lane, tile))
+        f.write('        </Tiles>\n      </TileSet>\n    </FlowcellLayout>\n')
+        if image_channels:
+            f.write('    <ImageChannels>\n')
+            for channel in image_channels:
+                f.write('      <Name>' + channel + '</Name>\n')
+            f.write('    </ImageChannels>\n')
+        f.write('  </Run>\n</RunInfo>\n')
+
+
+def _cycle_ranges(reads):
+    cycle_ranges = {}
+    first_cycle = 1
+    for read_number, num_cycles, _ in reads:
+        cycle_ranges[read_number] = list(range(first_cycle, first_cycle + num_cycles))
+        first_cycle += num_cycles
+
+    return cycle_ranges
+
+
+def make_nextseq_run(run_dir):
+    """
+    NextSeq 2000-style run: TileMetricsOut v3, ErrorMetricsOut v4, binned QMetricsOut v7,
+    ExtractionMetricsOut v3, EmpiricalPhasingMetricsOut v2 and ExtendedTileMetricsOut v3.
+    """
+    rnd = random.Random(17)
+    os.makedirs(os.path.join(run_dir, 'InterOp'), exist_ok=True)
+    reads = [(1, 26, False), (2, 8, True), (3, 8, True), (4, 26, False)]
+    tiles = [(lane, tile) for lane in [1, 2] for tile in [1101, 1102, 2101, 2102]]
+    num_cycles = sum(r[1] for r in reads)
+    cycle_ranges = _cycle_ranges(reads)
+    _write_run_info(run_dir, '240110_VH00123_110_AAG4WXG10', reads, 2, tiles, image_channels=['blue', 'green'])
+    interop_dir = os.path.join(run_dir, 'InterOp')
+
+    tile_area = 2.6
+    cluster_counts = {}
+    with open(os.path.join(interop_dir, 'TileMetricsOut.bin'), 'wb') as f:
+        f.write(bytes([3, 15]) + struct.pack('<f', tile_area))
+        for lane, tile in tiles:
+            cluster_count = rnd.uniform(4.0e6, 4.4e6) * (0.9 if lane == 2 else 1.0)
+            cluster_counts[(lane, tile)] = cluster_count
+            f.write(struct.pack('<HIcff', lane, tile, b't', cluster_count, cluster_count * rnd.uniform(0.75, 0.8)))
+            for read_number in [1, 4]:
+                f.write(struct.pack('<HIcIf', lane, tile, b'r', read_number, rnd.uniform(1.0, 2.0)))
+
+    with open(os.path.join(interop_dir, 'ErrorMetricsOut.bin'), 'wb') as f:
+        f.write(bytes([4, 12]))
+        for lane, tile in tiles:
+            for read_number in [1, 4]:
+                for cycle in cycle_ranges[read_number]:
+                    f.write(struct.pack('<HIHf', lane, tile, cycle, rnd.uniform(0.1, 0.6)))
+
+    # Each bin is written as (lower bound, upper bound, value).
+    q_bins = [(2, 19, 12), (20, 29, 24), (30, 40, 36)]
+    with open(os.path.join(interop_dir, 'QMetricsOut.bin'), 'wb') as f:
+        f.write(bytes([7, 8 + 4 * len(q_bins), 1, len(q_bins)]))
+        for q_bin in q_bins:
+            f.write(bytes(q_bin))
+        for lane, tile in tiles:
+            for cycle in range(1, num_cycles + 1):
+                f.write(struct.pack('<HIH3I', lane, tile, cycle, rnd.randint(100, 400), rnd.randint(400, 900), rnd.randint(5000, 8000)))
+
+    with open(os.path.join(interop_dir, 'ExtractionMetricsOut.bin'), 'wb') as f:
+        f.write(bytes([3, 20, 2]))
+        for lane, tile in tiles:
+            for cycle in range(1, num_cycles + 1):
+                f.write(struct.pack('<HIH2f2H', lane, tile, cycle, 2.5, 2.6, rnd.randint(900, 1200), rnd.randint(800, 1100)))
+
+    with open(os.path.join(interop_dir, 'EmpiricalPhasingMetricsOut.bin'), 'wb') as f:
+        f.write(bytes([2, 16]))
+        for lane, tile in tiles:
+            for cycle in range(1, num_cycles + 1):
+                f.write(struct.pack('<HIHff', lane, tile, cycle, 1.2 + 0.09 * cycle + rnd.uniform(0, 0.3), 0.6 + 0.12 * cycle + rnd.uniform(0, 0.2)))
+
+    with open(os.path.join(interop_dir, 'ExtendedTileMetricsOut.bin'), 'wb') as f:
+        f.write(bytes([3, 18]))
+        for lane, tile in tiles:
+            f.write(struct.pack('<HIfff', lane, tile, cluster_counts[(lane, tile)] * rnd.uniform(0.85, 0.98), 0.0, 0.0))
+
+
+def make_miseq_run(run_dir):
+    """
+    MiSeq-style run: TileMetricsOut v2, ErrorMetricsOut v3, unbinned QMetricsOut v4 and ExtractionMetricsOut v2.
+    There are no EmpiricalPhasingMetricsOut or ExtendedTileMetricsOut files.
+    """
+    rnd = random.Random(23)
+    os.makedirs(os.path.join(run_dir, 'InterOp'), exist_ok=True)
+    reads = [(1, 26, False), (2, 8, True), (3, 26, False)]
+    tiles = [(1, tile) for tile in [1101, 1102, 2101, 2102]]
+    num_cycles = sum(r[1] for r in reads)
+    cycle_ranges = _cycle_ranges(reads)
+    _write_run_info(run_dir, '240112_M00123_0112_000000000-AAG4W', reads, 1, tiles)
+    with open(os.path.join(run_dir, 'RunParameters.xml'), 'w') as f:
+        f.write('<?xml version="1.0"?>\n<RunParameters>\n  <Setup>\n    <ApplicationName>MiSeq Control Software</ApplicationName>\n')
+        f.write('    <ApplicationVersion>2.6.2.1</ApplicationVersion>\n  </Setup>\n</RunParameters>\n')
+    interop_dir = os.path.join(run_dir, 'InterOp')
+
+    with open(os.path.join(interop_dir, 'TileMetricsOut.bin'), 'wb') as f:
+        f.write(bytes([2, 10]))
+        for lane, tile in tiles:
+            density = rnd.uniform(9.0e5, 1.1e6)
+            cluster_count = density * 0.9
+            f.write(struct.pack('<HHHf', lane, tile, 100, density))
+            f.write(struct.pack('<HHHf', lane, tile, 101, density * 0.85))
+            f.write(struct.pack('<HHHf', lane, tile, 102, cluster_count))
+            f.write(struct.pack('<HHHf', lane, tile, 103, cluster_count * rnd.uniform(0.8, 0.9)))
+            for read_index in [0, 2]:
+                f.write(struct.pack('<HHHf', lane, tile, 300 + read_index, rnd.uniform(5.0, 8.0)))
+
+    with open(os.path.join(interop_dir, 'ErrorMetricsOut.bin'), 'wb') as f:
+        f.write(bytes([3, 30]))
+        for lane, tile in tiles:
+            for read_number in [1, 3]:
+                for cycle in cycle_ranges[read_number]:
+                    f.write(struct.pack('<HHHf5I', lane, tile, cycle, rnd.uniform(0.5, 1.5), 0, 0, 0, 0, 0))
+
+    with open(os.path.join(interop_dir, 'QMetricsOut.bin'), 'wb') as f:
+        f.write(bytes([4, 206]))
+        for lane, tile in tiles:
+            for cycle in range(1, num_cycles + 1):
+                histogram = [0] * 50
+                for q in range(2, 42):
+                    histogram[q - 1] = rnd.randint(10, 100) * (10 if q >= 30 else 1)
+                f.write(struct.pack('<HHH50I', lane, tile, cycle, *histogram))
+
+    with open(os.path.join(interop_dir, 'ExtractionMetricsOut.bin'), 'wb') as f:
+        f.write(bytes([2, 38]))
+        for lane, tile in tiles:
+            for cycle in range(1, num_cycles + 1):
+                intensities = [rnd.randint(200, 400) for _ in range(4)]
+                f.write(struct.pack('<HHH4f4HQ', lane, tile, cycle, 2.5, 2.5, 2.5, 2.5, *intensities, 0))
+
+
+def main(output_dir):
+    make_nextseq_run(os.path.join(output_dir, 'nextseq_interop_run'))
+    make_miseq_run(os.path.join(output_dir, 'miseq_interop_run'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(os.path.abspath(__file__)))
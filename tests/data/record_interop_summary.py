@@ -0,0 +1,114 @@
+"""
+Record the interop_summary csv output for each of the synthetic InterOp run directories.
+
+The summary is computed by Illumina's InterOp library (`pip install interop`), the same code that
+`interop_summary` runs, and written in the layout of `interop_summary --csv=1`. Values are formatted
+with the same precision as `interop_summary`, so the recorded files exercise the same rounding.
+
+    python tests/data/record_interop_summary.py tests/data/nextseq_interop_run tests/data/miseq_interop_run
+"""
+import math
+import os
+import sys
+
+from interop import py_interop_run_metrics
+from interop import py_interop_summary
+
+
+LANE_HEADER = [
+    'Lane', 'Surface', 'Tiles', 'Density', 'Cluster PF', 'Legacy Phasing/Prephasing Rate', 'Phasing slope/offset',
+    'Prephasing slope/offset', 'Reads', 'Reads PF', '%>=Q30', 'Yield', 'Cycles Error', 'Aligned', 'Error',
+    'Error (35)', 'Error (75)', 'Error (100)', '% Occupied', 'Intensity C1',
+]
+
+
+def _fixed(value, digits=2):
+    if math.isnan(value):
+        return 'nan'
+    return '%.*f' % (digits, value)
+
+
+def _stat(stat, digits=2, scale=1.0):
+    return _fixed(stat.mean() / scale, digits) + ' +/- ' + _fixed(stat.stddev() / scale, digits)
+
+
+def _pair(first, second):
+    return _fixed(first, 3) + ' / ' + _fixed(second, 3)
+
+
+def _read_label(read_info):
+    return 'Read ' + str(read_info.number()) + (' (I)' if read_info.is_index() else '')
+
+
+def _read_summary_line(label, metrics):
+    return ','.join([
+        label,
+        _fixed(metrics.yield_g()),
+        _fixed(metrics.projected_yield_g()),
+        _fixed(metrics.percent_aligned()),
+        _fixed(metrics.error_rate()),
+        _fixed(metrics.first_cycle_intensity(), 0),
+        _fixed(metrics.percent_gt_q30()),
+        _fixed(metrics.percent_occupied()),
+    ])
+
+
+def _lane_line(lane):
+    return ','.join([
+        str(lane.lane()),
+        '-',
+        str(lane.tile_count()),
+        _stat(lane.density(), 0, 1000.0),
+        _stat(lane.percent_pf()),
+        _pair(lane.phasing().mean(), lane.prephasing().mean()),
+        _pair(lane.phasing_slope().mean(), lane.phasing_offset().mean()),
+        _pair(lane.prephasing_slope().mean(), lane.prephasing_offset().mean()),
+        _fixed(lane.reads() / 1e6),
+        _fixed(lane.reads_pf() / 1e6),
+        _fixed(lane.percent_gt_q30()),
+        _fixed(lane.yield_g()),
+        str(lane.cycle_state().error_cycle_range().last_cycle()),
+        _stat(lane.percent_aligned()),
+        _stat(lane.error_rate()),
+        _stat(lane.error_rate_35()),
+        _stat(lane.error_rate_75()),
+        _stat(lane.error_rate_100()),
+        _stat(lane.percent_occupied()),
+        _stat(lane.first_cycle_intensity(), 0),
+    ])
+
+
+def record_interop_summary(run_dir):
+    """
+    Write `interop_summary.csv` into a run directory.
+    """
+    run_metrics = py_interop_run_metrics.run_metrics()
+    run_metrics.read(run_dir)
+    summary = py_interop_summary.run_summary()
+    py_interop_summary.summarize_run_metrics(run_metrics, summary)
+
+    lines = ['# Version: v1.9.0 (InterOp python library)', 'Run Info', '']
+    lines.append('Level,Yield,Projected Yield,Aligned,Error Rate,Intensity C1,%>=Q30,% Occupied')
+    for read_idx in range(summary.size()):
+        read = summary.at(read_idx)
+        lines.append(_read_summary_line(_read_label(read.read()), read.summary()))
+    lines.append(_read_summary_line('Non-indexed', summary.nonindex_summary()))
+    lines.append(_read_summary_line('Total', summary.total_summary()))
+    lines += ['', '', '']
+    for read_idx in range(summary.size()):
+        read = summary.at(read_idx)
+        lines.append(_read_label(read.read()))
+        lines.append(','.join(LANE_HEADER))
+        for lane_idx in range(read.size()):
+            lines.append(_lane_line(read.at(lane_idx)))
+    lines.append('Extracted: ' + str(summary.cycle_state().extracted_cycle_range().last_cycle()))
+    lines.append('Called: ' + str(summary.cycle_state().called_cycle_range().last_cycle()))
+    lines.append('Scored: ' + str(summary.cycle_state().qscored_cycle_range().last_cycle()))
+
+    with open(os.path.join(run_dir, 'interop_summary.csv'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    for run_dir in sys.argv[1:]:
+        record_interop_summary(run_dir)
@@ -0,0 +1,161 @@
+import http.server
+import json
+import os
+import shutil
+import threading
+
+import pytest
+
+import auto_illumina_run_qc_check.backfill as backfill
+import auto_illumina_run_qc_check.core as core
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# Run IDs, and the fixture run that each is copied from.
+RUNS = {
+    '240105_M00123_0105_000000000-AAG4A': 'miseq_interop_run',
+    '240110_VH00123_110_AAG4WXG10': 'nextseq_interop_run',
+    '240120_M00123_0120_000000000-AAG4C': 'miseq_interop_run',
+    '240201_M00123_0130_000000000-AAG4D': 'miseq_interop_run',
+}
+# Has a '<RUN_ID>_qc_metrics.json' file from an earlier check.
+RUN_ID_WITH_QC_METRICS = '240120_M00123_0120_000000000-AAG4C'
+RUN_ID_AFTER_END_DATE = '240201_M00123_0130_000000000-AAG4D'
+# NextSeq runs fail, so that both verdicts are counted.
+QC_THRESHOLDS = [
+    {'metric': 'PercentGtQ30', 'level': 'lane', 'pass_above_or_below': 'above', 'threshold': 70},
+    {'metric': 'PercentGtQ30', 'level': 'lane', 'instrument_type': 'nextseq', 'pass_above_or_below': 'above', 'threshold': 100},
+]
+
+
+class NotificationRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.server.request_paths.append(self.path)
+        self.send_response(500)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def notification_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), NotificationRequestHandler)
+    server.request_paths = []
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def run_parent_dir(tmp_path, stub_interop_summary):
+    run_parent_dir = tmp_path / 'runs'
+    for run_id, fixture_name in RUNS.items():
+        run_dir = str(run_parent_dir / run_id)
+        shutil.copytree(os.path.join(DATA_DIR, fixture_name), run_dir)
+        with open(os.path.join(run_dir, 'upload_complete.json'), 'w') as f:
+            json.dump({}, f)
+
+    run_dir = str(run_parent_dir / RUN_ID_WITH_QC_METRICS)
+    run = {'sequencing_run_id': RUN_ID_WITH_QC_METRICS, 'path': run_dir, 'instrument_type': 'miseq', 'run_parameters': {}}
+    core.qc_check({'qc_thresholds': QC_THRESHOLDS}, run, send_notifications=False)
+    for filename in ['qc_check_complete.json', 'interop_summary_was_run']:
+        os.remove(os.path.join(run_dir, filename))
+
+    return str(run_parent_dir)
+
+
+@pytest.fixture
+def config_path(tmp_path, run_parent_dir, notification_server):
+    base_url = 'http://127.0.0.1:' + str(notification_server.server_address[1])
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({
+        'run_parent_dirs': [run_parent_dir],
+        'qc_thresholds': QC_THRESHOLDS,
+        'notification': {
+            'send_notification_emails': True,
+            'auth_url': base_url + '/auth',
+            'email_url': base_url + '/email',
+            'client_id': 'client',
+            'client_secret': 'secret',
+            'sender_email': 'sender@example.org',
+            'recipient_email_addresses': ['recipient@example.org'],
+            'http_max_retries': 0,
+        },
+    }))
+
+    return str(config_path)
+
+
+def _was_checked(run_parent_dir, run_id):
+    return os.path.exists(os.path.join(run_parent_dir, run_id, 'qc_check_complete.json'))
+
+
+def _interop_summary_was_run(run_parent_dir, run_id):
+    return os.path.exists(os.path.join(run_parent_dir, run_id, 'interop_summary_was_run'))
+
+
+def _read_checkpoint(checkpoint_path):
+    with open(checkpoint_path, 'r') as f:
+        return sorted(f.read().split())
+
+
+def test_backfill_checks_runs_in_date_range(config_path, run_parent_dir):
+    backfill.backfill(config_path, start_date='2024-01-06', end_date='2024-01-31', num_workers=1)
+
+    assert [run_id for run_id in RUNS if _was_checked(run_parent_dir, run_id)] == ['240110_VH00123_110_AAG4WXG10', RUN_ID_WITH_QC_METRICS]
+
+
+def test_backfill_records_throughput_stats(config_path):
+    throughput_stats = backfill.backfill(config_path, num_workers=1)
+
+    assert {k: v for k, v in throughput_stats.items() if k not in ['elapsed_seconds', 'runs_per_second']} == {
+        'num_runs_completed': 4,
+        'num_pass': 3,
+        'num_fail': 1,
+        'num_errors': 0,
+        'num_reused_qc_metrics': 1,
+    }
+    assert throughput_stats['elapsed_seconds'] >= 0
+    assert throughput_stats['runs_per_second'] >= 0
+
+
+def test_backfill_reuses_qc_metrics(config_path, run_parent_dir):
+    backfill.backfill(config_path, num_workers=1)
+
+    assert _was_checked(run_parent_dir, RUN_ID_WITH_QC_METRICS)
+    assert not _interop_summary_was_run(run_parent_dir, RUN_ID_WITH_QC_METRICS)
+    assert _interop_summary_was_run(run_parent_dir, RUN_ID_AFTER_END_DATE)
+
+
+def test_backfill_can_collect_qc_metrics_again(config_path, run_parent_dir):
+    throughput_stats = backfill.backfill(config_path, num_workers=1, reuse_qc_metrics=False)
+
+    assert throughput_stats['num_reused_qc_metrics'] == 0
+    assert _interop_summary_was_run(run_parent_dir, RUN_ID_WITH_QC_METRICS)
+
+
+def test_backfill_resumes_from_checkpoint(tmp_path, config_path, run_parent_dir):
+    checkpoint_path = str(tmp_path / 'checkpoint.txt')
+    with open(checkpoint_path, 'w') as f:
+        f.write('240105_M00123_0105_000000000-AAG4A\n')
+
+    throughput_stats = backfill.backfill(config_path, num_workers=1, checkpoint_path=checkpoint_path)
+
+    assert throughput_stats['num_runs_completed'] == 3
+    assert not _was_checked(run_parent_dir, '240105_M00123_0105_000000000-AAG4A')
+    assert _read_checkpoint(checkpoint_path) == sorted(RUNS)
+
+    # Everything has been backfilled, so running again does nothing.
+    assert backfill.backfill(config_path, num_workers=1, checkpoint_path=checkpoint_path)['num_runs_completed'] == 0
+
+
+def test_backfill_doesnt_send_notifications(config_path, notification_server):
+    throughput_stats = backfill.backfill(config_path, num_workers=1)
+
+    assert throughput_stats['num_runs_completed'] == len(RUNS)
+    assert notification_server.request_paths == []
@@ -0,0 +1,149 @@
+import json
+import os
+
+import pytest
+
+import auto_illumina_run_qc_check.__main__ as main
+import auto_illumina_run_qc_check.config as config_module
+
+
+QC_THRESHOLD = {'metric': 'PercentGtQ30', 'level': 'lane', 'pass_above_or_below': 'above', 'threshold': 70}
+
+
+def _write(path, content):
+    """
+    Write a file, moving its modification time on, so that the change is seen however coarse the filesystem's timestamps are.
+    """
+    previous_mtime = os.stat(path).st_mtime if os.path.exists(path) else 0
+    with open(path, 'w') as f:
+        f.write(content)
+    mtime = max(os.stat(path).st_mtime, previous_mtime + 1)
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = str(tmp_path / 'config.json')
+    excluded_runs_path = str(tmp_path / 'excluded_runs.txt')
+    _write(excluded_runs_path, 'run_1\n')
+    _write(path, json.dumps({
+        'run_parent_dirs': [str(tmp_path / 'runs')],
+        'excluded_runs_list': excluded_runs_path,
+        'qc_thresholds': [QC_THRESHOLD],
+    }))
+
+    return path
+
+
+def _update_config_file(config_path, **kwargs):
+    with open(config_path, 'r') as f:
+        raw_config = json.load(f)
+    raw_config.update(kwargs)
+    _write(config_path, json.dumps(raw_config))
+
+
+def test_unchanged_config_is_reused(config_path):
+    config = config_module.load_config(config_path)
+
+    assert config_module.load_config(config_path) is config
+    assert config['excluded_runs'] == frozenset(['run_1'])
+    assert [rule['metric'] for rule in config['qc_rules']['rules_by_key'][(None, None)]] == ['PercentGtQ30']
+
+
+def test_changed_config_is_reloaded(config_path):
+    config = config_module.load_config(config_path)
+
+    _update_config_file(config_path, scan_interval_seconds=60)
+    reloaded_config = config_module.load_config(config_path)
+
+    assert reloaded_config is not config
+    assert reloaded_config['scan_interval_seconds'] == 60
+    assert config_module.load_config(config_path) is reloaded_config
+
+
+def test_changed_excluded_runs_list_is_reloaded(config_path, tmp_path):
+    config = config_module.load_config(config_path)
+
+    _write(str(tmp_path / 'excluded_runs.txt'), 'run_1\nrun_2\n')
+    reloaded_config = config_module.load_config(config_path)
+
+    assert reloaded_config is not config
+    assert reloaded_config['excluded_runs'] == frozenset(['run_1', 'run_2'])
+
+
+def test_schema_errors_are_all_reported(config_path):
+    _update_config_file(config_path, scan_interval_seconds='often', max_concurrent_checks=1.5, notification={'digest_mode': 'yes'})
+
+    with pytest.raises(ValueError) as e:
+        config_module.load_config(config_path)
+
+    assert "'scan_interval_seconds' must be a number" in str(e.value)
+    assert "'max_concurrent_checks' must be an integer" in str(e.value)
+    assert "'notification.digest_mode' must be true or false" in str(e.value)
+
+
+@pytest.mark.parametrize('raw_config', [
+    [],
+    {'pipeline_mode': 'processes'},
+    {'run_parent_dirs': '/runs'},
+    {'spc_ewma_lambda': 0},
+])
+def test_invalid_values_are_rejected(raw_config):
+    with pytest.raises(ValueError):
+        config_module.validate_config(raw_config)
+
+
+def test_invalid_json_is_rejected(config_path):
+    _write(config_path, '{"run_parent_dirs": [')
+
+    with pytest.raises(ValueError) as e:
+        config_module.load_config(config_path)
+
+    assert 'Invalid JSON' in str(e.value)
+
+
+def test_invalid_qc_threshold_is_rejected(config_path):
+    _update_config_file(config_path, qc_thresholds=[dict(QC_THRESHOLD, metric='NotAMetric')])
+
+    with pytest.raises(ValueError):
+        config_module.load_config(config_path)
+
+
+def test_reload_keeps_last_valid_config_when_config_is_invalid(config_path):
+    config = main._reload_config(config_path, {})
+
+    _update_config_file(config_path, scan_interval_seconds='often')
+
+    assert main._reload_config(config_path, config) is config
+
+
+def test_reload_keeps_last_valid_config_when_config_is_removed(config_path):
+    config = main._reload_config(config_path, {})
+
+    os.remove(config_path)
+
+    assert main._reload_config(config_path, config) is config
+
+
+def test_reload_keeps_last_valid_config_when_config_cant_be_read(config_path, monkeypatch):
+    config = main._reload_config(config_path, {})
+    _update_config_file(config_path, scan_interval_seconds=60)
+
+    def raise_permission_error(path, parse):
+        raise PermissionError(13, 'Permission denied', path)
+
+    monkeypatch.setattr(config_module, '_read_file_cached', raise_permission_error)
+
+    assert main._reload_config(config_path, config) is config
+
+
+@pytest.mark.parametrize('config_content', [None, '{"scan_interval_seconds": "often"}'])
+def test_tool_exits_when_initial_config_cant_be_loaded(tmp_path, config_content):
+    config_path = str(tmp_path / 'config.json')
+    if config_content is not None:
+        _write(config_path, config_content)
+
+    with pytest.raises(SystemExit) as e:
+        main._load_initial_config(config_path)
+
+    assert e.value.code != 0
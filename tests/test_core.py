@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+
+import auto_illumina_run_qc_check.core as core
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def _make_run(tmp_path, fixture_name):
+    run_dir = str(tmp_path / 'runs' / fixture_name)
+    shutil.copytree(os.path.join(DATA_DIR, fixture_name), run_dir)
+    with open(os.path.join(run_dir, 'RunInfo.xml'), 'r') as f:
+        run_id = f.read().split('Run Id="')[1].split('"')[0]
+    renamed_run_dir = os.path.join(os.path.dirname(run_dir), run_id)
+    os.rename(run_dir, renamed_run_dir)
+
+    return {
+        'sequencing_run_id': run_id,
+        'path': renamed_run_dir,
+        'instrument_type': core.get_instrument_type(run_id),
+        'run_parameters': {},
+    }
+
+
+def _make_config(qc_thresholds):
+    return {
+        'interop_reader': 'native',
+        'qc_thresholds': qc_thresholds,
+    }
+
+
+def test_native_reader_is_used_when_rules_dont_need_missing_metrics(tmp_path, stub_interop_summary):
+    run = _make_run(tmp_path, 'miseq_interop_run')
+    config = _make_config([{'metric': 'PercentGtQ30', 'level': 'lane', 'pass_above_or_below': 'above', 'threshold': 70}])
+
+    qc_check_result = core.qc_check(config, run, send_notifications=False)
+
+    assert qc_check_result['overall_pass_fail'] == 'PASS'
+    assert not os.path.exists(os.path.join(run['path'], 'interop_summary_was_run'))
+
+
+def test_falls_back_to_interop_summary_when_rules_need_missing_metrics(tmp_path, stub_interop_summary):
+    run = _make_run(tmp_path, 'miseq_interop_run')
+    config = _make_config([{'metric': 'PhasingSlope', 'level': 'lane', 'pass_above_or_below': 'below', 'threshold': 0.2}])
+
+    qc_check_result = core.qc_check(config, run, send_notifications=False)
+
+    assert os.path.exists(os.path.join(run['path'], 'interop_summary_was_run'))
+    # interop_summary reports the phasing of a run without EmpiricalPhasingMetricsOut.bin as NaN, parsed as 0.
+    assert [m['value'] for m in qc_check_result['checked_metrics']] == [0, 0, 0]
+    assert qc_check_result['overall_pass_fail'] == 'PASS'
+
+
+def test_native_reader_provides_phasing_when_present(tmp_path, stub_interop_summary):
+    run = _make_run(tmp_path, 'nextseq_interop_run')
+    config = _make_config([{'metric': 'PhasingSlope', 'level': 'lane', 'read_role': 'R1', 'pass_above_or_below': 'below', 'threshold': 0.2}])
+
+    qc_check_result = core.qc_check(config, run, send_notifications=False)
+
+    assert not os.path.exists(os.path.join(run['path'], 'interop_summary_was_run'))
+    assert [m['value'] for m in qc_check_result['checked_metrics']] == [0.09, 0.091]
+    with open(os.path.join(run['path'], run['sequencing_run_id'] + '_qc_metrics.json'), 'r') as f:
+        qc_metrics = json.load(f)
+    assert all('Occupancy' in lane_read for lane_read in qc_metrics['LanesByRead'])
+
+
+def test_lane_outlier_scores_are_added_to_reused_metrics(tmp_path):
+    run = _make_run(tmp_path, 'nextseq_interop_run')
+    qc_metrics = {'LanesByRead': [
+        {'ReadNumber': 1, 'LaneNumber': lane_number, 'Role': 'R1', 'PercentGtQ30': percent_gt_q30}
+        for lane_number, percent_gt_q30 in [(1, 90.0), (2, 91.0), (3, 90.5), (4, 60.0)]
+    ]}
+    with open(os.path.join(run['path'], run['sequencing_run_id'] + '_qc_metrics.json'), 'w') as f:
+        json.dump(qc_metrics, f)
+    config = _make_config([{'metric': 'PercentGtQ30OutlierScore', 'level': 'lane', 'pass_above_or_below': 'above', 'threshold': -3.5}])
+    config['lane_outlier_method'] = 'mad'
+
+    qc_check_result = core.qc_check(config, run, reuse_qc_metrics=True, send_notifications=False)
+
+    assert [m['pass_fail'] for m in qc_check_result['checked_metrics']] == ['PASS', 'PASS', 'PASS', 'FAIL']
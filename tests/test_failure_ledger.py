@@ -0,0 +1,79 @@
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import pytest
+
+import auto_illumina_run_qc_check.failure_ledger as failure_ledger
+
+
+RUN_ID = '240110_M00123_0110_000000000-AAG4W'
+
+
+def _run(tmp_path, run_id=RUN_ID):
+    run_dir = tmp_path / run_id
+    run_dir.mkdir(exist_ok=True)
+
+    return {'sequencing_run_id': run_id, 'path': str(run_dir)}
+
+
+@pytest.fixture
+def config(tmp_path):
+    failure_ledger._ledger = {}
+    failure_ledger._ledger_path = None
+    failure_ledger._ledger_signature = None
+    config = {
+        'failure_ledger_file': str(tmp_path / 'failure_ledger.json'),
+        'max_qc_check_attempts': 1,
+        'qc_check_retry_backoff_seconds': 0,
+    }
+    yield config
+    failure_ledger._ledger = {}
+    failure_ledger._ledger_path = None
+    failure_ledger._ledger_signature = None
+
+
+def _record_failures(config, run_ids):
+    for run_id in run_ids:
+        failure_ledger.record_failure(config, {'sequencing_run_id': run_id, 'path': config['failure_ledger_file']}, 'error')
+
+
+def test_failed_run_is_quarantined(tmp_path, config):
+    run = _run(tmp_path)
+
+    entry = failure_ledger.record_failure(config, run, 'error')
+
+    assert entry['quarantined']
+    assert failure_ledger.check_run_allowed(config, run) == (False, 'quarantined')
+
+
+def test_release_from_cli_reaches_running_process(tmp_path, config):
+    run = _run(tmp_path)
+    failure_ledger.record_failure(config, run, 'error')
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(config))
+
+    subprocess.run(
+        [sys.executable, '-m', 'auto_illumina_run_qc_check', '-c', str(config_path), 'failures', '--release', RUN_ID],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    assert failure_ledger.check_run_allowed(config, run) == (True, None)
+    assert failure_ledger.get_ledger_entries(config) == []
+
+
+def test_updates_from_other_processes_are_merged(tmp_path, config):
+    run_id_groups = [['run_{}_{}'.format(i, j) for j in range(20)] for i in range(4)]
+    processes = [multiprocessing.Process(target=_record_failures, args=(config, run_ids)) for run_ids in run_id_groups]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failure_ledger.record_failure(config, _run(tmp_path), 'error')
+
+    run_ids = [entry['sequencing_run_id'] for entry in failure_ledger.get_ledger_entries(config)]
+
+    assert run_ids == sorted([RUN_ID] + sum(run_id_groups, []))
+    assert os.path.exists(config['failure_ledger_file'] + '.lock')
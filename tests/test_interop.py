@@ -0,0 +1,189 @@
+import math
+import os
+import shutil
+
+import pytest
+
+import auto_illumina_run_qc_check.interop as interop
+import auto_illumina_run_qc_check.parsers as parsers
+import auto_illumina_run_qc_check.thresholds as thresholds
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+RUN_DIRS = ['nextseq_interop_run', 'miseq_interop_run']
+
+PHASING_METRICS = ['PhasingSlope', 'PhasingOffset', 'PrePhasingSlope', 'PrePhasingOffset']
+
+# interop_summary prints most values to 2 decimal places, so values computed from the same
+# data can differ by one in the last place. These metrics are printed with other precisions.
+LANE_METRIC_TOLERANCES = {
+    'TileCount': 0,
+    # Printed in K/mm2, to 0 decimal places.
+    'Density': 501,
+    'ClusterDensity': 501,
+    'DensityDeviation': 0.51,
+    # Printed in millions, to 2 decimal places.
+    'Reads': 5001,
+    'ReadsPf': 5001,
+    'IntensityCycle1': 1,
+    'IntensityCycle1Deviation': 1,
+    'PhasingSlope': 0.0011,
+    'PhasingOffset': 0.0011,
+    'PrePhasingSlope': 0.0011,
+    'PrePhasingOffset': 0.0011,
+}
+DEFAULT_TOLERANCE = 0.011
+
+
+def _read_csv_metrics(run_dir):
+    with open(os.path.join(run_dir, 'interop_summary.csv'), 'r') as f:
+        return parsers.parse_interop_summary(f, parsers.parse_run_info_xml(os.path.join(run_dir, 'RunInfo.xml')))
+
+
+def _value(value):
+    # The csv parser reports some missing values as NaN, and the native reader reports them as 0.
+    if isinstance(value, float) and math.isnan(value):
+        return 0
+    return value
+
+
+@pytest.fixture(params=RUN_DIRS)
+def run_dir(request):
+    return os.path.join(DATA_DIR, request.param)
+
+
+def test_lane_metrics_match_interop_summary(run_dir):
+    native_metrics = interop.read_interop_metrics(run_dir)
+    csv_metrics = _read_csv_metrics(run_dir)
+
+    assert len(native_metrics['LanesByRead']) == len(csv_metrics['LanesByRead'])
+    for native_lane, csv_lane in zip(native_metrics['LanesByRead'], csv_metrics['LanesByRead']):
+        assert (native_lane['ReadNumber'], native_lane['LaneNumber'], native_lane['Role']) == (csv_lane['ReadNumber'], csv_lane['LaneNumber'], csv_lane['Role'])
+        for metric in thresholds.LANE_LEVEL_METRICS:
+            if metric not in native_lane:
+                continue
+            tolerance = LANE_METRIC_TOLERANCES.get(metric, DEFAULT_TOLERANCE)
+            assert _value(native_lane[metric]) == pytest.approx(_value(csv_lane[metric]), abs=tolerance), (native_lane['ReadNumber'], native_lane['LaneNumber'], metric)
+
+
+def test_run_metrics_match_interop_summary(run_dir):
+    native_metrics = interop.read_interop_metrics(run_dir)
+    csv_metrics = _read_csv_metrics(run_dir)
+
+    for metric in thresholds.RUN_LEVEL_METRICS:
+        if metric not in csv_metrics:
+            continue
+        tolerance = LANE_METRIC_TOLERANCES.get(metric, DEFAULT_TOLERANCE)
+        assert _value(native_metrics[metric]) == pytest.approx(_value(csv_metrics[metric]), abs=tolerance), metric
+    for native_read, csv_read in zip(native_metrics['Reads'], csv_metrics['Reads']):
+        for field in parsers.READ_SUMMARY_OUTPUT_FIELDS:
+            tolerance = 1 if field == 'IntensityCycle1' else DEFAULT_TOLERANCE
+            assert _value(native_read[field]) == pytest.approx(_value(csv_read[field]), abs=tolerance), (native_read['ReadNumber'], field)
+
+
+def test_phasing_and_occupancy_are_read_when_present():
+    native_metrics = interop.read_interop_metrics(os.path.join(DATA_DIR, 'nextseq_interop_run'))
+
+    for lane_read in native_metrics['LanesByRead']:
+        for metric in PHASING_METRICS + ['Occupancy']:
+            assert lane_read[metric] > 0
+
+
+def test_phasing_and_occupancy_are_omitted_when_absent():
+    native_metrics = interop.read_interop_metrics(os.path.join(DATA_DIR, 'miseq_interop_run'))
+
+    for lane_read in native_metrics['LanesByRead']:
+        for metric in PHASING_METRICS + ['Occupancy']:
+            assert metric not in lane_read
+
+
+def test_binned_q_scores_are_read_from_bin_values():
+    q_counts = interop.read_q_metrics(os.path.join(DATA_DIR, 'nextseq_interop_run', 'InterOp', 'QMetricsOut.bin'))
+
+    # Only the top bin (value 36) is >= Q30; it holds most of the bases in the fixture.
+    for q30, total in q_counts.values():
+        assert 0.8 < q30 / total < 0.95
+
+
+def test_unsupported_version_raises(tmp_path):
+    path = str(tmp_path / 'EmpiricalPhasingMetricsOut.bin')
+    with open(path, 'wb') as f:
+        f.write(bytes([3, 16]))
+
+    with pytest.raises(interop.InterOpError):
+        interop.read_empirical_phasing_metrics(path)
+
+
+def test_fit_line():
+    slope, offset = interop._fit_line([1, 2, 3, 4], [3.0, 5.0, 7.0, 9.0])
+
+    assert slope == pytest.approx(2.0)
+    assert offset == pytest.approx(1.0)
+    assert all(math.isnan(v) for v in interop._fit_line([1], [1.0]))
+
+
+def test_missing_phasing_file_is_tolerated(tmp_path):
+    run_dir = str(tmp_path / 'run')
+    shutil.copytree(os.path.join(DATA_DIR, 'nextseq_interop_run'), run_dir)
+    os.remove(os.path.join(run_dir, 'InterOp', 'EmpiricalPhasingMetricsOut.bin'))
+
+    native_metrics = interop.read_interop_metrics(run_dir)
+
+    for lane_read in native_metrics['LanesByRead']:
+        assert 'PhasingSlope' not in lane_read
+        assert lane_read['Occupancy'] > 0
+
+
+class CapturingTimer:
+    """
+    Stands in for `threading.Timer`, so that a test can decide when the timer fires.
+    """
+    instances = []
+
+    def __init__(self, interval, function):
+        self.function = function
+        self.cancelled = False
+        CapturingTimer.instances.append(self)
+
+    def start(self):
+        pass
+
+    def cancel(self):
+        self.cancelled = True
+
+
+@pytest.fixture
+def interop_summary_run_dir(tmp_path, stub_interop_summary):
+    run_dir = str(tmp_path / 'run')
+    shutil.copytree(os.path.join(DATA_DIR, 'nextseq_interop_run'), run_dir)
+
+    return run_dir
+
+
+def test_run_interop_summary_matches_recorded_output(interop_summary_run_dir):
+    qc_metrics, resource_usage = interop.run_interop_summary(interop_summary_run_dir, timeout_seconds=60)
+
+    assert qc_metrics == _read_csv_metrics(interop_summary_run_dir)
+    assert resource_usage['wall_time_seconds'] >= 0
+
+
+def test_run_interop_summary_is_killed_on_timeout(interop_summary_run_dir, monkeypatch):
+    monkeypatch.setenv('STUB_INTEROP_SUMMARY_SLEEP', '30')
+
+    with pytest.raises(interop.InterOpError, match='timed out'):
+        interop.run_interop_summary(interop_summary_run_dir, timeout_seconds=0.2)
+
+
+def test_timeout_after_process_is_reaped_doesnt_kill(interop_summary_run_dir, monkeypatch):
+    killed_pids = []
+    monkeypatch.setattr(interop, '_kill_process_group', killed_pids.append)
+    monkeypatch.setattr(interop.threading, 'Timer', CapturingTimer)
+    CapturingTimer.instances = []
+
+    interop.run_interop_summary(interop_summary_run_dir, timeout_seconds=60)
+    [timer] = CapturingTimer.instances
+    assert timer.cancelled
+    # The timer fires anyway, as it can if it was already running when it was cancelled.
+    timer.function()
+
+    assert killed_pids == []
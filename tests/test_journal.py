@@ -0,0 +1,234 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import auto_illumina_run_qc_check.__main__ as main
+import auto_illumina_run_qc_check.core as core
+import auto_illumina_run_qc_check.journal as journal
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+RUN_ID = '240110_M00123_0110_000000000-AAG4W'
+RESUMABLE_STAGES = [journal.STARTED, journal.METRICS_WRITTEN, journal.VERDICT_WRITTEN, journal.NOTIFICATION_FAILED, journal.NOTIFICATION_QUEUED]
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    journal.close_journal()
+    yield str(tmp_path / 'journal.jsonl')
+    journal.close_journal()
+
+
+@pytest.fixture
+def notified_run_ids(monkeypatch):
+    """
+    Stub out notifications, recording the runs that they were sent for.
+    """
+    run_ids = []
+
+    def notify_qc_check_result(config, run_id, qc_check_complete_path, overall_pass_fail):
+        run_ids.append(run_id)
+        journal.record_stage(run_id, journal.COMPLETE)
+
+    monkeypatch.setattr(core, 'notify_qc_check_result', notify_qc_check_result)
+
+    return run_ids
+
+
+def _record_stages_until(run_id, stage, run_dir_path):
+    for recorded_stage in journal.STAGES[:journal.STAGES.index(stage) + 1]:
+        if recorded_stage not in [journal.NOTIFICATION_FAILED, journal.NOTIFICATION_QUEUED] or recorded_stage == stage:
+            journal.record_stage(run_id, recorded_stage, run_dir_path)
+
+
+def _crash_and_restart(journal_path):
+    # The journal file is left as it was, without any further entries.
+    journal.close_journal()
+    assert journal.open_journal(journal_path)
+
+
+def _read_lines(journal_path):
+    with open(journal_path, 'r') as f:
+        return f.read().splitlines()
+
+
+def _write_qc_check_complete(run_dir_path):
+    os.makedirs(run_dir_path, exist_ok=True)
+    with open(os.path.join(run_dir_path, 'qc_check_complete.json'), 'w') as f:
+        json.dump({'sequencing_run_id': RUN_ID, 'overall_pass_fail': 'PASS'}, f)
+
+
+@pytest.mark.parametrize('stage', RESUMABLE_STAGES)
+def test_incomplete_check_is_found_after_a_crash(journal_path, tmp_path, stage):
+    journal.open_journal(journal_path)
+    _record_stages_until(RUN_ID, stage, str(tmp_path))
+
+    _crash_and_restart(journal_path)
+
+    assert journal.get_stage(RUN_ID) == stage
+    assert [entry['run_dir_path'] for entry in journal.get_incomplete_checks()] == [str(tmp_path)]
+
+
+@pytest.mark.parametrize('stage', journal.FINAL_STAGES)
+def test_finished_check_is_dropped(journal_path, tmp_path, stage):
+    journal.open_journal(journal_path)
+    journal.record_stage(RUN_ID, journal.STARTED, str(tmp_path))
+    journal.record_stage(RUN_ID, stage)
+
+    assert journal.get_stage(RUN_ID) is None
+    _crash_and_restart(journal_path)
+    assert journal.get_incomplete_checks() == []
+
+
+@pytest.mark.parametrize('stage', RESUMABLE_STAGES)
+def test_notification_is_resumed_after_a_crash(journal_path, tmp_path, notified_run_ids, stage):
+    run_dir_path = str(tmp_path / RUN_ID)
+    _write_qc_check_complete(run_dir_path)
+    journal.open_journal(journal_path)
+    _record_stages_until(RUN_ID, stage, run_dir_path)
+    journal.close_journal()
+
+    main._open_journal({'journal_file': journal_path})
+
+    if stage in [journal.STARTED, journal.METRICS_WRITTEN]:
+        # Left for the next scan, which checks the run again.
+        assert notified_run_ids == []
+        assert journal.get_stage(RUN_ID) == stage
+    else:
+        assert notified_run_ids == [RUN_ID]
+        assert journal.get_stage(RUN_ID) is None
+
+
+def test_failed_notification_is_resent_on_the_next_scan(journal_path, tmp_path, notified_run_ids):
+    run_dir_paths = {}
+    for run_id in ['run_in_progress', 'run_notification_failed']:
+        run_dir_paths[run_id] = str(tmp_path / run_id)
+        _write_qc_check_complete(run_dir_paths[run_id])
+    main._open_journal({'journal_file': journal_path})
+    # One check's notification is about to be sent (on another thread), and the other's has failed.
+    journal.record_stage('run_in_progress', journal.VERDICT_WRITTEN, run_dir_paths['run_in_progress'])
+    journal.record_stage('run_notification_failed', journal.NOTIFICATION_FAILED, run_dir_paths['run_notification_failed'])
+
+    main._open_journal({'journal_file': journal_path})
+
+    assert notified_run_ids == ['run_notification_failed']
+    assert journal.get_stage('run_in_progress') == journal.VERDICT_WRITTEN
+
+
+def test_check_without_a_result_isnt_resumed_again(journal_path, tmp_path, notified_run_ids):
+    journal.open_journal(journal_path)
+    journal.record_stage(RUN_ID, journal.VERDICT_WRITTEN, str(tmp_path / 'removed_run'))
+    journal.close_journal()
+
+    main._open_journal({'journal_file': journal_path})
+
+    assert notified_run_ids == []
+    assert journal.get_incomplete_checks() == []
+
+
+def test_check_with_metrics_written_reuses_them_after_a_crash(journal_path, tmp_path, stub_interop_summary):
+    run_dir_path = str(tmp_path / 'runs' / RUN_ID)
+    shutil.copytree(os.path.join(DATA_DIR, 'miseq_interop_run'), run_dir_path)
+    run = {'sequencing_run_id': RUN_ID, 'path': run_dir_path, 'instrument_type': 'miseq', 'run_parameters': {}}
+    config = {'qc_thresholds': [{'metric': 'PercentGtQ30', 'level': 'lane', 'pass_above_or_below': 'above', 'threshold': 70}]}
+    core.qc_check(config, run, send_notifications=False)
+    for filename in ['qc_check_complete.json', 'interop_summary_was_run']:
+        os.remove(os.path.join(run_dir_path, filename))
+    journal.open_journal(journal_path)
+    _record_stages_until(RUN_ID, journal.METRICS_WRITTEN, run_dir_path)
+
+    _crash_and_restart(journal_path)
+    qc_check_result = core.qc_check(config, run, send_notifications=False)
+
+    assert qc_check_result['overall_pass_fail'] == 'PASS'
+    assert not os.path.exists(os.path.join(run_dir_path, 'interop_summary_was_run'))
+    assert journal.get_incomplete_checks() == []
+
+
+def test_torn_final_line_is_ignored(journal_path, tmp_path):
+    journal.open_journal(journal_path)
+    journal.record_stage('run_1', journal.METRICS_WRITTEN, str(tmp_path))
+    journal.close_journal()
+    # A crash while writing the next entry.
+    with open(journal_path, 'a') as f:
+        f.write('{"sequencing_run_id": "run_2", "sta')
+
+    journal.open_journal(journal_path)
+    journal.record_stage('run_3', journal.STARTED, str(tmp_path))
+
+    assert journal.get_stage('run_1') == journal.METRICS_WRITTEN
+    assert journal.get_stage('run_2') is None
+    assert [json.loads(line)['sequencing_run_id'] for line in _read_lines(journal_path)] == ['run_1', 'run_3']
+
+
+def test_journal_is_compacted_when_opened(journal_path, tmp_path):
+    journal.open_journal(journal_path)
+    for run_id in ['run_complete', 'run_failed', 'run_incomplete']:
+        journal.record_stage(run_id, journal.STARTED, str(tmp_path / run_id))
+        journal.record_stage(run_id, journal.METRICS_WRITTEN)
+    journal.record_stage('run_complete', journal.VERDICT_WRITTEN)
+    journal.record_stage('run_complete', journal.COMPLETE)
+    journal.record_stage('run_failed', journal.CHECK_FAILED)
+    journal.record_stage('run_incomplete', journal.VERDICT_WRITTEN)
+    assert len(_read_lines(journal_path)) == 10
+
+    _crash_and_restart(journal_path)
+
+    entries = [json.loads(line) for line in _read_lines(journal_path)]
+    assert [(entry['sequencing_run_id'], entry['stage'], entry['run_dir_path']) for entry in entries] == [
+        ('run_incomplete', journal.VERDICT_WRITTEN, str(tmp_path / 'run_incomplete')),
+    ]
+
+
+@pytest.mark.parametrize('fail_at_stage', [journal.STARTED, journal.METRICS_WRITTEN])
+def test_failed_check_is_dropped_from_the_journal(journal_path, tmp_path, monkeypatch, fail_at_stage):
+    run = {'sequencing_run_id': RUN_ID, 'path': str(tmp_path)}
+    config = {'failure_ledger_file': str(tmp_path / 'failure_ledger.json')}
+
+    def qc_check(config, run, defer_notification=False):
+        _record_stages_until(run['sequencing_run_id'], fail_at_stage, run['path'])
+        raise OSError('Input/output error')
+
+    monkeypatch.setattr(core, 'qc_check', qc_check)
+    journal.open_journal(journal_path)
+
+    with pytest.raises(OSError):
+        core.run_qc_check(config, run)
+
+    assert journal.get_incomplete_checks() == []
+    with open(config['failure_ledger_file'], 'r') as f:
+        assert json.load(f)[RUN_ID]['num_failures'] == 1
+    _crash_and_restart(journal_path)
+    assert journal.get_incomplete_checks() == []
+
+
+def test_check_that_fails_without_metrics_is_dropped_from_the_journal(journal_path, tmp_path, monkeypatch):
+    run = {'sequencing_run_id': RUN_ID, 'path': str(tmp_path)}
+
+    def qc_check(config, run, defer_notification=False):
+        journal.record_stage(run['sequencing_run_id'], journal.STARTED, run['path'])
+        return None
+
+    monkeypatch.setattr(core, 'qc_check', qc_check)
+    journal.open_journal(journal_path)
+
+    assert core.run_qc_check({'failure_ledger_file': str(tmp_path / 'failure_ledger.json')}, run) is None
+    assert journal.get_incomplete_checks() == []
+
+
+def test_check_that_fails_after_writing_its_verdict_keeps_its_notification(journal_path, tmp_path, monkeypatch):
+    run = {'sequencing_run_id': RUN_ID, 'path': str(tmp_path)}
+
+    def qc_check(config, run, defer_notification=False):
+        _record_stages_until(run['sequencing_run_id'], journal.VERDICT_WRITTEN, run['path'])
+        raise RuntimeError('Failed after writing the verdict')
+
+    monkeypatch.setattr(core, 'qc_check', qc_check)
+    journal.open_journal(journal_path)
+
+    with pytest.raises(RuntimeError):
+        core.run_qc_check({'failure_ledger_file': str(tmp_path / 'failure_ledger.json')}, run)
+
+    assert journal.get_stage(RUN_ID) == journal.VERDICT_WRITTEN
@@ -0,0 +1,150 @@
+import pytest
+
+import auto_illumina_run_qc_check.metrics_store as metrics_store
+
+
+# (sequencing_run_id, instrument_id, instrument_type, run_date, PercentGtQ30)
+RUNS = [
+    ('240105_M00123_0105_000000000-AAG4A', 'M00123', 'miseq', '2024-01-05', 90.0),
+    ('240106_VH00123_106_AAG4WXG10', 'VH00123', 'nextseq', '2024-01-06', 80.0),
+    ('240110_M00123_0110_000000000-AAG4B', 'M00123', 'miseq', '2024-01-10', 70.0),
+    ('240112_M00456_0112_000000000-AAG4C', 'M00456', 'miseq', '2024-01-12', 60.0),
+    ('240120_M00123_0120_000000000-AAG4D', 'M00123', 'miseq', '2024-01-20', 50.0),
+    ('240201_M00123_0130_000000000-AAG4E', 'M00123', 'miseq', '2024-02-01', 40.0),
+]
+
+
+def _make_qc_metrics(percent_gt_q30, num_lanes=1):
+    lanes_by_read = []
+    for read_role in ['R1', 'R2']:
+        for lane_number in range(1, num_lanes + 1):
+            lanes_by_read.append({'Role': read_role, 'LaneNumber': lane_number, 'PercentGtQ30': percent_gt_q30 + lane_number})
+    # Reads without a role (eg. index reads that aren't used) aren't stored.
+    lanes_by_read.append({'Role': None, 'LaneNumber': 1, 'PercentGtQ30': 0.0})
+
+    return {'PercentGtQ30': percent_gt_q30, 'LanesByRead': lanes_by_read}
+
+
+def _make_run(sequencing_run_id, instrument_id, instrument_type, run_date):
+    return {'sequencing_run_id': sequencing_run_id, 'instrument_id': instrument_id, 'instrument_type': instrument_type, 'run_date': run_date}
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = metrics_store.open_metrics_store_db(str(tmp_path / 'metrics_store' / 'metrics.db'))
+    for sequencing_run_id, instrument_id, instrument_type, run_date, percent_gt_q30 in RUNS:
+        metrics_store.store_run_metrics(conn, _make_run(sequencing_run_id, instrument_id, instrument_type, run_date), _make_qc_metrics(percent_gt_q30))
+    yield conn
+    conn.close()
+
+
+def _values(time_series):
+    return [point['value'] for point in time_series]
+
+
+def test_time_series_is_ordered_by_instrument_and_date(conn):
+    time_series = metrics_store.query_metric_time_series(conn, 'PercentGtQ30')
+
+    assert [(point['instrument_id'], point['run_date']) for point in time_series] == [
+        ('M00123', '2024-01-05'),
+        ('M00123', '2024-01-10'),
+        ('M00123', '2024-01-20'),
+        ('M00123', '2024-02-01'),
+        ('M00456', '2024-01-12'),
+        ('VH00123', '2024-01-06'),
+    ]
+    assert time_series[0] == {
+        'run_date': '2024-01-05',
+        'sequencing_run_id': '240105_M00123_0105_000000000-AAG4A',
+        'instrument_id': 'M00123',
+        'metric': 'PercentGtQ30',
+        'value': 90.0,
+    }
+
+
+@pytest.mark.parametrize('filters, expected_values', [
+    ({'instrument_id': 'M00123'}, [90.0, 70.0, 50.0, 40.0]),
+    ({'instrument_type': 'nextseq'}, [80.0]),
+    ({'instrument_type': 'miseq'}, [90.0, 70.0, 50.0, 40.0, 60.0]),
+    ({'start_date': '2024-01-10'}, [70.0, 50.0, 40.0, 60.0]),
+    ({'end_date': '2024-01-10'}, [90.0, 70.0, 80.0]),
+    ({'instrument_id': 'M00123', 'start_date': '2024-01-06', 'end_date': '2024-01-20'}, [70.0, 50.0]),
+])
+def test_time_series_filters(conn, filters, expected_values):
+    assert _values(metrics_store.query_metric_time_series(conn, 'PercentGtQ30', **filters)) == expected_values
+
+
+def test_stored_run_is_replaced(conn):
+    run = _make_run(*RUNS[0][:4])
+    metrics_store.store_run_metrics(conn, run, _make_qc_metrics(95.0))
+
+    assert _values(metrics_store.query_metric_time_series(conn, 'PercentGtQ30', instrument_id='M00123')) == [95.0, 70.0, 50.0, 40.0]
+    assert metrics_store.query_lane_metric_history(conn, _make_run(*RUNS[2][:4]), 10, ['PercentGtQ30']) == {
+        ('R1', 'PercentGtQ30'): [96.0],
+        ('R2', 'PercentGtQ30'): [96.0],
+    }
+
+
+def test_rolling_mean_uses_a_window_of_values(conn):
+    time_series = metrics_store.query_metric_time_series(conn, 'PercentGtQ30', instrument_id='M00123')
+
+    metrics_store.add_rolling_mean(time_series, 2)
+
+    assert [point['rolling_mean'] for point in time_series] == [90.0, 80.0, 60.0, 45.0]
+
+
+def test_rolling_mean_is_calculated_for_each_instrument(conn):
+    time_series = metrics_store.query_metric_time_series(conn, 'PercentGtQ30', instrument_type='miseq')
+    # Instruments interleaved, as they would be in a series ordered by date.
+    time_series.sort(key=lambda point: point['run_date'])
+
+    metrics_store.add_rolling_mean(time_series, 3)
+
+    assert [(point['instrument_id'], point['rolling_mean']) for point in time_series] == [
+        ('M00123', 90.0),
+        ('M00123', 80.0),
+        ('M00456', 60.0),
+        ('M00123', 70.0),
+        ('M00123', 160.0 / 3),
+    ]
+
+
+def test_rolling_mean_window_larger_than_series(conn):
+    time_series = metrics_store.query_metric_time_series(conn, 'PercentGtQ30', instrument_id='M00123')
+
+    assert [point['rolling_mean'] for point in metrics_store.add_rolling_mean(time_series, 10)] == [90.0, 80.0, 70.0, 62.5]
+
+
+def test_lane_metric_history_includes_previous_runs_on_the_same_instrument(conn):
+    run = _make_run(*RUNS[4][:4])
+
+    lane_history = metrics_store.query_lane_metric_history(conn, run, 10, ['PercentGtQ30'])
+
+    # Not the run itself, or the later run on the same instrument, or runs on other instruments.
+    assert {key: sorted(values) for key, values in lane_history.items()} == {
+        ('R1', 'PercentGtQ30'): [71.0, 91.0],
+        ('R2', 'PercentGtQ30'): [71.0, 91.0],
+    }
+
+
+def test_lane_metric_history_is_limited_to_the_most_recent_runs(conn):
+    run = _make_run(*RUNS[5][:4])
+
+    lane_history = metrics_store.query_lane_metric_history(conn, run, 2, ['PercentGtQ30'])
+
+    assert {key: sorted(values) for key, values in lane_history.items()} == {
+        ('R1', 'PercentGtQ30'): [51.0, 71.0],
+        ('R2', 'PercentGtQ30'): [51.0, 71.0],
+    }
+
+
+def test_lane_metric_history_includes_every_lane(conn):
+    run = _make_run('240301_VH00123_140_AAG4WXG11', 'VH00123', 'nextseq', '2024-03-01')
+    metrics_store.store_run_metrics(conn, _make_run('240201_VH00123_130_AAG4WXG12', 'VH00123', 'nextseq', '2024-02-01'), _make_qc_metrics(85.0, num_lanes=2))
+
+    lane_history = metrics_store.query_lane_metric_history(conn, run, 1, ['PercentGtQ30', 'ErrorRate'])
+
+    assert {key: sorted(values) for key, values in lane_history.items()} == {
+        ('R1', 'PercentGtQ30'): [86.0, 87.0],
+        ('R2', 'PercentGtQ30'): [86.0, 87.0],
+    }
@@ -0,0 +1,324 @@
+import http.server
+import json
+import os
+import threading
+import time
+
+import pytest
+import requests
+
+import auto_illumina_run_qc_check.core as core
+import auto_illumina_run_qc_check.journal as journal
+import auto_illumina_run_qc_check.notification as notification
+
+
+RUN_ID = '240110_M00123_0110_000000000-AAG4W'
+
+
+class StubServiceHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stands in for the auth and email services. Responds to each path with the next status code
+    queued for it on the server (or 200 once the queue is empty), and records the requests.
+    """
+    def do_POST(self):
+        request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get('Authorization', None)))
+            if self.path == '/email':
+                server.emails.append(json.loads(request_body)['email'])
+            status_codes = server.status_codes.get(self.path, [])
+            status_code = status_codes.pop(0) if status_codes else 200
+            server.num_tokens_granted += 1 if self.path == '/auth' and status_code == 200 else 0
+            access_token = 'token-' + str(server.num_tokens_granted)
+        if self.path == '/auth':
+            time.sleep(server.auth_delay_seconds)
+        body = b'{}'
+        if self.path == '/auth' and status_code == 200:
+            body = json.dumps({'access_token': access_token, 'expires_in': 3600}).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubServiceHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.emails = []
+    server.status_codes = {}
+    server.num_tokens_granted = 0
+    server.auth_delay_seconds = 0.0
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    notification._access_token_cache.clear()
+    notification._digest_entries.clear()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        notification._access_token_cache.clear()
+        notification._digest_entries.clear()
+
+
+@pytest.fixture
+def notification_config(stub_server):
+    base_url = 'http://127.0.0.1:' + str(stub_server.server_address[1])
+
+    return {
+        'send_notification_emails': True,
+        'auth_url': base_url + '/auth',
+        'email_url': base_url + '/email',
+        'client_id': 'client',
+        'client_secret': 'secret',
+        'sender_email': 'sender@example.org',
+        'recipient_email_addresses': ['recipient@example.org'],
+        'http_max_retries': 3,
+        'http_retry_backoff_seconds': 0,
+    }
+
+
+@pytest.fixture
+def qc_check_complete_path(tmp_path):
+    path = tmp_path / 'qc_check_complete.json'
+    path.write_text(json.dumps({'sequencing_run_id': RUN_ID, 'overall_pass_fail': 'PASS', 'checked_metrics': []}))
+
+    return path
+
+
+def _paths(stub_server):
+    return [path for path, _ in stub_server.requests]
+
+
+def test_email_is_retried_on_server_errors(stub_server, notification_config, qc_check_complete_path):
+    stub_server.status_codes['/email'] = [503, 502]
+
+    notification.send_notification_email(qc_check_complete_path, notification_config)
+
+    assert _paths(stub_server) == ['/auth', '/email', '/email', '/email']
+
+
+def test_email_fails_once_retries_are_exhausted(stub_server, notification_config, qc_check_complete_path):
+    stub_server.status_codes['/email'] = [503] * 4
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        notification.send_notification_email(qc_check_complete_path, notification_config)
+
+    assert _paths(stub_server).count('/email') == 4
+
+
+def test_access_token_is_reused(stub_server, notification_config, qc_check_complete_path):
+    notification.send_notification_email(qc_check_complete_path, notification_config)
+    notification.send_notification_email(qc_check_complete_path, notification_config)
+
+    assert _paths(stub_server) == ['/auth', '/email', '/email']
+    assert [auth for path, auth in stub_server.requests if path == '/email'] == ['Bearer token-1', 'Bearer token-1']
+
+
+def test_access_token_is_requested_once_by_concurrent_threads(stub_server, notification_config):
+    stub_server.auth_delay_seconds = 0.2
+    access_tokens = []
+
+    def get_access_token():
+        access_tokens.append(notification._get_access_token(notification_config))
+
+    threads = [threading.Thread(target=get_access_token) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert access_tokens == ['token-1'] * 8
+    assert _paths(stub_server) == ['/auth']
+
+
+def test_access_token_request_doesnt_hold_up_other_auth_services(stub_server, notification_config):
+    other_notification_config = dict(notification_config, client_id='other_client')
+    assert notification._get_access_token(other_notification_config) == 'token-1'
+    stub_server.auth_delay_seconds = 1.0
+    thread = threading.Thread(target=notification._get_access_token, args=(notification_config,))
+    thread.start()
+    time.sleep(0.1)
+
+    start_time = time.monotonic()
+    access_token = notification._get_access_token(other_notification_config)
+    elapsed_seconds = time.monotonic() - start_time
+    thread.join()
+
+    assert access_token == 'token-1'
+    assert elapsed_seconds < 0.5
+
+
+def test_retry_after_is_capped():
+    response = requests.Response()
+    response.headers['Retry-After'] = '3600'
+
+    assert notification._get_retry_delay_seconds(response, 1, 1.0, max_backoff_seconds=60.0) == 60.0
+    assert notification._get_retry_delay_seconds(None, 10, 1.0, max_backoff_seconds=60.0) == 60.0
+    response.headers['Retry-After'] = '5'
+    assert notification._get_retry_delay_seconds(response, 1, 1.0, max_backoff_seconds=60.0) == 5.0
+
+
+def test_rejected_access_token_is_replaced(stub_server, notification_config, qc_check_complete_path):
+    stub_server.status_codes['/email'] = [401]
+
+    notification.send_notification_email(qc_check_complete_path, notification_config)
+
+    assert _paths(stub_server) == ['/auth', '/email', '/auth', '/email']
+    assert [auth for path, auth in stub_server.requests if path == '/email'] == ['Bearer token-1', 'Bearer token-2']
+
+
+def test_authentication_failure_raises(stub_server, notification_config, qc_check_complete_path):
+    stub_server.status_codes['/auth'] = [403]
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        notification.send_notification_email(qc_check_complete_path, notification_config)
+
+    assert _paths(stub_server) == ['/auth']
+
+
+def test_authentication_failure_leaves_qc_check_incomplete(tmp_path, stub_server, notification_config, qc_check_complete_path):
+    stub_server.status_codes['/auth'] = [403]
+    journal.open_journal(str(tmp_path / 'journal.jsonl'))
+    try:
+        journal.record_stage(RUN_ID, journal.VERDICT_WRITTEN, str(tmp_path))
+        core.notify_qc_check_result({'notification': notification_config}, RUN_ID, str(qc_check_complete_path), 'PASS')
+
+        assert journal.get_stage(RUN_ID) == journal.NOTIFICATION_FAILED
+    finally:
+        journal.close_journal()
+
+
+def test_authentication_failure_keeps_digest_entries(stub_server, notification_config, qc_check_complete_path):
+    stub_server.status_codes['/auth'] = [403]
+    notification.queue_digest_entry(qc_check_complete_path)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        notification.flush_digest(notification_config, force=True)
+    assert len(notification._digest_entries) == 1
+
+    assert notification.flush_digest(notification_config, force=True) == 1
+    assert notification._digest_entries == []
+
+
+def _write_qc_check_complete(tmp_path, run_id, overall_pass_fail='PASS'):
+    path = tmp_path / run_id / 'qc_check_complete.json'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({'sequencing_run_id': run_id, 'overall_pass_fail': overall_pass_fail, 'checked_metrics': []}))
+
+    return path
+
+
+def _write_template(path, content):
+    """
+    Write a template, moving its modification time on, so that the change is seen however coarse the filesystem's timestamps are.
+    """
+    previous_mtime = path.stat().st_mtime if path.exists() else 0
+    path.write_text(content)
+    mtime = max(path.stat().st_mtime, previous_mtime + 1)
+    os.utime(str(path), (mtime, mtime))
+
+
+def test_digest_is_held_until_the_window_has_elapsed(stub_server, notification_config, tmp_path):
+    notification_config['digest_window_seconds'] = 60
+    for run_id in ['run_1', 'run_2']:
+        notification.queue_digest_entry(_write_qc_check_complete(tmp_path, run_id))
+
+    assert notification.flush_digest(notification_config) == 0
+    assert _paths(stub_server) == []
+
+    # The window starts when the first entry is queued.
+    notification._digest_window_started -= 61
+    assert notification.flush_digest(notification_config) == 2
+    assert len(stub_server.emails) == 1
+    assert stub_server.emails[0]['subject'].endswith('QC Check Digest: 2 run(s), 0 failed')
+    assert notification._digest_entries == []
+    assert notification.flush_digest(notification_config, force=True) == 0
+
+
+def test_digest_is_sent_on_each_flush_without_a_window(stub_server, notification_config, tmp_path):
+    notification.queue_digest_entry(_write_qc_check_complete(tmp_path, 'run_1', 'FAIL'))
+
+    assert notification.flush_digest(notification_config) == 1
+    assert stub_server.emails[0]['subject'].endswith('QC Check Digest: 1 run(s), 1 failed')
+
+
+def test_failed_digest_is_queued_again(stub_server, notification_config, tmp_path):
+    notification_config['digest_window_seconds'] = 60
+    notification_config['http_max_retries'] = 0
+    stub_server.status_codes['/email'] = [503]
+    notification.queue_digest_entry(_write_qc_check_complete(tmp_path, 'run_1'))
+    digest_window_started = notification._digest_window_started
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        notification.flush_digest(notification_config, force=True)
+
+    # Runs queued since the failed send follow the ones that were put back, in the same window.
+    notification.queue_digest_entry(_write_qc_check_complete(tmp_path, 'run_2'))
+    assert [digest_entry['sequencing_run_id'] for digest_entry in notification._digest_entries] == ['run_1', 'run_2']
+    assert notification._digest_window_started == digest_window_started
+    assert notification.flush_digest(notification_config) == 0
+
+    notification._digest_window_started -= 61
+    assert notification.flush_digest(notification_config) == 2
+    assert len(stub_server.emails) == 2
+    assert notification._digest_entries == []
+
+
+def test_digest_completes_journalled_checks(tmp_path, stub_server, notification_config):
+    config = {'notification': dict(notification_config, digest_mode=True)}
+    journal.open_journal(str(tmp_path / 'journal.jsonl'))
+    try:
+        for run_id in ['run_1', 'run_2']:
+            journal.record_stage(run_id, journal.VERDICT_WRITTEN, str(tmp_path / run_id))
+            core.notify_qc_check_result(config, run_id, str(_write_qc_check_complete(tmp_path, run_id)), 'PASS')
+            assert journal.get_stage(run_id) == journal.NOTIFICATION_QUEUED
+        assert _paths(stub_server) == []
+
+        assert notification.flush_digest(config['notification']) == 2
+
+        assert [journal.get_stage(run_id) for run_id in ['run_1', 'run_2']] == [None, None]
+        assert journal.get_incomplete_checks() == []
+    finally:
+        journal.close_journal()
+
+
+def test_template_in_template_dir_overrides_packaged_template(stub_server, notification_config, qc_check_complete_path, tmp_path):
+    template_dir = tmp_path / 'templates'
+    template_dir.mkdir()
+    _write_template(template_dir / notification.DEFAULT_EMAIL_TEMPLATE, 'Custom email for {{ sequencing_run_id }}')
+    notification_config['template_dir'] = str(template_dir)
+
+    notification.send_notification_email(qc_check_complete_path, notification_config)
+    notification.queue_digest_entry(qc_check_complete_path)
+    notification.flush_digest(notification_config)
+
+    assert stub_server.emails[0]['body'] == 'Custom email for ' + RUN_ID
+    # Templates that aren't overridden are taken from the package.
+    assert stub_server.emails[1]['body'].startswith('<!DOCTYPE html>')
+
+
+@pytest.mark.parametrize('use_bytecode_cache', [False, True])
+def test_changed_template_is_reloaded(stub_server, notification_config, qc_check_complete_path, tmp_path, use_bytecode_cache):
+    template_dir = tmp_path / 'templates'
+    template_dir.mkdir()
+    template_path = template_dir / notification.DEFAULT_EMAIL_TEMPLATE
+    _write_template(template_path, 'First template: {{ overall_pass_fail }}')
+    notification_config['template_dir'] = str(template_dir)
+    if use_bytecode_cache:
+        notification_config['template_bytecode_cache_dir'] = str(tmp_path / 'bytecode_cache')
+
+    notification.send_notification_email(qc_check_complete_path, notification_config)
+    env = notification._get_template_environment(notification_config)
+    _write_template(template_path, 'Second template: {{ overall_pass_fail }}')
+    notification.send_notification_email(qc_check_complete_path, notification_config)
+
+    assert notification._get_template_environment(notification_config) is env
+    assert [email['body'] for email in stub_server.emails] == ['First template: PASS', 'Second template: PASS']
@@ -0,0 +1,92 @@
+import statistics
+
+import pytest
+
+import auto_illumina_run_qc_check.outliers as outliers
+
+
+def _lanes_by_read(values_by_lane, metric='PercentGtQ30', role='R1', read_number=1):
+    return [{'ReadNumber': read_number, 'LaneNumber': lane_number, 'Role': role, metric: value} for lane_number, value in values_by_lane]
+
+
+def test_robust_score():
+    reference_values = [10.0, 11.0, 12.0, 13.0, 14.0]
+
+    # Median 12, median absolute deviation 1.
+    assert outliers.robust_score(15.0, reference_values) == pytest.approx(3.0 * outliers.MAD_SCALE)
+    assert outliers.robust_score(9.0, reference_values) == pytest.approx(-3.0 * outliers.MAD_SCALE)
+
+
+def test_robust_score_isnt_distorted_by_other_outliers():
+    reference_values = [10.0, 11.0, 12.0, 13.0, 14.0]
+
+    # Another outlying lane hides this one from the z-score, but not from the robust score.
+    assert outliers.robust_score(30.0, reference_values + [1000.0]) > outliers.DEFAULT_LANE_OUTLIER_SCORE_THRESHOLD
+    assert outliers.z_score(30.0, reference_values + [1000.0]) < 0
+
+
+def test_robust_score_falls_back_to_mean_absolute_deviation():
+    reference_values = [10.0, 10.0, 10.0, 14.0]
+
+    # More than half of the values are identical, so the median absolute deviation is 0.
+    assert outliers.robust_score(12.0, reference_values) == pytest.approx(2.0 / (outliers.MEAN_ABSOLUTE_DEVIATION_SCALE * 1.0))
+
+
+def test_z_score():
+    reference_values = [10.0, 11.0, 12.0, 13.0, 14.0]
+
+    assert outliers.z_score(15.0, reference_values) == pytest.approx(3.0 / statistics.stdev(reference_values))
+
+
+def test_scale_is_at_least_a_fraction_of_the_center():
+    reference_values = [100.0, 100.0, 100.0]
+
+    assert outliers.robust_score(104.0, reference_values) == pytest.approx(4.0 / (outliers.MIN_SCALE_FRACTION_OF_CENTER * 100.0))
+    assert outliers.z_score(104.0, reference_values) == pytest.approx(4.0 / (outliers.MIN_SCALE_FRACTION_OF_CENTER * 100.0))
+    assert outliers.robust_score(1.0, [0.0, 0.0, 0.0]) is None
+
+
+def test_add_lane_outlier_scores():
+    qc_metrics = {'LanesByRead': _lanes_by_read([(1, 90.0), (2, 91.0), (3, 90.5), (4, 60.0)])}
+
+    lane_outliers = outliers.add_lane_outlier_scores(qc_metrics, metrics=['PercentGtQ30'])
+
+    scores = [lane_read['PercentGtQ30OutlierScore'] for lane_read in qc_metrics['LanesByRead']]
+    assert all(abs(score) < outliers.DEFAULT_LANE_OUTLIER_SCORE_THRESHOLD for score in scores[:3])
+    assert scores[3] <= -outliers.DEFAULT_LANE_OUTLIER_SCORE_THRESHOLD
+    assert [(o['LaneNumber'], o['Metric'], o['Reference']) for o in lane_outliers] == [(4, 'PercentGtQ30', 'run')]
+    assert qc_metrics['LaneOutliers'] == lane_outliers
+    # Without a history, the historical scores can't be calculated.
+    assert all(lane_read['PercentGtQ30HistoricalOutlierScore'] is None for lane_read in qc_metrics['LanesByRead'])
+
+
+def test_lanes_are_only_compared_within_their_read():
+    qc_metrics = {'LanesByRead': (
+        _lanes_by_read([(1, 90.0), (2, 91.0), (3, 90.5), (4, 89.5)]) +
+        _lanes_by_read([(1, 60.0), (2, 61.0), (3, 60.5), (4, 59.5)], role='R2', read_number=2)
+    )}
+
+    lane_outliers = outliers.add_lane_outlier_scores(qc_metrics, metrics=['PercentGtQ30'])
+
+    assert lane_outliers == []
+
+
+def test_too_few_lanes_are_not_scored():
+    qc_metrics = {'LanesByRead': _lanes_by_read([(1, 90.0), (2, 60.0), (3, 90.0)])}
+
+    outliers.add_lane_outlier_scores(qc_metrics, metrics=['PercentGtQ30', 'ErrorRate'])
+
+    for lane_read in qc_metrics['LanesByRead']:
+        assert lane_read['PercentGtQ30OutlierScore'] is None
+        assert lane_read['ErrorRateOutlierScore'] is None
+    assert qc_metrics['LaneOutliers'] == []
+
+
+def test_lanes_are_scored_against_history():
+    qc_metrics = {'LanesByRead': _lanes_by_read([(1, 90.0), (2, 70.0)])}
+    lane_history = {('R1', 'PercentGtQ30'): [89.0, 90.0, 91.0, 90.5, 89.5] * 2}
+
+    lane_outliers = outliers.add_lane_outlier_scores(qc_metrics, method='zscore', metrics=['PercentGtQ30'], lane_history=lane_history)
+
+    assert [(o['LaneNumber'], o['Reference']) for o in lane_outliers] == [(2, 'history')]
+    assert abs(qc_metrics['LanesByRead'][0]['PercentGtQ30HistoricalOutlierScore']) < 1
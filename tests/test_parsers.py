@@ -0,0 +1,61 @@
+import importlib.util
+import os
+
+import pytest
+
+import auto_illumina_run_qc_check.parsers as parsers
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+LEGACY_PARSERS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'legacy_parsers.py')
+
+# Metrics added with read roles, which the previous parser didn't produce.
+READ_ROLE_METRICS = [metric + role for role, metrics in parsers.READ_ROLE_METRICS.items() for metric in metrics]
+
+# The previous parser carried the read number of 'Read 2 (I)' over to the lanes of the MiSeq's 'Read 3'.
+LEGACY_LANE_READ_NUMBERS = {
+    'miseq_interop_run': {3: 2},
+    'nextseq_interop_run': {},
+}
+
+
+@pytest.fixture(scope='module')
+def legacy_parsers():
+    spec = importlib.util.spec_from_file_location('legacy_parsers', LEGACY_PARSERS_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def _read_summary_lines(run_dir):
+    with open(os.path.join(run_dir, 'interop_summary.csv'), 'r') as f:
+        return f.readlines()
+
+
+def _without_roles(rows):
+    return [{k: v for k, v in row.items() if k != 'Role'} for row in rows]
+
+
+@pytest.mark.parametrize('run_dir_name', sorted(LEGACY_LANE_READ_NUMBERS))
+def test_single_pass_parser_matches_legacy_parser(legacy_parsers, run_dir_name):
+    run_dir = os.path.join(DATA_DIR, run_dir_name)
+    summary_lines = _read_summary_lines(run_dir)
+    run_info_reads = parsers.parse_run_info_xml(os.path.join(run_dir, 'RunInfo.xml'))
+
+    legacy_qc_metrics = legacy_parsers.parse_interop_summary(summary_lines)
+    # Lines are supplied by a generator, as they are when read from interop_summary's output.
+    qc_metrics = parsers.parse_interop_summary((line for line in summary_lines), run_info_reads)
+
+    assert set(qc_metrics) - set(legacy_qc_metrics) <= set(READ_ROLE_METRICS)
+    for key, value in legacy_qc_metrics.items():
+        if key not in ['Reads', 'LanesByRead']:
+            assert qc_metrics[key] == value, key
+    assert _without_roles(qc_metrics['Reads']) == _without_roles(legacy_qc_metrics['Reads'])
+
+    lanes_by_read = _without_roles(qc_metrics['LanesByRead'])
+    for lane_read in lanes_by_read:
+        lane_read['ReadNumber'] = LEGACY_LANE_READ_NUMBERS[run_dir_name].get(lane_read['ReadNumber'], lane_read['ReadNumber'])
+    assert lanes_by_read == _without_roles(legacy_qc_metrics['LanesByRead'])
+    assert [list(lane_read) for lane_read in lanes_by_read] == [list(lane_read) for lane_read in _without_roles(legacy_qc_metrics['LanesByRead'])]
+
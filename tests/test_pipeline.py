@@ -0,0 +1,184 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import auto_illumina_run_qc_check.core as core
+import auto_illumina_run_qc_check.pipeline as pipeline
+
+
+TIMEOUT_SECONDS = 5.0
+
+
+def _make_run(i):
+    return {'sequencing_run_id': 'run_{}'.format(i), 'path': '/runs/run_{}'.format(i), 'instrument_type': 'miseq'}
+
+
+async def _wait_until(condition):
+    deadline = time.monotonic() + TIMEOUT_SECONDS
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def stub_core(monkeypatch):
+    """
+    Stub out the qc check and notification. Checks of runs listed in `block_run_ids`, and all notifications
+    while `notifications_blocked` is set, wait until they're released.
+    """
+    class StubCore:
+        def __init__(self):
+            self.checked_run_ids = []
+            self.notified_run_ids = []
+            self.block_run_ids = set()
+            self.checks_released = threading.Event()
+            self.notifications_blocked = False
+            self.notifications_released = threading.Event()
+            self.lock = threading.Lock()
+
+        def run_qc_check(self, config, run, defer_notification=False):
+            assert defer_notification
+            with self.lock:
+                self.checked_run_ids.append(run['sequencing_run_id'])
+            if run['sequencing_run_id'] in self.block_run_ids:
+                assert self.checks_released.wait(TIMEOUT_SECONDS)
+            return {'sequencing_run_id': run['sequencing_run_id'], 'overall_pass_fail': 'PASS'}
+
+        def notify_qc_check_result(self, config, run_id, qc_check_complete_path, overall_pass_fail):
+            if self.notifications_blocked:
+                assert self.notifications_released.wait(TIMEOUT_SECONDS)
+            with self.lock:
+                self.notified_run_ids.append(run_id)
+
+    stub = StubCore()
+    monkeypatch.setattr(core, 'run_qc_check', stub.run_qc_check)
+    monkeypatch.setattr(core, 'notify_qc_check_result', stub.notify_qc_check_result)
+
+    return stub
+
+
+def test_run_found_twice_is_checked_once(stub_core):
+    stub_core.block_run_ids.add('run_0')
+
+    async def main():
+        qc_check_pipeline = pipeline.QcCheckPipeline()
+        await qc_check_pipeline._enqueue_run({}, _make_run(0))
+        await _wait_until(lambda: stub_core.checked_run_ids == ['run_0'])
+        # Found again by the watcher while it is being checked.
+        await qc_check_pipeline._enqueue_run({}, _make_run(0))
+        await qc_check_pipeline._enqueue_run({}, _make_run(1))
+        await qc_check_pipeline._enqueue_run({}, _make_run(1))
+        assert qc_check_pipeline.pending_run_ids == {'run_0', 'run_1'}
+        stub_core.checks_released.set()
+        await asyncio.wait_for(qc_check_pipeline.drain(), TIMEOUT_SECONDS)
+        await qc_check_pipeline.close()
+        return qc_check_pipeline
+
+    qc_check_pipeline = asyncio.run(main())
+
+    assert stub_core.checked_run_ids == ['run_0', 'run_1']
+    assert sorted(stub_core.notified_run_ids) == ['run_0', 'run_1']
+    assert qc_check_pipeline.pending_run_ids == set()
+
+
+def test_full_queue_holds_up_discovery(stub_core, monkeypatch):
+    runs = [_make_run(i) for i in range(5)]
+    found_run_ids = []
+
+    def find_run_dirs(config):
+        for run in runs:
+            found_run_ids.append(run['sequencing_run_id'])
+            yield run
+
+    monkeypatch.setattr(core, 'find_run_dirs', find_run_dirs)
+    stub_core.block_run_ids.add('run_0')
+
+    async def main():
+        qc_check_pipeline = pipeline.QcCheckPipeline(queue_size=1)
+        scan = asyncio.ensure_future(qc_check_pipeline.scan({'run_parent_dirs': ['/runs']}))
+        # run_0 is being checked and run_1 fills the queue, so discovery waits to queue run_2.
+        await _wait_until(lambda: len(found_run_ids) == 3 and qc_check_pipeline.run_queue.full())
+        await asyncio.sleep(0.1)
+        assert found_run_ids == ['run_0', 'run_1', 'run_2']
+        assert stub_core.checked_run_ids == ['run_0']
+        assert not scan.done()
+        stub_core.checks_released.set()
+        await asyncio.wait_for(scan, TIMEOUT_SECONDS)
+        await qc_check_pipeline.close()
+
+    asyncio.run(main())
+
+    assert stub_core.checked_run_ids == [run['sequencing_run_id'] for run in runs]
+    assert sorted(stub_core.notified_run_ids) == [run['sequencing_run_id'] for run in runs]
+
+
+def test_queued_runs_arent_checked_after_stop(stub_core):
+    stub_core.block_run_ids.add('run_0')
+
+    async def main():
+        qc_check_pipeline = pipeline.QcCheckPipeline()
+        for i in range(3):
+            await qc_check_pipeline._enqueue_run({}, _make_run(i))
+        await _wait_until(lambda: stub_core.checked_run_ids == ['run_0'])
+        qc_check_pipeline.request_stop()
+        assert qc_check_pipeline.is_stopping()
+        stub_core.checks_released.set()
+        await asyncio.wait_for(qc_check_pipeline.drain(), TIMEOUT_SECONDS)
+        await qc_check_pipeline.close()
+        return qc_check_pipeline
+
+    qc_check_pipeline = asyncio.run(main())
+
+    # The check that was in progress finishes and sends its notification.
+    assert stub_core.checked_run_ids == ['run_0']
+    assert stub_core.notified_run_ids == ['run_0']
+    assert qc_check_pipeline.pending_run_ids == set()
+
+
+def test_close_waits_for_notifications_and_shuts_down(stub_core):
+    stub_core.notifications_blocked = True
+
+    async def main():
+        qc_check_pipeline = pipeline.QcCheckPipeline(max_concurrent_checks=2)
+        for i in range(3):
+            await qc_check_pipeline._enqueue_run({}, _make_run(i))
+        await _wait_until(lambda: len(stub_core.checked_run_ids) == 3)
+        close = asyncio.ensure_future(qc_check_pipeline.close())
+        await asyncio.sleep(0.1)
+        assert not close.done()
+        assert stub_core.notified_run_ids == []
+        stub_core.notifications_released.set()
+        await asyncio.wait_for(close, TIMEOUT_SECONDS)
+        return qc_check_pipeline
+
+    qc_check_pipeline = asyncio.run(main())
+
+    assert sorted(stub_core.notified_run_ids) == ['run_0', 'run_1', 'run_2']
+    assert all(worker.done() for worker in qc_check_pipeline.check_workers + qc_check_pipeline.notification_workers)
+    for executor in [qc_check_pipeline.discovery_executor, qc_check_pipeline.check_executor, qc_check_pipeline.notification_executor]:
+        with pytest.raises(RuntimeError):
+            executor.submit(print)
+
+
+def test_failed_check_doesnt_stop_the_pipeline(stub_core, monkeypatch):
+    def run_qc_check(config, run, defer_notification=False):
+        if run['sequencing_run_id'] == 'run_0':
+            raise OSError('Input/output error')
+        return {'sequencing_run_id': run['sequencing_run_id'], 'overall_pass_fail': 'FAIL'}
+
+    monkeypatch.setattr(core, 'run_qc_check', run_qc_check)
+
+    async def main():
+        qc_check_pipeline = pipeline.QcCheckPipeline()
+        for i in range(2):
+            await qc_check_pipeline._enqueue_run({}, _make_run(i))
+        await asyncio.wait_for(qc_check_pipeline.drain(), TIMEOUT_SECONDS)
+        await qc_check_pipeline.close()
+        return qc_check_pipeline
+
+    qc_check_pipeline = asyncio.run(main())
+
+    assert stub_core.notified_run_ids == ['run_1']
+    assert qc_check_pipeline.pending_run_ids == set()
@@ -0,0 +1,116 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import auto_illumina_run_qc_check.core as core
+import auto_illumina_run_qc_check.regrade as regrade
+import auto_illumina_run_qc_check.thresholds as thresholds
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+RUN_ID = '240112_M00123_0112_000000000-AAG4W'
+PASSING_QC_THRESHOLD = {'metric': 'PercentGtQ30', 'level': 'lane', 'pass_above_or_below': 'above', 'threshold': 70}
+FAILING_QC_THRESHOLD = {'metric': 'PercentGtQ30', 'level': 'lane', 'pass_above_or_below': 'above', 'threshold': 100}
+
+
+@pytest.fixture
+def run_parent_dir(tmp_path, stub_interop_summary):
+    run_parent_dir = tmp_path / 'runs'
+    run_dir = str(run_parent_dir / RUN_ID)
+    shutil.copytree(os.path.join(DATA_DIR, 'miseq_interop_run'), run_dir)
+    with open(os.path.join(run_dir, 'upload_complete.json'), 'w') as f:
+        json.dump({}, f)
+
+    run = {'sequencing_run_id': RUN_ID, 'path': run_dir, 'instrument_type': 'miseq', 'run_parameters': {}}
+    qc_check_result = core.qc_check({'qc_thresholds': [PASSING_QC_THRESHOLD]}, run, send_notifications=False)
+    assert qc_check_result['overall_pass_fail'] == 'PASS'
+
+    return str(run_parent_dir)
+
+
+def _make_config(run_parent_dir, qc_thresholds):
+    return {'run_parent_dirs': [run_parent_dir], 'excluded_runs': frozenset(), 'qc_thresholds': qc_thresholds}
+
+
+def _qc_check_complete_path(run_parent_dir):
+    return os.path.join(run_parent_dir, RUN_ID, 'qc_check_complete.json')
+
+
+def _read_qc_check_result(run_parent_dir):
+    with open(_qc_check_complete_path(run_parent_dir), 'r') as f:
+        return json.load(f)
+
+
+def test_changed_verdict_is_written(run_parent_dir):
+    regrade_results = list(regrade.regrade(_make_config(run_parent_dir, [FAILING_QC_THRESHOLD])))
+
+    assert regrade_results == [{
+        'sequencing_run_id': RUN_ID,
+        'previous_overall_pass_fail': 'PASS',
+        'overall_pass_fail': 'FAIL',
+        'verdict_changed': True,
+    }]
+    qc_check_result = _read_qc_check_result(run_parent_dir)
+    assert qc_check_result['overall_pass_fail'] == 'FAIL'
+    assert all(checked_metric['pass_fail'] == 'FAIL' for checked_metric in qc_check_result['checked_metrics'])
+    assert 'timestamp_regraded' in qc_check_result
+
+
+def test_unchanged_verdict_isnt_written(run_parent_dir):
+    stat_result = os.stat(_qc_check_complete_path(run_parent_dir))
+
+    regrade_results = list(regrade.regrade(_make_config(run_parent_dir, [PASSING_QC_THRESHOLD])))
+
+    assert [regrade_result['verdict_changed'] for regrade_result in regrade_results] == [False]
+    assert os.stat(_qc_check_complete_path(run_parent_dir)).st_mtime_ns == stat_result.st_mtime_ns
+    assert 'timestamp_regraded' not in _read_qc_check_result(run_parent_dir)
+
+
+def test_dry_run_leaves_files_untouched(run_parent_dir):
+    run_dir = os.path.join(run_parent_dir, RUN_ID)
+    with open(_qc_check_complete_path(run_parent_dir), 'rb') as f:
+        qc_check_complete = f.read()
+    file_mtimes = {name: os.stat(os.path.join(run_dir, name)).st_mtime_ns for name in os.listdir(run_dir)}
+
+    regrade_results = list(regrade.regrade(_make_config(run_parent_dir, [FAILING_QC_THRESHOLD]), dry_run=True))
+
+    assert [(regrade_result['overall_pass_fail'], regrade_result['verdict_changed']) for regrade_result in regrade_results] == [('FAIL', True)]
+    with open(_qc_check_complete_path(run_parent_dir), 'rb') as f:
+        assert f.read() == qc_check_complete
+    assert {name: os.stat(os.path.join(run_dir, name)).st_mtime_ns for name in os.listdir(run_dir)} == file_mtimes
+
+
+def test_run_without_saved_qc_metrics_is_skipped(run_parent_dir):
+    os.remove(os.path.join(run_parent_dir, RUN_ID, RUN_ID + '_qc_metrics.json'))
+
+    assert list(regrade.regrade(_make_config(run_parent_dir, [FAILING_QC_THRESHOLD]))) == []
+    assert _read_qc_check_result(run_parent_dir)['overall_pass_fail'] == 'PASS'
+
+
+def test_saved_run_parameters_take_precedence(run_parent_dir):
+    qc_rules = thresholds.compile_qc_thresholds([
+        PASSING_QC_THRESHOLD,
+        dict(FAILING_QC_THRESHOLD, run_parameters={'chemistry': 'Amplicon'}),
+        dict(FAILING_QC_THRESHOLD, metric='ErrorRate', pass_above_or_below='below', threshold=0, run_parameters={'instrument_serial': 'M00999'}),
+    ])
+    with open(os.path.join(run_parent_dir, RUN_ID, RUN_ID + '_qc_metrics.json'), 'r') as f:
+        qc_metrics = json.load(f)
+    qc_check_result = _read_qc_check_result(run_parent_dir)
+    run = {'sequencing_run_id': RUN_ID, 'path': os.path.join(run_parent_dir, RUN_ID), 'instrument_type': 'miseq'}
+
+    # The run directory now gives a different chemistry to the one that the run was checked with.
+    run['run_parameters'] = {'chemistry': 'Amplicon', 'instrument_serial': 'M00123'}
+    qc_check_result['run_parameters'] = {'chemistry': 'Nextera'}
+    regraded_qc_check_result = regrade.regrade_run(qc_rules, run, qc_metrics, qc_check_result)
+    assert regraded_qc_check_result['overall_pass_fail'] == 'PASS'
+    assert {checked_metric['threshold'] for checked_metric in regraded_qc_check_result['checked_metrics']} == {70}
+
+    # Fields that weren't saved are taken from the run directory.
+    run['run_parameters'] = {'chemistry': 'Nextera', 'instrument_serial': 'M00999'}
+    qc_check_result['run_parameters'] = {'chemistry': 'Amplicon'}
+    regraded_qc_check_result = regrade.regrade_run(qc_rules, run, qc_metrics, qc_check_result)
+    assert regraded_qc_check_result['overall_pass_fail'] == 'FAIL'
+    assert {checked_metric['metric'] for checked_metric in regraded_qc_check_result['checked_metrics'] if checked_metric['pass_fail'] == 'FAIL'} == {'PercentGtQ30', 'ErrorRate'}
+    assert qc_check_result['overall_pass_fail'] == 'PASS'
@@ -0,0 +1,131 @@
+import json
+import os
+
+import auto_illumina_run_qc_check.core as core
+import auto_illumina_run_qc_check.scan_state as scan_state
+
+
+RUN_ID = '240110_M00123_0110_000000000-AAG4W'
+
+
+def _make_config(tmp_path):
+    run_parent_dir = tmp_path / 'runs'
+    run_parent_dir.mkdir()
+
+    return {
+        'run_parent_dirs': [str(run_parent_dir)],
+        'excluded_runs': [],
+        'scan_state_db': str(tmp_path / 'scan_state.db'),
+    }
+
+
+def _make_run_dir(config, run_id=RUN_ID):
+    run_dir = os.path.join(config['run_parent_dirs'][0], run_id)
+    os.makedirs(run_dir)
+    with open(os.path.join(run_dir, 'upload_complete.json'), 'w') as f:
+        json.dump({}, f)
+
+    return run_dir
+
+
+def _set_mtime(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+
+def _found_run_ids(config):
+    return [run['sequencing_run_id'] for run in core.find_run_dirs(config) if run]
+
+
+def _recorded_state(config, run_id=RUN_ID):
+    conn = scan_state.open_scan_state_db(config['scan_state_db'])
+    try:
+        run_dir_states = scan_state.get_run_dir_states(conn, os.path.abspath(config['run_parent_dirs'][0]))
+    finally:
+        conn.close()
+
+    return run_dir_states.get(run_id, None)
+
+
+def test_ready_run_is_found(tmp_path):
+    config = _make_config(tmp_path)
+    _make_run_dir(config)
+
+    assert _found_run_ids(config) == [RUN_ID]
+
+
+def test_qc_checked_run_is_skipped_until_its_mtime_changes(tmp_path):
+    config = _make_config(tmp_path)
+    run_dir = _make_run_dir(config)
+    with open(os.path.join(run_dir, 'qc_check_complete.json'), 'w') as f:
+        json.dump({}, f)
+    _set_mtime(run_dir, 1000000000)
+
+    assert _found_run_ids(config) == []
+    assert _recorded_state(config) == {'state': scan_state.QC_CHECK_COMPLETE, 'mtime': 1000000000}
+    assert _found_run_ids(config) == []
+
+    os.remove(os.path.join(run_dir, 'qc_check_complete.json'))
+    _set_mtime(run_dir, 1000000010)
+
+    assert _found_run_ids(config) == [RUN_ID]
+
+
+def test_upload_incomplete_run_is_found_once_upload_completes(tmp_path):
+    config = _make_config(tmp_path)
+    run_dir = _make_run_dir(config)
+    os.remove(os.path.join(run_dir, 'upload_complete.json'))
+    _set_mtime(run_dir, 1000000000)
+
+    assert _found_run_ids(config) == []
+    assert _recorded_state(config)['state'] == scan_state.UPLOAD_INCOMPLETE
+
+    with open(os.path.join(run_dir, 'upload_complete.json'), 'w') as f:
+        json.dump({}, f)
+    _set_mtime(run_dir, 1000000010)
+
+    assert _found_run_ids(config) == [RUN_ID]
+
+
+def test_wrong_format_dir_is_never_reinspected(tmp_path):
+    config = _make_config(tmp_path)
+    os.makedirs(os.path.join(config['run_parent_dirs'][0], 'not_a_run'))
+
+    assert _found_run_ids(config) == []
+    assert _recorded_state(config, 'not_a_run') == {'state': scan_state.WRONG_FORMAT, 'mtime': None}
+    assert _found_run_ids(config) == []
+
+
+def test_excluded_run_isnt_reinspected_until_it_is_no_longer_excluded(tmp_path, monkeypatch):
+    config = _make_config(tmp_path)
+    _make_run_dir(config)
+    config['excluded_runs'] = frozenset([RUN_ID])
+    evaluated_run_ids = []
+    evaluate_run_dir = core._evaluate_run_dir
+
+    def record_evaluate_run_dir(config, run_id, *args, **kwargs):
+        evaluated_run_ids.append(run_id)
+        return evaluate_run_dir(config, run_id, *args, **kwargs)
+
+    monkeypatch.setattr(core, '_evaluate_run_dir', record_evaluate_run_dir)
+
+    assert _found_run_ids(config) == []
+    assert _recorded_state(config) == {'state': scan_state.EXCLUDED, 'mtime': None}
+    assert _found_run_ids(config) == []
+    assert evaluated_run_ids == [RUN_ID]
+
+    config['excluded_runs'] = frozenset()
+
+    assert _found_run_ids(config) == [RUN_ID]
+    assert evaluated_run_ids == [RUN_ID, RUN_ID]
+
+
+def test_upload_complete_check_can_be_skipped(tmp_path):
+    config = _make_config(tmp_path)
+    run_dir = _make_run_dir(config)
+    os.remove(os.path.join(run_dir, 'upload_complete.json'))
+    _set_mtime(run_dir, 1000000000)
+
+    assert _found_run_ids(config) == []
+    assert _recorded_state(config)['state'] == scan_state.UPLOAD_INCOMPLETE
+
+    assert [run['sequencing_run_id'] for run in core.find_run_dirs(config, check_upload_complete=False) if run] == [RUN_ID]
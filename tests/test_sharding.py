@@ -0,0 +1,170 @@
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import auto_illumina_run_qc_check.sharding as sharding
+
+
+RUN_ID = '240110_M00123_0110_000000000-AAG4W'
+LEASE_EXPIRY_SECONDS = 300.0
+
+
+@pytest.fixture(autouse=True)
+def reset_sharding():
+    def reset():
+        sharding._worker_id = None
+        sharding._shard_dir = None
+        sharding._shard_members = []
+        sharding._held_run_leases.clear()
+        sharding._lease_expiry_seconds = LEASE_EXPIRY_SECONDS
+    reset()
+    yield
+    reset()
+
+
+@pytest.fixture
+def run(tmp_path):
+    run_dir = tmp_path / RUN_ID
+    run_dir.mkdir()
+
+    return {'sequencing_run_id': RUN_ID, 'path': str(run_dir)}
+
+
+def _lease_path(run):
+    return os.path.join(run['path'], sharding.RUN_LEASE_FILENAME)
+
+
+def _read_lease(run):
+    with open(_lease_path(run), 'r') as f:
+        return json.load(f)
+
+
+def _age(path, seconds):
+    mtime = os.stat(path).st_mtime - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def _acquire_as(worker_id, run):
+    sharding.set_worker_id(worker_id)
+
+    return sharding.acquire_run_lease(run)
+
+
+def _contend_for_lease(worker_id, run, start_time):
+    time.sleep(max(0.0, start_time - time.time()))
+
+    return _acquire_as(worker_id, run)
+
+
+def test_only_one_worker_acquires_a_run(run):
+    start_time = time.time() + 0.2
+    with multiprocessing.Pool(8) as pool:
+        acquired = pool.starmap(_contend_for_lease, [('worker-' + str(i), run, start_time) for i in range(8)])
+
+    assert acquired.count(True) == 1
+    assert _read_lease(run)['worker_id'] == 'worker-' + str(acquired.index(True))
+
+
+def test_held_lease_is_not_reclaimed(run):
+    assert _acquire_as('worker-a', run)
+    lease_id = _read_lease(run)['lease_id']
+
+    assert not _acquire_as('worker-b', run)
+    assert _read_lease(run)['lease_id'] == lease_id
+
+
+def test_expired_lease_is_reclaimed(run):
+    assert _acquire_as('worker-a', run)
+    worker_a_leases = dict(sharding._held_run_leases)
+    _age(_lease_path(run), LEASE_EXPIRY_SECONDS + 10)
+
+    assert _acquire_as('worker-b', run)
+    assert _read_lease(run)['worker_id'] == 'worker-b'
+    assert [name for name in os.listdir(run['path']) if name.startswith('.')] == []
+
+    # Worker A finds that its lease has been lost when it next renews it.
+    sharding._held_run_leases.clear()
+    sharding._held_run_leases.update(worker_a_leases)
+    sharding.set_worker_id('worker-a')
+    sharding._renew_run_leases()
+    assert sharding._held_run_leases == {}
+    assert _read_lease(run)['worker_id'] == 'worker-b'
+
+
+def test_renewal_racing_a_reclaim_keeps_the_lease(run, monkeypatch):
+    assert _acquire_as('worker-a', run)
+    lease_id = _read_lease(run)['lease_id']
+    _age(_lease_path(run), LEASE_EXPIRY_SECONDS + 10)
+    rename = os.rename
+
+    def renew_then_rename(src, dst):
+        # Worker A's heartbeat renews the lease just after worker B has seen that it expired.
+        sharding._renew_run_leases()
+        rename(src, dst)
+
+    monkeypatch.setattr(sharding.os, 'rename', renew_then_rename)
+    acquired = _acquire_as('worker-b', run)
+    monkeypatch.setattr(sharding.os, 'rename', rename)
+
+    assert not acquired
+    assert _read_lease(run)['lease_id'] == lease_id
+    assert [name for name in os.listdir(run['path']) if name.startswith('.')] == []
+
+
+def test_local_clock_skew_doesnt_expire_a_live_lease(run, monkeypatch):
+    assert _acquire_as('worker-a', run)
+    # Worker B's clock is ahead of the file server's.
+    monkeypatch.setattr(sharding.time, 'time', lambda: os.stat(_lease_path(run)).st_mtime + LEASE_EXPIRY_SECONDS * 2)
+
+    assert not _acquire_as('worker-b', run)
+    assert _read_lease(run)['worker_id'] == 'worker-a'
+
+
+def test_released_lease_can_be_acquired(run):
+    assert _acquire_as('worker-a', run)
+    sharding.release_run_lease(run)
+
+    assert not os.path.exists(_lease_path(run))
+    assert _acquire_as('worker-b', run)
+
+
+def test_release_leaves_a_reclaimed_lease_alone(run):
+    assert _acquire_as('worker-a', run)
+    worker_a_leases = dict(sharding._held_run_leases)
+    _age(_lease_path(run), LEASE_EXPIRY_SECONDS + 10)
+    assert _acquire_as('worker-b', run)
+
+    sharding._held_run_leases.clear()
+    sharding._held_run_leases.update(worker_a_leases)
+    sharding.set_worker_id('worker-a')
+    sharding.release_run_lease({'sequencing_run_id': RUN_ID, 'path': run['path']})
+
+    assert _read_lease(run)['worker_id'] == 'worker-b'
+
+
+def test_expired_workers_arent_shard_members(tmp_path):
+    for worker_id in ['worker-a', 'worker-b']:
+        (tmp_path / (worker_id + sharding.WORKER_FILE_SUFFIX)).write_text('{}')
+    _age(str(tmp_path / ('worker-b' + sharding.WORKER_FILE_SUFFIX)), LEASE_EXPIRY_SECONDS + 10)
+
+    assert sharding._list_live_workers(str(tmp_path)) == ['worker-a']
+
+
+def test_rendezvous_ownership_only_moves_the_leaving_workers_runs(tmp_path):
+    sharding._shard_dir = str(tmp_path)
+    run_ids = ['240110_M00123_{:04d}_000000000-AAG4W'.format(i) for i in range(200)]
+
+    sharding._shard_members = ['worker-a', 'worker-b', 'worker-c']
+    owners = {run_id: sharding.get_owner(run_id) for run_id in run_ids}
+    sharding._shard_members = ['worker-a', 'worker-b']
+    new_owners = {run_id: sharding.get_owner(run_id) for run_id in run_ids}
+
+    assert set(owners.values()) == {'worker-a', 'worker-b', 'worker-c'}
+    for run_id in run_ids:
+        if owners[run_id] != 'worker-c':
+            assert new_owners[run_id] == owners[run_id]
+    sharding.set_worker_id('worker-a')
+    assert [sharding.owns_run(str(tmp_path), run_id) for run_id in run_ids] == [owner == 'worker-a' for owner in new_owners.values()]
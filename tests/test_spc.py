@@ -0,0 +1,203 @@
+import json
+import math
+import multiprocessing
+import statistics
+
+import pytest
+
+import auto_illumina_run_qc_check.backfill as backfill
+import auto_illumina_run_qc_check.config
+import auto_illumina_run_qc_check.spc as spc
+
+
+INSTRUMENT_ID = 'M00123'
+# Alternates around 1.0, so the baseline has a mean of 1.0 and a standard deviation of about 0.1.
+BASELINE_VALUES = [0.9, 1.1] * 10
+
+
+def _settings(**kwargs):
+    return dict(spc.get_spc_settings({'spc_metrics': ['ErrorRate'], 'spc_min_baseline_runs': 10}), **kwargs)
+
+
+def _update(values, settings):
+    baseline = None
+    assessments = []
+    for value in values:
+        baseline, assessment = spc.update_metric_baseline(baseline, value, settings)
+        assessments.append(assessment)
+
+    return baseline, assessments
+
+
+@pytest.fixture
+def config(tmp_path):
+    spc._state = {'version': spc.STATE_FILE_VERSION, 'instruments': {}}
+    spc._state_path = None
+    spc._state_signature = None
+    config = {
+        'spc_state_file': str(tmp_path / 'spc_state.json'),
+        'spc_metrics': ['ErrorRate'],
+        'spc_min_baseline_runs': 10,
+    }
+    yield config
+    spc._state = {'version': spc.STATE_FILE_VERSION, 'instruments': {}}
+    spc._state_path = None
+    spc._state_signature = None
+
+
+def _assess_runs(config, instrument_id, num_runs):
+    for i in range(num_runs):
+        spc.assess_run(config, 'run_{}_{}'.format(instrument_id, i), instrument_id, {'ErrorRate': 1.0})
+
+
+def test_baseline_mean_and_variance():
+    values = [0.31, 0.45, 0.28, 0.52, 0.39, 0.41, 0.36]
+
+    baseline, assessments = _update(values, _settings())
+
+    assert baseline['n'] == len(values)
+    assert baseline['mean'] == pytest.approx(statistics.mean(values))
+    assert baseline['m2'] / (baseline['n'] - 1) == pytest.approx(statistics.variance(values))
+    # Each value is compared with the baseline before it was added.
+    assert assessments[0]['baseline_mean'] is None
+    assert assessments[-1]['baseline_mean'] == pytest.approx(statistics.mean(values[:-1]), abs=1e-6)
+    assert assessments[-1]['baseline_stdev'] == pytest.approx(statistics.stdev(values[:-1]), abs=1e-6)
+
+
+def test_ewma():
+    values = [1.0, 2.0, 4.0]
+
+    baseline, _ = _update(values, _settings(ewma_lambda=0.5))
+
+    # The EWMA starts at the first value.
+    assert baseline['ewma'] == pytest.approx(0.5 * 4.0 + 0.5 * (0.5 * 2.0 + 0.5 * 1.0))
+
+
+def test_no_signals_before_baseline_is_ready():
+    _, assessments = _update([1.0] * 2 + [100.0] * 5, _settings())
+
+    assert all(a['signals'] == [] for a in assessments)
+    assert all(a['ewma_limit'] is None for a in assessments)
+
+
+def test_stable_values_dont_signal():
+    _, assessments = _update(BASELINE_VALUES * 3, _settings())
+
+    assert all(a['signals'] == [] for a in assessments)
+
+
+def test_small_sustained_shift_signals_cusum():
+    baseline, _ = _update(BASELINE_VALUES, _settings())
+    # A shift of 1.5 standard deviations stays inside the EWMA limit, but accumulates in the upper CUSUM.
+    shifted_value = baseline['mean'] + 1.5 * math.sqrt(baseline['m2'] / (baseline['n'] - 1))
+
+    signals = []
+    for _ in range(6):
+        baseline, assessment = spc.update_metric_baseline(baseline, shifted_value, _settings())
+        signals.append(assessment['signals'])
+
+    assert signals == [[]] * 5 + [['cusum_high']]
+    assert assessment['cusum_lower'] == 0
+
+
+def test_large_drop_signals_ewma_and_cusum_low():
+    baseline, _ = _update(BASELINE_VALUES, _settings())
+
+    for _ in range(4):
+        baseline, assessment = spc.update_metric_baseline(baseline, 0.0, _settings())
+
+    assert assessment['signals'] == ['ewma_low', 'cusum_low']
+
+
+def test_cusum_is_reset_when_it_signals():
+    baseline, _ = _update(BASELINE_VALUES, _settings())
+    shifted_value = baseline['mean'] + 1.5 * math.sqrt(baseline['m2'] / (baseline['n'] - 1))
+    for _ in range(6):
+        baseline, assessment = spc.update_metric_baseline(baseline, shifted_value, _settings())
+    assert assessment['signals'] == ['cusum_high']
+    assert assessment['cusum_upper'] > 5.0
+
+    assert baseline['cusum_upper'] == 0.0
+    baseline, assessment = spc.update_metric_baseline(baseline, shifted_value, _settings())
+    assert 'cusum_high' not in assessment['signals']
+
+
+def test_signalling_values_are_kept_out_of_the_baseline():
+    baseline, _ = _update(BASELINE_VALUES, _settings())
+
+    for _ in range(4):
+        updated_baseline, assessment = spc.update_metric_baseline(baseline, 0.0, _settings())
+        assert assessment['signals'] == ['ewma_low', 'cusum_low']
+        assert (updated_baseline['n'], updated_baseline['mean'], updated_baseline['m2']) == (baseline['n'], baseline['mean'], baseline['m2'])
+        # The EWMA still follows every value.
+        assert updated_baseline['ewma'] < baseline['ewma']
+        baseline = updated_baseline
+
+
+def test_signalling_values_can_be_added_to_the_baseline():
+    settings = spc.get_spc_settings({'spc_metrics': ['ErrorRate'], 'spc_min_baseline_runs': 10, 'spc_exclude_signals_from_baseline': False})
+    baseline, _ = _update(BASELINE_VALUES, settings)
+
+    baseline, assessment = spc.update_metric_baseline(baseline, 0.0, settings)
+
+    assert assessment['signals'] == ['ewma_low', 'cusum_low']
+    assert baseline['n'] == len(BASELINE_VALUES) + 1
+    assert baseline['mean'] == pytest.approx(statistics.mean(BASELINE_VALUES + [0.0]))
+
+
+def test_verdicts():
+    settings = _settings()
+    instrument_baseline = None
+    verdicts = []
+    for value in BASELINE_VALUES + [0.0] * 4:
+        instrument_baseline, drift = spc.assess_instrument_run(instrument_baseline, {'ErrorRate': value}, settings)
+        verdicts.append(drift['verdict'])
+
+    assert verdicts[:10] == [spc.INSUFFICIENT_BASELINE] * 10
+    assert verdicts[10:20] == [spc.IN_CONTROL] * 10
+    assert verdicts[-1] == spc.DRIFT
+    assert [m['metric'] for m in drift['drifting_metrics']] == ['ErrorRate']
+    assert instrument_baseline['num_runs'] == len(BASELINE_VALUES) + 4
+
+
+def test_non_numeric_values_are_skipped():
+    instrument_baseline, drift = spc.assess_instrument_run(None, {'ErrorRate': float('nan')}, _settings())
+
+    assert instrument_baseline['metrics'] == {}
+    assert drift['verdict'] == spc.INSUFFICIENT_BASELINE
+
+
+def test_run_is_added_to_baseline_once(config):
+    first_drift = spc.assess_run(config, 'run_1', INSTRUMENT_ID, {'ErrorRate': 1.0})
+    second_drift = spc.assess_run(config, 'run_1', INSTRUMENT_ID, {'ErrorRate': 1.0})
+
+    assert second_drift == first_drift
+    with open(config['spc_state_file'], 'r') as f:
+        state = json.load(f)
+    assert state['instruments'][INSTRUMENT_ID]['num_runs'] == 1
+
+
+def test_updates_from_other_processes_are_merged(config):
+    processes = [multiprocessing.Process(target=_assess_runs, args=(config, instrument_id, 10)) for instrument_id in ['M00123', 'M00123', 'M00456']]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    spc.assess_run(config, 'run_M00456_extra', 'M00456', {'ErrorRate': 1.0})
+
+    with open(config['spc_state_file'], 'r') as f:
+        state = json.load(f)
+
+    # Two processes check the same runs on M00123, and each run is only added to the baseline once.
+    assert state['instruments']['M00123']['num_runs'] == 10
+    assert state['instruments']['M00456']['num_runs'] == 11
+
+
+def test_backfill_workers_dont_update_baselines(tmp_path, config):
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(config))
+
+    backfill._init_backfill_worker(str(config_path), None)
+
+    assert 'spc_state_file' not in backfill._worker_config
+    assert 'spc_state_file' in auto_illumina_run_qc_check.config.load_config(str(config_path))
@@ -0,0 +1,143 @@
+import pytest
+
+import auto_illumina_run_qc_check.thresholds as thresholds
+
+
+QC_METRICS = {
+    'LanesByRead': [
+        {'ReadNumber': 1, 'LaneNumber': 1, 'Role': 'R1', 'PercentGtQ30': 90.0},
+        {'ReadNumber': 1, 'LaneNumber': 2, 'Role': 'R1', 'PercentGtQ30': 91.0},
+    ],
+}
+
+
+def _rule(metric, level='lane', **kwargs):
+    return dict({'metric': metric, 'level': level, 'pass_above_or_below': 'below', 'threshold': 1}, **kwargs)
+
+
+def test_find_missing_lane_metrics():
+    qc_rules = thresholds.compile_qc_thresholds([
+        _rule('PercentGtQ30'),
+        _rule('Occupancy'),
+        _rule('PhasingSlopeOutlierScore'),
+        _rule('PhasingSlope'),
+        _rule('PrePhasingSlope', instrument_type='nextseq'),
+        _rule('ErrorRate', level='run'),
+    ])
+
+    missing_lane_metrics = thresholds.find_missing_lane_metrics(qc_rules, QC_METRICS, 'miseq', None)
+
+    assert missing_lane_metrics == ['Occupancy', 'PhasingSlope']
+
+
+def test_missing_lane_metric_fails_its_rule():
+    qc_rules = thresholds.compile_qc_thresholds([_rule('Occupancy', pass_above_or_below='above', threshold=50)])
+
+    checked_metrics = thresholds.evaluate_qc_rules(qc_rules, QC_METRICS, 'miseq', None)
+
+    assert [m['pass_fail'] for m in checked_metrics] == ['FAIL', 'FAIL']
+
+
+def test_between_comparison_includes_its_bounds():
+    qc_rules = thresholds.compile_qc_thresholds([_rule('PercentGtQ30', pass_above_or_below='between', threshold=[90.0, 90.5])])
+    qc_metrics = {'LanesByRead': QC_METRICS['LanesByRead'] + [{'ReadNumber': 1, 'LaneNumber': 3, 'Role': 'R1', 'PercentGtQ30': 90.5}]}
+
+    checked_metrics = thresholds.evaluate_qc_rules(qc_rules, qc_metrics, 'miseq', None)
+
+    assert [(m['lane_number'], m['pass_fail']) for m in checked_metrics] == [(1, 'PASS'), (2, 'FAIL'), (3, 'PASS')]
+    assert checked_metrics[0]['threshold'] == [90.0, 90.5]
+
+
+def test_warnings_dont_fail_a_run():
+    qc_rules = thresholds.compile_qc_thresholds([
+        _rule('PercentGtQ30', pass_above_or_below='above', threshold=95, severity='warn'),
+        _rule('PercentGtQ30', pass_above_or_below='above', threshold=80),
+    ])
+
+    checked_metrics = thresholds.evaluate_qc_rules(qc_rules, QC_METRICS, 'miseq', None)
+
+    assert [m['pass_fail'] for m in checked_metrics] == ['WARN', 'WARN', 'PASS', 'PASS']
+    assert [m.get('severity', None) for m in checked_metrics] == ['warn', 'warn', None, None]
+    assert thresholds.get_overall_pass_fail(checked_metrics) == 'PASS'
+    assert thresholds.get_overall_pass_fail(checked_metrics + [{'pass_fail': 'FAIL'}]) == 'FAIL'
+
+
+@pytest.mark.parametrize('qc_threshold, problem', [
+    (_rule('NotAMetric'), 'unknown lane-level metric'),
+    (_rule('PercentPfDeviation', level='run'), 'unknown metric'),
+    (_rule('PercentGtQ30', level='read'), 'unknown level'),
+    (_rule('PercentGtQ30', pass_above_or_below='equal'), "'pass_above_or_below' must be one of"),
+    (_rule('PercentGtQ30', threshold='90'), "'threshold' must be a number"),
+    (_rule('PercentGtQ30', pass_above_or_below='between', threshold=90), "'threshold' must be a [lower, upper] range"),
+    (_rule('PercentGtQ30', pass_above_or_below='between', threshold=[95, 90]), "'threshold' must be a [lower, upper] range"),
+    (_rule('PercentGtQ30', severity='info'), "'severity' must be one of"),
+    (_rule('PercentGtQ30', instrument_type='novaseq'), 'unsupported instrument_type'),
+    (_rule('PercentGtQ30', run_parameters={'read_cycles': '151'}), "'run_parameters' may only include"),
+    (_rule('PercentGtQ30', level='run', lane_number=1), "'lane_number' is only supported for lane-level thresholds"),
+    (_rule('PercentGtQ30', read_role='R3'), "'read_role' must be one of"),
+])
+def test_malformed_rule_is_rejected(qc_threshold, problem):
+    with pytest.raises(ValueError) as e:
+        thresholds.compile_qc_thresholds([_rule('PercentGtQ30'), qc_threshold])
+
+    assert str(e.value).startswith('Invalid qc_thresholds: qc_thresholds[1]: ' + problem)
+
+
+def test_all_problems_are_reported():
+    with pytest.raises(ValueError) as e:
+        thresholds.compile_qc_thresholds([_rule('NotAMetric'), _rule('PercentGtQ30', threshold=None)])
+
+    assert 'qc_thresholds[0]: unknown lane-level metric' in str(e.value)
+    assert "qc_thresholds[1]: 'threshold' must be a number" in str(e.value)
+
+
+def test_run_and_lane_level_rules():
+    qc_rules = thresholds.compile_qc_thresholds([
+        _rule('PercentGtQ30', level='run', pass_above_or_below='above', threshold=85),
+        _rule('PercentGtQ30', pass_above_or_below='above', threshold=90.5),
+        _rule('PercentGtQ30', pass_above_or_below='above', threshold=95, lane_number=2),
+    ])
+    qc_metrics = dict(QC_METRICS, PercentGtQ30=90.5)
+
+    checked_metrics = thresholds.evaluate_qc_rules(qc_rules, qc_metrics, 'miseq', None)
+
+    # Run-level results have no lane, and lane-level results have one for each lane & read (that the rule selects).
+    assert [(m['threshold'], m.get('lane_number', None), m['value'], m['pass_fail']) for m in checked_metrics] == [
+        (85, None, 90.5, 'PASS'),
+        (90.5, 1, 90.0, 'FAIL'),
+        (90.5, 2, 91.0, 'PASS'),
+        (95, 2, 91.0, 'FAIL'),
+    ]
+    assert 'read_number' not in checked_metrics[0]
+    assert checked_metrics[1]['read_number'] == 1
+
+
+def test_rules_apply_to_matching_runs_in_config_order():
+    qc_rules = thresholds.compile_qc_thresholds([
+        _rule('PercentGtQ30', instrument_type='nextseq', flowcell_version='P2'),
+        _rule('PercentGtQ30', flowcell_version='3'),
+        _rule('PercentGtQ30', instrument_type='MiSeq'),
+        _rule('PercentGtQ30'),
+        _rule('PercentGtQ30', instrument_type='nextseq'),
+    ])
+
+    def rule_indexes(instrument_type, flowcell_version):
+        return [rule['index'] for rule in thresholds.get_rules_for_run(qc_rules, instrument_type, flowcell_version)]
+
+    assert rule_indexes('miseq', '3') == [1, 2, 3]
+    assert rule_indexes('miseq', 3) == [1, 2, 3]
+    assert rule_indexes('miseq', None) == [2, 3]
+    assert rule_indexes('nextseq', 'P2') == [0, 3, 4]
+    # No rule mentions this flowcell version.
+    assert rule_indexes('nextseq', 'P1') == [3, 4]
+    assert rule_indexes('unknown', '3') == [1, 3]
+
+
+def test_compiled_rules_arent_modified_by_checks():
+    qc_rules = thresholds.compile_qc_thresholds([_rule('PercentGtQ30', flowcell_version='3')])
+    rules_by_run_type = {run_type: list(rules) for run_type, rules in qc_rules['rules_by_run_type'].items()}
+
+    for instrument_type, flowcell_version in [('miseq', '3'), ('nextseq', 'P1'), ('miseq', None)]:
+        thresholds.evaluate_qc_rules(qc_rules, QC_METRICS, instrument_type, flowcell_version)
+
+    assert qc_rules['rules_by_run_type'] == rules_by_run_type
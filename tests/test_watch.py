@@ -0,0 +1,143 @@
+import json
+import os
+
+import pytest
+
+import auto_illumina_run_qc_check.scan_state as scan_state
+import auto_illumina_run_qc_check.watch as watch
+
+
+RUN_ID = '240110_M00123_0110_000000000-AAG4W'
+
+
+def _open_fd_count():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def _create_inotify_watcher(run_parent_dirs, poll_interval_seconds):
+    try:
+        return watch.InotifyRunDirWatcher(run_parent_dirs, poll_interval_seconds)
+    except (OSError, AttributeError) as e:
+        if getattr(e, 'filename', None) is not None:
+            raise
+        pytest.skip("inotify not available: " + str(e))
+
+
+def _complete_upload(run_dir):
+    with open(os.path.join(run_dir, watch.UPLOAD_COMPLETE_FILENAME), 'w') as f:
+        json.dump({}, f)
+
+
+@pytest.fixture
+def run_dir(tmp_path):
+    run_dir = tmp_path / RUN_ID
+    run_dir.mkdir()
+
+    return str(run_dir)
+
+
+def test_inotify_watcher_reports_completed_upload(tmp_path, run_dir):
+    watcher = _create_inotify_watcher([str(tmp_path)], poll_interval_seconds=3600)
+    try:
+        _complete_upload(run_dir)
+        assert watcher.wait_for_run_dirs(5) == [run_dir]
+        assert watcher.wait_for_run_dirs(0.1) == []
+    finally:
+        watcher.close()
+
+
+def test_inotify_watcher_polls_for_changes_inotify_misses(tmp_path, run_dir):
+    watcher = _create_inotify_watcher([str(tmp_path)], poll_interval_seconds=0.05)
+    try:
+        # Without any watches, inotify sees nothing, as for changes made by another host on NFS.
+        for wd in list(watcher.parent_dir_watches) + list(watcher.run_dir_watches):
+            watcher.libc.inotify_rm_watch(watcher.fd, wd)
+        _complete_upload(run_dir)
+        assert watcher.wait_for_run_dirs(5) == [run_dir]
+        assert watcher.wait_for_run_dirs(0.2) == []
+    finally:
+        watcher.close()
+
+
+def test_inotify_watcher_reports_new_run_once(tmp_path):
+    watcher = _create_inotify_watcher([str(tmp_path)], poll_interval_seconds=0.05)
+    try:
+        run_dir = str(tmp_path / RUN_ID)
+        os.mkdir(run_dir)
+        _complete_upload(run_dir)
+        assert watcher.wait_for_run_dirs(5) == [run_dir]
+        assert watcher.wait_for_run_dirs(0.2) == []
+    finally:
+        watcher.close()
+
+
+def test_inotify_watcher_closes_fd_if_watch_fails(tmp_path):
+    open_fd_count = _open_fd_count()
+
+    with pytest.raises(OSError):
+        _create_inotify_watcher([str(tmp_path / 'missing')], poll_interval_seconds=3600)
+
+    assert _open_fd_count() == open_fd_count
+
+
+def test_polling_watcher_reports_completed_upload(tmp_path, run_dir):
+    watcher = watch.PollingRunDirWatcher([str(tmp_path)], poll_interval_seconds=0.05)
+
+    assert watcher.wait_for_run_dirs(0.1) == []
+    _complete_upload(run_dir)
+    assert watcher.wait_for_run_dirs(5) == [run_dir]
+    assert watcher.wait_for_run_dirs(0.1) == []
+
+
+def _record_scan_states(scan_state_db, run_parent_dir, states):
+    conn = scan_state.open_scan_state_db(scan_state_db)
+    try:
+        scan_state.set_run_dir_states(conn, run_parent_dir, {name: {'state': state, 'mtime': None} for name, state in states.items()})
+    finally:
+        conn.close()
+
+
+def test_watcher_skips_runs_already_checked(tmp_path, monkeypatch):
+    run_ids = {
+        'checked': '240110_M00123_0110_000000000-AAG4W',
+        'upload_incomplete': '240111_M00123_0111_000000000-AAG4X',
+        'not_in_scan_state': '240112_M00123_0112_000000000-AAG4Y',
+    }
+    for run_id in run_ids.values():
+        (tmp_path / 'runs' / run_id).mkdir(parents=True)
+    run_parent_dir = str(tmp_path / 'runs')
+    scan_state_db = str(tmp_path / 'scan_state.db')
+    _record_scan_states(scan_state_db, run_parent_dir, {
+        run_ids['checked']: scan_state.QC_CHECK_COMPLETE,
+        run_ids['upload_incomplete']: scan_state.UPLOAD_INCOMPLETE,
+    })
+    checked_paths = []
+    exists = os.path.exists
+    monkeypatch.setattr(watch.os.path, 'exists', lambda path: checked_paths.append(path) or exists(path))
+
+    watcher = watch.PollingRunDirWatcher([run_parent_dir], poll_interval_seconds=3600, scan_state_db=scan_state_db)
+
+    assert watcher.waiting_run_dirs == {os.path.join(run_parent_dir, run_ids['upload_incomplete']), os.path.join(run_parent_dir, run_ids['not_in_scan_state'])}
+    assert not any(run_ids['checked'] in path for path in checked_paths)
+
+
+def test_inotify_watcher_lists_run_parent_dirs_once(tmp_path, run_dir, monkeypatch):
+    scandir_paths = []
+    scandir = os.scandir
+    monkeypatch.setattr(watch.os, 'scandir', lambda path: scandir_paths.append(path) or scandir(path))
+
+    watcher = _create_inotify_watcher([str(tmp_path)], poll_interval_seconds=3600)
+    try:
+        assert scandir_paths == [str(tmp_path)]
+        assert watcher.poller.waiting_run_dirs == {run_dir}
+        assert list(watcher.run_dir_watches.values()) == [run_dir]
+    finally:
+        watcher.close()
+
+
+def test_files_named_like_runs_arent_watched(tmp_path):
+    (tmp_path / RUN_ID).write_text('')
+
+    watcher = watch.PollingRunDirWatcher([str(tmp_path)], poll_interval_seconds=3600)
+
+    assert watcher.waiting_run_dirs == set()